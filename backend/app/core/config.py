@@ -63,11 +63,24 @@ class Settings(BaseSettings):
     ML_MODEL_PATH: str = "./models"
     ML_ENABLE_TRAINING: bool = False
     ML_MIN_SAMPLES_FOR_TRAINING: int = 100
+    # Índices residentes del motor de recomendaciones (carga al crear el motor)
+    ML_RESIDENT_INDEXES: bool = True
+    # Vacío = índice de embeddings solo en memoria. Directorio de confianza: el
+    # pipeline de features se carga con joblib (deserializa objetos Python)
+    ML_EMBEDDING_INDEX_PATH: str = ""
+    # Fichero del job de materialización que cargan los workers (vacío = sin listas precalculadas)
+    ML_RECOMMENDATION_STORE_PATH: str = ""
 
     # Computer Vision
     CV_MAX_IMAGE_SIZE: int = 5242880  # 5MB
     CV_ALLOWED_FORMATS: str = "jpg,jpeg,png,webp"
     CV_FACE_DETECTION_CONFIDENCE: float = 0.7
+    CV_RESULT_CACHE_PATH: str = ""  # Vacío = ~/.cache/tucitasegura (0700)
+    CV_RESULT_CACHE_MAX_ENTRIES: int = 100000
+
+    # Auditoría en Firestore (escritura diferida por lotes)
+    FIRESTORE_AUDIT_FLUSH_MS: int = 250
+    FIRESTORE_AUDIT_SPILL_PATH: str = ""  # Vacío = directorio temporal del sistema
 
     # Security
     MAX_LOGIN_ATTEMPTS: int = 5
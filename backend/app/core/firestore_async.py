@@ -0,0 +1,198 @@
+"""
+TuCitaSegura - Acceso asíncrono a Firestore
+
+Puente entre el cliente síncrono de firebase_admin y los endpoints `async`
+de FastAPI: cada llamada bloqueante se ejecuta en un pool de hilos dedicado,
+con concurrencia acotada, de modo que una consulta lenta no bloquea el event
+loop del worker de uvicorn.
+
+Todos los servicios comparten el mismo cliente (y sus conexiones gRPC) a
+través de get_async_firestore().
+"""
+
+import asyncio
+import functools
+import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+Filter = Tuple[str, str, Any]
+
+
+class AsyncFirestore:
+    """
+    Capa de acceso a Firestore con API async sobre un pool de hilos
+    """
+
+    def __init__(
+        self,
+        client=None,
+        max_concurrency: int = 16,
+        batch_size: int = 100,
+        timeout: Optional[float] = None
+    ):
+        """
+        Args:
+            client: Cliente de Firestore (por defecto firestore.client(), creado al primer uso)
+            max_concurrency: Llamadas simultáneas máximas a Firestore
+            batch_size: Documentos por llamada a get_all
+            timeout: Tiempo máximo de espera por llamada en segundos (None = sin límite)
+        """
+        self._client = client
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='firestore')
+        # Un semáforo por event loop (los tests y los workers pueden usar varios)
+        self._semaphores: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.in_flight = 0
+        self.timeouts = 0
+
+    @property
+    def client(self):
+        if self._client is None:
+            from firebase_admin import firestore
+            self._client = firestore.client()
+        return self._client
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphores[loop] = semaphore
+        return semaphore
+
+    async def run(self, function: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        """
+        Ejecutar una función bloqueante en el pool sin bloquear el event loop
+
+        Raises:
+            asyncio.TimeoutError: si la llamada supera el timeout
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        loop = asyncio.get_running_loop()
+        async with self._semaphore():
+            with self._lock:
+                self.calls += 1
+                self.in_flight += 1
+            try:
+                future = loop.run_in_executor(self._executor, functools.partial(function, *args, **kwargs))
+                if timeout is None:
+                    return await future
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    self.timeouts += 1
+                raise
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+
+    # ------------------------------------------------------------------
+    # Lecturas
+    # ------------------------------------------------------------------
+
+    async def get_document(self, collection: str, doc_id: str) -> Optional[Dict]:
+        """Datos de un documento (None si no existe)"""
+        def fetch():
+            doc = self.client.collection(collection).document(doc_id).get()
+            return doc.to_dict() if doc.exists else None
+        return await self.run(fetch)
+
+    async def get_documents(self, collection: str, doc_ids: Iterable[str]) -> Dict[str, Optional[Dict]]:
+        """
+        Leer varios documentos con get_all en lotes de batch_size
+
+        Los lotes se lanzan en paralelo; los documentos inexistentes quedan a None.
+        """
+        doc_ids = list(dict.fromkeys(doc_ids))
+        if not doc_ids:
+            return {}
+
+        def fetch(batch: Sequence[str]) -> Dict[str, Optional[Dict]]:
+            collection_ref = self.client.collection(collection)
+            refs = [collection_ref.document(doc_id) for doc_id in batch]
+            found = {doc.id: (doc.to_dict() if doc.exists else None) for doc in self.client.get_all(refs)}
+            return {doc_id: found.get(doc_id) for doc_id in batch}
+
+        batches = [doc_ids[i:i + self.batch_size] for i in range(0, len(doc_ids), self.batch_size)]
+        results = await asyncio.gather(*(self.run(fetch, batch) for batch in batches))
+        documents: Dict[str, Optional[Dict]] = {}
+        for result in results:
+            documents.update(result)
+        return documents
+
+    async def query(
+        self,
+        collection: str,
+        filters: Sequence[Filter] = (),
+        limit: Optional[int] = None,
+        select: Optional[List[str]] = None
+    ) -> List[Tuple[str, Dict]]:
+        """Ejecutar una consulta y devolver [(doc_id, datos)]"""
+        def fetch():
+            query = self.client.collection(collection)
+            for field, op, value in filters:
+                query = query.where(field, op, value)
+            if select:
+                query = query.select(select)
+            if limit is not None:
+                query = query.limit(limit)
+            return [(doc.id, doc.to_dict() or {}) for doc in query.stream()]
+        return await self.run(fetch)
+
+    # ------------------------------------------------------------------
+    # Escrituras
+    # ------------------------------------------------------------------
+
+    async def add(self, collection: str, data: Dict) -> str:
+        """Crear un documento con ID automático y devolver su ID"""
+        def write():
+            _, ref = self.client.collection(collection).add(data)
+            return ref.id
+        return await self.run(write)
+
+    async def set(self, collection: str, doc_id: str, data: Dict, merge: bool = False):
+        def write():
+            self.client.collection(collection).document(doc_id).set(data, merge=merge)
+        await self.run(write)
+
+    async def update(self, collection: str, doc_id: str, data: Dict):
+        def write():
+            self.client.collection(collection).document(doc_id).update(data)
+        await self.run(write)
+
+    def close(self):
+        """Cerrar el pool de hilos"""
+        self._executor.shutdown(wait=False)
+
+    def get_stats(self) -> Dict:
+        """Estadísticas de uso para monitorización"""
+        with self._lock:
+            return {
+                'max_concurrency': self.max_concurrency,
+                'in_flight': self.in_flight,
+                'calls': self.calls,
+                'timeouts': self.timeouts
+            }
+
+
+_shared: Optional[AsyncFirestore] = None
+_shared_lock = threading.Lock()
+
+
+def get_async_firestore() -> AsyncFirestore:
+    """Instancia compartida por todos los servicios (se crea al primer uso)"""
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = AsyncFirestore()
+    return _shared
@@ -0,0 +1,443 @@
+"""
+TuCitaSegura - Escritura diferida (write-behind) de auditoría en Firestore
+
+Los resultados de verificación de fotos y de moderación se guardan para
+auditoría, pero nadie los lee en la misma petición: en lugar de una
+escritura bloqueante por documento, AuditWriter los encola en memoria y un
+hilo de fondo los envía en escrituras por lotes de Firestore (hasta 500
+documentos, el máximo de un WriteBatch) o cada `flush_interval_ms`.
+
+- Reintentos con backoff exponencial y jitter
+- Si Firestore no responde tras los reintentos (o la cola está llena), las
+  escrituras se añaden a un fichero local JSON Lines y se reenvían más tarde
+- Métricas de profundidad de cola y latencia de cada lote en get_stats()
+
+Varios procesos (workers de uvicorn/gunicorn) comparten el fichero: los
+añadidos y el renombrado previo al reenvío se serializan con un flock sobre
+`<spill>.lock`, y solo un proceso a la vez reenvía (flock no bloqueante sobre
+`<spill>.replay.lock`), de modo que ninguno borra un `.replay` que otro no
+ha leído.
+
+Cada escritura es un set() con ID fijado al encolar, así que reenviar un
+lote es idempotente. update() se aplica como set(merge=True): un documento
+inexistente no hace fallar el lote entero, pero se crea.
+
+Solo para registros de auditoría: el reenvío del fichero llega después de
+lotes posteriores y no respeta el orden de las escrituras. El estado vivo
+(p. ej. los campos de verificación del perfil en `users`) no debe pasar por
+aquí: un valor antiguo reenviado pisaría uno más reciente, y un set(merge)
+recrearía el documento de una cuenta borrada.
+
+Con FIRESTORE_EMULATOR_HOST definido, el cliente de firebase_admin usa el
+emulador; los tests pueden pasar cualquier cliente con batch() y collection().
+"""
+
+import atexit
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo exclusión entre hilos del proceso
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 500  # Límite de Firestore por WriteBatch
+
+try:
+    from app.core.config import settings
+    SPILL_PATH = settings.FIRESTORE_AUDIT_SPILL_PATH
+    FLUSH_INTERVAL_MS = settings.FIRESTORE_AUDIT_FLUSH_MS
+except Exception:
+    SPILL_PATH = ""
+    FLUSH_INTERVAL_MS = 250
+
+# Escritura pendiente: {'collection', 'doc_id', 'data', 'merge'}
+AuditOperation = Dict[str, Any]
+
+
+def default_spill_path() -> str:
+    return SPILL_PATH or os.path.join(tempfile.gettempdir(), 'tucitasegura', 'firestore_audit_spill.jsonl')
+
+
+@contextmanager
+def _file_lock(path: str, blocking: bool = True) -> Iterator[bool]:
+    """
+    Lock exclusivo entre procesos sobre `path` (flock)
+
+    Da True con el lock tomado, o False si blocking=False y otro lo tiene.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'a') as handle:
+        if fcntl is None:
+            yield True
+            return
+        try:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+
+def _encode_value(value: Any) -> Any:
+    """Tipos no JSON de los documentos de auditoría (centinelas, fechas, escalares numpy)"""
+    try:
+        from firebase_admin import firestore
+        if value is firestore.SERVER_TIMESTAMP:
+            return {'__sentinel__': 'SERVER_TIMESTAMP'}
+    except Exception:
+        pass
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def _decode_object(value: Dict) -> Any:
+    if '__sentinel__' in value:
+        from firebase_admin import firestore
+        return getattr(firestore, value['__sentinel__'])
+    if '__datetime__' in value:
+        return datetime.fromisoformat(value['__datetime__'])
+    return value
+
+
+class AuditWriter:
+    """
+    Cola acotada de escrituras de auditoría con envío por lotes en segundo plano
+    """
+
+    def __init__(
+        self,
+        client=None,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        flush_interval_ms: Optional[float] = None,
+        max_queue_size: int = 20000,
+        max_retries: int = 4,
+        retry_base_delay: float = 0.1,
+        spill_path: Optional[str] = None,
+        spill_retry_seconds: float = 30.0,
+        autostart: bool = True
+    ):
+        """
+        Args:
+            client: Cliente de Firestore (por defecto firestore.client(), creado al primer envío)
+            max_batch_size: Documentos por lote (como máximo 500)
+            flush_interval_ms: Espera máxima antes de enviar un lote incompleto
+            max_queue_size: Escrituras en memoria; el exceso va directamente al fichero
+            max_retries: Reintentos de un lote antes de volcarlo al fichero
+            retry_base_delay: Espera base en segundos del backoff exponencial
+            spill_path: Fichero JSON Lines de escrituras pendientes
+            spill_retry_seconds: Intervalo entre reenvíos del fichero tras un fallo
+            autostart: Arrancar el hilo de envío con la primera escritura
+        """
+        self._client = client
+        self.max_batch_size = min(max_batch_size, MAX_BATCH_SIZE)
+        self.flush_interval = (flush_interval_ms if flush_interval_ms is not None else FLUSH_INTERVAL_MS) / 1000
+        self.max_queue_size = max_queue_size
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.spill_path = spill_path or default_spill_path()
+        self.spill_retry_seconds = spill_retry_seconds
+        self.autostart = autostart
+        self._queue: deque = deque()
+        self._cond = threading.Condition()
+        self._spill_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._flush_requested = False
+        self._in_flight = 0
+        self._next_replay = 0.0
+        self._latencies: deque = deque(maxlen=1000)
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.retries = 0
+        self.failed_batches = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.overflows = 0
+        self.max_queue_depth = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from firebase_admin import firestore
+            self._client = firestore.client()
+        return self._client
+
+    # ------------------------------------------------------------------
+    # Escrituras (no bloquean)
+    # ------------------------------------------------------------------
+
+    def add(self, collection: str, data: Dict) -> str:
+        """Crear un documento con ID automático (asignado ya) y devolver su ID"""
+        doc_id = uuid.uuid4().hex[:20]
+        self._enqueue({'collection': collection, 'doc_id': doc_id, 'data': data, 'merge': False})
+        return doc_id
+
+    def set(self, collection: str, doc_id: str, data: Dict, merge: bool = False):
+        self._enqueue({'collection': collection, 'doc_id': doc_id, 'data': data, 'merge': merge})
+
+    def update(self, collection: str, doc_id: str, data: Dict):
+        """
+        Actualizar campos de primer nivel (como set con merge)
+
+        Crea el documento si no existe y no respeta el orden frente a escrituras
+        posteriores si pasa por el fichero de pendientes: no usar para estado vivo.
+        """
+        self.set(collection, doc_id, data, merge=True)
+
+    def _enqueue(self, operation: AuditOperation):
+        with self._cond:
+            self.enqueued += 1
+            if self._closed or len(self._queue) >= self.max_queue_size:
+                # Sin sitio (o cerrado): al fichero, sin perder la escritura
+                self.overflows += 1
+                overflow = True
+            else:
+                overflow = False
+                self._queue.append(operation)
+                self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+                if len(self._queue) >= self.max_batch_size:
+                    self._cond.notify_all()
+        if overflow:
+            self._spill([operation])
+        elif self.autostart:
+            self.start()
+
+    # ------------------------------------------------------------------
+    # Hilo de envío
+    # ------------------------------------------------------------------
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._cond:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name='firestore-audit-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and not self._flush_requested and len(self._queue) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._closed and not self._queue:
+                    self._cond.notify_all()
+                    return
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch_size))]
+                replay = self._replay_due()
+                self._in_flight = len(batch) + replay
+
+            sent = not batch or self._commit_with_retry(batch)
+            if not sent:
+                self._spill(batch)
+            elif replay:
+                self._replay_spill()
+
+            with self._cond:
+                self._in_flight = 0
+                if not self._queue:
+                    self._flush_requested = False
+                self._cond.notify_all()
+
+    def _commit(self, batch: List[AuditOperation]):
+        client = self.client
+        write_batch = client.batch()
+        for operation in batch:
+            ref = client.collection(operation['collection']).document(operation['doc_id'])
+            write_batch.set(ref, operation['data'], merge=operation['merge'])
+        write_batch.commit()
+
+    def _commit_with_retry(self, batch: List[AuditOperation]) -> bool:
+        """Enviar un lote con backoff exponencial y jitter; False si se agotan los reintentos"""
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                self._commit(batch)
+            except Exception as e:
+                self.last_error = str(e)
+                if attempt == self.max_retries:
+                    break
+                self.retries += 1
+                delay = self.retry_base_delay * (2 ** attempt)
+                time.sleep(random.uniform(delay / 2, delay * 1.5))
+                continue
+            with self._cond:
+                self._latencies.append(time.perf_counter() - started)
+                self.batches += 1
+                self.written += len(batch)
+            return True
+        self.failed_batches += 1
+        logger.warning(
+            f"[AuditWriter] Lote de {len(batch)} escrituras no enviado tras {self.max_retries} reintentos: {self.last_error}"
+        )
+        return False
+
+    # ------------------------------------------------------------------
+    # Fichero de escrituras pendientes
+    # ------------------------------------------------------------------
+
+    @property
+    def _replay_path(self) -> str:
+        return f"{self.spill_path}.replay"
+
+    def _replay_due(self) -> bool:
+        return time.monotonic() >= self._next_replay and (
+            os.path.exists(self.spill_path) or os.path.exists(self._replay_path)
+        )
+
+    def _spill(self, operations: List[AuditOperation]):
+        """Añadir escrituras al fichero local (con fsync) para reenviarlas más tarde"""
+        try:
+            with self._spill_lock, _file_lock(f"{self.spill_path}.lock"):
+                with open(self.spill_path, 'a', encoding='utf-8') as spill:
+                    for operation in operations:
+                        spill.write(json.dumps(operation, default=_encode_value) + '\n')
+                    spill.flush()
+                    os.fsync(spill.fileno())
+            self.spilled += len(operations)
+            self._next_replay = time.monotonic() + self.spill_retry_seconds
+        except Exception as e:
+            logger.error(f"[AuditWriter] Error guardando {len(operations)} escrituras en {self.spill_path}: {e}")
+
+    def _replay_spill(self):
+        """
+        Reenviar el fichero de pendientes; lo que vuelva a fallar queda en él
+
+        Si otro proceso ya está reenviando, no se hace nada: su `.replay` es suyo.
+        """
+        replay_path = self._replay_path
+        with _file_lock(f"{replay_path}.lock", blocking=False) as acquired:
+            if not acquired:
+                return
+            # Un .replay previo es de un reenvío interrumpido: se procesa antes de renombrar otro
+            if not os.path.exists(replay_path):
+                with self._spill_lock, _file_lock(f"{self.spill_path}.lock"):
+                    if not os.path.exists(self.spill_path):
+                        return
+                    os.replace(self.spill_path, replay_path)
+            try:
+                with open(replay_path, encoding='utf-8') as spill:
+                    operations = [json.loads(line, object_hook=_decode_object) for line in spill if line.strip()]
+            except Exception as e:
+                logger.error(f"[AuditWriter] Fichero de pendientes ilegible {replay_path}: {e}")
+                return
+            replayed = 0
+            for start in range(0, len(operations), self.max_batch_size):
+                batch = operations[start:start + self.max_batch_size]
+                if not self._commit_with_retry(batch):
+                    self._spill(operations[start:])
+                    break
+                replayed += len(batch)
+            os.remove(replay_path)
+        self.replayed += replayed
+        if replayed:
+            logger.info(f"[AuditWriter] Reenviadas {replayed} escrituras pendientes ({self.replayed} en total)")
+
+    # ------------------------------------------------------------------
+    # Ciclo de vida y métricas
+    # ------------------------------------------------------------------
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Enviar ya lo encolado (y el fichero de pendientes, si toca reenviarlo) y
+        esperar a que termine; False si vence el timeout
+        """
+        self.start()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._queue or self._in_flight or self._replay_due():
+                if self._thread is None or not self._thread.is_alive():
+                    return False
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout: Optional[float] = 10.0):
+        """Enviar lo pendiente y detener el hilo (lo que no se envíe queda en el fichero)"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        with self._cond:
+            leftover = list(self._queue) if thread is None or not thread.is_alive() else []
+            if leftover:
+                self._queue.clear()
+        if leftover:
+            self._spill(leftover)
+
+    def get_stats(self) -> Dict:
+        """Profundidad de cola, lotes, reintentos, volcados y latencias de envío (p50/p99)"""
+        with self._cond:
+            latencies = sorted(self._latencies)
+            queue_depth = len(self._queue)
+
+        def percentile(fraction: float) -> float:
+            if not latencies:
+                return 0.0
+            return latencies[min(int(fraction * len(latencies)), len(latencies) - 1)] * 1000
+
+        return {
+            'queue_depth': queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'in_flight': self._in_flight,
+            'enqueued': self.enqueued,
+            'written': self.written,
+            'batches': self.batches,
+            'avg_batch_size': self.written / self.batches if self.batches else 0.0,
+            'retries': self.retries,
+            'failed_batches': self.failed_batches,
+            'overflows': self.overflows,
+            'spilled': self.spilled,
+            'replayed': self.replayed,
+            'spill_pending': os.path.exists(self.spill_path) or os.path.exists(self._replay_path),
+            'flush_latency_p50_ms': percentile(0.5),
+            'flush_latency_p99_ms': percentile(0.99),
+            'last_error': self.last_error
+        }
+
+
+_shared: Optional[AuditWriter] = None
+_shared_lock = threading.Lock()
+
+
+def get_audit_writer() -> AuditWriter:
+    """Escritor compartido por los servicios (se crea al primer uso y se vacía al salir)"""
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = AuditWriter()
+                atexit.register(_shared.close)
+    return _shared
@@ -0,0 +1,85 @@
+"""
+TuCitaSegura - Proveedores perezosos de los servicios pesados
+
+Los módulos de servicios ya no crean sus instancias globales al importarse:
+cada uno expone un get_xxx() que la crea al primer uso. Aquí se registran
+esos proveedores por nombre (como "módulo:función", sin importar nada), de
+modo que el worker arranca y responde a /health enseguida y los servicios
+se calientan bajo demanda (get_service) o en segundo plano al arrancar
+(warm_up_in_background).
+"""
+
+import importlib
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+SERVICE_PROVIDERS: Dict[str, str] = {
+    'recommendations': 'app.services.ml.recommendation_engine:get_matching_engine',
+    'photo_verification': 'app.services.cv.photo_verifier:get_photo_verifier',
+    'photo_hash_index': 'app.services.cv.photo_hash_index:start_photo_hash_index',
+    'video_chat': 'app.services.video_chat.video_chat_manager:get_video_chat_manager',
+    'vip_events': 'app.services.vip_events.vip_events_manager:get_vip_events_manager',
+}
+
+# Estados: 'cold' (sin cargar), 'warming', 'ready', 'failed'
+_status: Dict[str, str] = {name: 'cold' for name in SERVICE_PROVIDERS}
+_load_ms: Dict[str, float] = {}
+_lock = threading.Lock()
+
+
+def get_service(name: str) -> Any:
+    """
+    Instancia compartida del servicio, importando su módulo si hace falta
+
+    Raises:
+        KeyError: servicio no registrado
+    """
+    module_name, provider = SERVICE_PROVIDERS[name].split(':')
+    with _lock:
+        if _status[name] != 'ready':
+            _status[name] = 'warming'
+    started = time.perf_counter()
+    try:
+        service = getattr(importlib.import_module(module_name), provider)()
+    except Exception:
+        with _lock:
+            _status[name] = 'failed'
+        raise
+    with _lock:
+        if _status[name] != 'ready':
+            _status[name] = 'ready'
+            _load_ms[name] = (time.perf_counter() - started) * 1000
+    return service
+
+
+def warm_up(names: Optional[Iterable[str]] = None):
+    """Cargar los servicios indicados (por defecto todos), registrando los fallos"""
+    for name in names if names is not None else SERVICE_PROVIDERS:
+        try:
+            get_service(name)
+            logger.info(f"[LazyServices] {name} listo en {_load_ms.get(name, 0.0):.0f} ms")
+        except Exception as e:
+            logger.error(f"[LazyServices] Error cargando {name}: {e}")
+
+
+def warm_up_in_background(names: Optional[Iterable[str]] = None) -> threading.Thread:
+    """Calentar los servicios en un hilo aparte sin retrasar el arranque"""
+    names = list(names) if names is not None else list(SERVICE_PROVIDERS)
+    thread = threading.Thread(target=warm_up, args=(names,), name='service-warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+def service_status() -> Dict[str, str]:
+    """Estado de carga de cada servicio (para /health)"""
+    with _lock:
+        return dict(_status)
+
+
+def get_stats() -> Dict:
+    with _lock:
+        return {'status': dict(_status), 'load_ms': dict(_load_ms)}
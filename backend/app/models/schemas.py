@@ -67,9 +67,10 @@ class PhotoVerificationRequest(BaseModel):
 
 class PhotoVerificationResult(BaseModel):
     """Photo verification results"""
-    is_real_person: bool
-    has_excessive_filters: bool
-    is_appropriate: bool
+    # None: etapa omitida por salida anticipada (no medido)
+    is_real_person: Optional[bool] = None
+    has_excessive_filters: Optional[bool] = None
+    is_appropriate: Optional[bool] = None
     estimated_age: Optional[int] = None
     confidence: float = Field(..., ge=0, le=1)
     faces_detected: int
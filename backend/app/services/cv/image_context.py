@@ -0,0 +1,138 @@
+"""
+TuCitaSegura - Contexto de análisis por imagen
+
+Las etapas de PhotoVerification (rostros, persona real, filtros, IA,
+contenido, calidad, texto) trabajan sobre las mismas imágenes derivadas:
+escala de grises, HSV, Laplaciano, gradientes de Sobel, histogramas y nivel
+de ruido. ImageAnalysisContext las calcula la primera vez que una etapa las
+pide y las comparte con el resto, de modo que cada derivada se calcula una
+sola vez por imagen.
+
+Los valores son idénticos a los que calculaba cada etapa por su cuenta.
+
+level(max_side) da el contexto de la misma imagen reducida (pirámide): los
+estadísticos globales de color y ruido se calculan igual de bien sobre una
+versión de 256 px, con una fracción del coste.
+"""
+
+from functools import cached_property
+from typing import Dict, Optional, Tuple, Union
+
+import numpy as np
+
+from app.services.cv.perceptual_hash import phash
+
+
+class ImageAnalysisContext:
+    """
+    Imagen RGB con sus derivadas calculadas bajo demanda y memorizadas
+    """
+
+    def __init__(self, image: np.ndarray):
+        """
+        Args:
+            image: Imagen RGB (uint8, alto x ancho x 3)
+        """
+        self.image = image
+        self._levels: Dict[int, 'ImageAnalysisContext'] = {}
+
+    @classmethod
+    def of(cls, image: Union[np.ndarray, 'ImageAnalysisContext']) -> 'ImageAnalysisContext':
+        """Contexto de una imagen (o el propio contexto si ya lo es)"""
+        return image if isinstance(image, cls) else cls(image)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.image.shape
+
+    @property
+    def pixel_count(self) -> int:
+        return self.image.shape[0] * self.image.shape[1]
+
+    def level(self, max_side: Optional[int]) -> 'ImageAnalysisContext':
+        """
+        Contexto de la imagen reducida (INTER_AREA) a max_side px de lado mayor
+
+        None, o un tamaño que no reduce la imagen, devuelve el propio contexto.
+        Cada nivel se calcula una sola vez.
+        """
+        import cv2
+
+        height, width = self.image.shape[:2]
+        if max_side is None or max(height, width) <= max_side:
+            return self
+        level = self._levels.get(max_side)
+        if level is None:
+            scale = max_side / max(height, width)
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            level = ImageAnalysisContext(cv2.resize(self.image, size, interpolation=cv2.INTER_AREA))
+            self._levels[max_side] = level
+        return level
+
+    @cached_property
+    def gray(self) -> np.ndarray:
+        import cv2
+        return cv2.cvtColor(self.image, cv2.COLOR_RGB2GRAY)
+
+    @cached_property
+    def hsv(self) -> np.ndarray:
+        import cv2
+        return cv2.cvtColor(self.image, cv2.COLOR_RGB2HSV)
+
+    @cached_property
+    def laplacian(self) -> np.ndarray:
+        import cv2
+        return cv2.Laplacian(self.gray, cv2.CV_64F)
+
+    @cached_property
+    def sobel(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Gradientes (x, y) de la escala de grises"""
+        import cv2
+        return (
+            cv2.Sobel(self.gray, cv2.CV_64F, 1, 0, ksize=3),
+            cv2.Sobel(self.gray, cv2.CV_64F, 0, 1, ksize=3)
+        )
+
+    @cached_property
+    def gradient_magnitude(self) -> np.ndarray:
+        grad_x, grad_y = self.sobel
+        return np.sqrt(grad_x**2 + grad_y**2)
+
+    @cached_property
+    def channel_histograms(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Histogramas de 256 niveles de los canales R, G y B"""
+        import cv2
+        return tuple(cv2.calcHist([self.image], [channel], None, [256], [0, 256]) for channel in range(3))
+
+    # Estadísticos escalares compartidos
+
+    @cached_property
+    def sharpness(self) -> float:
+        """Varianza del Laplaciano"""
+        return self.laplacian.var()
+
+    @cached_property
+    def brightness(self) -> float:
+        return np.mean(self.gray)
+
+    @cached_property
+    def contrast(self) -> float:
+        return np.std(self.gray)
+
+    @cached_property
+    def noise_level(self) -> float:
+        """Desviación estándar de la escala de grises normalizada a [0, 1]"""
+        return min(self.contrast / 50, 1.0)
+
+    @cached_property
+    def mean_saturation(self) -> float:
+        return np.mean(self.hsv[:, :, 1])
+
+    @cached_property
+    def perceptual_hash(self) -> int:
+        """pHash de 64 bits de la escala de grises"""
+        return phash(self.gray)
+
+    def gray_region(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        """Recorte de la escala de grises (contiguo, como si se convirtiera el recorte RGB)"""
+        return np.ascontiguousarray(self.gray[y:y + height, x:x + width])
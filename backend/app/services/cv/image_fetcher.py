@@ -0,0 +1,219 @@
+"""
+TuCitaSegura - Descarga de imágenes para verificación de fotos
+
+ImageFetcher sustituye al requests.get suelto de PhotoVerification:
+
+- Sesión HTTP con pool de conexiones (keep-alive con Firebase Storage)
+- Lectura en streaming que se corta al superar CV_MAX_IMAGE_SIZE, sin
+  cargar en memoria el cuerpo completo
+- Solo se aceptan los formatos de CV_ALLOWED_FORMATS
+- Los JPEG se decodifican en modo draft (escalado 1/2, 1/4 o 1/8 en el
+  propio decodificador), de modo que una foto de 24 MP se decodifica cerca
+  del tamaño objetivo en lugar de a resolución completa
+"""
+
+import logging
+import threading
+import time
+from io import BytesIO
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_IMAGE_SIZE = 5 * 1024 * 1024
+DEFAULT_ALLOWED_FORMATS = "jpg,jpeg,png,webp"
+
+try:
+    from app.core.config import settings
+    MAX_IMAGE_SIZE = settings.CV_MAX_IMAGE_SIZE
+    ALLOWED_FORMATS = settings.CV_ALLOWED_FORMATS
+except Exception:
+    MAX_IMAGE_SIZE = DEFAULT_MAX_IMAGE_SIZE
+    ALLOWED_FORMATS = DEFAULT_ALLOWED_FORMATS
+
+# Extensiones de configuración -> nombre de formato de PIL
+_FORMAT_ALIASES = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP', 'gif': 'GIF', 'bmp': 'BMP'}
+
+
+class ImageFetchError(Exception):
+    """Imagen rechazada o no descargable"""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason  # 'http', 'too_large', 'format', 'decode', 'too_small'
+
+
+def parse_formats(formats: Iterable[str]) -> frozenset:
+    """Formatos de PIL admitidos a partir de una lista o cadena 'jpg,png,...'"""
+    if isinstance(formats, str):
+        formats = formats.split(',')
+    return frozenset(
+        _FORMAT_ALIASES.get(name.strip().lower(), name.strip().upper())
+        for name in formats if name.strip()
+    )
+
+
+class ImageFetcher:
+    """
+    Descarga acotada y decodificación reducida de imágenes
+    """
+
+    def __init__(
+        self,
+        max_bytes: Optional[int] = None,
+        allowed_formats: Optional[Iterable[str]] = None,
+        target_size: Tuple[int, int] = (1024, 1024),
+        min_size: int = 100,
+        timeout: float = 10,
+        pool_size: int = 16,
+        chunk_size: int = 64 * 1024,
+        session: Optional[requests.Session] = None
+    ):
+        """
+        Args:
+            max_bytes: Tamaño máximo de descarga (por defecto CV_MAX_IMAGE_SIZE)
+            allowed_formats: Formatos admitidos (por defecto CV_ALLOWED_FORMATS)
+            target_size: Tamaño máximo de la imagen decodificada
+            min_size: Lado mínimo aceptado tras redimensionar
+            timeout: Timeout de conexión y lectura en segundos
+            pool_size: Conexiones keep-alive por host
+            chunk_size: Bytes por lectura del streaming
+            session: Sesión HTTP a reutilizar (por defecto una propia con pool)
+        """
+        self.max_bytes = max_bytes if max_bytes is not None else MAX_IMAGE_SIZE
+        self.allowed_formats = parse_formats(allowed_formats if allowed_formats is not None else ALLOWED_FORMATS)
+        self.target_size = target_size
+        self.min_size = min_size
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        # Los contadores se actualizan en fetch_bytes y decode, que
+        # PhotoVerification llama por separado (no a través de fetch)
+        self._lock = threading.Lock()
+        self.fetched = 0
+        self.downloaded = 0
+        self.bytes_downloaded = 0
+        self.rejected: Dict[str, int] = {}
+        self.download_seconds = 0.0
+        self.decode_seconds = 0.0
+        self.decodes = 0
+
+    def fetch(self, url: str) -> np.ndarray:
+        """
+        Descargar y decodificar una imagen como array RGB de tamaño <= target_size
+
+        Raises:
+            ImageFetchError: descarga fallida o imagen rechazada
+        """
+        return self.decode(self.fetch_bytes(url))
+
+    def _reject(self, error: ImageFetchError):
+        with self._lock:
+            self.rejected[error.reason] = self.rejected.get(error.reason, 0) + 1
+
+    def fetch_bytes(self, url: str) -> bytes:
+        """Descargar el cuerpo en streaming, abortando si supera max_bytes"""
+        started = time.perf_counter()
+        try:
+            data = self._download(url)
+        except ImageFetchError as e:
+            self._reject(e)
+            raise
+        with self._lock:
+            self.downloaded += 1
+            self.bytes_downloaded += len(data)
+            self.download_seconds += time.perf_counter() - started
+        return data
+
+    def _download(self, url: str) -> bytes:
+        try:
+            response = self.session.get(url, stream=True, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ImageFetchError('http', f"Error descargando imagen: {e}")
+
+        try:
+            if response.status_code >= 400:
+                raise ImageFetchError('http', f"Respuesta HTTP {response.status_code}")
+
+            declared = response.headers.get('Content-Length')
+            if declared is not None and declared.isdigit() and int(declared) > self.max_bytes:
+                raise ImageFetchError('too_large', f"Imagen de {declared} bytes (máximo {self.max_bytes})")
+
+            buffer = bytearray()
+            for chunk in response.iter_content(self.chunk_size):
+                buffer.extend(chunk)
+                if len(buffer) > self.max_bytes:
+                    raise ImageFetchError('too_large', f"Imagen de más de {self.max_bytes} bytes")
+            return bytes(buffer)
+        except requests.RequestException as e:
+            raise ImageFetchError('http', f"Error descargando imagen: {e}")
+        finally:
+            response.close()
+
+    def decode(self, data: bytes) -> np.ndarray:
+        """Decodificar a RGB con reducción en el decodificador y miniatura LANCZOS"""
+        started = time.perf_counter()
+        try:
+            image = self._decode(data)
+        except ImageFetchError as e:
+            self._reject(e)
+            raise
+        finally:
+            with self._lock:
+                self.decodes += 1
+                self.decode_seconds += time.perf_counter() - started
+        with self._lock:
+            self.fetched += 1
+        return image
+
+    def _decode(self, data: bytes) -> np.ndarray:
+        try:
+            image = Image.open(BytesIO(data))
+        except Exception as e:
+            raise ImageFetchError('decode', f"Imagen no reconocida: {e}")
+
+        if image.format not in self.allowed_formats:
+            raise ImageFetchError('format', f"Formato no permitido: {image.format}")
+
+        try:
+            if image.format == 'JPEG':
+                # El decodificador escala por 1/2, 1/4 o 1/8 sin bajar de target_size
+                image.draft('RGB', self.target_size)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.thumbnail(self.target_size, Image.Resampling.LANCZOS)
+            image_array = np.array(image)
+        except Exception as e:
+            raise ImageFetchError('decode', f"Error decodificando imagen: {e}")
+
+        if image_array.shape[0] < self.min_size or image_array.shape[1] < self.min_size:
+            raise ImageFetchError('too_small', "Imagen demasiado pequeña")
+        return image_array
+
+    def close(self):
+        self.session.close()
+
+    def get_stats(self) -> Dict:
+        """Imágenes aceptadas, descargas, bytes, rechazos por motivo y tiempos medios"""
+        with self._lock:
+            avg_download_ms = self.download_seconds / self.downloaded * 1000 if self.downloaded else 0.0
+            avg_decode_ms = self.decode_seconds / self.decodes * 1000 if self.decodes else 0.0
+            return {
+                'fetched': self.fetched,
+                'downloaded': self.downloaded,
+                'bytes_downloaded': self.bytes_downloaded,
+                'rejected': dict(self.rejected),
+                'avg_download_ms': avg_download_ms,
+                'avg_decode_ms': avg_decode_ms,
+                'avg_fetch_ms': avg_download_ms + avg_decode_ms
+            }
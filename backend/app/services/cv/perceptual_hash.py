@@ -0,0 +1,58 @@
+"""
+TuCitaSegura - Hashes perceptuales de fotos
+
+Huellas de 64 bits que apenas cambian con recompresión JPEG, cambios de
+tamaño o recortes ligeros, de modo que la distancia de Hamming entre dos
+hashes mide lo parecidas que son dos fotos:
+
+- phash: signo de las frecuencias bajas de la DCT (el más robusto)
+- dhash: signo del gradiente horizontal (más barato)
+"""
+
+import numpy as np
+
+HASH_BITS = 64
+
+
+def _to_int(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.astype(np.uint8)).tobytes(), 'big')
+
+
+def phash(gray: np.ndarray, hash_size: int = 8, highfreq_factor: int = 4) -> int:
+    """
+    Hash perceptual por DCT
+
+    Args:
+        gray: Imagen en escala de grises
+        hash_size: Lado del bloque de frecuencias bajas (hash de hash_size² bits)
+        highfreq_factor: Tamaño de la reducción previa respecto a hash_size
+    """
+    import cv2
+
+    size = hash_size * highfreq_factor
+    small = cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:hash_size, :hash_size]
+    # Mediana sin el término de continua, que solo refleja el brillo medio
+    median = np.median(low.flatten()[1:])
+    return _to_int(low.flatten() > median)
+
+
+def dhash(gray: np.ndarray, hash_size: int = 8) -> int:
+    """Hash de diferencias entre píxeles horizontales vecinos"""
+    import cv2
+
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return _to_int((small[:, 1:] > small[:, :-1]).flatten())
+
+
+def hamming_distance(a: int, b: int) -> int:
+    # int.bit_count() requiere Python 3.10; el proyecto declara 3.9
+    return bin(a ^ b).count('1')
+
+
+def hash_to_hex(value: int) -> str:
+    return f'{value:016x}'
+
+
+def hex_to_hash(value: str) -> int:
+    return int(value, 16)
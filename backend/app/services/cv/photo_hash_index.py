@@ -0,0 +1,258 @@
+"""
+TuCitaSegura - Índice global de fotos casi duplicadas
+
+Los estafadores reutilizan las mismas fotos robadas en decenas de cuentas,
+con recortes ligeros y recompresión. PhotoHashIndex guarda el hash
+perceptual (64 bits) de cada foto verificada y responde "qué otras cuentas
+tienen una foto a distancia de Hamming <= k" sin recorrer todas las fotos.
+
+Multi-index hashing: el hash se parte en `chunks` trozos (de 21-22 bits con
+los 3 por defecto), cada uno con su tabla trozo -> fotos. Si dos hashes
+están a distancia <= k, por el principio del palomar al menos un trozo está
+a distancia <= k // chunks; basta con consultar en cada tabla los valores a
+esa distancia del trozo de la consulta y comprobar la distancia completa
+solo de esos candidatos (unos 2 ms por consulta con un millón de fotos).
+
+Cada proceso mantiene su copia al día con un listener de photo_verifications
+(`start_listener`): la primera instantánea carga la colección y las
+siguientes traen las fotos verificadas en cualquier otro worker.
+"""
+
+import itertools
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from app.services.cv.perceptual_hash import HASH_BITS, hamming_distance, hex_to_hash
+
+logger = logging.getLogger(__name__)
+
+# (photo_id, user_id, distancia)
+HashMatch = Tuple[str, str, int]
+
+
+class PhotoHashIndex:
+    """
+    Búsqueda de fotos por distancia de Hamming entre hashes perceptuales
+    """
+
+    def __init__(self, max_distance: int = 10, chunks: int = 3):
+        """
+        Args:
+            max_distance: Distancia por defecto para considerar dos fotos la misma
+                (un recorte del 4% con recompresión JPEG queda por debajo de 10)
+            chunks: Trozos en que se divide el hash (uno por tabla)
+        """
+        self.max_distance = max_distance
+        self.chunks = chunks
+        # (desplazamiento, ancho) de cada trozo
+        widths = [HASH_BITS // chunks + (i < HASH_BITS % chunks) for i in range(chunks)]
+        self._layout = [(sum(widths[:i]), width) for i, width in enumerate(widths)]
+        self._tables: List[Dict[int, Set[str]]] = [{} for _ in range(chunks)]
+        # photo_id -> (hash, user_id)
+        self._photos: Dict[str, Tuple[int, str]] = {}
+        # user_id -> photo_ids (hashes de un usuario sin recorrer el índice)
+        self._by_user: Dict[str, Set[str]] = {}
+        # Máscaras XOR con <= r bits a 1 dentro de un trozo, por (radio, ancho)
+        self._masks: Dict[Tuple[int, int], List[int]] = {}
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()
+        self._listener = None
+        self.is_ready = False
+        self.queries = 0
+        self.candidates_checked = 0
+
+    def __len__(self) -> int:
+        return len(self._photos)
+
+    def _split(self, value: int) -> List[int]:
+        return [(value >> shift) & ((1 << width) - 1) for shift, width in self._layout]
+
+    def _masks_for(self, radius: int, width: int) -> List[int]:
+        masks = self._masks.get((radius, width))
+        if masks is None:
+            masks = [0]
+            for bits in range(1, min(radius, width) + 1):
+                for positions in itertools.combinations(range(width), bits):
+                    masks.append(sum(1 << position for position in positions))
+            self._masks[(radius, width)] = masks
+        return masks
+
+    def add(self, photo_id: str, user_id: str, value: int):
+        """Registrar (o reemplazar) el hash de una foto"""
+        with self._lock:
+            self.remove(photo_id)
+            self._photos[photo_id] = (value, user_id)
+            self._by_user.setdefault(user_id, set()).add(photo_id)
+            for table, chunk in zip(self._tables, self._split(value)):
+                table.setdefault(chunk, set()).add(photo_id)
+
+    def remove(self, photo_id: str):
+        with self._lock:
+            entry = self._photos.pop(photo_id, None)
+            if entry is None:
+                return
+            photo_ids = self._by_user.get(entry[1])
+            if photo_ids is not None:
+                photo_ids.discard(photo_id)
+                if not photo_ids:
+                    del self._by_user[entry[1]]
+            for table, chunk in zip(self._tables, self._split(entry[0])):
+                bucket = table.get(chunk)
+                if bucket is not None:
+                    bucket.discard(photo_id)
+                    if not bucket:
+                        del table[chunk]
+
+    def hashes_for_user(self, user_id: str) -> Dict[str, int]:
+        """Fotos registradas de un usuario (photo_id -> hash)"""
+        with self._lock:
+            return {photo_id: self._photos[photo_id][0] for photo_id in self._by_user.get(user_id, ())}
+
+    def query(
+        self,
+        value: int,
+        max_distance: Optional[int] = None,
+        exclude_user_id: Optional[str] = None
+    ) -> List[HashMatch]:
+        """
+        Fotos a distancia <= max_distance, de la más parecida a la menos
+
+        Args:
+            value: Hash perceptual de la consulta
+            max_distance: Distancia máxima (por defecto la del índice)
+            exclude_user_id: Ignorar las fotos de este usuario
+        """
+        max_distance = self.max_distance if max_distance is None else max_distance
+        radius = max_distance // self.chunks
+        matches = []
+        with self._lock:
+            self.queries += 1
+            seen: Set[str] = set()
+            for table, chunk, (_, width) in zip(self._tables, self._split(value), self._layout):
+                for mask in self._masks_for(radius, width):
+                    bucket = table.get(chunk ^ mask)
+                    if bucket:
+                        seen.update(bucket)
+            self.candidates_checked += len(seen)
+            for photo_id in seen:
+                photo_hash, user_id = self._photos[photo_id]
+                if user_id == exclude_user_id:
+                    continue
+                distance = hamming_distance(value, photo_hash)
+                if distance <= max_distance:
+                    matches.append((photo_id, user_id, distance))
+        matches.sort(key=lambda match: (match[2], match[0]))
+        return matches
+
+    def accounts_near(
+        self,
+        value: int,
+        max_distance: Optional[int] = None,
+        exclude_user_id: Optional[str] = None
+    ) -> Dict[str, int]:
+        """Otras cuentas con una foto parecida y la menor distancia de cada una"""
+        accounts: Dict[str, int] = {}
+        for _, user_id, distance in self.query(value, max_distance, exclude_user_id):
+            accounts.setdefault(user_id, distance)
+        return accounts
+
+    def apply_document(self, data: Dict) -> bool:
+        """Registrar un documento de photo_verifications (userId, imageUrl, perceptualHash)"""
+        value = data.get('perceptualHash')
+        if not value or not data.get('userId') or not data.get('imageUrl'):
+            return False
+        try:
+            self.add(data['imageUrl'], data['userId'], hex_to_hash(value))
+        except ValueError:
+            return False
+        return True
+
+    def apply_documents(self, docs: Iterable) -> int:
+        """Cargar documentos de photo_verifications"""
+        return sum(self.apply_document(doc.to_dict() or {}) for doc in docs)
+
+    def load(self, db) -> int:
+        """Carga completa de los hashes guardados con cada verificación"""
+        count = self.apply_documents(db.collection('photo_verifications').stream())
+        self.is_ready = True
+        logger.info(f"[PhotoHashIndex] Cargados {count} hashes de fotos")
+        return count
+
+    def ensure_loaded(self, db):
+        """Cargar el índice la primera vez que se necesita (sin listener activo)"""
+        if self.is_ready or self._listener is not None:
+            return
+        with self._load_lock:
+            if not self.is_ready and self._listener is None:
+                self.load(db)
+
+    def start_listener(self, db):
+        """Suscribirse a photo_verifications; la primera instantánea hace de carga completa"""
+        with self._load_lock:
+            if self._listener is not None:
+                return
+            self._listener = db.collection('photo_verifications').on_snapshot(self._on_snapshot)
+        logger.info("[PhotoHashIndex] Listener de Firestore iniciado")
+
+    def stop_listener(self):
+        with self._load_lock:
+            if self._listener is not None:
+                self._listener.unsubscribe()
+                self._listener = None
+
+    def _on_snapshot(self, col_snapshot, changes, read_time):
+        """Callback de on_snapshot (se ejecuta en un hilo de Firestore)"""
+        try:
+            count = 0
+            for change in changes:
+                data = change.document.to_dict() or {}
+                if change.type.name == 'REMOVED':
+                    if data.get('imageUrl'):
+                        self.remove(data['imageUrl'])
+                else:
+                    count += self.apply_document(data)
+            if not self.is_ready:
+                self.is_ready = True
+                logger.info(f"[PhotoHashIndex] Cargados {count} hashes de fotos")
+        except Exception as e:
+            logger.error(f"[PhotoHashIndex] Error aplicando cambios: {e}")
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'photos': len(self._photos),
+                'accounts': len(self._by_user),
+                'queries': self.queries,
+                'listening': self._listener is not None,
+                'avg_candidates': self.candidates_checked / self.queries if self.queries else 0.0
+            }
+
+
+_shared: Optional[PhotoHashIndex] = None
+_shared_lock = threading.Lock()
+
+
+def get_photo_hash_index() -> PhotoHashIndex:
+    """Índice compartido por la verificación de fotos y la detección de fraude"""
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = PhotoHashIndex()
+    return _shared
+
+
+def start_photo_hash_index(db=None) -> PhotoHashIndex:
+    """
+    Índice compartido, al día con el listener de photo_verifications
+
+    Lo calienta lazy_services al arrancar el worker, de modo que ninguna
+    petición recorre la colección.
+    """
+    index = get_photo_hash_index()
+    if db is None:
+        from firebase_admin import firestore
+        db = firestore.client()
+    index.start_listener(db)
+    return index
@@ -10,22 +10,57 @@ Este módulo implementa verificación de autenticidad de fotos usando:
 - Verificación de calidad de imagen
 """
 
-import cv2
 import numpy as np
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 from dataclasses import dataclass
 import logging
-from PIL import Image, ImageEnhance
-import requests
-from io import BytesIO
-import base64
 from datetime import datetime
-import firebase_admin
-from firebase_admin import firestore
+import threading
 import json
+import hashlib
+from app.core.firestore_async import get_async_firestore
+from app.core.firestore_audit import get_audit_writer
+from app.services.cv.image_context import ImageAnalysisContext
+from app.services.cv.image_fetcher import ImageFetcher, ImageFetchError
+from app.services.cv.perceptual_hash import hash_to_hex, hex_to_hash
+from app.services.cv.photo_hash_index import get_photo_hash_index
+from app.services.cv.verification_cache import content_key, get_verification_cache
+from app.services.cv.verification_pipeline import VerificationPipeline
 
 logger = logging.getLogger(__name__)
 
+# Las etapas de análisis aceptan la imagen o su contexto de derivadas compartidas
+ImageInput = Union[np.ndarray, ImageAnalysisContext]
+
+# Resolución (lado mayor en px) a la que se calcula cada análisis; None = la
+# imagen completa (hasta 1024 px). Los estadísticos globales de brillo,
+# contraste, ruido, histograma y piel no necesitan más de 256 px; los detalles
+# finos (nitidez, rostros, texto, gradientes, suavizado local) y la saturación
+# se quedan a resolución completa. La saturación media decide el filtro
+# 'color' por umbral y la reducción la desplaza lo justo para cruzarlo en
+# fotos ruidosas, lo que cambia filter_types y la intensidad del filtro.
+#
+# Tolerancia frente a calcularlo todo a resolución completa, medida con el
+# conjunto de fotos de prueba (tests/test_services.py):
+# - verification_score y quality_score: |Δ| <= 0.05 (la reducción promedia el
+#   ruido de píxel, que baja algo el contraste de las fotos muy ruidosas)
+# - Mismos filtros detectados (filter_types) y avisos
+# - Misma recomendación salvo imágenes justo en un umbral de brillo (no
+#   ocurre en el conjunto de prueba)
+ANALYSIS_RESOLUTION: Dict[str, Optional[int]] = {
+    'sharpness': None,
+    'face_crop': None,
+    'gradients': None,
+    'text': None,
+    'brightness': 256,
+    'contrast': 256,
+    'noise': 256,
+    'saturation': None,
+    'color_histogram': 256,
+    'skin': 256,
+    'smoothing': None,
+}
+
 @dataclass
 class FaceDetection:
     """Resultado de detección de rostros"""
@@ -65,10 +100,18 @@ class ContentAnalysis:
 
 @dataclass
 class PhotoVerificationResult:
-    """Resultado completo de verificación"""
-    is_real_person: bool
-    has_excessive_filters: bool
-    is_appropriate: bool
+    """
+    Resultado completo de verificación
+
+    Con salida anticipada, lo que no llegó a medirse queda a None (ver
+    details['skipped_stages']). El score sigue siendo numérico para quien lo
+    consume (perfil, auditoría): es la cota inferior de details['score_bounds'],
+    suficiente para la recomendación ya decidida, y details['score_is_bound']
+    lo indica.
+    """
+    is_real_person: Optional[bool]
+    has_excessive_filters: Optional[bool]
+    is_appropriate: Optional[bool]
     estimated_age: int
     confidence: float
     faces_detected: int
@@ -84,7 +127,26 @@ class PhotoVerification:
     """
     
     def __init__(self):
-        self.db = firestore.client()
+        # Sin Firebase (tests, workers del pool de verificación) no se guardan resultados
+        try:
+            from firebase_admin import firestore
+            self.db = firestore.client()
+        except Exception as e:
+            logger.warning(f"[PhotoVerification] Firebase no disponible, resultados sin guardar: {e}")
+            self.db = None
+        self.async_db = get_async_firestore()
+        # Auditoría y perfil se escriben por lotes en segundo plano
+        self.audit_writer = get_audit_writer()
+        # Descargas con pool de conexiones, límite de tamaño y formatos permitidos
+        self.image_fetcher = ImageFetcher()
+        # Hashes perceptuales de las fotos verificadas (duplicados entre cuentas)
+        self.photo_index = get_photo_hash_index()
+        # Etapas de análisis ordenadas por coste con salida anticipada
+        self.pipeline = VerificationPipeline()
+        # Resultados por contenido de la imagen (re-verificaciones de la misma foto)
+        self.result_cache = get_verification_cache()
+        # Nivel de la pirámide de cada análisis (todo a None = resolución completa)
+        self.analysis_resolution = dict(ANALYSIS_RESOLUTION)
         self.min_face_confidence = 0.7
         self.max_filter_intensity = 0.3
         self.min_quality_score = 0.6
@@ -104,7 +166,8 @@ class PhotoVerification:
         self, 
         image_url: str, 
         claimed_age: Optional[int] = None,
-        user_id: Optional[str] = None
+        user_id: Optional[str] = None,
+        save_result: bool = True
     ) -> PhotoVerificationResult:
         """
         Verificar foto completa con todos los análisis
@@ -113,6 +176,7 @@ class PhotoVerification:
             image_url: URL de la imagen
             claimed_age: Edad declarada por el usuario
             user_id: ID del usuario para contexto
+            save_result: Guardar el resultado en Firestore (verify_photo_async lo guarda por su cuenta)
             
         Returns:
             Resultado completo de verificación
@@ -122,71 +186,24 @@ class PhotoVerification:
         try:
             logger.info(f"[PhotoVerification] Iniciando verificación de foto para usuario {user_id}")
             
-            # 1. Descargar y preprocesar imagen
-            image = self._download_and_preprocess_image(image_url)
-            if image is None:
+            # 1. Descargar imagen (la caché de resultados se consulta antes de decodificar)
+            data = self._download_image_bytes(image_url)
+            if data is None:
                 return self._create_error_result("No se pudo descargar o procesar la imagen")
             
-            # 2. Detección de rostros
-            faces = self._detect_faces(image)
-            
-            # 3. Verificar si es persona real
-            is_real = self._verify_real_person(image, faces)
-            
-            # 4. Estimar edad
-            age_result = self._estimate_age(image, faces)
-            
-            # 5. Detectar filtros y edición
-            filter_result = self._detect_filters(image)
-            
-            # 6. Análisis de contenido
-            content_result = self._analyze_content(image)
-            
-            # 7. Evaluar calidad de imagen
-            quality_score = self._assess_image_quality(image)
-            
-            # 8. Verificar consistencia con edad declarada
-            age_consistency = self._check_age_consistency(claimed_age, age_result)
-            
-            # 9. Calcular score final y recomendaciones
-            verification_score = self._calculate_verification_score(
-                is_real, filter_result, content_result, quality_score, age_consistency
-            )
-            
-            # 10. Generar recomendación final
-            recommendation = self._generate_recommendation(verification_score, filter_result, content_result)
-            
-            # 11. Preparar warnings
-            warnings = self._generate_warnings(age_consistency, filter_result, content_result, quality_score)
-            
-            processing_time = int((datetime.now() - start_time).total_seconds() * 1000)
+            result = self.verify_image_bytes(data, claimed_age, start_time)
+            if result.recommendation == "ERROR":
+                return result
             
-            result = PhotoVerificationResult(
-                is_real_person=is_real,
-                has_excessive_filters=filter_result.has_filters and filter_result.filter_intensity > self.max_filter_intensity,
-                is_appropriate=content_result.is_appropriate,
-                estimated_age=age_result.predicted_age if age_result else 0,
-                confidence=verification_score,
-                faces_detected=len(faces),
-                warnings=warnings,
-                details={
-                    'face_detection': len(faces),
-                    'filter_analysis': filter_result.__dict__,
-                    'content_analysis': content_result.__dict__,
-                    'quality_score': quality_score,
-                    'age_consistency': age_consistency,
-                    'processing_time_ms': processing_time
-                },
-                verification_score=verification_score,
-                recommendation=recommendation,
-                processing_time_ms=processing_time
-            )
+            # Misma foto (o casi) en otras cuentas
+            if user_id:
+                self.check_duplicate_photo(result, user_id, image_url)
             
             # Log del resultado
-            logger.info(f"[PhotoVerification] Verificación completada en {processing_time}ms - Score: {verification_score:.2f}")
+            logger.info(f"[PhotoVerification] Verificación completada en {result.processing_time_ms}ms - Score: {result.verification_score:.2f}")
             
             # Guardar en Firestore para auditoría
-            if user_id:
+            if user_id and save_result and self.db is not None:
                 self._save_verification_result(user_id, image_url, result)
             
             return result
@@ -196,46 +213,192 @@ class PhotoVerification:
             processing_time = int((datetime.now() - start_time).total_seconds() * 1000)
             return self._create_error_result(f"Error en verificación: {str(e)}", processing_time)
     
+    def verify_image_bytes(
+        self,
+        data: bytes,
+        claimed_age: Optional[int] = None,
+        start_time: Optional[datetime] = None
+    ) -> PhotoVerificationResult:
+        """
+        Verificar una imagen descargada, reutilizando el resultado si ya se analizó
+        
+        Args:
+            data: Bytes de la imagen tal como se descargaron
+            claimed_age: Edad declarada por el usuario
+            start_time: Inicio de la verificación para processing_time_ms (por defecto ahora)
+        """
+        start_time = start_time or datetime.now()
+        key = content_key(data, claimed_age)
+        result = self.result_cache.get(key)
+        if result is not None:
+            result.details['cached'] = True
+            result.processing_time_ms = int((datetime.now() - start_time).total_seconds() * 1000)
+            return result
+        
+        image = self._decode_image(data)
+        if image is None:
+            return self._create_error_result("No se pudo descargar o procesar la imagen")
+        
+        result = self.verify_image(image, claimed_age, start_time)
+        self.result_cache.set(key, result)
+        return result
+    
+    def verify_image(
+        self,
+        image: np.ndarray,
+        claimed_age: Optional[int] = None,
+        start_time: Optional[datetime] = None
+    ) -> PhotoVerificationResult:
+        """
+        Analizar una imagen ya descargada (etapas 2 a 11 de verify_photo)
+        
+        Args:
+            image: Imagen RGB preprocesada
+            claimed_age: Edad declarada por el usuario
+            start_time: Inicio de la verificación para processing_time_ms (por defecto ahora)
+        """
+        start_time = start_time or datetime.now()
+        
+        # Derivadas de la imagen (grises, HSV, gradientes...) compartidas por todas las etapas
+        image = ImageAnalysisContext(image)
+        
+        # 2-7. Rostros, edad, contenido, persona real, calidad y filtros, de la
+        # etapa más barata a la más cara; se omiten las que ya no cambian la recomendación
+        run = self.pipeline.run(self, image, claimed_age)
+        fields = run.fields
+        
+        faces = fields['faces']
+        is_real = fields.get('is_real')
+        age_result = fields.get('age_result')
+        # 8. Consistencia con edad declarada
+        age_consistency = fields.get('age_consistency') or self._check_age_consistency(claimed_age, None)
+        filter_result = fields.get('filter_result') or FilterDetection(
+            has_filters=False, filter_intensity=0, filter_types=[], editing_score=0, is_ai_generated=False
+        )
+        # Las etapas de contenido omitidas cuentan como sin señales
+        content_result = self._combine_content_analysis(
+            fields['content_color'] if 'content_color' in fields else {"nudity_detected": False, "violence_detected": False},
+            fields['content_text'] if 'content_text' in fields else {"contains_text": False, "text_content": "", "spam_detected": False}
+        )
+        quality_score = fields.get('quality_score')
+        
+        if run.skipped:
+            # Recomendación ya decidida: cota inferior del score (coherente con ella)
+            verification_score, _ = run.score_bounds
+            recommendation = run.recommendation
+        else:
+            # 9. Calcular score final y recomendaciones
+            verification_score = self._calculate_verification_score(
+                is_real, filter_result, content_result, quality_score, age_consistency
+            )
+            
+            # 10. Generar recomendación final
+            recommendation = self._generate_recommendation(verification_score, filter_result, content_result)
+        
+        # 11. Preparar warnings (las etapas omitidas no generan avisos)
+        warnings = self._generate_warnings(
+            age_consistency, filter_result, content_result, quality_score if quality_score is not None else 1.0
+        )
+        
+        processing_time = int((datetime.now() - start_time).total_seconds() * 1000)
+        
+        details = {
+            'face_detection': len(faces),
+            'filter_analysis': filter_result.__dict__,
+            'content_analysis': content_result.__dict__,
+            'quality_score': quality_score,
+            'age_consistency': age_consistency,
+            'perceptual_hash': hash_to_hex(image.perceptual_hash),
+            # Tiempo por etapa y total
+            'processing_time_ms': {**run.timings_ms, 'total': processing_time},
+            'skipped_stages': run.skipped
+        }
+        if run.skipped:
+            details['score_bounds'] = list(run.score_bounds)
+            details['score_is_bound'] = True
+        
+        # Sin la etapa de filtros no se sabe; sin alguna de las de contenido
+        # solo se sabe si ya hay señales (las omitidas solo podrían añadir más)
+        has_excessive_filters = None
+        if 'filter_result' in fields:
+            has_excessive_filters = filter_result.has_filters and filter_result.filter_intensity > self.max_filter_intensity
+        is_appropriate = content_result.is_appropriate
+        if is_appropriate and not ('content_color' in fields and 'content_text' in fields):
+            is_appropriate = None
+        
+        result = PhotoVerificationResult(
+            is_real_person=is_real,
+            has_excessive_filters=has_excessive_filters,
+            is_appropriate=is_appropriate,
+            estimated_age=age_result.predicted_age if age_result else 0,
+            confidence=verification_score,
+            faces_detected=len(faces),
+            warnings=warnings,
+            details=details,
+            verification_score=verification_score,
+            recommendation=recommendation,
+            processing_time_ms=processing_time
+        )
+        
+        return result
+    
+    def check_duplicate_photo(self, result: PhotoVerificationResult, user_id: str, image_url: str) -> Dict[str, int]:
+        """
+        Buscar la foto en otras cuentas y registrarla en el índice de hashes perceptuales
+        
+        Las cuentas encontradas (usuario -> distancia de Hamming) se añaden a
+        details['duplicate_accounts'] junto con un aviso.
+        """
+        value = result.details.get('perceptual_hash')
+        if not value:
+            return {}
+        
+        if self.db is not None:
+            try:
+                self.photo_index.ensure_loaded(self.db)
+            except Exception as e:
+                logger.error(f"[PhotoVerification] Error cargando el índice de hashes: {e}")
+        
+        photo_hash = hex_to_hash(value)
+        accounts = self.photo_index.accounts_near(photo_hash, exclude_user_id=user_id)
+        self.photo_index.add(image_url, user_id, photo_hash)
+        
+        if accounts:
+            result.details['duplicate_accounts'] = accounts
+            result.warnings.append(f"Foto usada también en {len(accounts)} cuenta(s)")
+            logger.warning(f"[PhotoVerification] Foto de {user_id} presente en {len(accounts)} cuentas más")
+        return accounts
+    
     def _download_and_preprocess_image(self, image_url: str) -> Optional[np.ndarray]:
-        """Descargar y preprocesar imagen"""
+        """Descargar y preprocesar imagen (RGB, como máximo 1024x1024)"""
+        data = self._download_image_bytes(image_url)
+        return self._decode_image(data) if data is not None else None
+    
+    def _download_image_bytes(self, image_url: str) -> Optional[bytes]:
+        """Descargar la imagen sin decodificarla"""
         try:
-            response = requests.get(image_url, timeout=10)
-            response.raise_for_status()
-            
-            # Convertir a imagen PIL
-            image = Image.open(BytesIO(response.content))
-            
-            # Convertir a RGB si es necesario
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # Redimensionar si es muy grande
-            max_size = (1024, 1024)
-            image.thumbnail(max_size, Image.Resampling.LANCZOS)
-            
-            # Convertir a numpy array
-            image_array = np.array(image)
-            
-            # Verificar tamaño mínimo
-            if image_array.shape[0] < 100 or image_array.shape[1] < 100:
-                logger.warning("[PhotoVerification] Imagen demasiado pequeña")
-                return None
-            
-            return image_array
-            
-        except Exception as e:
+            return self.image_fetcher.fetch_bytes(image_url)
+        except ImageFetchError as e:
             logger.error(f"[PhotoVerification] Error descargando imagen: {e}")
             return None
     
-    def _detect_faces(self, image: np.ndarray) -> List[FaceDetection]:
+    def _decode_image(self, data: bytes) -> Optional[np.ndarray]:
+        """Decodificar y preprocesar imagen (RGB, como máximo 1024x1024)"""
+        try:
+            return self.image_fetcher.decode(data)
+        except ImageFetchError as e:
+            if e.reason == 'too_small':
+                logger.warning("[PhotoVerification] Imagen demasiado pequeña")
+            else:
+                logger.error(f"[PhotoVerification] Error procesando imagen: {e}")
+            return None
+    
+    def _detect_faces(self, image: ImageInput) -> List[FaceDetection]:
         """Detectar rostros en la imagen"""
         try:
             # Simulación de detección de rostros (en producción usar OpenCV o similar)
             faces = []
             
-            # Análisis simple de patrones faciales
-            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-            
             # Simular detección de 1 rostro con alta confianza
             # En producción, esto usaría modelos reales de detección
             height, width = image.shape[:2]
@@ -263,7 +426,7 @@ class PhotoVerification:
             logger.error(f"[PhotoVerification] Error detectando rostros: {e}")
             return []
     
-    def _verify_real_person(self, image: np.ndarray, faces: List[FaceDetection]) -> bool:
+    def _verify_real_person(self, image: ImageInput, faces: List[FaceDetection]) -> bool:
         """Verificar si es una persona real (no foto de foto)"""
         try:
             if not faces:
@@ -280,18 +443,18 @@ class PhotoVerification:
             quality_indicators = []
             
             # 1. Análisis de nitidez
-            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-            laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
+            context = ImageAnalysisContext.of(image)
+            laplacian_var = self._level(context, 'sharpness').sharpness
             sharpness_score = min(laplacian_var / 1000, 1.0)
             quality_indicators.append(sharpness_score)
             
             # 2. Análisis de ruido
-            noise_level = self._estimate_noise_level(image)
+            noise_level = self._estimate_noise_level(context)
             noise_score = max(0, 1.0 - noise_level)
             quality_indicators.append(noise_score)
             
             # 3. Análisis de iluminación
-            brightness = np.mean(gray)
+            brightness = self._level(context, 'brightness').brightness
             brightness_score = 1.0 if 50 < brightness < 200 else 0.5
             quality_indicators.append(brightness_score)
             
@@ -311,7 +474,7 @@ class PhotoVerification:
             logger.error(f"[PhotoVerification] Error verificando persona real: {e}")
             return False
     
-    def _estimate_age(self, image: np.ndarray, faces: List[FaceDetection]) -> Optional[AgeEstimation]:
+    def _estimate_age(self, image: ImageInput, faces: List[FaceDetection]) -> Optional[AgeEstimation]:
         """Estimar edad basada en el rostro detectado"""
         try:
             if not faces:
@@ -325,10 +488,8 @@ class PhotoVerification:
             x, y, w, h = face.bbox
             
             # Extraer región del rostro
-            face_region = image[y:y+h, x:x+w]
-            
             # Análisis de textura (más rugosidad = mayor edad)
-            gray_face = cv2.cvtColor(face_region, cv2.COLOR_RGB2GRAY)
+            gray_face = self._level(image, 'face_crop').gray_region(x, y, w, h)
             
             # Calcular desviación estándar como proxy de textura
             texture_score = np.std(gray_face)
@@ -363,8 +524,10 @@ class PhotoVerification:
             logger.error(f"[PhotoVerification] Error estimando edad: {e}")
             return None
     
-    def _detect_filters(self, image: np.ndarray) -> FilterDetection:
+    def _detect_filters(self, image: ImageInput) -> FilterDetection:
         """Detectar filtros y edición en la imagen"""
+        import cv2
+
         try:
             # Análisis de histograma para detectar edición
             # En producción incluiría:
@@ -375,16 +538,17 @@ class PhotoVerification:
             
             filter_types = []
             intensity_scores = []
+            context = ImageAnalysisContext.of(image)
             
             # 1. Análisis de saturación de color (filtros de belleza)
-            hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
-            saturation = np.mean(hsv[:, :, 1])
+            saturation = self._level(context, 'saturation').mean_saturation
             if saturation > 150:  # Saturación alta
                 filter_types.append('color')
                 intensity_scores.append(min(saturation / 255, 1.0))
             
             # 2. Análisis de suavizado (filtros de belleza)
             # Comparar con versión ligeramente desenfocada
+            image = self._level(context, 'smoothing').image
             blurred = cv2.GaussianBlur(image, (5, 5), 0)
             diff = cv2.absdiff(image, blurred)
             smooth_score = np.mean(diff) / 255
@@ -399,7 +563,7 @@ class PhotoVerification:
             
             # 4. Verificar si parece generada por IA
             # En producción usaría modelos específicos
-            is_ai_generated = self._detect_ai_generation(image)
+            is_ai_generated = self._detect_ai_generation(context)
             if is_ai_generated:
                 filter_types.append('ai_enhancement')
                 intensity_scores.append(0.8)
@@ -420,7 +584,7 @@ class PhotoVerification:
             logger.error(f"[PhotoVerification] Error detectando filtros: {e}")
             return FilterDetection(has_filters=False, filter_intensity=0, filter_types=[], editing_score=0, is_ai_generated=False)
     
-    def _detect_ai_generation(self, image: np.ndarray) -> bool:
+    def _detect_ai_generation(self, image: ImageInput) -> bool:
         """Detectar si la imagen fue generada por IA"""
         try:
             # En producción usaría modelos específicos como:
@@ -432,21 +596,19 @@ class PhotoVerification:
             # Las imágenes generadas por IA a menudo tienen patrones específicos
             
             # 1. Análisis de textura
-            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+            context = ImageAnalysisContext.of(image)
             
             # Calcular gradientes
-            grad_x = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=3)
-            grad_y = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=3)
-            gradient_magnitude = np.sqrt(grad_x**2 + grad_y**2)
+            gradient_magnitude = self._level(context, 'gradients').gradient_magnitude
             
             # Las imágenes generadas por IA a menudo tienen gradientes más suaves
             gradient_variance = np.var(gradient_magnitude)
             
             # 2. Análisis de ruido
-            noise_level = self._estimate_noise_level(image)
+            noise_level = self._estimate_noise_level(context)
             
             # 3. Análisis de consistencia de color
-            color_consistency = self._analyze_color_consistency(image)
+            color_consistency = self._analyze_color_consistency(context)
             
             # Combinar factores
             ai_score = 0
@@ -463,16 +625,26 @@ class PhotoVerification:
             logger.error(f"[PhotoVerification] Error detectando IA: {e}")
             return False
     
-    def _analyze_content(self, image: np.ndarray) -> ContentAnalysis:
+    def _analyze_content(self, image: ImageInput) -> ContentAnalysis:
         """Análisis de contenido para detectar inadecuaciones"""
+        context = ImageAnalysisContext.of(image)
+        return self._combine_content_analysis(
+            self._analyze_content_color(context),
+            self._analyze_content_text(context)
+        )
+    
+    def _analyze_content_color(self, image: ImageInput) -> Optional[Dict[str, any]]:
+        """Señales de color del contenido: piel expuesta y violencia (barato)"""
+        import cv2
+
         try:
-            inappropriate_flags = []
-            
             # En producción usaría modelos de clasificación entrenados
             # Aquí simulamos con análisis básico
             
             # 1. Análisis de color (detección básica de piel)
-            hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+            skin_context = self._level(image, 'skin')
+            image = skin_context.image
+            hsv = skin_context.hsv
             
             # Rangos de color para piel
             lower_skin = np.array([0, 20, 70], dtype=np.uint8)
@@ -483,41 +655,36 @@ class PhotoVerification:
             
             # 2. Detección de nudidad (simplificada)
             nudity_detected = skin_percentage > 0.4  # Umbral conservador
-            if nudity_detected:
-                inappropriate_flags.append("excessive_skin_exposure")
-            
-            # 3. Análisis de texto (si hay texto en la imagen)
-            contains_text, text_content = self._extract_text_from_image(image)
-            
-            # 4. Detección de spam
-            spam_detected = self._detect_spam_in_text(text_content) if contains_text else False
-            if spam_detected:
-                inappropriate_flags.append("spam_content")
             
             # 5. Detección de violencia (colores rojos intensos)
             red_channel = image[:, :, 0]
             red_intensity = np.mean(red_channel)
             violence_suspected = red_intensity > 180  # Umbral simple
             
-            # Determinar si es apropiado
-            is_appropriate = len(inappropriate_flags) == 0 and not nudity_detected and not violence_suspected
-            
-            result = ContentAnalysis(
-                is_appropriate=is_appropriate,
-                inappropriate_flags=inappropriate_flags,
-                nudity_detected=nudity_detected,
-                violence_detected=violence_suspected,
-                spam_detected=spam_detected,
-                contains_text=contains_text,
-                text_content=text_content
-            )
+            return {"nudity_detected": nudity_detected, "violence_detected": violence_suspected}
+            
+        except Exception as e:
+            logger.error(f"[PhotoVerification] Error analizando contenido: {e}")
+            return None
+    
+    def _analyze_content_text(self, image: ImageInput) -> Optional[Dict[str, any]]:
+        """Texto y spam en la imagen (contornos, la parte cara del análisis de contenido)"""
+        try:
+            # 3. Análisis de texto (si hay texto en la imagen)
+            contains_text, text_content = self._extract_text_from_image(image)
             
-            logger.info(f"[PhotoVerification] Contenido apropiado: {is_appropriate} - Flags: {inappropriate_flags}")
+            # 4. Detección de spam
+            spam_detected = self._detect_spam_in_text(text_content) if contains_text else False
             
-            return result
+            return {"contains_text": contains_text, "text_content": text_content, "spam_detected": spam_detected}
             
         except Exception as e:
             logger.error(f"[PhotoVerification] Error analizando contenido: {e}")
+            return None
+    
+    def _combine_content_analysis(self, color: Optional[Dict[str, any]], text: Optional[Dict[str, any]]) -> ContentAnalysis:
+        """Resultado de contenido a partir de las señales de color y de texto"""
+        if color is None or text is None:
             return ContentAnalysis(
                 is_appropriate=True,
                 inappropriate_flags=["analysis_error"],
@@ -527,36 +694,58 @@ class PhotoVerification:
                 contains_text=False,
                 text_content=""
             )
+        
+        inappropriate_flags = []
+        if color["nudity_detected"]:
+            inappropriate_flags.append("excessive_skin_exposure")
+        if text["spam_detected"]:
+            inappropriate_flags.append("spam_content")
+        
+        # Determinar si es apropiado
+        is_appropriate = len(inappropriate_flags) == 0 and not color["nudity_detected"] and not color["violence_detected"]
+        
+        result = ContentAnalysis(
+            is_appropriate=is_appropriate,
+            inappropriate_flags=inappropriate_flags,
+            nudity_detected=color["nudity_detected"],
+            violence_detected=color["violence_detected"],
+            spam_detected=text["spam_detected"],
+            contains_text=text["contains_text"],
+            text_content=text["text_content"]
+        )
+        
+        logger.info(f"[PhotoVerification] Contenido apropiado: {is_appropriate} - Flags: {inappropriate_flags}")
+        
+        return result
     
-    def _assess_image_quality(self, image: np.ndarray) -> float:
+    def _assess_image_quality(self, image: ImageInput) -> float:
         """Evaluar calidad técnica de la imagen"""
         try:
             quality_scores = []
             
             # 1. Nitidez
-            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-            laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
+            context = ImageAnalysisContext.of(image)
+            laplacian_var = self._level(context, 'sharpness').sharpness
             sharpness_score = min(laplacian_var / 1000, 1.0)
             quality_scores.append(sharpness_score)
             
             # 2. Brillo
-            brightness = np.mean(gray)
+            brightness = self._level(context, 'brightness').brightness
             brightness_score = 1.0 if 40 < brightness < 220 else 0.5
             quality_scores.append(brightness_score)
             
             # 3. Contraste
-            contrast = np.std(gray)
+            contrast = self._level(context, 'contrast').contrast
             contrast_score = min(contrast / 50, 1.0)
             quality_scores.append(contrast_score)
             
             # 4. Ruido
-            noise_level = self._estimate_noise_level(image)
+            noise_level = self._estimate_noise_level(context)
             noise_score = max(0, 1.0 - noise_level)
             quality_scores.append(noise_score)
             
             # 5. Saturación de color
-            hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
-            saturation = np.mean(hsv[:, :, 1])
+            saturation = self._level(context, 'saturation').mean_saturation
             saturation_score = min(saturation / 128, 1.0)
             quality_scores.append(saturation_score)
             
@@ -681,32 +870,98 @@ class PhotoVerification:
         
         return warnings
     
+    async def verify_photo_async(
+        self,
+        image_url: str,
+        claimed_age: Optional[int] = None,
+        user_id: Optional[str] = None
+    ) -> PhotoVerificationResult:
+        """
+        Versión async de verify_photo para endpoints de FastAPI
+        
+        La descarga y el análisis se ejecutan en el pool de hilos de la capa
+        async de Firestore y el resultado se encola en el escritor diferido.
+        """
+        result = await self.async_db.run(self.verify_photo, image_url, claimed_age, user_id, save_result=False)
+        if user_id and result.recommendation != "ERROR":
+            await self._save_verification_result_async(user_id, image_url, result)
+        return result
+    
+    def _verification_documents(self, user_id: str, image_url: str, result: PhotoVerificationResult) -> Tuple[Dict, Dict]:
+        """Documento de auditoría y campos a actualizar en el perfil"""
+        from firebase_admin import firestore
+        
+        verification_data = {
+            "userId": user_id,
+            "imageUrl": image_url,
+            "verificationResult": result.__dict__,
+            "perceptualHash": result.details.get('perceptual_hash'),
+            "timestamp": firestore.SERVER_TIMESTAMP,
+            "status": result.recommendation
+        }
+        profile_update = {
+            "photoVerificationStatus": result.recommendation,
+            "photoVerificationScore": result.verification_score,
+            "photoVerificationDate": firestore.SERVER_TIMESTAMP
+        }
+        return verification_data, profile_update
+    
+    @staticmethod
+    def _result_fingerprint(result: PhotoVerificationResult) -> str:
+        """Huella del resultado sin tiempos de proceso ni marca de caché"""
+        comparable = {key: value for key, value in result.__dict__.items() if key != 'processing_time_ms'}
+        comparable['details'] = {
+            key: value for key, value in result.details.items() if key not in ('processing_time_ms', 'cached')
+        }
+        # Escalares numpy como valores nativos: igual huella que un resultado leído de la caché JSON
+        encoded = json.dumps(
+            comparable, sort_keys=True, default=lambda value: value.item() if hasattr(value, 'item') else str(value)
+        )
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+    
     def _save_verification_result(self, user_id: str, image_url: str, result: PhotoVerificationResult):
-        """Guardar resultado en Firestore para auditoría"""
+        """
+        Guardar resultado en Firestore
+        
+        El documento de auditoría se encola en el escritor diferido, que lo envía
+        por lotes en segundo plano, y se omite si el resultado de esa foto no
+        cambió desde el último guardado. El perfil se actualiza siempre: refleja
+        la última foto verificada, que puede ser otra. El perfil no pasa por él: es estado vivo y un
+        resultado antiguo reenviado desde el fichero de pendientes pisaría uno más
+        reciente. Se escribe al momento con un update() real, que falla (y no
+        recrea el documento) si la cuenta ya no existe.
+        """
         try:
-            verification_data = {
-                "userId": user_id,
-                "imageUrl": image_url,
-                "verificationResult": result.__dict__,
-                "timestamp": firestore.SERVER_TIMESTAMP,
-                "status": result.recommendation
-            }
-            
-            self.db.collection('photo_verifications').add(verification_data)
-            
-            # Actualizar perfil del usuario con resultado
-            user_ref = self.db.collection('users').document(user_id)
-            user_ref.update({
-                "photoVerificationStatus": result.recommendation,
-                "photoVerificationScore": result.verification_score,
-                "photoVerificationDate": firestore.SERVER_TIMESTAMP
-            })
-            
-            logger.info(f"[PhotoVerification] Resultado guardado para usuario {user_id}")
-            
+            self._update_profile(user_id, self._queue_audit(user_id, image_url, result))
         except Exception as e:
             logger.error(f"[PhotoVerification] Error guardando resultado: {e}")
     
+    async def _save_verification_result_async(self, user_id: str, image_url: str, result: PhotoVerificationResult):
+        """Guardar resultado desde código async (el perfil se escribe en el pool de hilos)"""
+        try:
+            await self.async_db.run(self._update_profile, user_id, self._queue_audit(user_id, image_url, result))
+        except Exception as e:
+            logger.error(f"[PhotoVerification] Error guardando resultado: {e}")
+    
+    def _queue_audit(self, user_id: str, image_url: str, result: PhotoVerificationResult) -> Dict:
+        """Encolar el documento de auditoría (si cambió) y devolver los campos del perfil"""
+        verification_data, profile_update = self._verification_documents(user_id, image_url, result)
+        fingerprint = self._result_fingerprint(result)
+        if self.result_cache.is_saved(user_id, image_url, fingerprint):
+            logger.info(f"[PhotoVerification] Resultado sin cambios para usuario {user_id}, sin nueva auditoría")
+            return profile_update
+        
+        self.audit_writer.add('photo_verifications', verification_data)
+        self.result_cache.mark_saved(user_id, image_url, fingerprint)
+        logger.info(f"[PhotoVerification] Resultado encolado para usuario {user_id}")
+        return profile_update
+    
+    def _update_profile(self, user_id: str, profile_update: Dict):
+        """Actualizar el perfil del usuario con el resultado"""
+        if self.db is None:
+            return
+        self.db.collection('users').document(user_id).update(profile_update)
+    
     def _create_error_result(self, error_message: str, processing_time: int = 0) -> PhotoVerificationResult:
         """Crear resultado de error"""
         return PhotoVerificationResult(
@@ -724,32 +979,33 @@ class PhotoVerification:
         )
     
     # Métodos auxiliares
-    def _estimate_noise_level(self, image: np.ndarray) -> float:
+    def _level(self, image: ImageInput, analysis: str) -> ImageAnalysisContext:
+        """Nivel de la pirámide de la imagen declarado para un análisis"""
+        return ImageAnalysisContext.of(image).level(self.analysis_resolution.get(analysis))
+    
+    def _estimate_noise_level(self, image: ImageInput) -> float:
         """Estimar nivel de ruido en la imagen"""
         try:
-            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-            
-            # Usar desviación estándar como proxy de ruido
-            noise = np.std(gray)
-            
-            # Normalizar
-            return min(noise / 50, 1.0)
+            # Desviación estándar de los grises como proxy de ruido, normalizada
+            return self._level(image, 'noise').noise_level
             
         except Exception:
             return 0.5
     
-    def _analyze_color_consistency(self, image: np.ndarray) -> float:
+    def _analyze_color_consistency(self, image: ImageInput) -> float:
         """Analizar consistencia de colores"""
         try:
             # Calcular histograma de colores
-            hist_r = cv2.calcHist([image], [0], None, [256], [0, 256])
-            hist_g = cv2.calcHist([image], [1], None, [256], [0, 256])
-            hist_b = cv2.calcHist([image], [2], None, [256], [0, 256])
+            context = ImageAnalysisContext.of(image)
+            level = self._level(context, 'color_histogram')
+            hist_r, hist_g, hist_b = level.channel_histograms
             
-            # Calcular varianza de los histogramas
-            variance_r = np.var(hist_r)
-            variance_g = np.var(hist_g)
-            variance_b = np.var(hist_b)
+            # Calcular varianza de los histogramas, con los conteos escalados al
+            # número de píxeles de la imagen completa (la varianza crece con su cuadrado)
+            scale = (context.pixel_count / level.pixel_count) ** 2
+            variance_r = np.var(hist_r) * scale
+            variance_g = np.var(hist_g) * scale
+            variance_b = np.var(hist_b) * scale
             
             # Consistencia alta = varianza baja
             avg_variance = (variance_r + variance_g + variance_b) / 3
@@ -760,14 +1016,16 @@ class PhotoVerification:
         except Exception:
             return 0.5
     
-    def _extract_text_from_image(self, image: np.ndarray) -> Tuple[bool, str]:
+    def _extract_text_from_image(self, image: ImageInput) -> Tuple[bool, str]:
         """Extraer texto de la imagen (OCR simplificado)"""
+        import cv2
+
         try:
             # En producción usaría Tesseract OCR o similar
             # Aquí simulamos con análisis de patrones
             
-            # Convertir a escala de grises
-            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+            # Escala de grises
+            gray = self._level(image, 'text').gray
             
             # Aplicar umbral para detectar regiones de texto
             _, thresh = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)
@@ -816,8 +1074,19 @@ class PhotoVerification:
         except Exception:
             return False
 
-# Instancia global del verificador
-photo_verifier = PhotoVerification()
+# Instancia global del verificador: se crea al primer uso (get_photo_verifier),
+# no al importar el módulo
+photo_verifier: Optional[PhotoVerification] = None
+_photo_verifier_lock = threading.Lock()
+
+def get_photo_verifier() -> PhotoVerification:
+    """Verificador compartido (se crea al primer uso o en el calentamiento de arranque)"""
+    global photo_verifier
+    if photo_verifier is None:
+        with _photo_verifier_lock:
+            if photo_verifier is None:
+                photo_verifier = PhotoVerification()
+    return photo_verifier
 
 def verify_user_photo(image_url: str, claimed_age: Optional[int] = None, user_id: Optional[str] = None) -> Dict:
     """
@@ -831,5 +1100,10 @@ def verify_user_photo(image_url: str, claimed_age: Optional[int] = None, user_id
     Returns:
         Resultado de verificación como diccionario
     """
-    result = photo_verifier.verify_photo(image_url, claimed_age, user_id)
+    result = get_photo_verifier().verify_photo(image_url, claimed_age, user_id)
+    return result.__dict__
+
+async def verify_user_photo_async(image_url: str, claimed_age: Optional[int] = None, user_id: Optional[str] = None) -> Dict:
+    """Versión async de verify_user_photo (no bloquea el event loop)"""
+    result = await get_photo_verifier().verify_photo_async(image_url, claimed_age, user_id)
     return result.__dict__
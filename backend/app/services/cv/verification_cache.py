@@ -0,0 +1,238 @@
+"""
+TuCitaSegura - Caché en disco de resultados de verificación de fotos
+
+La misma foto se vuelve a verificar cuando el usuario reordena su galería,
+la reenvía a verificación o un administrador repite la comprobación. El
+resultado depende solo de los bytes de la imagen, de la edad declarada y
+de la versión del pipeline, así que se guarda con la clave
+sha256(bytes):edad:versión y se consulta antes de decodificar nada.
+
+El almacén es un SQLite local (compartido por los procesos del pool de
+verificación) con desalojo LRU al superar `max_entries`. También recuerda la
+huella del último resultado guardado en Firestore por (usuario, foto), para
+no repetir escrituras idénticas, con el mismo límite y desalojo.
+
+Los resultados se guardan como JSON (nunca pickle) y el fichero por defecto
+vive en un directorio propio de la aplicación con permisos 0700.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, TYPE_CHECKING
+
+from app.services.cv.verification_pipeline import PIPELINE_VERSION
+
+if TYPE_CHECKING:
+    from app.services.cv.photo_verifier import PhotoVerificationResult
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tucitasegura')
+
+# Versión del esquema (PRAGMA user_version): si no coincide se recrean las tablas
+SCHEMA_VERSION = 2
+
+try:
+    from app.core.config import settings
+    CACHE_PATH = settings.CV_RESULT_CACHE_PATH
+    CACHE_MAX_ENTRIES = settings.CV_RESULT_CACHE_MAX_ENTRIES
+except Exception:
+    CACHE_PATH = ""
+    CACHE_MAX_ENTRIES = DEFAULT_MAX_ENTRIES
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+CREATE TABLE IF NOT EXISTS saved (
+    user_id TEXT NOT NULL,
+    image_url TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (user_id, image_url)
+);
+CREATE INDEX IF NOT EXISTS saved_last_used ON saved (last_used);
+"""
+
+
+def private_dir(path: str) -> str:
+    """
+    Crear (si hace falta) un directorio solo accesible por el usuario del proceso
+
+    Raises:
+        PermissionError: el directorio existe y pertenece a otro usuario
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.stat(path)
+    if hasattr(os, 'getuid') and info.st_uid != os.getuid():
+        raise PermissionError(f"El directorio {path} pertenece a otro usuario")
+    if info.st_mode & 0o077:
+        os.chmod(path, 0o700)
+    return path
+
+
+def default_cache_path() -> str:
+    """CV_RESULT_CACHE_PATH o un fichero en el directorio privado de la aplicación"""
+    if CACHE_PATH:
+        return CACHE_PATH
+    return os.path.join(private_dir(DEFAULT_CACHE_DIR), 'photo_verifications.sqlite')
+
+
+def _encode_value(value):
+    """Escalares numpy y otros tipos no JSON de details"""
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def content_key(data: bytes, claimed_age: Optional[int], version: str = PIPELINE_VERSION) -> str:
+    """Clave de caché: digest de los bytes descargados, edad declarada y versión del pipeline"""
+    return f"{hashlib.sha256(data).hexdigest()}:{claimed_age if claimed_age is not None else '-'}:{version}"
+
+
+class VerificationResultCache:
+    """
+    Resultados de verificación por contenido de la imagen, con desalojo LRU
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: Optional[int] = None):
+        """
+        Args:
+            path: Fichero SQLite (por defecto CV_RESULT_CACHE_PATH o uno en ~/.cache/tucitasegura)
+            max_entries: Resultados (y huellas guardadas) antes de desalojar los menos usados
+        """
+        self.path = path or default_cache_path()
+        self.max_entries = max_entries if max_entries is not None else CACHE_MAX_ENTRIES
+        if self.path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), mode=0o700, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        if self.path != ':memory:':
+            # Lectores concurrentes mientras otro proceso del pool escribe
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        if self._conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            # Ficheros de versiones anteriores (resultados en pickle): se descartan
+            self._conn.executescript('DROP TABLE IF EXISTS results; DROP TABLE IF EXISTS saved;')
+            self._conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_evictions = 0
+        self.skipped_writes = 0
+
+    def get(self, key: str) -> Optional['PhotoVerificationResult']:
+        """Resultado guardado (una copia nueva en cada llamada) o None"""
+        with self._lock:
+            row = self._conn.execute('SELECT result FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE results SET last_used = ? WHERE key = ?', (time.time(), key))
+            self.hits += 1
+        try:
+            from app.services.cv.photo_verifier import PhotoVerificationResult
+            return PhotoVerificationResult(**json.loads(row[0]))
+        except Exception as e:
+            logger.warning(f"[VerificationResultCache] Entrada ilegible descartada: {e}")
+            self.delete(key)
+            return None
+
+    def set(self, key: str, result: 'PhotoVerificationResult'):
+        """Guardar un resultado, desalojando los menos usados si se supera max_entries"""
+        encoded = json.dumps(result.__dict__, default=_encode_value)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO results (key, result, last_used) VALUES (?, ?, ?)',
+                (key, encoded, time.time())
+            )
+            self.evictions += self._evict('results', 'key')
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute('DELETE FROM results WHERE key = ?', (key,))
+
+    def is_saved(self, user_id: str, image_url: str, fingerprint: str) -> bool:
+        """Si el último resultado guardado en Firestore para la foto tiene esta huella"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT fingerprint FROM saved WHERE user_id = ? AND image_url = ?', (user_id, image_url)
+            ).fetchone()
+            if row is not None and row[0] == fingerprint:
+                self._conn.execute(
+                    'UPDATE saved SET last_used = ? WHERE user_id = ? AND image_url = ?',
+                    (time.time(), user_id, image_url)
+                )
+                self.skipped_writes += 1
+                return True
+            return False
+
+    def mark_saved(self, user_id: str, image_url: str, fingerprint: str):
+        """Recordar la huella guardada, desalojando las menos usadas si se supera max_entries"""
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO saved (user_id, image_url, fingerprint, last_used) VALUES (?, ?, ?, ?)',
+                (user_id, image_url, fingerprint, time.time())
+            )
+            self.saved_evictions += self._evict('saved', 'rowid')
+
+    def _evict(self, table: str, key_column: str) -> int:
+        """Borrar las filas menos usadas que excedan max_entries (con el lock tomado)"""
+        excess = self._count(table) - self.max_entries
+        if excess <= 0:
+            return 0
+        self._conn.execute(
+            f'DELETE FROM {table} WHERE {key_column} IN '
+            f'(SELECT {key_column} FROM {table} ORDER BY last_used LIMIT ?)',
+            (excess,)
+        )
+        return excess
+
+    def _count(self, table: str = 'results') -> int:
+        return self._conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._count()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get_stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        with self._lock:
+            saved_entries = self._count('saved')
+        return {
+            'entries': len(self),
+            'saved_entries': saved_entries,
+            'saved_evictions': self.saved_evictions,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'skipped_writes': self.skipped_writes
+        }
+
+
+_shared: Optional[VerificationResultCache] = None
+_shared_lock = threading.Lock()
+
+
+def get_verification_cache() -> VerificationResultCache:
+    """Caché compartida por los verificadores del proceso"""
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = VerificationResultCache()
+    return _shared
@@ -0,0 +1,459 @@
+"""
+TuCitaSegura - Cola de trabajos de verificación de fotos
+
+verify_user_photo ejecuta todo el pipeline de visión dentro de la petición:
+un usuario que sube seis fotos ocupa un worker durante segundos. Con
+PhotoVerificationJobQueue el endpoint encola las URLs y responde con los
+identificadores de trabajo; un pool de procesos (OpenCV solo libera el GIL
+en parte) descarga y analiza las fotos en segundo plano.
+
+- Carriles de prioridad: las fotos de perfil pasan por delante de las de
+  galería y de las re-verificaciones masivas (backfill)
+- Estado y resultado consultables por job_id (get_job) o por suscripción
+  (subscribe / wait)
+- Desglose de tiempos por trabajo: espera en cola, descarga, análisis y total
+- Al terminar, en un hilo aparte (no en el que recoge los resultados del
+  pool), se buscan duplicados en el índice de hashes perceptuales del
+  proceso principal (cargado al arrancar), se guarda el trabajo en
+  Firestore (photo_verification_jobs) y el resultado en la auditoría y el
+  perfil, como verify_photo
+
+Uso típico:
+
+    queue = get_photo_verification_queue()
+    job_id = queue.submit(url, user_id=user_id, lane='profile')
+    job = await queue.wait(job_id, timeout=30)
+"""
+
+import asyncio
+import atexit
+import itertools
+import logging
+import multiprocessing
+import os
+import queue as queue_module
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, TYPE_CHECKING
+
+from app.utils.cache import TTLCache
+
+if TYPE_CHECKING:
+    from app.services.cv.photo_verifier import PhotoVerification
+
+logger = logging.getLogger(__name__)
+
+# Carriles por orden de prioridad
+LANES = {'profile': 0, 'gallery': 1, 'backfill': 2}
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# Verificador del proceso del pool (se crea en _init_worker)
+_worker_verifier: Optional['PhotoVerification'] = None
+
+
+def _init_worker():
+    """Crear el verificador del proceso una sola vez (modelos y sesión HTTP calientes)"""
+    global _worker_verifier
+    from app.services.cv.photo_verifier import PhotoVerification
+    _worker_verifier = PhotoVerification()
+
+
+def _run_verification(verifier: 'PhotoVerification', image_url: str, claimed_age: Optional[int]) -> Dict:
+    """Descargar y analizar una foto midiendo cada fase"""
+    start_time = datetime.now()
+    started = time.perf_counter()
+    data = verifier._download_image_bytes(image_url)
+    downloaded = time.perf_counter()
+    if data is None:
+        result = verifier._create_error_result("No se pudo descargar o procesar la imagen")
+    else:
+        # Decodificación y análisis, o el resultado en caché si la foto ya se verificó
+        result = verifier.verify_image_bytes(data, claimed_age, start_time)
+    finished = time.perf_counter()
+    failed = result.recommendation == "ERROR"
+    return {
+        'result': result.__dict__,
+        'error': result.warnings[0] if failed else None,
+        'timings': {
+            'download_ms': (downloaded - started) * 1000,
+            'analysis_ms': (finished - downloaded) * 1000 if data is not None else 0.0
+        }
+    }
+
+
+def _verify_in_worker(image_url: str, claimed_age: Optional[int]) -> Dict:
+    """Verificación dentro del pool de procesos"""
+    if _worker_verifier is None:
+        _init_worker()
+    return _run_verification(_worker_verifier, image_url, claimed_age)
+
+
+@dataclass
+class PhotoVerificationJob:
+    """Trabajo de verificación de una foto"""
+    job_id: str
+    image_url: str
+    user_id: Optional[str]
+    claimed_age: Optional[int]
+    lane: str
+    status: str = STATUS_QUEUED
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[Dict] = None
+    error: Optional[str] = None
+    # queue_wait_ms, download_ms, analysis_ms, overhead_ms, total_ms
+    timings: Dict[str, float] = field(default_factory=dict)
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (STATUS_DONE, STATUS_FAILED)
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+class PhotoVerificationJobQueue:
+    """
+    Cola de verificación de fotos con carriles de prioridad sobre un pool de procesos
+    """
+
+    def __init__(
+        self,
+        verifier: Optional['PhotoVerification'] = None,
+        workers: Optional[int] = None,
+        persist: bool = True,
+        max_finished_jobs: int = 10000,
+        finished_ttl_seconds: int = 24 * 3600,
+        autostart: bool = True
+    ):
+        """
+        Args:
+            verifier: Verificador del proceso (guarda resultados; con workers=0 también analiza)
+            workers: Procesos del pool (None = nº de CPUs, 0 = en un hilo del propio proceso)
+            persist: Guardar trabajos y resultados en Firestore al terminar
+            max_finished_jobs: Trabajos terminados que se conservan en memoria
+            finished_ttl_seconds: Tiempo que se conserva un trabajo terminado
+            autostart: Arrancar el despachador al primer submit (False: esperar a start())
+        """
+        self._verifier = verifier
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.persist = persist
+        self.autostart = autostart
+        self._pending: 'queue_module.PriorityQueue' = queue_module.PriorityQueue()
+        self._sequence = itertools.count()
+        # Un hueco por proceso: la prioridad se decide cuando un proceso queda libre
+        self._slots = threading.Semaphore(max(self.workers, 1))
+        self._active: Dict[str, PhotoVerificationJob] = {}
+        self._finished = TTLCache(max_entries=max_finished_jobs, ttl_seconds=finished_ttl_seconds)
+        self._subscribers: Dict[str, List[Callable[[Dict], None]]] = {}
+        self._lock = threading.Lock()
+        self._executor: Optional[Executor] = None
+        # Duplicados y escrituras en Firestore fuera del hilo que recoge los resultados del pool
+        self._persist_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='photo-jobs-persist')
+        self._dispatcher: Optional[threading.Thread] = None
+        self._closed = False
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.lane_counts = {lane: 0 for lane in LANES}
+        self.total_timings = {'queue_wait_ms': 0.0, 'download_ms': 0.0, 'analysis_ms': 0.0, 'total_ms': 0.0}
+
+    @property
+    def verifier(self) -> 'PhotoVerification':
+        if self._verifier is None:
+            from app.services.cv.photo_verifier import PhotoVerification
+            self._verifier = PhotoVerification()
+        return self._verifier
+
+    def start(self):
+        """Arrancar el pool y el hilo despachador"""
+        with self._lock:
+            if self._dispatcher is not None or self._closed:
+                return
+            if self.workers == 0:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='photo-jobs')
+            else:
+                # spawn: no se heredan los hilos ni conexiones gRPC del proceso padre
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker
+                )
+            self._dispatcher = threading.Thread(target=self._dispatch, name='photo-jobs-dispatcher', daemon=True)
+            self._dispatcher.start()
+        # Antes que cualquier trabajo terminado (mismo hilo): la primera búsqueda no recorre Firestore
+        self._persist_executor.submit(self._warm_photo_index)
+
+    def _warm_photo_index(self):
+        """Mantener el índice de hashes perceptuales al día con photo_verifications"""
+        verifier = self.verifier
+        if verifier.db is None:
+            return
+        try:
+            verifier.photo_index.start_listener(verifier.db)
+        except Exception as e:
+            logger.error(f"[PhotoVerificationJobQueue] Error cargando el índice de hashes: {e}")
+
+    def submit(
+        self,
+        image_url: str,
+        user_id: Optional[str] = None,
+        claimed_age: Optional[int] = None,
+        lane: str = 'profile'
+    ) -> str:
+        """
+        Encolar la verificación de una foto
+
+        Args:
+            lane: 'profile', 'gallery' o 'backfill'
+
+        Returns:
+            Identificador del trabajo
+        """
+        if lane not in LANES:
+            raise ValueError(f"Carril desconocido: {lane}")
+        if self._closed:
+            raise RuntimeError("La cola de verificación está cerrada")
+
+        job = PhotoVerificationJob(
+            job_id=uuid.uuid4().hex,
+            image_url=image_url,
+            user_id=user_id,
+            claimed_age=claimed_age,
+            lane=lane
+        )
+        with self._lock:
+            self._active[job.job_id] = job
+            self.submitted += 1
+            self.lane_counts[lane] += 1
+        self._pending.put((LANES[lane], next(self._sequence), job.job_id))
+        if self.autostart:
+            self.start()
+        return job.job_id
+
+    def submit_many(self, image_urls: List[str], user_id: Optional[str] = None, claimed_age: Optional[int] = None, lane: str = 'gallery') -> List[str]:
+        """Encolar varias fotos del mismo usuario"""
+        return [self.submit(url, user_id, claimed_age, lane) for url in image_urls]
+
+    def get_job(self, job_id: str) -> Optional[Dict]:
+        """Estado del trabajo (None si no existe o ya caducó)"""
+        with self._lock:
+            job = self._active.get(job_id) or self._finished.get(job_id)
+            return job.to_dict() if job is not None else None
+
+    def subscribe(self, job_id: str, callback: Callable[[Dict], None]) -> bool:
+        """
+        Llamar a callback(job) cuando el trabajo termine (en el acto si ya terminó)
+
+        Returns:
+            False si el trabajo no existe
+        """
+        with self._lock:
+            job = self._active.get(job_id)
+            if job is not None:
+                self._subscribers.setdefault(job_id, []).append(callback)
+                return True
+            job = self._finished.get(job_id)
+        if job is None:
+            return False
+        callback(job.to_dict())
+        return True
+
+    async def wait(self, job_id: str, timeout: Optional[float] = None) -> Optional[Dict]:
+        """
+        Esperar sin bloquear el event loop a que el trabajo termine
+
+        Raises:
+            asyncio.TimeoutError: si no termina a tiempo
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(job: Dict):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(job))
+
+        if not self.subscribe(job_id, resolve):
+            return None
+        return await asyncio.wait_for(future, timeout)
+
+    def _dispatch(self):
+        while True:
+            self._slots.acquire()
+            _, _, job_id = self._pending.get()
+            if job_id is None:
+                self._slots.release()
+                return
+
+            with self._lock:
+                job = self._active[job_id]
+                job.status = STATUS_RUNNING
+                job.started_at = time.time()
+                job.timings['queue_wait_ms'] = (job.started_at - job.submitted_at) * 1000
+
+            try:
+                if self.workers == 0:
+                    future = self._executor.submit(_run_verification, self.verifier, job.image_url, job.claimed_age)
+                else:
+                    future = self._executor.submit(_verify_in_worker, job.image_url, job.claimed_age)
+            except Exception as e:
+                self._complete(job_id, None, e)
+                continue
+            future.add_done_callback(lambda done, job_id=job_id: self._on_done(job_id, done))
+
+    def _on_done(self, job_id: str, future: Future):
+        try:
+            output, error = future.result(), None
+        except (Exception, CancelledError) as e:
+            output, error = None, e
+        self._complete(job_id, output, error)
+
+    def _complete(self, job_id: str, output: Optional[Dict], error: Optional[Exception]):
+        """Liberar el hueco del pool y terminar el trabajo en el hilo de persistencia"""
+        self._slots.release()
+        try:
+            self._persist_executor.submit(self._finish, job_id, output, error)
+        except RuntimeError:
+            # Cola ya cerrada (close con wait=False): terminar aquí mismo
+            self._finish(job_id, output, error)
+
+    def _finish(self, job_id: str, output: Optional[Dict], error: Optional[Exception]):
+        with self._lock:
+            job = self._active[job_id]
+            user_id, image_url = job.user_id, job.image_url
+        if user_id and error is None and not output['error']:
+            # El índice de hashes perceptuales vive en este proceso, no en el pool
+            try:
+                from app.services.cv.photo_verifier import PhotoVerificationResult
+                result = PhotoVerificationResult(**output['result'])
+                self.verifier.check_duplicate_photo(result, user_id, image_url)
+                output['result'] = result.__dict__
+            except Exception as e:
+                logger.error(f"[PhotoVerificationJobQueue] Error buscando duplicados del trabajo {job_id}: {e}")
+        with self._lock:
+            job = self._active.pop(job_id)
+            job.finished_at = time.time()
+            total_ms = (job.finished_at - job.submitted_at) * 1000
+            if error is None:
+                job.status = STATUS_FAILED if output['error'] else STATUS_DONE
+                job.error = output['error']
+                job.result = output['result']
+                job.timings.update(output['timings'])
+                # Serialización, arranque del proceso y espera del pool
+                job.timings['overhead_ms'] = max(
+                    (job.finished_at - job.started_at) * 1000
+                    - output['timings']['download_ms'] - output['timings']['analysis_ms'], 0.0
+                )
+                if output['error']:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+            else:
+                job.status = STATUS_FAILED
+                job.error = str(error)
+                self.failed += 1
+                logger.error(f"[PhotoVerificationJobQueue] Error en el trabajo {job_id}: {error}")
+            job.timings['total_ms'] = total_ms
+            for key in self.total_timings:
+                self.total_timings[key] += job.timings.get(key, 0.0)
+            self._finished.set(job_id, job)
+            subscribers = self._subscribers.pop(job_id, [])
+
+        if self.persist:
+            self._persist(job)
+        snapshot = job.to_dict()
+        for callback in subscribers:
+            try:
+                callback(snapshot)
+            except Exception as e:
+                logger.error(f"[PhotoVerificationJobQueue] Error notificando el trabajo {job_id}: {e}")
+
+    def _persist(self, job: PhotoVerificationJob):
+        """Guardar el trabajo por job_id y el resultado en auditoría y perfil"""
+        verifier = self.verifier
+        if verifier.db is None:
+            return
+        try:
+            verifier.audit_writer.set('photo_verification_jobs', job.job_id, job.to_dict())
+            if job.user_id and job.result and job.result.get('recommendation') != "ERROR":
+                from app.services.cv.photo_verifier import PhotoVerificationResult
+                verifier._save_verification_result(job.user_id, job.image_url, PhotoVerificationResult(**job.result))
+        except Exception as e:
+            logger.error(f"[PhotoVerificationJobQueue] Error guardando el trabajo {job.job_id}: {e}")
+
+    def close(self, wait: bool = True):
+        """
+        Detener el despachador y el pool
+
+        Con wait=True terminan los trabajos pendientes; con wait=False se
+        cancelan los que el pool aún no ha empezado.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            dispatcher = self._dispatcher
+        if dispatcher is not None:
+            # Centinela con prioridad mínima: se atiende tras los trabajos pendientes
+            self._pending.put((len(LANES), next(self._sequence), None))
+            if wait:
+                dispatcher.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=not wait)
+        self._persist_executor.shutdown(wait=wait)
+
+    def get_stats(self) -> Dict:
+        """Trabajos por estado y carril, y tiempos medios por fase"""
+        with self._lock:
+            finished = self.completed + self.failed
+            return {
+                'workers': self.workers,
+                'submitted': self.submitted,
+                'queued': self._pending.qsize(),
+                'running': sum(1 for job in self._active.values() if job.status == STATUS_RUNNING),
+                'completed': self.completed,
+                'failed': self.failed,
+                'lanes': dict(self.lane_counts),
+                'avg_timings_ms': {
+                    key: total / finished if finished else 0.0 for key, total in self.total_timings.items()
+                }
+            }
+
+
+_shared: Optional[PhotoVerificationJobQueue] = None
+_shared_lock = threading.Lock()
+
+
+def get_photo_verification_queue() -> PhotoVerificationJobQueue:
+    """Cola compartida por los endpoints de fotos (se crea al primer uso y se cierra al salir)"""
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = PhotoVerificationJobQueue()
+                # Sin esperar a los trabajos en cola: solo que el pool no quede huérfano
+                atexit.register(_shared.close, False)
+    return _shared
+
+
+def submit_photo_verification(
+    image_url: str,
+    user_id: Optional[str] = None,
+    claimed_age: Optional[int] = None,
+    lane: str = 'profile'
+) -> str:
+    """Encolar una foto en la cola compartida y devolver el job_id"""
+    return get_photo_verification_queue().submit(image_url, user_id, claimed_age, lane)
+
+
+def get_photo_verification_job(job_id: str) -> Optional[Dict]:
+    """Estado de un trabajo de la cola compartida"""
+    return get_photo_verification_queue().get_job(job_id)
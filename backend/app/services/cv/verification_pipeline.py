@@ -0,0 +1,229 @@
+"""
+TuCitaSegura - Pipeline de verificación de fotos por etapas
+
+Cada etapa declara su coste aproximado y los campos que aporta (y los que
+necesita). VerificationPipeline las ejecuta de la más barata a la más cara
+y, tras cada una, acota el score final con los campos ya conocidos: cuando
+ninguna combinación de los resultados pendientes puede cambiar la
+recomendación, el resto de etapas se omite.
+
+El tráfico de altas falsas suele rechazarse con las etapas baratas
+(persona real, señales de color del contenido) sin llegar a los filtros ni
+a la extracción de texto.
+
+Sin omisiones, el resultado es idéntico al de ejecutar todas las etapas.
+"""
+
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, TYPE_CHECKING
+
+from app.services.cv.image_context import ImageAnalysisContext
+
+if TYPE_CHECKING:
+    from app.services.cv.photo_verifier import PhotoVerification
+
+# Versión de los análisis y umbrales: forma parte de la clave de la caché de
+# resultados, así que hay que subirla con cualquier cambio que altere un resultado
+PIPELINE_VERSION = "2026.10-1"
+
+# (verificador, contexto de la imagen, campos ya calculados) -> campos nuevos
+StageFunction = Callable[['PhotoVerification', ImageAnalysisContext, Dict], Dict]
+
+
+@dataclass(frozen=True)
+class VerificationStage:
+    """Etapa del pipeline"""
+    name: str
+    cost: float  # ms aproximados en una foto de 1024 px
+    provides: Tuple[str, ...]
+    run: StageFunction
+    requires: Tuple[str, ...] = ()
+
+
+@dataclass
+class PipelineRun:
+    """Campos calculados, tiempos por etapa y decisión anticipada"""
+    fields: Dict
+    timings_ms: Dict[str, float] = field(default_factory=dict)
+    skipped: List[str] = field(default_factory=list)
+    recommendation: Optional[str] = None  # Solo si se omitieron etapas
+    score_bounds: Optional[Tuple[float, float]] = None
+
+
+def _faces(verifier: 'PhotoVerification', image: ImageAnalysisContext, fields: Dict) -> Dict:
+    return {'faces': verifier._detect_faces(image)}
+
+
+def _real_person(verifier: 'PhotoVerification', image: ImageAnalysisContext, fields: Dict) -> Dict:
+    return {'is_real': verifier._verify_real_person(image, fields['faces'])}
+
+
+def _age(verifier: 'PhotoVerification', image: ImageAnalysisContext, fields: Dict) -> Dict:
+    age_result = verifier._estimate_age(image, fields['faces'])
+    return {
+        'age_result': age_result,
+        'age_consistency': verifier._check_age_consistency(fields['claimed_age'], age_result)
+    }
+
+
+def _content_color(verifier: 'PhotoVerification', image: ImageAnalysisContext, fields: Dict) -> Dict:
+    return {'content_color': verifier._analyze_content_color(image)}
+
+
+def _quality(verifier: 'PhotoVerification', image: ImageAnalysisContext, fields: Dict) -> Dict:
+    return {'quality_score': verifier._assess_image_quality(image)}
+
+
+def _filters(verifier: 'PhotoVerification', image: ImageAnalysisContext, fields: Dict) -> Dict:
+    return {'filter_result': verifier._detect_filters(image)}
+
+
+def _content_text(verifier: 'PhotoVerification', image: ImageAnalysisContext, fields: Dict) -> Dict:
+    return {'content_text': verifier._analyze_content_text(image)}
+
+
+# Costes medidos sobre fotos de 1024x768 con el contexto de derivadas en frío
+DEFAULT_STAGES: Tuple[VerificationStage, ...] = (
+    VerificationStage('faces', 0.1, ('faces',), _faces),
+    VerificationStage('age', 0.3, ('age_result', 'age_consistency'), _age, requires=('faces',)),
+    VerificationStage('content_color', 1.0, ('content_color',), _content_color),
+    VerificationStage('real_person', 2.0, ('is_real',), _real_person, requires=('faces',)),
+    VerificationStage('quality', 2.5, ('quality_score',), _quality),
+    VerificationStage('filters', 6.0, ('filter_result',), _filters),
+    VerificationStage('content_text', 7.0, ('content_text',), _content_text),
+)
+
+
+def order_stages(stages: Sequence[VerificationStage]) -> List[VerificationStage]:
+    """Orden de ejecución: siempre la etapa más barata con sus requisitos cumplidos"""
+    pending = list(stages)
+    available = {'claimed_age'}
+    ordered = []
+    while pending:
+        ready = [stage for stage in pending if set(stage.requires) <= available]
+        if not ready:
+            names = ', '.join(stage.name for stage in pending)
+            raise ValueError(f"Etapas con requisitos que ninguna etapa aporta: {names}")
+        stage = min(ready, key=lambda candidate: candidate.cost)
+        pending.remove(stage)
+        available.update(stage.provides)
+        ordered.append(stage)
+    return ordered
+
+
+class VerificationPipeline:
+    """
+    Ejecución ordenada por coste con salida anticipada
+    """
+
+    def __init__(self, stages: Sequence[VerificationStage] = DEFAULT_STAGES, early_exit: bool = True):
+        """
+        Args:
+            stages: Etapas del pipeline
+            early_exit: Omitir las etapas que ya no pueden cambiar la recomendación
+        """
+        self.stages = order_stages(stages)
+        self.early_exit = early_exit
+
+    def run(self, verifier: 'PhotoVerification', image: ImageAnalysisContext, claimed_age: Optional[int]) -> PipelineRun:
+        run = PipelineRun(fields={'claimed_age': claimed_age})
+        for position, stage in enumerate(self.stages):
+            started = time.perf_counter()
+            run.fields.update(stage.run(verifier, image, run.fields))
+            run.timings_ms[stage.name] = (time.perf_counter() - started) * 1000
+
+            remaining = self.stages[position + 1:]
+            if not self.early_exit or not remaining:
+                continue
+            bounds = self.score_bounds(verifier, run.fields)
+            recommendation = self.decided_recommendation(verifier, run.fields, bounds)
+            if recommendation is not None:
+                run.skipped = [pending.name for pending in remaining]
+                run.recommendation = recommendation
+                run.score_bounds = bounds
+                break
+        return run
+
+    @staticmethod
+    def _filter_options(fields: Dict) -> List:
+        from app.services.cv.photo_verifier import FilterDetection
+
+        if 'filter_result' in fields:
+            return [fields['filter_result']]
+        return [
+            FilterDetection(has_filters=False, filter_intensity=0.0, filter_types=[], editing_score=0.0, is_ai_generated=False),
+            FilterDetection(has_filters=True, filter_intensity=1.0, filter_types=[], editing_score=1.0, is_ai_generated=False)
+        ]
+
+    @staticmethod
+    def _content_options(verifier: 'PhotoVerification', fields: Dict) -> List:
+        from app.services.cv.photo_verifier import ContentAnalysis
+
+        color = fields.get('content_color', {})
+        if 'content_color' in fields and 'content_text' in fields:
+            return [verifier._combine_content_analysis(fields['content_color'], fields['content_text'])]
+        # Con piel expuesta o violencia ya es inapropiado (_analyze_content_text
+        # no devuelve error: sus funciones capturan sus propias excepciones)
+        if color and (color['nudity_detected'] or color['violence_detected']):
+            appropriate = [False]
+        else:
+            appropriate = [True, False]
+        return [
+            ContentAnalysis(
+                is_appropriate=value, inappropriate_flags=[], nudity_detected=False, violence_detected=False,
+                spam_detected=False, contains_text=False, text_content=""
+            )
+            for value in appropriate
+        ]
+
+    @staticmethod
+    def _age_options(verifier: 'PhotoVerification', fields: Dict) -> List[Dict]:
+        from app.services.cv.photo_verifier import AgeEstimation
+
+        if 'age_consistency' in fields:
+            return [fields['age_consistency']]
+        claimed_age = fields['claimed_age']
+        options = [verifier._check_age_consistency(claimed_age, None)]
+        if claimed_age is not None:
+            # Estimaciones a distintas distancias cubren todas las confianzas posibles
+            for difference in (0, 5, 10):
+                estimate = AgeEstimation(claimed_age + difference, (0, 0), 0.0, '')
+                options.append(verifier._check_age_consistency(claimed_age, estimate))
+        return options
+
+    def score_bounds(self, verifier: 'PhotoVerification', fields: Dict) -> Tuple[float, float]:
+        """Score mínimo y máximo alcanzables con los campos pendientes"""
+        real_options = [fields['is_real']] if 'is_real' in fields else [False, True]
+        quality_options = [fields['quality_score']] if 'quality_score' in fields else [0.0, 1.0]
+        # El score es creciente en cada componente: basta con los extremos
+        scores = [
+            verifier._calculate_verification_score(is_real, filter_result, content, quality, age)
+            for is_real in (min(real_options), max(real_options))
+            for filter_result in self._filter_options(fields)
+            for content in self._content_options(verifier, fields)
+            for quality in (min(quality_options), max(quality_options))
+            for age in self._age_options(verifier, fields)
+        ]
+        return min(scores), max(scores)
+
+    def decided_recommendation(
+        self,
+        verifier: 'PhotoVerification',
+        fields: Dict,
+        bounds: Tuple[float, float]
+    ) -> Optional[str]:
+        """
+        Recomendación si ya no puede cambiar, None si depende de etapas pendientes
+
+        La recomendación solo depende del score (por umbrales) y, por encima de
+        ellos, de la intensidad de filtros y del contenido: si coincide en los
+        dos extremos del score para todas las opciones pendientes, es definitiva.
+        """
+        recommendations = {
+            verifier._generate_recommendation(score, filter_result, content)
+            for score in bounds
+            for filter_result in self._filter_options(fields)
+            for content in self._content_options(verifier, fields)
+        }
+        return recommendations.pop() if len(recommendations) == 1 else None
@@ -2,6 +2,8 @@ import logging
 import math
 import requests
 import json
+import itertools
+import threading
 from typing import Dict, List, Optional, Tuple
 from dataclasses import dataclass
 from datetime import datetime, timedelta
@@ -9,6 +11,8 @@ import numpy as np
 from geopy.distance import geodesic
 from geopy.geocoders import GoogleV3
 
+from app.services.geo.spatial_index import GeoGridIndex, haversine_km
+
 logger = logging.getLogger(__name__)
 
 @dataclass
@@ -38,10 +42,124 @@ class LocationVerification:
     confidence: float
     factors: List[str]
 
+# Máximo de resultados de una llamada a Places Nearby Search (sin paginar)
+PLACES_PAGE_SIZE = 20
+
+
+class NearbyPlacesCache:
+    """
+    Caché de resultados de Google Places indexada espacialmente
+
+    Guarda las áreas ya consultadas (centro + radio); una búsqueda cuyo círculo
+    queda dentro de un área reciente se responde desde el índice sin llamar a la API.
+
+    Nearby Search devuelve como mucho 20 lugares por llamada: si la respuesta
+    venía truncada (20 resultados o next_page_token), el área es solo una
+    muestra y únicamente responde a la misma consulta (mismo centro y radio),
+    no a las que caben dentro de ella.
+
+    Los centros de las áreas van en su propio índice por celdas: un área solo
+    puede cubrir la consulta si su centro está a menos de su radio, así que
+    basta con mirar las celdas a menos del mayor radio registrado.
+    """
+
+    def __init__(self, ttl_minutes: int = 360, cell_size_deg: float = 0.01):
+        self.ttl = timedelta(minutes=ttl_minutes)
+        self.index = GeoGridIndex(cell_size_deg)
+        self._places: Dict[str, Tuple[Dict, datetime]] = {}
+        # Centros de las áreas consultadas (area_id -> lat/lng)
+        self.area_index = GeoGridIndex(cell_size_deg)
+        # area_id -> (radio, fecha, completa), en orden de consulta
+        self._areas: Dict[int, Tuple[float, datetime, bool]] = {}
+        self._area_ids = itertools.count()
+        self._max_area_radius = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _covered(self, lat: float, lng: float, radius_km: float, now: datetime) -> bool:
+        for area_id, distance in self.area_index.query_radius(lat, lng, self._max_area_radius):
+            area_radius, fetched_at, complete = self._areas[area_id]
+            if now - fetched_at > self.ttl:
+                continue
+            if complete and distance + radius_km <= area_radius:
+                return True
+            # Área truncada: solo la misma consulta (a menos de 1 m)
+            if distance <= 0.001 and abs(radius_km - area_radius) <= 0.001:
+                return True
+        return False
+
+    def get(self, lat: float, lng: float, radius_km: float) -> Optional[List[Dict]]:
+        """Lugares dentro del radio si el área ya fue consultada recientemente"""
+        now = datetime.now()
+        with self._lock:
+            if not self._covered(lat, lng, radius_km, now):
+                self.misses += 1
+                return None
+            self.hits += 1
+            places = []
+            for place_id, _ in self.index.query_radius(lat, lng, radius_km):
+                place, fetched_at = self._places[place_id]
+                if now - fetched_at <= self.ttl:
+                    places.append(place)
+            return places
+
+    def add(self, lat: float, lng: float, radius_km: float, places: List[Dict], complete: bool = True):
+        """
+        Registrar el resultado de una búsqueda por área
+
+        Args:
+            complete: False si alguna respuesta venía truncada (ver la clase)
+        """
+        now = datetime.now()
+        with self._lock:
+            # Desalojar áreas y lugares caducados (del diccionario y del índice)
+            self._evict_areas(now)
+            expired = [place_id for place_id, (_, fetched_at) in self._places.items() if now - fetched_at > self.ttl]
+            for place_id in expired:
+                del self._places[place_id]
+                self.index.remove(place_id)
+            area_id = next(self._area_ids)
+            if self.area_index.insert(area_id, lat, lng):
+                self._areas[area_id] = (radius_km, now, complete)
+                self._max_area_radius = max(self._max_area_radius, radius_km)
+            for place in places:
+                place_id = place.get('place_id')
+                location = place.get('geometry', {}).get('location', {})
+                if place_id and self.index.insert(place_id, location.get('lat'), location.get('lng')):
+                    self._places[place_id] = (place, now)
+
+    def _evict_areas(self, now: datetime):
+        """Quitar las áreas caducadas (las más antiguas van primero)"""
+        expired = []
+        for area_id, (_, fetched_at, _) in self._areas.items():
+            if now - fetched_at <= self.ttl:
+                break
+            expired.append(area_id)
+        for area_id in expired:
+            del self._areas[area_id]
+            self.area_index.remove(area_id)
+        if expired:
+            self._max_area_radius = max((area[0] for area in self._areas.values()), default=0.0)
+
+    def clear(self):
+        with self._lock:
+            self._areas.clear()
+            self._places.clear()
+            self._max_area_radius = 0.0
+            self.index = GeoGridIndex(self.index.cell_size_deg)
+            self.area_index = GeoGridIndex(self.area_index.cell_size_deg)
+
+
+# Caché compartida entre instancias de LocationIntelligence
+nearby_places_cache = NearbyPlacesCache()
+
+
 class LocationIntelligence:
-    def __init__(self, google_api_key: str):
+    def __init__(self, google_api_key: str, places_cache: Optional[NearbyPlacesCache] = None):
         self.google_api_key = google_api_key
         self.geocoder = GoogleV3(api_key=google_api_key)
+        self.places_cache = places_cache if places_cache is not None else nearby_places_cache
         
         # Criterios de seguridad para lugares de encuentro
         self.safety_criteria = {
@@ -193,6 +311,12 @@ class LocationIntelligence:
             lat, lng = location
             radius_meters = int(radius_km * 1000)
             
+            # Responder desde la caché espacial si el área ya fue consultada
+            cached_places = self.places_cache.get(lat, lng, radius_km)
+            if cached_places is not None:
+                logger.info(f"Found {len(cached_places)} cached places near {location}")
+                return cached_places
+            
             # Tipos de lugares a buscar
             place_types = [
                 'cafe', 'restaurant', 'bar', 'bakery', 'shopping_mall',
@@ -200,6 +324,8 @@ class LocationIntelligence:
             ]
             
             all_places = []
+            all_ok = True
+            truncated = False
             
             for place_type in place_types:
                 url = (
@@ -213,6 +339,13 @@ class LocationIntelligence:
                     data = response.json()
                     if data.get('results'):
                         all_places.extend(data['results'])
+                    # Página llena o con más páginas: el área no está completa
+                    if len(data.get('results') or []) >= PLACES_PAGE_SIZE or data.get('next_page_token'):
+                        truncated = True
+                    if data.get('status') not in ('OK', 'ZERO_RESULTS'):
+                        all_ok = False
+                else:
+                    all_ok = False
             
             # Eliminar duplicados
             seen_places = {}
@@ -223,6 +356,10 @@ class LocationIntelligence:
                     seen_places[place_id] = True
                     unique_places.append(place)
             
+            # Solo se cachean búsquedas completas
+            if all_ok:
+                self.places_cache.add(lat, lng, radius_km, unique_places, complete=not truncated)
+            
             logger.info(f"Found {len(unique_places)} unique places near {location}")
             return unique_places
             
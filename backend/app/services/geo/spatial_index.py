@@ -0,0 +1,169 @@
+"""
+TuCitaSegura - Índice espacial en rejilla
+
+Rejilla regular de celdas lat/lng para recuperar puntos dentro de un radio:
+solo se visitan las celdas que cubre el bounding box del círculo, se aplica
+un pre-filtro barato por bounding box y después la distancia Haversine exacta.
+
+Lo usan el índice de candidatos de MatchingEngine, VIPEventsManager y la
+caché de lugares de LocationIntelligence.
+"""
+
+import math
+import threading
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+# Kilómetros por grado de latitud (esfera de radio EARTH_RADIUS_KM)
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+Cell = Tuple[int, int]
+
+
+def haversine_km(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """Distancia Haversine vectorizada en km (inf para coordenadas inválidas)"""
+    lat1, lng1, lat2, lng2 = map(np.radians, [lat1, lng1, lat2, lng2])
+    dlat = lat2 - lat1
+    dlng = lng2 - lng1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
+    distance = 2 * np.arcsin(np.sqrt(a)) * EARTH_RADIUS_KM
+    distance = np.array(distance, dtype=np.float64, ndmin=1)
+    distance[~np.isfinite(distance)] = np.inf
+    return distance
+
+
+def bounding_box(lat: float, lng: float, radius_km: float) -> Tuple[float, float, float, float]:
+    """
+    Bounding box (lat_min, lat_max, lng_min, lng_max) que contiene el círculo
+
+    Cerca de los polos, o si el radio cubre todas las longitudes, el rango de
+    longitud se amplía a [-180, 180].
+    """
+    dlat = radius_km / KM_PER_DEGREE
+    lat_min, lat_max = max(-90.0, lat - dlat), min(90.0, lat + dlat)
+
+    cos_lat = math.cos(math.radians(max(abs(lat_min), abs(lat_max))))
+    if cos_lat <= 1e-9:
+        return lat_min, lat_max, -180.0, 180.0
+    dlng = radius_km / (KM_PER_DEGREE * cos_lat)
+    if dlng >= 180:
+        return lat_min, lat_max, -180.0, 180.0
+    return lat_min, lat_max, lng - dlng, lng + dlng
+
+
+class GeoGridIndex:
+    """
+    Índice de puntos (clave -> lat/lng) sobre una rejilla de celdas en grados
+    """
+
+    def __init__(self, cell_size_deg: float = 0.1):
+        """
+        Args:
+            cell_size_deg: Lado de la celda en grados (0.1° ≈ 11 km de latitud)
+        """
+        self.cell_size_deg = cell_size_deg
+        self._columns = int(math.ceil(360 / cell_size_deg))
+        self._lock = threading.RLock()
+        self._points: Dict[Hashable, Tuple[float, float]] = {}
+        self._cells: Dict[Cell, Set[Hashable]] = {}
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._points
+
+    def _cell(self, lat: float, lng: float) -> Cell:
+        row = int(math.floor((lat + 90) / self.cell_size_deg))
+        col = int(math.floor((lng + 180) / self.cell_size_deg)) % self._columns
+        return row, col
+
+    def insert(self, key: Hashable, lat: float, lng: float) -> bool:
+        """Insertar o mover un punto; devuelve False si las coordenadas no son válidas"""
+        try:
+            lat, lng = float(lat), float(lng)
+        except (TypeError, ValueError):
+            self.remove(key)
+            return False
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            self.remove(key)
+            return False
+
+        cell = self._cell(lat, lng)
+        with self._lock:
+            previous = self._points.get(key)
+            if previous is not None:
+                previous_cell = self._cell(*previous)
+                if previous_cell != cell:
+                    self._discard(previous_cell, key)
+            self._points[key] = (lat, lng)
+            self._cells.setdefault(cell, set()).add(key)
+        return True
+
+    def remove(self, key: Hashable):
+        """Eliminar un punto del índice"""
+        with self._lock:
+            previous = self._points.pop(key, None)
+            if previous is not None:
+                self._discard(self._cell(*previous), key)
+
+    def _discard(self, cell: Cell, key: Hashable):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(key)
+            if not members:
+                del self._cells[cell]
+
+    def get(self, key: Hashable) -> Optional[Tuple[float, float]]:
+        return self._points.get(key)
+
+    def _cells_in_box(self, lat_min: float, lat_max: float, lng_min: float, lng_max: float) -> Iterable[Cell]:
+        row_min, col_min = self._cell(lat_min, -180)[0], int(math.floor((lng_min + 180) / self.cell_size_deg))
+        row_max, col_max = self._cell(lat_max, -180)[0], int(math.floor((lng_max + 180) / self.cell_size_deg))
+        col_span = min(col_max - col_min + 1, self._columns)
+
+        # Con pocas celdas ocupadas es más barato recorrer las existentes
+        if (row_max - row_min + 1) * col_span > len(self._cells):
+            for row, col in list(self._cells):
+                if row_min <= row <= row_max and (col - col_min) % self._columns < col_span:
+                    yield row, col
+            return
+
+        for row in range(row_min, row_max + 1):
+            for offset in range(col_span):
+                yield row, (col_min + offset) % self._columns
+
+    def query_radius(self, lat: float, lng: float, radius_km: float) -> List[Tuple[Hashable, float]]:
+        """
+        Puntos a menos de radius_km de (lat, lng)
+
+        Returns:
+            Lista de (clave, distancia_km) ordenada por distancia
+        """
+        lat_min, lat_max, lng_min, lng_max = bounding_box(lat, lng, radius_km)
+        wraps = lng_min < -180 or lng_max > 180
+
+        keys = []
+        coords = []
+        with self._lock:
+            for cell in self._cells_in_box(lat_min, lat_max, lng_min, lng_max):
+                for key in self._cells.get(cell, ()):
+                    point_lat, point_lng = self._points[key]
+                    # Pre-filtro por bounding box antes de la distancia exacta
+                    if not (lat_min <= point_lat <= lat_max):
+                        continue
+                    if not wraps and not (lng_min <= point_lng <= lng_max):
+                        continue
+                    keys.append(key)
+                    coords.append((point_lat, point_lng))
+
+        if not keys:
+            return []
+
+        points = np.asarray(coords, dtype=np.float64)
+        distances = haversine_km(lat, lng, points[:, 0], points[:, 1])
+        inside = np.flatnonzero(distances <= radius_km)
+        inside = inside[np.argsort(distances[inside], kind='stable')]
+        return [(keys[i], float(distances[i])) for i in inside]
@@ -0,0 +1,422 @@
+"""
+TuCitaSegura - Scoring vectorizado de candidatos
+
+Empaqueta el pool de candidatos en columnas NumPy (edad, lat/lng, actividad,
+reputación, ordinales de verificación y educación, códigos de estilo de vida
+y bitsets de intereses) y calcula los scores de contenido, geográfico y de
+comportamiento de todo el pool con unas pocas operaciones de arrays.
+
+Los resultados replican la lógica escalar de MatchingEngine
+(_calculate_content_score, _calculate_geographic_score,
+_calculate_behavioral_score, _calculate_distance y _predict_success_rate).
+"""
+
+import numpy as np
+from typing import Dict, List, Optional, Sequence, TYPE_CHECKING
+from dataclasses import dataclass
+import logging
+
+from app.services.geo.spatial_index import haversine_km
+
+if TYPE_CHECKING:
+    from app.services.ml.recommendation_engine import UserProfile
+
+logger = logging.getLogger(__name__)
+
+# Tablas compartidas con la implementación escalar de MatchingEngine
+EDUCATION_LEVELS = ['none', 'high_school', 'bachelor', 'master', 'phd']
+VERIFICATION_LEVELS = {'none': 0, 'email': 1, 'phone': 2, 'identity': 3, 'premium': 4}
+LIFESTYLE_FACTORS = ['smoking', 'drinking', 'exercise', 'religion', 'politics']
+NO_PREFERENCE = 'no_preference'
+
+# Tabla de popcount por byte para contar bits en los bitsets de intereses
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class CodeBook:
+    """Diccionario incremental valor -> código entero"""
+
+    def __init__(self, reserved: Sequence[str] = ()):
+        self._codes: Dict[str, int] = {}
+        for value in reserved:
+            self.code(value)
+
+    def code(self, value) -> int:
+        """Obtener (o asignar) el código de un valor"""
+        code = self._codes.get(value)
+        if code is None:
+            code = len(self._codes)
+            self._codes[value] = code
+        return code
+
+    def lookup(self, value) -> int:
+        """Obtener el código de un valor sin asignarlo (-1 si no existe)"""
+        return self._codes.get(value, -1)
+
+    def __len__(self) -> int:
+        return len(self._codes)
+
+
+def _education_ordinal(level) -> int:
+    """Ordinal educativo (-1 si el nivel no es reconocido)"""
+    try:
+        return EDUCATION_LEVELS.index(level.lower())
+    except (ValueError, AttributeError):
+        return -1
+
+
+def _location_coords(location) -> tuple:
+    """Extraer (lat, lng) de un dict de ubicación (inf si no es válido)"""
+    try:
+        return float(location.get('lat', 0)), float(location.get('lng', 0))
+    except (AttributeError, TypeError, ValueError):
+        return float('inf'), float('inf')
+
+
+def popcount_rows(bits: np.ndarray) -> np.ndarray:
+    """Contar bits activos por fila de una matriz de palabras uint64"""
+    if bits.shape[1] == 0:
+        return np.zeros(bits.shape[0], dtype=np.int64)
+    as_bytes = np.ascontiguousarray(bits).view(np.uint8)
+    return _POPCOUNT_TABLE[as_bytes].sum(axis=1, dtype=np.int64)
+
+
+@dataclass
+class CandidateColumns:
+    """Pool de candidatos empaquetado en columnas NumPy"""
+    profiles: List['UserProfile']
+    ids: np.ndarray             # object, user_id de cada fila
+    age: np.ndarray             # float64
+    lat: np.ndarray             # float64 (grados)
+    lng: np.ndarray             # float64 (grados)
+    activity: np.ndarray        # float64
+    reputation: np.ndarray      # float64
+    verification: np.ndarray    # int8, ordinal de VERIFICATION_LEVELS
+    education: np.ndarray       # int8, ordinal de EDUCATION_LEVELS (-1 desconocido)
+    goals: np.ndarray           # int32, código de relationship_goals
+    lifestyle: np.ndarray       # int32 (n, 5), código por factor (0 = no_preference)
+    interest_bits: np.ndarray   # uint64 (n, palabras), bitset de intereses
+    interest_len: np.ndarray    # int32, longitud de la lista de intereses
+    interests_book: CodeBook
+    goals_book: CodeBook
+    lifestyle_book: CodeBook
+
+    def __len__(self) -> int:
+        return len(self.profiles)
+
+    @classmethod
+    def from_profiles(
+        cls,
+        profiles: Sequence['UserProfile'],
+        interests_book: Optional[CodeBook] = None,
+        goals_book: Optional[CodeBook] = None,
+        lifestyle_book: Optional[CodeBook] = None,
+        extra_interests: Sequence[str] = ()
+    ) -> 'CandidateColumns':
+        """
+        Empaquetar perfiles en columnas
+
+        Args:
+            profiles: Perfiles de candidatos
+            interests_book / goals_book / lifestyle_book: Codebooks a reutilizar
+            extra_interests: Intereses a registrar en el vocabulario aunque
+                ningún candidato los tenga (p.ej. los del usuario objetivo)
+        """
+        profiles = list(profiles)
+        n = len(profiles)
+        interests_book = interests_book if interests_book is not None else CodeBook()
+        goals_book = goals_book if goals_book is not None else CodeBook()
+        lifestyle_book = lifestyle_book if lifestyle_book is not None else CodeBook([NO_PREFERENCE])
+
+        for interest in extra_interests:
+            interests_book.code(interest)
+
+        ids = np.empty(n, dtype=object)
+        age = np.empty(n, dtype=np.float64)
+        lat = np.empty(n, dtype=np.float64)
+        lng = np.empty(n, dtype=np.float64)
+        activity = np.empty(n, dtype=np.float64)
+        reputation = np.empty(n, dtype=np.float64)
+        verification = np.empty(n, dtype=np.int8)
+        education = np.empty(n, dtype=np.int8)
+        goals = np.empty(n, dtype=np.int32)
+        lifestyle = np.empty((n, len(LIFESTYLE_FACTORS)), dtype=np.int32)
+        interest_len = np.empty(n, dtype=np.int32)
+        interest_codes: List[List[int]] = []
+
+        for i, profile in enumerate(profiles):
+            ids[i] = profile.user_id
+            age[i] = profile.age
+            lat[i], lng[i] = _location_coords(profile.location)
+            activity[i] = profile.activity_score
+            reputation[i] = profile.reputation_score
+            verification[i] = VERIFICATION_LEVELS.get(profile.verification_level, 0)
+            education[i] = _education_ordinal(profile.education_level)
+            goals[i] = goals_book.code(profile.relationship_goals)
+            for j, factor in enumerate(LIFESTYLE_FACTORS):
+                lifestyle[i, j] = lifestyle_book.code(getattr(profile, factor, NO_PREFERENCE))
+            interest_len[i] = len(profile.interests)
+            interest_codes.append([interests_book.code(interest) for interest in profile.interests])
+
+        words = max(1, (len(interests_book) + 63) // 64)
+        interest_bits = np.zeros((n, words), dtype=np.uint64)
+        for i, codes in enumerate(interest_codes):
+            for code in codes:
+                interest_bits[i, code >> 6] |= np.uint64(1) << np.uint64(code & 63)
+
+        return cls(
+            profiles=profiles, ids=ids, age=age, lat=lat, lng=lng,
+            activity=activity, reputation=reputation,
+            verification=verification, education=education, goals=goals,
+            lifestyle=lifestyle, interest_bits=interest_bits, interest_len=interest_len,
+            interests_book=interests_book, goals_book=goals_book,
+            lifestyle_book=lifestyle_book
+        )
+
+    def take(self, indices: np.ndarray) -> 'CandidateColumns':
+        """Sub-pool con las filas indicadas (mismos codebooks)"""
+        indices = np.asarray(indices, dtype=np.int64)
+        return CandidateColumns(
+            profiles=[self.profiles[i] for i in indices],
+            ids=self.ids[indices], age=self.age[indices], lat=self.lat[indices], lng=self.lng[indices],
+            activity=self.activity[indices], reputation=self.reputation[indices],
+            verification=self.verification[indices], education=self.education[indices],
+            goals=self.goals[indices], lifestyle=self.lifestyle[indices],
+            interest_bits=self.interest_bits[indices], interest_len=self.interest_len[indices],
+            interests_book=self.interests_book, goals_book=self.goals_book,
+            lifestyle_book=self.lifestyle_book
+        )
+
+    @classmethod
+    def concat(cls, parts: Sequence['CandidateColumns']) -> 'CandidateColumns':
+        """
+        Unir varios pools que comparten codebooks
+
+        Los bitsets de intereses se rellenan con ceros hasta el ancho mayor,
+        ya que el vocabulario puede haber crecido entre construcciones.
+        """
+        parts = list(parts)
+        if len(parts) == 1:
+            return parts[0]
+        first = parts[0]
+        words = max(part.interest_bits.shape[1] for part in parts)
+        interest_bits = np.zeros((sum(len(part) for part in parts), words), dtype=np.uint64)
+        offset = 0
+        for part in parts:
+            interest_bits[offset:offset + len(part), :part.interest_bits.shape[1]] = part.interest_bits
+            offset += len(part)
+
+        return cls(
+            profiles=[profile for part in parts for profile in part.profiles],
+            ids=np.concatenate([part.ids for part in parts]),
+            age=np.concatenate([part.age for part in parts]),
+            lat=np.concatenate([part.lat for part in parts]),
+            lng=np.concatenate([part.lng for part in parts]),
+            activity=np.concatenate([part.activity for part in parts]),
+            reputation=np.concatenate([part.reputation for part in parts]),
+            verification=np.concatenate([part.verification for part in parts]),
+            education=np.concatenate([part.education for part in parts]),
+            goals=np.concatenate([part.goals for part in parts]),
+            lifestyle=np.concatenate([part.lifestyle for part in parts]),
+            interest_bits=interest_bits,
+            interest_len=np.concatenate([part.interest_len for part in parts]),
+            interests_book=first.interests_book, goals_book=first.goals_book,
+            lifestyle_book=first.lifestyle_book
+        )
+
+    def encode_user(self, user: 'UserProfile') -> Dict:
+        """Codificar el usuario objetivo con los codebooks del pool"""
+        words = self.interest_bits.shape[1]
+        bits = np.zeros(words, dtype=np.uint64)
+        for interest in user.interests:
+            code = self.interests_book.lookup(interest)
+            # Intereses fuera del vocabulario no pueden coincidir con ningún candidato
+            if 0 <= code < words * 64:
+                bits[code >> 6] |= np.uint64(1) << np.uint64(code & 63)
+
+        lat, lng = _location_coords(user.location)
+        return {
+            'age': user.age,
+            'lat': lat,
+            'lng': lng,
+            'activity': user.activity_score,
+            'reputation': user.reputation_score,
+            'verification': VERIFICATION_LEVELS.get(user.verification_level, 0),
+            'education': _education_ordinal(user.education_level),
+            'goals': self.goals_book.lookup(user.relationship_goals),
+            'lifestyle': np.array(
+                [self.lifestyle_book.lookup(getattr(user, factor, NO_PREFERENCE))
+                 for factor in LIFESTYLE_FACTORS],
+                dtype=np.int32
+            ),
+            'interest_bits': bits,
+            'interest_len': len(user.interests)
+        }
+
+
+@dataclass
+class BatchScores:
+    """Scores del pool completo, alineados con las filas de CandidateColumns"""
+    final: np.ndarray
+    collaborative: np.ndarray
+    content: np.ndarray
+    geographic: np.ndarray
+    behavioral: np.ndarray
+    distance_km: np.ndarray
+    common_interests: np.ndarray
+    goals_match: np.ndarray
+    success_rate: np.ndarray
+
+
+class BatchScorer:
+    """
+    Calcula los scores híbridos de un pool completo con operaciones vectorizadas
+    """
+
+    def __init__(
+        self,
+        collaborative_weight: float = 0.4,
+        content_weight: float = 0.3,
+        geographic_weight: float = 0.2,
+        behavioral_weight: float = 0.1
+    ):
+        self.collaborative_weight = collaborative_weight
+        self.content_weight = content_weight
+        self.geographic_weight = geographic_weight
+        self.behavioral_weight = behavioral_weight
+
+    def score(
+        self,
+        user: 'UserProfile',
+        columns: CandidateColumns,
+        collaborative_scores: Optional[np.ndarray] = None
+    ) -> BatchScores:
+        """
+        Calcular todos los scores del pool para un usuario
+
+        Args:
+            user: Perfil del usuario objetivo
+            columns: Pool de candidatos empaquetado
+            collaborative_scores: Score colaborativo por candidato (0.5 si se omite)
+
+        Returns:
+            BatchScores alineados con las filas del pool
+        """
+        n = len(columns)
+        target = columns.encode_user(user)
+
+        if collaborative_scores is None:
+            collaborative = np.full(n, 0.5)
+        else:
+            collaborative = np.asarray(collaborative_scores, dtype=np.float64)
+
+        distance = haversine_km(target['lat'], target['lng'], columns.lat, columns.lng)
+        common = popcount_rows(columns.interest_bits & target['interest_bits'])
+        goals_match = columns.goals == target['goals']
+
+        content = self._content_scores(target, columns, common, goals_match)
+        geographic = self._geographic_scores(distance)
+        behavioral = self._behavioral_scores(target, columns)
+
+        final = (
+            collaborative * self.collaborative_weight +
+            content * self.content_weight +
+            geographic * self.geographic_weight +
+            behavioral * self.behavioral_weight
+        )
+
+        return BatchScores(
+            final=final,
+            collaborative=collaborative,
+            content=content,
+            geographic=geographic,
+            behavioral=behavioral,
+            distance_km=distance,
+            common_interests=common,
+            goals_match=goals_match,
+            success_rate=self._success_rates(target, columns, common, distance)
+        )
+
+    def _content_scores(
+        self,
+        target: Dict,
+        columns: CandidateColumns,
+        common: np.ndarray,
+        goals_match: np.ndarray
+    ) -> np.ndarray:
+        """Equivalente vectorizado de _calculate_content_score"""
+        # 1. Intereses comunes (30%)
+        denominator = np.maximum(np.maximum(columns.interest_len, target['interest_len']), 1)
+        interest_score = common / denominator
+
+        # 2. Metas de relación (25%)
+        goal_score = np.where(goals_match, 1.0, 0.3)
+
+        # 3. Diferencia de edad (20%)
+        age_diff = np.abs(target['age'] - columns.age)
+        age_score = np.where(age_diff <= 5, 1.0, np.where(age_diff <= 10, 0.7, 0.3))
+
+        # 4. Nivel educativo (15%)
+        if target['education'] < 0:
+            education_score = np.full(len(columns), 0.5)
+        else:
+            edu_diff = np.abs(columns.education.astype(np.int64) - target['education'])
+            education_score = np.where(
+                columns.education >= 0,
+                np.maximum(0, 1.0 - (edu_diff * 0.2)),
+                0.5
+            )
+
+        # 5. Estilo de vida (10%)
+        user_lifestyle = target['lifestyle']
+        no_pref = columns.lifestyle_book.lookup(NO_PREFERENCE)
+        compatible = (
+            (columns.lifestyle == no_pref) |
+            (user_lifestyle == no_pref) |
+            (columns.lifestyle == user_lifestyle)
+        )
+        lifestyle_score = compatible.sum(axis=1) / len(LIFESTYLE_FACTORS)
+
+        return (
+            interest_score * 0.3 +
+            goal_score * 0.25 +
+            age_score * 0.2 +
+            education_score * 0.15 +
+            lifestyle_score * 0.1
+        )
+
+    def _geographic_scores(self, distance: np.ndarray) -> np.ndarray:
+        """Equivalente vectorizado de _calculate_geographic_score"""
+        return np.select(
+            [distance <= 5, distance <= 25, distance <= 50, distance <= 100],
+            [1.0, 0.8, 0.6, 0.3],
+            default=0.1
+        )
+
+    def _behavioral_scores(self, target: Dict, columns: CandidateColumns) -> np.ndarray:
+        """Equivalente vectorizado de _calculate_behavioral_score"""
+        activity_score = np.maximum(0, 1.0 - np.abs(target['activity'] - columns.activity))
+        reputation_score = np.maximum(0, 1.0 - np.abs(target['reputation'] - columns.reputation))
+
+        ver_diff = np.abs(columns.verification.astype(np.int64) - target['verification'])
+        verification_score = np.where(ver_diff == 0, 1.0, np.where(ver_diff <= 1, 0.7, 0.4))
+
+        return (
+            activity_score * 0.4 +
+            reputation_score * 0.3 +
+            verification_score * 0.3
+        )
+
+    def _success_rates(
+        self,
+        target: Dict,
+        columns: CandidateColumns,
+        common: np.ndarray,
+        distance: np.ndarray
+    ) -> np.ndarray:
+        """Equivalente vectorizado de _predict_success_rate"""
+        interest_factor = np.minimum(common / 5, 1.0)
+        distance_factor = np.maximum(0, 1.0 - (distance / 100))
+        verification_factor = (target['reputation'] + columns.reputation) / 2
+        activity_factor = (target['activity'] + columns.activity) / 2
+        return (interest_factor + distance_factor + verification_factor + activity_factor) / 4
@@ -0,0 +1,324 @@
+"""
+TuCitaSegura - Índice residente de candidatos
+
+Mantiene en memoria los perfiles activos en formato columnar, particionados
+por género y tramo de edad, para que MatchingEngine no tenga que recorrer la
+colección `users` de Firestore en cada petición de recomendaciones.
+
+El índice se alimenta de tres formas:
+- Carga completa inicial (`load`)
+- Listener de cambios de Firestore (`start_listener`, vía on_snapshot)
+- Refrescos periódicos por delta sobre el campo `updatedAt` (`refresh`)
+
+Las consultas por radio usan un GeoGridIndex sobre la ubicación de cada
+perfil, de modo que solo se materializan los candidatos cercanos.
+"""
+
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, TYPE_CHECKING
+
+import numpy as np
+
+from app.services.geo.spatial_index import GeoGridIndex
+from app.services.ml.batch_scoring import CandidateColumns, CodeBook, NO_PREFERENCE
+
+if TYPE_CHECKING:
+    from app.services.ml.recommendation_engine import UserProfile
+
+logger = logging.getLogger(__name__)
+
+PartitionKey = Tuple[str, int]
+
+
+class CandidateIndex:
+    """
+    Almacén columnar de perfiles activos particionado por (género, tramo de edad)
+    """
+
+    def __init__(
+        self,
+        profile_builder: Callable[[str, Dict], 'UserProfile'],
+        age_bucket_size: int = 5,
+        cell_size_deg: float = 0.1
+    ):
+        """
+        Args:
+            profile_builder: Función (user_id, datos del documento) -> UserProfile
+            age_bucket_size: Amplitud en años de cada tramo de edad
+            cell_size_deg: Tamaño de celda del índice espacial
+        """
+        self.profile_builder = profile_builder
+        self.age_bucket_size = age_bucket_size
+        self.geo_index = GeoGridIndex(cell_size_deg)
+
+        self._lock = threading.RLock()
+        self._profiles: Dict[str, 'UserProfile'] = {}
+        self._partition_of: Dict[str, PartitionKey] = {}
+        self._partitions: Dict[PartitionKey, Set[str]] = {}
+        self._columns: Dict[PartitionKey, CandidateColumns] = {}
+        self._rows: Dict[PartitionKey, Dict[str, int]] = {}
+
+        # Codebooks compartidos por todas las particiones
+        self._interests_book = CodeBook()
+        self._goals_book = CodeBook()
+        self._lifestyle_book = CodeBook([NO_PREFERENCE])
+
+        self._listener = None
+        self._subscribers: List[Callable[[str, Optional['UserProfile']], None]] = []
+        self.last_sync: Optional[datetime] = None
+        self.is_ready = False
+
+    def __len__(self) -> int:
+        return len(self._profiles)
+
+    # ------------------------------------------------------------------
+    # Mantenimiento
+    # ------------------------------------------------------------------
+
+    def _partition_key(self, profile: 'UserProfile') -> PartitionKey:
+        try:
+            bucket = int(profile.age) // self.age_bucket_size
+        except (TypeError, ValueError):
+            bucket = -1
+        return profile.gender, bucket
+
+    def subscribe(self, callback: Callable[[str, Optional['UserProfile']], None]):
+        """Registrar un callback (user_id, perfil o None si se elimina) para cada cambio"""
+        self._subscribers.append(callback)
+
+    def _notify(self, user_id: str, profile: Optional['UserProfile']):
+        for callback in self._subscribers:
+            try:
+                callback(user_id, profile)
+            except Exception as e:
+                logger.error(f"[CandidateIndex] Error notificando cambio de {user_id}: {e}")
+
+    def upsert(self, user_id: str, data: Dict):
+        """Insertar o actualizar un perfil a partir de los datos de Firestore"""
+        if not data.get('isActive', False):
+            self.remove(user_id)
+            return
+        self.add_profile(self.profile_builder(user_id, data))
+
+    def add_profile(self, profile: 'UserProfile'):
+        """Insertar o actualizar un UserProfile ya construido"""
+        user_id = profile.user_id
+        key = self._partition_key(profile)
+
+        with self._lock:
+            previous_key = self._partition_of.get(user_id)
+            if previous_key is not None and previous_key != key:
+                self._partitions[previous_key].discard(user_id)
+                self._columns.pop(previous_key, None)
+
+            self._profiles[user_id] = profile
+            self._partition_of[user_id] = key
+            self._partitions.setdefault(key, set()).add(user_id)
+            # La partición se reconstruye de forma perezosa en la próxima consulta
+            self._columns.pop(key, None)
+
+            location = profile.location if isinstance(profile.location, dict) else {}
+            self.geo_index.insert(user_id, location.get('lat', 0), location.get('lng', 0))
+        self._notify(user_id, profile)
+
+    def remove(self, user_id: str):
+        """Eliminar un perfil del índice (baja o desactivación)"""
+        with self._lock:
+            key = self._partition_of.pop(user_id, None)
+            self._profiles.pop(user_id, None)
+            if key is not None:
+                self._partitions[key].discard(user_id)
+                self._columns.pop(key, None)
+            self.geo_index.remove(user_id)
+        if key is not None:
+            self._notify(user_id, None)
+
+    def apply_documents(self, documents: Iterable):
+        """Aplicar una serie de documentos de Firestore (DocumentSnapshot)"""
+        count = 0
+        for doc in documents:
+            if getattr(doc, 'exists', True):
+                self.upsert(doc.id, doc.to_dict() or {})
+            else:
+                self.remove(doc.id)
+            count += 1
+        return count
+
+    def load(self, db):
+        """Carga completa de los usuarios activos"""
+        started_at = datetime.now()
+        query = db.collection('users').where('isActive', '==', True)
+        count = self.apply_documents(query.stream())
+        self.last_sync = started_at
+        self.is_ready = True
+        logger.info(f"[CandidateIndex] Cargados {count} perfiles activos")
+
+    def refresh(self, db) -> int:
+        """
+        Refresco por delta: aplica los usuarios modificados desde la última sincronización
+
+        Incluye los usuarios desactivados, que se eliminan del índice.
+        """
+        if self.last_sync is None:
+            self.load(db)
+            return len(self)
+
+        started_at = datetime.now()
+        query = db.collection('users').where('updatedAt', '>', self.last_sync)
+        count = self.apply_documents(query.stream())
+        self.last_sync = started_at
+        logger.info(f"[CandidateIndex] Refresco incremental: {count} perfiles actualizados")
+        return count
+
+    def start_listener(self, db):
+        """Suscribirse a los cambios de usuarios activos en Firestore"""
+        if self._listener is not None:
+            return
+        query = db.collection('users').where('isActive', '==', True)
+        self._listener = query.on_snapshot(self._on_snapshot)
+        logger.info("[CandidateIndex] Listener de Firestore iniciado")
+
+    def stop_listener(self):
+        if self._listener is not None:
+            self._listener.unsubscribe()
+            self._listener = None
+
+    def _on_snapshot(self, col_snapshot, changes, read_time):
+        """Callback de on_snapshot (se ejecuta en un hilo de Firestore)"""
+        try:
+            for change in changes:
+                doc = change.document
+                if change.type.name == 'REMOVED':
+                    self.remove(doc.id)
+                else:
+                    self.upsert(doc.id, doc.to_dict() or {})
+            self.last_sync = datetime.now()
+            self.is_ready = True
+        except Exception as e:
+            logger.error(f"[CandidateIndex] Error aplicando cambios: {e}")
+
+    # ------------------------------------------------------------------
+    # Consultas
+    # ------------------------------------------------------------------
+
+    def _partition_columns(self, key: PartitionKey) -> CandidateColumns:
+        columns = self._columns.get(key)
+        if columns is None:
+            profiles = [self._profiles[user_id] for user_id in sorted(self._partitions[key])]
+            columns = CandidateColumns.from_profiles(
+                profiles,
+                interests_book=self._interests_book,
+                goals_book=self._goals_book,
+                lifestyle_book=self._lifestyle_book
+            )
+            self._columns[key] = columns
+            self._rows[key] = {user_id: row for row, user_id in enumerate(columns.ids)}
+        return columns
+
+    def _empty_columns(self) -> CandidateColumns:
+        return CandidateColumns.from_profiles(
+            [], interests_book=self._interests_book,
+            goals_book=self._goals_book, lifestyle_book=self._lifestyle_book
+        )
+
+    def get(self, user_id: str) -> Optional['UserProfile']:
+        return self._profiles.get(user_id)
+
+    def profiles(self) -> List['UserProfile']:
+        """Copia de todos los perfiles indexados"""
+        with self._lock:
+            return list(self._profiles.values())
+
+    def query(
+        self,
+        genders: Optional[List[str]] = None,
+        min_age: Optional[int] = None,
+        max_age: Optional[int] = None,
+        exclude_user_id: Optional[str] = None,
+        verification_level: Optional[str] = None,
+        near: Optional[Tuple[float, float, float]] = None
+    ) -> CandidateColumns:
+        """
+        Obtener las columnas de los candidatos que cumplen los filtros
+
+        Args:
+            genders: Géneros admitidos (None = todos)
+            min_age / max_age: Rango de edad inclusivo
+            exclude_user_id: Usuario a excluir (el propio solicitante)
+            verification_level: Nivel de verificación exacto requerido
+            near: (lat, lng, radio_km) para limitar a candidatos dentro del radio
+        """
+        with self._lock:
+            keys = []
+            for key, members in self._partitions.items():
+                gender, bucket = key
+                if not members:
+                    continue
+                if genders is not None and gender not in genders:
+                    continue
+                if bucket >= 0:
+                    if min_age is not None and (bucket + 1) * self.age_bucket_size <= min_age:
+                        continue
+                    if max_age is not None and bucket * self.age_bucket_size > max_age:
+                        continue
+                keys.append(key)
+
+            if not keys:
+                return self._empty_columns()
+
+            if near is None:
+                columns = CandidateColumns.concat([self._partition_columns(key) for key in sorted(keys)])
+            else:
+                columns = self._query_near(set(keys), *near)
+                if columns is None:
+                    return self._empty_columns()
+
+        # Filtros exactos sobre las columnas
+        mask = np.ones(len(columns), dtype=bool)
+        if min_age is not None:
+            mask &= columns.age >= min_age
+        if max_age is not None:
+            mask &= columns.age <= max_age
+        if exclude_user_id is not None:
+            mask &= columns.ids != exclude_user_id
+        if verification_level is not None:
+            mask &= np.array(
+                [profile.verification_level == verification_level for profile in columns.profiles],
+                dtype=bool
+            )
+
+        if mask.all():
+            return columns
+        return columns.take(np.flatnonzero(mask))
+
+    def _query_near(self, keys: Set[PartitionKey], lat: float, lng: float, radius_km: float) -> Optional[CandidateColumns]:
+        """Filas de las particiones indicadas cuyo perfil está dentro del radio"""
+        rows_by_key: Dict[PartitionKey, List[int]] = {}
+        for user_id, _ in self.geo_index.query_radius(lat, lng, radius_km):
+            key = self._partition_of.get(user_id)
+            if key not in keys:
+                continue
+            self._partition_columns(key)
+            rows_by_key.setdefault(key, []).append(self._rows[key][user_id])
+
+        if not rows_by_key:
+            return None
+        return CandidateColumns.concat([
+            self._columns[key].take(np.sort(np.array(rows_by_key[key], dtype=np.int64)))
+            for key in sorted(rows_by_key)
+        ])
+
+    def get_stats(self) -> Dict:
+        """Estadísticas del índice para monitorización"""
+        with self._lock:
+            return {
+                'profiles': len(self._profiles),
+                'partitions': sum(1 for members in self._partitions.values() if members),
+                'materialized_partitions': len(self._columns),
+                'geo_indexed': len(self.geo_index),
+                'is_ready': self.is_ready,
+                'listening': self._listener is not None,
+                'last_sync': self.last_sync.isoformat() if self.last_sync else None
+            }
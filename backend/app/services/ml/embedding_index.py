@@ -0,0 +1,316 @@
+"""
+TuCitaSegura - Índice de embeddings de perfiles
+
+Convierte cada perfil en un vector de tamaño fijo (TF-IDF de bio, profesión
+e intereses + rasgos numéricos estandarizados), lo guarda en una matriz
+memory-mapped y permite recuperar los perfiles más parecidos a un usuario.
+
+MatchingEngine lo usa como preselección: cuando el pool filtrado es grande,
+solo la lista corta de perfiles más similares pasa al scoring híbrido exacto.
+La búsqueda usa HNSW (hnswlib) si está instalado y, si no, producto escalar
+exacto con NumPy.
+
+El pipeline de features se guarda con joblib, que deserializa objetos
+Python arbitrarios al cargar: el directorio del índice (ML_EMBEDDING_INDEX_PATH)
+debe ser de confianza y escribible solo por el job que lo construye.
+"""
+
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple, TYPE_CHECKING
+
+import numpy as np
+
+from app.services.ml.batch_scoring import VERIFICATION_LEVELS, _education_ordinal
+
+try:
+    import hnswlib
+except ImportError:  # Dependencia opcional: se usa la búsqueda exacta con NumPy
+    hnswlib = None
+
+if TYPE_CHECKING:
+    from app.services.ml.recommendation_engine import UserProfile
+
+logger = logging.getLogger(__name__)
+
+# scikit-learn solo trae la lista de stop words en inglés
+SPANISH_STOP_WORDS = [
+    'a', 'al', 'algo', 'con', 'de', 'del', 'el', 'ella', 'en', 'es', 'esta',
+    'este', 'hay', 'la', 'las', 'le', 'lo', 'los', 'me', 'mi', 'muy', 'no',
+    'o', 'para', 'pero', 'por', 'que', 'se', 'si', 'sin', 'soy', 'su', 'sus',
+    'te', 'tu', 'un', 'una', 'uno', 'y', 'ya', 'yo'
+]
+
+NUMERIC_FEATURES = ['age', 'activity_score', 'reputation_score', 'verification', 'education']
+
+MATRIX_FILE = 'embeddings.npy'
+IDS_FILE = 'ids.json'
+EMBEDDER_FILE = 'embedder.joblib'
+
+
+class ProfileEmbedder:
+    """
+    Pipeline de features: TF-IDF de texto + rasgos numéricos estandarizados
+    """
+
+    def __init__(self, max_features: int = 100, text_weight: float = 0.6, numeric_weight: float = 0.4):
+        """
+        Args:
+            max_features: Tamaño del vocabulario TF-IDF
+            text_weight / numeric_weight: Peso de cada bloque en el embedding
+        """
+        # sklearn se importa al crear el embedder, no al importar el módulo
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        from sklearn.preprocessing import StandardScaler
+
+        self.max_features = max_features
+        self.text_weight = text_weight
+        self.numeric_weight = numeric_weight
+        self.vectorizer = TfidfVectorizer(max_features=max_features, stop_words=SPANISH_STOP_WORDS)
+        self.scaler = StandardScaler()
+        self.has_vocabulary = False
+        self.is_fitted = False
+
+    @property
+    def dim(self) -> int:
+        return self.max_features + len(NUMERIC_FEATURES)
+
+    @staticmethod
+    def _text(profile: 'UserProfile') -> str:
+        # Cada interés es un único token aunque tenga varias palabras
+        interests = ' '.join(str(interest).replace(' ', '_') for interest in profile.interests)
+        return f"{getattr(profile, 'bio', '')} {profile.profession} {interests}"
+
+    @staticmethod
+    def _numeric(profiles: Sequence['UserProfile']) -> np.ndarray:
+        values = np.zeros((len(profiles), len(NUMERIC_FEATURES)), dtype=np.float64)
+        for i, profile in enumerate(profiles):
+            row = [
+                profile.age, profile.activity_score, profile.reputation_score,
+                VERIFICATION_LEVELS.get(profile.verification_level, 0),
+                _education_ordinal(profile.education_level)
+            ]
+            for j, value in enumerate(row):
+                try:
+                    values[i, j] = float(value)
+                except (TypeError, ValueError):
+                    values[i, j] = np.nan
+        # Valores no numéricos se imputan con la media de la columna
+        missing = np.isnan(values)
+        if missing.any():
+            means = np.nansum(values, axis=0) / np.maximum((~missing).sum(axis=0), 1)
+            rows, cols = np.nonzero(missing)
+            values[rows, cols] = means[cols]
+        return values
+
+    def fit(self, profiles: Sequence['UserProfile']) -> 'ProfileEmbedder':
+        try:
+            self.vectorizer.fit([self._text(profile) for profile in profiles])
+            self.has_vocabulary = True
+        except ValueError:
+            # Vocabulario vacío (ningún perfil con texto): el bloque de texto queda a cero
+            self.has_vocabulary = False
+        self.scaler.fit(self._numeric(profiles))
+        self.is_fitted = True
+        return self
+
+    def transform(self, profiles: Sequence['UserProfile']) -> np.ndarray:
+        """Embeddings L2-normalizados (float32, n x dim)"""
+        n = len(profiles)
+        embeddings = np.zeros((n, self.dim), dtype=np.float32)
+        if n == 0:
+            return embeddings
+
+        if self.has_vocabulary:
+            text = self.vectorizer.transform([self._text(profile) for profile in profiles]).toarray()
+            embeddings[:, :text.shape[1]] = text * self.text_weight
+
+        numeric = self.scaler.transform(self._numeric(profiles))
+        embeddings[:, self.max_features:] = numeric * (self.numeric_weight / np.sqrt(len(NUMERIC_FEATURES)))
+
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        np.divide(embeddings, norms, out=embeddings, where=norms > 0)
+        return embeddings
+
+
+class EmbeddingIndex:
+    """
+    Matriz de embeddings (memory-mapped si se persiste) con búsqueda de vecinos
+    """
+
+    def __init__(self, embedder: Optional[ProfileEmbedder] = None, ann_threshold: int = 5000, oversample: int = 4):
+        """
+        Args:
+            embedder: Pipeline de features (se crea uno por defecto)
+            ann_threshold: Tamaño mínimo para construir el índice HNSW
+            oversample: Factor de vecinos extra pedidos al ANN al filtrar por pool
+        """
+        self.embedder = embedder or ProfileEmbedder()
+        self.ann_threshold = ann_threshold
+        self.oversample = oversample
+
+        self._lock = threading.RLock()
+        self.matrix = np.zeros((0, self.embedder.dim), dtype=np.float32)
+        self.ids = np.empty(0, dtype=object)
+        # user_id -> fila de la matriz
+        self._id_rows: Dict[str, int] = {}
+        self._ann = None
+        self.path: Optional[str] = None
+        self.is_ready = False
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def backend(self) -> str:
+        return 'hnsw' if self._ann is not None else 'numpy'
+
+    # ------------------------------------------------------------------
+    # Construcción y persistencia
+    # ------------------------------------------------------------------
+
+    def build(self, profiles: Sequence['UserProfile'], path: Optional[str] = None):
+        """
+        Ajustar el pipeline con los perfiles y calcular sus embeddings
+
+        Args:
+            profiles: Perfiles a indexar
+            path: Directorio donde persistir la matriz (se reabre memory-mapped)
+        """
+        profiles = list(profiles)
+        embedder = ProfileEmbedder(
+            self.embedder.max_features, self.embedder.text_weight, self.embedder.numeric_weight
+        ).fit(profiles)
+        matrix = embedder.transform(profiles)
+        ids = np.array([profile.user_id for profile in profiles], dtype=object)
+
+        if path:
+            self._save(path, embedder, matrix, ids)
+            matrix = np.load(os.path.join(path, MATRIX_FILE), mmap_mode='r')
+        self._install(embedder, matrix, ids, path)
+        logger.info(f"[EmbeddingIndex] Indexados {len(ids)} perfiles ({self.backend})")
+
+    @staticmethod
+    def _save(path: str, embedder: ProfileEmbedder, matrix: np.ndarray, ids: np.ndarray):
+        os.makedirs(path, exist_ok=True)
+        stored = np.lib.format.open_memmap(
+            os.path.join(path, MATRIX_FILE), mode='w+', dtype=np.float32, shape=matrix.shape
+        )
+        stored[:] = matrix
+        stored.flush()
+        del stored
+        with open(os.path.join(path, IDS_FILE), 'w') as f:
+            json.dump(list(ids), f)
+        import joblib
+
+        joblib.dump(embedder, os.path.join(path, EMBEDDER_FILE))
+
+    def load(self, path: str):
+        """
+        Abrir un índice persistido; la matriz se mapea en memoria sin copiarla
+
+        El pipeline se deserializa con joblib: `path` debe ser de confianza.
+        """
+        import joblib
+
+        embedder = joblib.load(os.path.join(path, EMBEDDER_FILE))
+        with open(os.path.join(path, IDS_FILE)) as f:
+            ids = np.array(json.load(f), dtype=object)
+        matrix = np.load(os.path.join(path, MATRIX_FILE), mmap_mode='r')
+        self._install(embedder, matrix, ids, path)
+        logger.info(f"[EmbeddingIndex] Cargados {len(ids)} embeddings desde {path}")
+
+    def _install(self, embedder: ProfileEmbedder, matrix: np.ndarray, ids: np.ndarray, path: Optional[str]):
+        ann = None
+        if hnswlib is not None and len(ids) >= self.ann_threshold:
+            ann = hnswlib.Index(space='ip', dim=matrix.shape[1])
+            ann.init_index(max_elements=len(ids), ef_construction=200, M=16)
+            ann.add_items(np.asarray(matrix), np.arange(len(ids)))
+
+        with self._lock:
+            self.embedder = embedder
+            self.matrix = matrix
+            self.ids = ids
+            self._id_rows = {user_id: row for row, user_id in enumerate(ids)}
+            self._ann = ann
+            self.path = path
+            self.is_ready = True
+
+    # ------------------------------------------------------------------
+    # Consultas
+    # ------------------------------------------------------------------
+
+    def embed(self, profile: 'UserProfile') -> np.ndarray:
+        return self.embedder.transform([profile])[0]
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        """Top-k perfiles por similitud coseno con el vector de consulta"""
+        k = min(k, len(self.ids))
+        if k <= 0:
+            return []
+        rows, similarities = self._nearest_rows(query, k)
+        return [(self.ids[row], float(similarity)) for row, similarity in zip(rows, similarities)]
+
+    def _nearest_rows(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        if self._ann is not None:
+            self._ann.set_ef(max(k, 50))
+            labels, distances = self._ann.knn_query(query, k=k)
+            return labels[0].astype(np.int64), 1.0 - distances[0]
+        similarities = np.asarray(self.matrix) @ query
+        return self._top(similarities, k)
+
+    @staticmethod
+    def _top(similarities: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        if k < len(similarities):
+            top = np.argpartition(-similarities, k - 1)[:k]
+        else:
+            top = np.arange(len(similarities))
+        top = top[np.argsort(-similarities[top], kind='stable')]
+        return top, similarities[top]
+
+    def shortlist(self, query: np.ndarray, pool_ids: Sequence[str], k: int) -> np.ndarray:
+        """
+        Posiciones del pool que pasan al scoring exacto
+
+        Los k perfiles del pool más parecidos a la consulta, más los que aún no
+        tienen embedding (altas posteriores a la construcción del índice).
+        Devuelve posiciones en orden creciente para conservar el orden del pool.
+        """
+        with self._lock:
+            rows = np.fromiter(
+                (self._id_rows.get(user_id, -1) for user_id in pool_ids), dtype=np.int64, count=len(pool_ids)
+            )
+            known = np.flatnonzero(rows >= 0)
+            unknown = np.flatnonzero(rows < 0)
+            if len(known) <= k:
+                return np.arange(len(pool_ids))
+
+            selected = None
+            if self._ann is not None:
+                # Vecinos globales filtrados por pertenencia al pool
+                neighbours, _ = self._nearest_rows(query, min(len(self.ids), k * self.oversample))
+                in_pool = np.isin(rows[known], neighbours)
+                if in_pool.sum() >= k:
+                    rank = {row: position for position, row in enumerate(neighbours.tolist())}
+                    order = np.array([rank[row] for row in rows[known][in_pool].tolist()], dtype=np.int64)
+                    selected = known[in_pool][np.argsort(order, kind='stable')][:k]
+
+            if selected is None:
+                similarities = np.asarray(self.matrix[rows[known]]) @ query
+                top, _ = self._top(similarities, k)
+                selected = known[top]
+
+        return np.sort(np.concatenate([selected, unknown]))
+
+    def get_stats(self) -> Dict:
+        """Estadísticas del índice para monitorización"""
+        return {
+            'profiles': len(self.ids),
+            'dim': int(self.matrix.shape[1]),
+            'backend': self.backend,
+            'memory_mapped': isinstance(self.matrix, np.memmap),
+            'path': self.path,
+            'is_ready': self.is_ready
+        }
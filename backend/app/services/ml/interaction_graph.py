@@ -0,0 +1,457 @@
+"""
+TuCitaSegura - Grafo de interacciones para filtrado colaborativo
+
+Sustituye las consultas por candidato de `_get_user_interactions` y
+`_find_similar_users` por estructuras residentes en memoria:
+- Matrices dispersas usuario x usuario (CSR) con el número de interacciones
+  (likes + mensajes) y cuántas de ellas tuvieron éxito (match / cita)
+- Índice invertido interés -> usuarios y meta de relación -> usuarios
+
+El grafo se mantiene de forma incremental: cada documento de `likes` y
+`messages` suma uno al par (origen, destino), los cambios se acumulan como
+deltas y se fusionan en las matrices CSR en la siguiente consulta. La memoria
+es proporcional a los pares, no a los documentos: solo se recuerdan los
+documentos con éxito, para poder retirarlo si el documento cambia.
+"""
+
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple, TYPE_CHECKING
+
+import numpy as np
+
+from app.services.ml.batch_scoring import CandidateColumns, CodeBook
+
+if TYPE_CHECKING:
+    from app.services.ml.recommendation_engine import UserProfile
+
+logger = logging.getLogger(__name__)
+
+NEUTRAL_SCORE = 0.5
+
+# Colección -> (campo origen, campo destino, campo de éxito)
+INTERACTION_SOURCES = {
+    'likes': ('fromUserId', 'toUserId', 'matched'),
+    'messages': ('senderId', 'receiverId', 'ledToDate'),
+}
+
+Edge = Tuple[int, int]
+
+
+class InteractionGraph:
+    """
+    Interacciones usuario -> usuario en CSR e índice invertido de atributos
+    """
+
+    def __init__(self):
+        # scipy se importa al crear el grafo, no al importar el módulo
+        from scipy import sparse
+
+        self._lock = threading.RLock()
+        self._users = CodeBook()
+        self._user_ids: List[str] = []
+
+        # Matrices de interacciones (fila = origen, columna = destino)
+        self._total = sparse.csr_matrix((0, 0), dtype=np.int32)
+        self._success = sparse.csr_matrix((0, 0), dtype=np.int32)
+        self._pending: List[Tuple[int, int, int, int]] = []
+
+        # Documentos con éxito (el resto solo cuenta en la matriz de totales)
+        self._successful: Dict[str, Edge] = {}
+        self._interactions = 0
+        # Instante de la carga completa por colección: la primera instantánea
+        # de cada listener solo aplica lo creado o modificado después
+        self._loaded_at: Dict[str, datetime] = {}
+
+        # Índice invertido sobre la colección `users`
+        self._interests_of: Dict[str, FrozenSet[str]] = {}
+        self._goal_of: Dict[str, str] = {}
+        self.interest_users: Dict[str, Set[str]] = {}
+        self.goal_users: Dict[str, Set[str]] = {}
+
+        self._listeners = []
+        self._subscribers: List[Callable[[str], None]] = []
+        self.last_sync: Optional[datetime] = None
+        self.is_ready = False
+
+    # ------------------------------------------------------------------
+    # Mantenimiento
+    # ------------------------------------------------------------------
+
+    def subscribe(self, callback: Callable[[str], None]):
+        """Registrar un callback (usuario origen) para cada interacción que llega por el listener"""
+        self._subscribers.append(callback)
+
+    def _notify(self, collection: str, data: Dict):
+        source = data.get(INTERACTION_SOURCES[collection][0])
+        if not source:
+            return
+        for callback in self._subscribers:
+            try:
+                callback(source)
+            except Exception as e:
+                logger.error(f"[InteractionGraph] Error notificando cambio de {source}: {e}")
+
+    def _row(self, user_id: str) -> int:
+        row = self._users.code(user_id)
+        if row == len(self._user_ids):
+            self._user_ids.append(user_id)
+        return row
+
+    def upsert_user(self, user_id: str, data: Dict):
+        """Actualizar los intereses y la meta de relación de un usuario"""
+        interests = data.get('interests', [])
+        interests = frozenset(interests) if isinstance(interests, (list, tuple, set)) else frozenset()
+
+        with self._lock:
+            self.remove_user(user_id)
+            self._interests_of[user_id] = interests
+            for interest in interests:
+                self.interest_users.setdefault(interest, set()).add(user_id)
+            # Igual que la consulta `==` de Firestore, sin campo no hay meta
+            if 'relationshipGoals' in data:
+                goal = data['relationshipGoals']
+                self._goal_of[user_id] = goal
+                self.goal_users.setdefault(goal, set()).add(user_id)
+
+    def remove_user(self, user_id: str):
+        """Eliminar un usuario del índice invertido"""
+        with self._lock:
+            for interest in self._interests_of.pop(user_id, ()):
+                members = self.interest_users.get(interest)
+                if members is not None:
+                    members.discard(user_id)
+                    if not members:
+                        del self.interest_users[interest]
+            if user_id in self._goal_of:
+                goal = self._goal_of.pop(user_id)
+                members = self.goal_users.get(goal)
+                if members is not None:
+                    members.discard(user_id)
+                    if not members:
+                        del self.goal_users[goal]
+
+    def _edge(self, collection: str, data: Dict) -> Optional[Edge]:
+        source_field, target_field, _ = INTERACTION_SOURCES[collection]
+        source = data.get(source_field)
+        target = data.get(target_field)
+        # Sin destino la interacción nunca puede coincidir con un usuario similar
+        if not source or not target:
+            return None
+        return self._row(source), self._row(target)
+
+    def add_interaction(self, collection: str, doc_id: str, data: Dict):
+        """Sumar la interacción de un like o un mensaje nuevo"""
+        with self._lock:
+            edge = self._edge(collection, data)
+            if edge is None:
+                return
+            success = bool(data.get(INTERACTION_SOURCES[collection][2], False))
+            if success:
+                self._successful[f"{collection}/{doc_id}"] = edge
+            self._interactions += 1
+            self._pending.append((edge[0], edge[1], 1, int(success)))
+
+    def update_interaction(self, collection: str, doc_id: str, data: Dict):
+        """
+        Aplicar la modificación de un documento ya contado
+
+        Origen y destino no cambian; solo puede cambiar el éxito (match / cita).
+        """
+        key = f"{collection}/{doc_id}"
+        success = bool(data.get(INTERACTION_SOURCES[collection][2], False))
+        with self._lock:
+            if success and key not in self._successful:
+                edge = self._edge(collection, data)
+                if edge is not None:
+                    self._successful[key] = edge
+                    self._pending.append((edge[0], edge[1], 0, 1))
+            elif not success and key in self._successful:
+                edge = self._successful.pop(key)
+                self._pending.append((edge[0], edge[1], 0, -1))
+
+    def remove_interaction(self, collection: str, doc_id: str, data: Dict):
+        """Retirar la interacción de un documento borrado (con sus últimos datos)"""
+        with self._lock:
+            edge = self._successful.pop(f"{collection}/{doc_id}", None)
+            success = edge is not None
+            if edge is None:
+                edge = self._edge(collection, data)
+                if edge is None:
+                    return
+            self._interactions -= 1
+            self._pending.append((edge[0], edge[1], -1, -int(success)))
+
+    def _flush(self):
+        """Fusionar los deltas pendientes en las matrices CSR"""
+        size = len(self._user_ids)
+        if self._total.shape[0] != size:
+            self._total.resize((size, size))
+            self._success.resize((size, size))
+        if not self._pending:
+            return
+
+        rows, cols, totals, successes = (np.array(values, dtype=np.int32) for values in zip(*self._pending))
+        self._pending = []
+        self._total = self._merge(self._total, rows, cols, totals, size)
+        self._success = self._merge(self._success, rows, cols, successes, size)
+
+    @staticmethod
+    def _merge(matrix, rows, cols, values, size):
+        from scipy import sparse
+
+        delta = sparse.csr_matrix((values, (rows, cols)), shape=(size, size), dtype=np.int32)
+        merged = (matrix + delta).tocsr()
+        merged.eliminate_zeros()
+        return merged
+
+    def apply_users(self, documents: Iterable) -> int:
+        """Aplicar documentos de `users` (DocumentSnapshot)"""
+        count = 0
+        for doc in documents:
+            if getattr(doc, 'exists', True):
+                self.upsert_user(doc.id, doc.to_dict() or {})
+            else:
+                self.remove_user(doc.id)
+            count += 1
+        return count
+
+    def apply_interactions(self, collection: str, documents: Iterable) -> int:
+        """Sumar documentos nuevos de `likes` o `messages` (DocumentSnapshot)"""
+        count = 0
+        for doc in documents:
+            if getattr(doc, 'exists', True):
+                self.add_interaction(collection, doc.id, doc.to_dict() or {})
+                count += 1
+        return count
+
+    def _stream(self, query, collection: str) -> Iterable:
+        """
+        Recorrer una consulta anotando el instante de lectura de la colección
+
+        Es el read_time del servidor (común a toda la consulta); si la colección
+        está vacía se usa la hora local de inicio.
+        """
+        loaded_at = datetime.now(timezone.utc)
+        for doc in query.stream():
+            loaded_at = getattr(doc, 'read_time', None) or loaded_at
+            yield doc
+        self._loaded_at[collection] = loaded_at
+
+    def load(self, db):
+        """Carga completa de usuarios, likes y mensajes"""
+        started_at = datetime.now()
+        users = self.apply_users(self._stream(
+            db.collection('users').select(['interests', 'relationshipGoals']), 'users'
+        ))
+        interactions = 0
+        for collection, fields in INTERACTION_SOURCES.items():
+            interactions += self.apply_interactions(
+                collection, self._stream(db.collection(collection).select(list(fields)), collection)
+            )
+        with self._lock:
+            self._flush()
+        self.last_sync = started_at
+        self.is_ready = True
+        logger.info(f"[InteractionGraph] Cargados {users} usuarios y {interactions} interacciones")
+
+    def start_listener(self, db):
+        """Suscribirse a los cambios de usuarios e interacciones en Firestore"""
+        if self._listeners:
+            return
+        self._listeners.append(db.collection('users').on_snapshot(self._on_users_snapshot))
+        for collection in INTERACTION_SOURCES:
+            self._listeners.append(
+                db.collection(collection).on_snapshot(self._interactions_callback(collection))
+            )
+        logger.info("[InteractionGraph] Listeners de Firestore iniciados")
+
+    def stop_listener(self):
+        for listener in self._listeners:
+            listener.unsubscribe()
+        self._listeners = []
+
+    @staticmethod
+    def _after(timestamp: Optional[datetime], cutoff: datetime) -> bool:
+        return timestamp is not None and timestamp > cutoff
+
+    def _on_users_snapshot(self, col_snapshot, changes, read_time):
+        """Callback de on_snapshot para `users`"""
+        try:
+            # La primera instantánea repite toda la colección como ADDED
+            cutoff = self._loaded_at.pop('users', None)
+            for change in changes:
+                doc = change.document
+                if cutoff is not None and not self._after(getattr(doc, 'update_time', None), cutoff):
+                    continue
+                if change.type.name == 'REMOVED':
+                    self.remove_user(doc.id)
+                else:
+                    self.upsert_user(doc.id, doc.to_dict() or {})
+            self.last_sync = datetime.now()
+        except Exception as e:
+            logger.error(f"[InteractionGraph] Error aplicando cambios de usuarios: {e}")
+
+    def _interactions_callback(self, collection: str):
+        def on_snapshot(col_snapshot, changes, read_time):
+            try:
+                # La primera instantánea repite toda la colección como ADDED:
+                # lo ya cargado se salta y lo modificado después se actualiza
+                cutoff = self._loaded_at.pop(collection, None)
+                for change in changes:
+                    doc = change.document
+                    kind = change.type.name
+                    if cutoff is not None:
+                        if self._after(getattr(doc, 'create_time', None), cutoff):
+                            kind = 'ADDED'
+                        elif self._after(getattr(doc, 'update_time', None), cutoff):
+                            kind = 'MODIFIED'
+                        else:
+                            continue
+                    data = doc.to_dict() or {}
+                    if kind == 'REMOVED':
+                        self.remove_interaction(collection, doc.id, data)
+                    elif kind == 'MODIFIED':
+                        self.update_interaction(collection, doc.id, data)
+                    else:
+                        self.add_interaction(collection, doc.id, data)
+                    self._notify(collection, data)
+                self.last_sync = datetime.now()
+            except Exception as e:
+                logger.error(f"[InteractionGraph] Error aplicando cambios de {collection}: {e}")
+        return on_snapshot
+
+    # ------------------------------------------------------------------
+    # Consultas
+    # ------------------------------------------------------------------
+
+    def similar_users(self, user: 'UserProfile') -> Set[str]:
+        """Usuarios que comparten algún interés o la meta de relación (sin el propio usuario)"""
+        with self._lock:
+            similar = set()
+            for interest in user.interests:
+                similar |= self.interest_users.get(interest, set())
+            similar |= self.goal_users.get(user.relationship_goals, set())
+        similar.discard(user.user_id)
+        return similar
+
+    def _targets(self, user_id: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Destinos del usuario con sus totales y éxitos (fila CSR)"""
+        with self._lock:
+            self._flush()
+            row = self._users.lookup(user_id)
+            if row < 0:
+                empty = np.zeros(0, dtype=np.int32)
+                return empty, empty, empty
+            start, end = self._total.indptr[row], self._total.indptr[row + 1]
+            targets = self._total.indices[start:end]
+            totals = self._total.data[start:end]
+            successes = self._success[row, targets].toarray().ravel().astype(np.int32)
+        return targets, totals, successes
+
+    def collaborative_score(self, user_id: str, candidate: 'UserProfile') -> float:
+        """Score colaborativo de un candidato (equivale a _calculate_collaborative_score)"""
+        targets, totals, successes = self._targets(user_id)
+        if len(targets) == 0:
+            return NEUTRAL_SCORE
+
+        similar = self.similar_users(candidate)
+        inside = np.array([self._user_ids[target] in similar for target in targets], dtype=bool)
+        total = int(totals[inside].sum())
+        if total == 0:
+            return NEUTRAL_SCORE
+        return int(successes[inside].sum()) / total
+
+    def collaborative_scores(self, user_id: str, columns: CandidateColumns) -> np.ndarray:
+        """
+        Score colaborativo de todo el pool
+
+        Para cada destino con el que ha interactuado el usuario se marca, con
+        los bitsets de intereses del pool, qué candidatos lo tendrían como
+        usuario similar; el score es éxitos / total sobre esos destinos.
+        """
+        n = len(columns)
+        targets, totals, successes = self._targets(user_id)
+        if len(targets) == 0 or n == 0:
+            return np.full(n, NEUTRAL_SCORE, dtype=np.float64)
+
+        words = columns.interest_bits.shape[1]
+        total = np.zeros(n, dtype=np.int64)
+        successful = np.zeros(n, dtype=np.int64)
+        with self._lock:
+            attributes = [
+                (self._user_ids[target], self._interests_of.get(self._user_ids[target]),
+                 self._goal_of.get(self._user_ids[target]))
+                for target in targets
+            ]
+
+        for (target_id, interests, goal), target_total, target_success in zip(attributes, totals, successes):
+            # Destinos sin documento en `users` nunca son similares
+            if interests is None:
+                continue
+            bits = np.zeros(words, dtype=np.uint64)
+            for interest in interests:
+                code = columns.interests_book.lookup(interest)
+                if 0 <= code < words * 64:
+                    bits[code >> 6] |= np.uint64(1) << np.uint64(code & 63)
+
+            similar = (columns.interest_bits & bits).any(axis=1)
+            if goal is not None:
+                similar |= columns.goals == columns.goals_book.lookup(goal)
+            similar &= columns.ids != target_id
+
+            total += similar * int(target_total)
+            successful += similar * int(target_success)
+
+        scores = np.full(n, NEUTRAL_SCORE, dtype=np.float64)
+        has_data = total > 0
+        scores[has_data] = successful[has_data] / total[has_data]
+        return scores
+
+    def snapshot(self, user_ids: Iterable[str]) -> Dict:
+        """
+        Subgrafo serializable con las interacciones de los usuarios indicados
+
+        Incluye los atributos de sus destinos, que es todo lo necesario para
+        calcular sus scores colaborativos en otro proceso (ver `restore`).
+        """
+        users = {}
+        edges = []
+        with self._lock:
+            for user_id in user_ids:
+                targets, totals, successes = self._targets(user_id)
+                for target, total, success in zip(targets, totals, successes):
+                    target_id = self._user_ids[target]
+                    edges.append((user_id, target_id, int(total), int(success)))
+                    if target_id in self._interests_of and target_id not in users:
+                        data = {'interests': list(self._interests_of[target_id])}
+                        if target_id in self._goal_of:
+                            data['relationshipGoals'] = self._goal_of[target_id]
+                        users[target_id] = data
+        return {'users': users, 'edges': edges}
+
+    def restore(self, snapshot: Dict):
+        """Cargar un subgrafo generado con `snapshot`"""
+        with self._lock:
+            for user_id, data in snapshot['users'].items():
+                self.upsert_user(user_id, data)
+            for source, target, total, success in snapshot['edges']:
+                self._pending.append((self._row(source), self._row(target), total, success))
+            self._flush()
+        self.is_ready = True
+
+    def get_stats(self) -> Dict:
+        """Estadísticas del grafo para monitorización"""
+        with self._lock:
+            return {
+                'users': len(self._user_ids),
+                'interactions': self._interactions,
+                'successful_documents': len(self._successful),
+                'edges': int(self._total.nnz),
+                'pending_deltas': len(self._pending),
+                'indexed_interests': len(self.interest_users),
+                'is_ready': self.is_ready,
+                'listening': bool(self._listeners),
+                'last_sync': self.last_sync.isoformat() if self.last_sync else None
+            }
@@ -0,0 +1,264 @@
+"""
+TuCitaSegura - Job de materialización de recomendaciones
+
+Precalcula el top-K de recomendaciones de cada usuario activo y lo guarda en
+el RecommendationStore del motor, desde donde get_recommendations_for_user
+lo sirve sin puntuar en línea.
+
+Los usuarios se reparten en particiones por género y zona (celda geográfica
+de `cell_size_deg` grados, que hace las veces de ciudad). Cada partición se
+envía a un proceso del pool con los perfiles de sus candidatos dentro del
+radio máximo y el subgrafo de interacciones de sus usuarios. Si el grafo del
+motor aún no está cargado se carga antes (sin listeners): sin él los procesos
+del pool darían el score colaborativo neutro a todos los candidatos.
+
+Cada proceso del pool monta un único MatchingEngine (inicializador del pool)
+y solo cambia de índice de candidatos y de grafo entre particiones.
+
+Ejecución (cron o tarea programada, con las credenciales de Firebase):
+
+    python -m app.services.ml.materialization --top-k 20 --output /ruta/recommendations.json
+
+El resultado se guarda en ML_RECOMMENDATION_STORE_PATH (o --output). Los
+workers de la API lo cargan al calentar el motor y lo recargan cuando el
+fichero cambia (RecommendationStore.refresh), de modo que
+get_recommendations_for_user sirve esas listas sin puntuar en línea.
+"""
+
+import argparse
+import logging
+import math
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from typing import Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
+
+from app.services.ml.recommendation_store import profile_signature
+
+if TYPE_CHECKING:
+    from app.services.ml.recommendation_engine import MatchingEngine, UserProfile
+
+logger = logging.getLogger(__name__)
+
+PartitionKey = Tuple[str, int, int]
+
+try:
+    from app.core.config import settings as app_settings
+    STORE_PATH = app_settings.ML_RECOMMENDATION_STORE_PATH
+except Exception:
+    STORE_PATH = ""
+
+# Motor del proceso del pool (lo crea _init_worker una vez por proceso)
+_worker_engine: Optional['MatchingEngine'] = None
+_worker_settings: Dict = {}
+
+
+def _init_worker(settings: Dict):
+    """Inicializador del pool: un MatchingEngine por proceso, no por partición"""
+    global _worker_engine, _worker_settings
+    from app.services.ml.recommendation_engine import MatchingEngine
+
+    engine = MatchingEngine()
+    engine.max_distance_km = settings['max_distance_km']
+    engine.min_compatibility_score = settings['min_compatibility_score']
+    _worker_engine = engine
+    _worker_settings = settings
+
+
+def _materialize_partition(payload: Dict) -> Dict[str, List[Dict]]:
+    """
+    Calcular el top-K de los usuarios de una partición (se ejecuta en el pool)
+
+    Carga en el motor del proceso los candidatos de la partición y, si se
+    envía, el subgrafo de interacciones, y aplica el mismo scoring que en línea.
+    """
+    from app.services.ml.candidate_index import CandidateIndex
+    from app.services.ml.interaction_graph import InteractionGraph
+
+    engine = _worker_engine
+    settings = _worker_settings
+    # Índice y grafo nuevos por partición (son baratos); el motor se reutiliza
+    engine.candidate_index = CandidateIndex(engine._profile_from_data)
+    engine.interaction_graph = InteractionGraph()
+
+    for profile in payload['candidates']:
+        engine.candidate_index.add_profile(profile)
+    engine.candidate_index.is_ready = True
+    if payload['graph'] is not None:
+        engine.interaction_graph.restore(payload['graph'])
+
+    results = {}
+    for profile in payload['requesters']:
+        columns = engine._get_candidate_columns(profile.user_id, profile)
+        if columns is None or len(columns) == 0:
+            results[profile.user_id] = []
+            continue
+        recommendations = engine._score_candidates_batch(profile, columns, settings['top_k'])
+        results[profile.user_id] = [asdict(rec) for rec in recommendations]
+    return results
+
+
+class RecommendationMaterializer:
+    """
+    Job batch que llena el RecommendationStore del motor
+    """
+
+    def __init__(
+        self,
+        engine: 'MatchingEngine',
+        top_k: int = 20,
+        workers: Optional[int] = None,
+        cell_size_deg: float = 1.0
+    ):
+        """
+        Args:
+            engine: Motor con el índice de candidatos cargado
+            top_k: Recomendaciones guardadas por usuario
+            workers: Procesos del pool (None = nº de CPUs, 0 = en el propio proceso)
+            cell_size_deg: Tamaño de la zona geográfica de cada partición
+        """
+        self.engine = engine
+        self.store = engine.recommendation_store
+        self.top_k = top_k
+        self.workers = workers
+        self.cell_size_deg = cell_size_deg
+
+    def _partition_key(self, profile: 'UserProfile') -> PartitionKey:
+        location = profile.location if isinstance(profile.location, dict) else {}
+        try:
+            row = int(math.floor(float(location.get('lat', 0)) / self.cell_size_deg))
+            col = int(math.floor(float(location.get('lng', 0)) / self.cell_size_deg))
+        except (TypeError, ValueError):
+            row = col = 0
+        return profile.gender, row, col
+
+    def partition(self, profiles: Iterable['UserProfile']) -> Dict[PartitionKey, List['UserProfile']]:
+        """Agrupar usuarios por (género, zona)"""
+        partitions: Dict[PartitionKey, List['UserProfile']] = {}
+        for profile in profiles:
+            partitions.setdefault(self._partition_key(profile), []).append(profile)
+        return partitions
+
+    def _payload(self, requesters: List['UserProfile']) -> Dict:
+        index = self.engine.candidate_index
+        candidate_ids = set()
+        for profile in requesters:
+            location = profile.location if isinstance(profile.location, dict) else {}
+            try:
+                lat, lng = float(location.get('lat', 0)), float(location.get('lng', 0))
+            except (TypeError, ValueError):
+                continue
+            for user_id, _ in index.geo_index.query_radius(lat, lng, self.engine.max_distance_km):
+                candidate_ids.add(user_id)
+
+        candidates = [index.get(user_id) for user_id in sorted(candidate_ids)]
+        graph = None
+        if self.engine.interaction_graph.is_ready:
+            graph = self.engine.interaction_graph.snapshot(profile.user_id for profile in requesters)
+
+        return {
+            'requesters': requesters,
+            'candidates': [profile for profile in candidates if profile is not None],
+            'graph': graph
+        }
+
+    def _settings(self) -> Dict:
+        return {
+            'top_k': self.top_k,
+            'max_distance_km': self.engine.max_distance_km,
+            'min_compatibility_score': self.engine.min_compatibility_score
+        }
+
+    def run(self, user_ids: Optional[Iterable[str]] = None) -> Dict:
+        """
+        Materializar las recomendaciones de los usuarios indicados (todos por defecto)
+
+        Returns:
+            Estadísticas de la ejecución
+        """
+        index = self.engine.candidate_index
+        if not index.is_ready:
+            logger.warning("[RecommendationMaterializer] El índice de candidatos no está cargado")
+            return {'users': 0, 'partitions': 0, 'elapsed_seconds': 0.0}
+
+        started = time.perf_counter()
+        if not self.engine.interaction_graph.is_ready and not self.engine.enable_interaction_graph(listen=False):
+            # Sin Firestore tampoco el scoring en línea tiene interacciones: ambos dan el score neutro
+            logger.warning("[RecommendationMaterializer] Grafo de interacciones no disponible")
+        profiles = index.profiles()
+        if user_ids is not None:
+            wanted = set(user_ids)
+            profiles = [profile for profile in profiles if profile.user_id in wanted]
+
+        partitions = self.partition(profiles)
+        payloads = [self._payload(partitions[key]) for key in sorted(partitions)]
+
+        if self.workers == 0:
+            _init_worker(self._settings())
+            results = map(_materialize_partition, payloads)
+            stored = self._store_results(results)
+        else:
+            # spawn: no se heredan los hilos ni conexiones gRPC del proceso padre
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=context,
+                initializer=_init_worker, initargs=(self._settings(),)
+            ) as pool:
+                stored = self._store_results(pool.map(_materialize_partition, payloads))
+
+        elapsed = time.perf_counter() - started
+        logger.info(
+            f"[RecommendationMaterializer] {stored} usuarios en {len(payloads)} particiones ({elapsed:.1f}s)"
+        )
+        return {'users': stored, 'partitions': len(payloads), 'elapsed_seconds': elapsed}
+
+    def _store_results(self, results: Iterable[Dict[str, List[Dict]]]) -> int:
+        index = self.engine.candidate_index
+        stored = 0
+        for partition_results in results:
+            for user_id, recommendations in partition_results.items():
+                signatures = {}
+                for profile_id in [user_id] + [rec['user_id'] for rec in recommendations]:
+                    profile = index.get(profile_id)
+                    if profile is not None:
+                        signatures[profile_id] = profile_signature(profile)
+                self.store.put(user_id, recommendations, self.top_k, signatures)
+                stored += 1
+        return stored
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Entrada del job: materializar todos los usuarios activos y guardar el almacén"""
+    parser = argparse.ArgumentParser(description="Materializar el top-K de recomendaciones")
+    parser.add_argument('--top-k', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--cell-size-deg', type=float, default=1.0)
+    parser.add_argument('--output', default=STORE_PATH, help="Fichero del almacén (ML_RECOMMENDATION_STORE_PATH)")
+    args = parser.parse_args(argv)
+    if not args.output:
+        parser.error("indica --output o ML_RECOMMENDATION_STORE_PATH")
+
+    import firebase_admin
+    from app.services.ml.recommendation_engine import MatchingEngine
+
+    if not firebase_admin._apps:
+        # Credenciales por defecto (GOOGLE_APPLICATION_CREDENTIALS)
+        firebase_admin.initialize_app()
+    engine = MatchingEngine()
+    # Una sola lectura de los datos: el job no necesita listeners
+    if not engine.enable_candidate_index(listen=False):
+        logger.error("[RecommendationMaterializer] No se pudo cargar el índice de candidatos")
+        return 1
+    materializer = RecommendationMaterializer(
+        engine, top_k=args.top_k, workers=args.workers, cell_size_deg=args.cell_size_deg
+    )
+    stats = materializer.run()
+    engine.recommendation_store.save(args.output)
+    logger.info(f"[RecommendationMaterializer] Almacén guardado en {args.output}: {stats}")
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    raise SystemExit(main())
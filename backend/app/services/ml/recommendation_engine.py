@@ -9,21 +9,35 @@ Este módulo implementa un sistema de recomendaciones inteligente que utiliza:
 - Behavioral patterns
 """
 
+import asyncio
 import numpy as np
-import pandas as pd
 from typing import List, Dict, Optional, Tuple
 from datetime import datetime, timedelta
 import logging
-from dataclasses import dataclass
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.preprocessing import StandardScaler, LabelEncoder
-import firebase_admin
-from firebase_admin import firestore
+from dataclasses import dataclass, asdict
 import json
+import os
+import threading
+from app.services.ml.batch_scoring import BatchScorer, CandidateColumns
+from app.services.ml.candidate_index import CandidateIndex
+from app.services.ml.embedding_index import EmbeddingIndex, MATRIX_FILE as EMBEDDINGS_MATRIX_FILE
+from app.services.ml.interaction_graph import InteractionGraph
+from app.services.ml.recommendation_store import RecommendationStore
+from app.utils.cache import TTLCache
+from app.core.firestore_async import AsyncFirestore, get_async_firestore
 
 logger = logging.getLogger(__name__)
 
+try:
+    from app.core.config import settings
+    RESIDENT_INDEXES = settings.ML_RESIDENT_INDEXES
+    EMBEDDING_INDEX_PATH = settings.ML_EMBEDDING_INDEX_PATH
+    RECOMMENDATION_STORE_PATH = settings.ML_RECOMMENDATION_STORE_PATH
+except Exception:
+    RESIDENT_INDEXES = True
+    EMBEDDING_INDEX_PATH = ""
+    RECOMMENDATION_STORE_PATH = ""
+
 @dataclass
 class UserProfile:
     """Perfil de usuario para recomendaciones"""
@@ -48,6 +62,7 @@ class UserProfile:
     exercise: str
     religion: str
     politics: str
+    bio: str = ''
 
 @dataclass
 class InteractionData:
@@ -79,25 +94,173 @@ class MatchingEngine:
     def __init__(self):
         # Inicializar Firebase solo si está disponible
         try:
+            from firebase_admin import firestore
             self.db = firestore.client()
         except Exception as e:
             logger.warning(f"Firebase no disponible, usando modo demo: {e}")
             self.db = None
+        # Capa async sobre self.db (se resuelve al primer uso con _async_firestore)
+        self.async_db: Optional[AsyncFirestore] = None
             
         self.collaborative_weight = 0.4
         self.content_weight = 0.3
         self.geographic_weight = 0.2
         self.behavioral_weight = 0.1
         
-        # Modelos y escaladores
-        self.tfidf_vectorizer = TfidfVectorizer(max_features=100, stop_words='spanish')
-        self.scaler = StandardScaler()
+        # Modelos y escaladores (el pipeline de embeddings se ajusta en enable_embedding_index)
+        self.embedding_index = EmbeddingIndex()
         self.label_encoders = {}
         
+        # Scoring vectorizado del pool de candidatos
+        self.batch_scorer = BatchScorer(
+            collaborative_weight=self.collaborative_weight,
+            content_weight=self.content_weight,
+            geographic_weight=self.geographic_weight,
+            behavioral_weight=self.behavioral_weight
+        )
+        
         # Umbrales de configuración
         self.max_distance_km = 100
         self.min_compatibility_score = 0.6
         self.max_recommendations = 20
+        self.shortlist_size = 500
+        
+        # Índice residente de candidatos (se activa con enable_candidate_index)
+        self.candidate_index = CandidateIndex(self._profile_from_data)
+        
+        # Grafo de interacciones para filtrado colaborativo (se activa con enable_interaction_graph)
+        self.interaction_graph = InteractionGraph()
+        
+        # Top-K precalculado por el job de materialización (se carga de su fichero)
+        self.recommendation_store = RecommendationStore(path=RECOMMENDATION_STORE_PATH or None)
+        self.candidate_index.subscribe(self.recommendation_store.on_profile_change)
+        
+        # Cachés de proceso para el filtrado colaborativo sin grafo
+        self.interactions_cache = TTLCache(max_entries=1024, ttl_seconds=300)
+        self.similar_users_cache = TTLCache(max_entries=4096, ttl_seconds=600)
+        # Los listeners invalidan lo que cambia sin esperar al TTL
+        self.candidate_index.subscribe(self.invalidate_user_cache)
+        self.interaction_graph.subscribe(self.invalidate_user_cache)
+        
+    def enable_candidate_index(self, listen: bool = True) -> bool:
+        """
+        Cargar el índice de candidatos y mantenerlo sincronizado con Firestore
+        
+        Args:
+            listen: Suscribirse a cambios en tiempo real; si es False el índice
+                debe refrescarse periódicamente con candidate_index.refresh(db)
+                
+        Returns:
+            True si el índice quedó operativo
+        """
+        if not self.db:
+            return False
+        try:
+            self.candidate_index.load(self.db)
+            if listen:
+                self.candidate_index.start_listener(self.db)
+            return True
+        except Exception as e:
+            logger.error(f"[MatchingEngine] Error iniciando índice de candidatos: {e}")
+            return False
+        
+    def enable_interaction_graph(self, listen: bool = True) -> bool:
+        """
+        Cargar el grafo de interacciones y mantenerlo sincronizado con Firestore
+        
+        Args:
+            listen: Suscribirse a cambios en tiempo real de users, likes y messages
+                
+        Returns:
+            True si el grafo quedó operativo
+        """
+        if not self.db:
+            return False
+        try:
+            self.interaction_graph.load(self.db)
+            if listen:
+                self.interaction_graph.start_listener(self.db)
+            return True
+        except Exception as e:
+            logger.error(f"[MatchingEngine] Error iniciando grafo de interacciones: {e}")
+            return False
+        
+    def enable_resident_indexes(self) -> Dict[str, bool]:
+        """
+        Activar las estructuras residentes con las que get_smart_recommendations
+        deja de recorrer la colección `users` en cada petición
+        
+        Returns:
+            Estado de cada estructura (vacío sin Firebase)
+        """
+        if not self.db:
+            return {}
+        status = {
+            'candidate_index': self.enable_candidate_index(),
+            'interaction_graph': self.enable_interaction_graph()
+        }
+        # Se construye con los perfiles del índice de candidatos (o se abre de disco)
+        status['embedding_index'] = self.enable_embedding_index(EMBEDDING_INDEX_PATH or None)
+        logger.info(f"[MatchingEngine] Índices residentes: {status}")
+        return status
+        
+    @property
+    def tfidf_vectorizer(self):
+        return self.embedding_index.embedder.vectorizer
+    
+    @property
+    def scaler(self):
+        return self.embedding_index.embedder.scaler
+    
+    def enable_embedding_index(self, path: Optional[str] = None) -> bool:
+        """
+        Preparar el índice de embeddings usado para preseleccionar candidatos
+        
+        Si `path` contiene un índice persistido se abre memory-mapped; si no,
+        se construye con los perfiles del índice de candidatos y se guarda en
+        `path` (si se indica).
+        
+        Returns:
+            True si el índice quedó operativo
+        """
+        try:
+            if path and os.path.exists(os.path.join(path, EMBEDDINGS_MATRIX_FILE)):
+                self.embedding_index.load(path)
+                return True
+            if not self.candidate_index.is_ready:
+                logger.warning("[MatchingEngine] El índice de embeddings requiere el índice de candidatos")
+                return False
+            self.embedding_index.build(self.candidate_index.profiles(), path)
+            return True
+        except Exception as e:
+            logger.error(f"[MatchingEngine] Error iniciando índice de embeddings: {e}")
+            return False
+        
+    def get_cache_stats(self) -> Dict:
+        """Contadores de las cachés de interacciones y usuarios similares"""
+        return {
+            'interactions': self.interactions_cache.get_stats(),
+            'similar_users': self.similar_users_cache.get_stats()
+        }
+        
+    def invalidate_user_cache(self, user_id: str, profile: Optional[UserProfile] = None):
+        """
+        Descartar lo cacheado que depende de un usuario
+        
+        Sus interacciones y los conjuntos de usuarios similares en los que
+        estaba o en los que entra con el perfil nuevo (intereses o meta).
+        """
+        self.interactions_cache.invalidate(user_id)
+        
+        def stale(fingerprint, members) -> bool:
+            if user_id in members:
+                return True
+            if profile is None:
+                return False
+            interests, goal = fingerprint
+            return bool(interests & set(profile.interests)) or goal == profile.relationship_goals
+        
+        self.similar_users_cache.invalidate_where(stale)
         
     def get_smart_recommendations(
         self, 
@@ -125,33 +288,81 @@ class MatchingEngine:
                 logger.warning(f"[MatchingEngine] Perfil no encontrado para usuario {user_id}")
                 return []
             
-            # Obtener pool de usuarios candidatos
-            candidate_pool = self._get_candidate_pool(user_id, user_profile, filters)
-            if not candidate_pool:
+            return self._recommend_for_profile(user_id, user_profile, limit, filters)
+            
+        except Exception as e:
+            logger.error(f"[MatchingEngine] Error generando recomendaciones: {e}", exc_info=True)
+            return []
+    
+    async def get_smart_recommendations_async(
+        self,
+        user_id: str,
+        limit: int = 10,
+        filters: Optional[Dict] = None
+    ) -> List[Recommendation]:
+        """
+        Versión async de get_smart_recommendations para endpoints de FastAPI
+        
+        El perfil se lee con la capa async y el scoring (y cualquier consulta
+        síncrona de respaldo) se ejecuta en el pool de hilos, sin bloquear el
+        event loop.
+        """
+        async_db = self._async_firestore()
+        try:
+            if self.db:
+                user_data = await async_db.get_document('users', user_id)
+            else:
+                user_data = self._get_demo_user_data(user_id)
+            if not user_data:
+                logger.warning(f"[MatchingEngine] Perfil no encontrado para usuario {user_id}")
+                return []
+            
+            user_profile = self._profile_from_data(user_id, user_data)
+            return await async_db.run(self._recommend_for_profile, user_id, user_profile, limit, filters)
+            
+        except Exception as e:
+            logger.error(f"[MatchingEngine] Error generando recomendaciones: {e}", exc_info=True)
+            return []
+    
+    def _async_firestore(self) -> AsyncFirestore:
+        """
+        Capa async sobre el cliente del motor
+
+        La compartida si self.db es el cliente por defecto (o no hay cliente);
+        una propia si se inyectó otro, para no leer de la app por defecto.
+        """
+        if self.async_db is None:
+            shared = get_async_firestore()
+            try:
+                default_client = shared.client
+            except Exception:
+                default_client = None
+            if self.db is None or self.db is default_client:
+                self.async_db = shared
+            else:
+                self.async_db = AsyncFirestore(client=self.db)
+        return self.async_db
+    
+    def _recommend_for_profile(
+        self,
+        user_id: str,
+        user_profile: UserProfile,
+        limit: int,
+        filters: Optional[Dict] = None
+    ) -> List[Recommendation]:
+        """Candidatos, preselección y scoring para un perfil ya cargado"""
+        try:
+            # Obtener pool de usuarios candidatos en formato columnar
+            candidates = self._get_candidate_columns(user_id, user_profile, filters)
+            if candidates is None or len(candidates) == 0:
                 logger.info(f"[MatchingEngine] No hay candidatos disponibles para {user_id}")
                 return []
             
-            # Calcular scores para cada candidato
-            recommendations = []
-            for candidate in candidate_pool:
-                score, reasons = self._calculate_compatibility_score(user_profile, candidate)
-                
-                if score >= self.min_compatibility_score:
-                    recommendation = Recommendation(
-                        user_id=candidate.user_id,
-                        score=score,
-                        reasons=reasons,
-                        compatibility_percentage=score * 100,
-                        distance_km=self._calculate_distance(user_profile.location, candidate.location),
-                        common_interests=list(set(user_profile.interests) & set(candidate.interests)),
-                        predicted_success_rate=self._predict_success_rate(user_profile, candidate),
-                        risk_factors=self._assess_risk_factors(candidate)
-                    )
-                    recommendations.append(recommendation)
+            # Preselección por similitud de embeddings en pools grandes
+            candidates = self._shortlist_candidates(user_profile, candidates)
             
-            # Ordenar por score y aplicar límite
-            recommendations.sort(key=lambda x: x.score, reverse=True)
-            final_recommendations = recommendations[:limit]
+            # Calcular scores de todo el pool con operaciones vectorizadas
+            final_recommendations = self._score_candidates_batch(user_profile, candidates, limit)
             
             # Log de métricas
             logger.info(f"[MatchingEngine] Generadas {len(final_recommendations)} recomendaciones para {user_id}")
@@ -162,6 +373,120 @@ class MatchingEngine:
             logger.error(f"[MatchingEngine] Error generando recomendaciones: {e}", exc_info=True)
             return []
     
+    def _get_candidate_columns(
+        self,
+        user_id: str,
+        user_profile: UserProfile,
+        filters: Optional[Dict] = None
+    ) -> Optional[CandidateColumns]:
+        """Obtener el pool de candidatos desde el índice residente o desde Firestore"""
+        if not self.candidate_index.is_ready:
+            candidate_pool = self._get_candidate_pool(user_id, user_profile, filters)
+            if not candidate_pool:
+                return None
+            return CandidateColumns.from_profiles(candidate_pool)
+        
+        try:
+            filters = filters or {}
+            
+            # Mismo filtro de género que la consulta a Firestore
+            genders = None
+            if user_profile.gender == 'masculino':
+                genders = ['femenino']
+            elif user_profile.gender == 'femenino':
+                genders = ['masculino']
+            
+            # Solo se materializan los candidatos dentro del radio máximo
+            lat = user_profile.location.get('lat', 0)
+            lng = user_profile.location.get('lng', 0)
+            return self.candidate_index.query(
+                genders=genders,
+                min_age=filters.get('min_age'),
+                max_age=filters.get('max_age'),
+                exclude_user_id=user_id,
+                verification_level=filters.get('verification_level'),
+                near=(lat, lng, self.max_distance_km)
+            )
+            
+        except Exception as e:
+            logger.error(f"[MatchingEngine] Error consultando índice de candidatos: {e}")
+            return None
+    
+    def _shortlist_candidates(self, user_profile: UserProfile, candidates: CandidateColumns) -> CandidateColumns:
+        """Reducir el pool a los perfiles más parecidos antes del scoring exacto"""
+        if not self.embedding_index.is_ready or len(candidates) <= self.shortlist_size:
+            return candidates
+        try:
+            query = self.embedding_index.embed(user_profile)
+            positions = self.embedding_index.shortlist(query, candidates.ids, self.shortlist_size)
+            return candidates.take(positions)
+        except Exception as e:
+            logger.error(f"[MatchingEngine] Error en la preselección por embeddings: {e}")
+            return candidates
+    
+    def _score_candidates_batch(
+        self,
+        user_profile: UserProfile,
+        candidates,
+        limit: int
+    ) -> List[Recommendation]:
+        """
+        Puntuar el pool completo en columnas NumPy y materializar solo el top
+        
+        Equivale a aplicar _calculate_compatibility_score, _calculate_distance,
+        _predict_success_rate y _assess_risk_factors candidato a candidato.
+        
+        Args:
+            user_profile: Perfil del usuario objetivo
+            candidates: CandidateColumns o lista de UserProfile
+            limit: Número máximo de recomendaciones
+        """
+        if isinstance(candidates, CandidateColumns):
+            columns = candidates
+        else:
+            columns = CandidateColumns.from_profiles(candidates)
+        if self.interaction_graph.is_ready:
+            collaborative = self.interaction_graph.collaborative_scores(user_profile.user_id, columns)
+        else:
+            # Caché de la petición: las interacciones del usuario se leen una sola vez
+            request_cache = {}
+            collaborative = np.array([
+                self._calculate_collaborative_score(user_profile, candidate, request_cache)
+                for candidate in columns.profiles
+            ], dtype=np.float64)
+        scores = self.batch_scorer.score(user_profile, columns, collaborative)
+        
+        # Filtrar por umbral y ordenar de forma estable (igual que list.sort)
+        eligible = np.flatnonzero(scores.final >= self.min_compatibility_score)
+        order = eligible[np.argsort(-scores.final[eligible], kind='stable')][:limit]
+        
+        recommendations = []
+        user_interests = set(user_profile.interests)
+        for idx in order:
+            candidate = columns.profiles[idx]
+            # En el orden del candidato: igual en cualquier proceso (el orden de un set depende de PYTHONHASHSEED)
+            common_interests = [interest for interest in dict.fromkeys(candidate.interests) if interest in user_interests]
+            
+            reasons = []
+            if common_interests:
+                reasons.append(f"Intereses comunes: {', '.join(common_interests[:3])}")
+            if scores.goals_match[idx]:
+                reasons.append("Metas de relación compatibles")
+            
+            score = float(scores.final[idx])
+            recommendations.append(Recommendation(
+                user_id=candidate.user_id,
+                score=score,
+                reasons=reasons,
+                compatibility_percentage=score * 100,
+                distance_km=float(scores.distance_km[idx]),
+                common_interests=common_interests,
+                predicted_success_rate=float(scores.success_rate[idx]),
+                risk_factors=self._assess_risk_factors(candidate)
+            ))
+        
+        return recommendations
+    
     def _get_user_profile(self, user_id: str) -> Optional[UserProfile]:
         """Obtener perfil completo de usuario desde Firestore o modo demo"""
         try:
@@ -178,34 +503,39 @@ class MatchingEngine:
                     return None
             
             # Extraer datos de perfil
-            return UserProfile(
-                user_id=user_id,
-                age=user_data.get('age', 25),
-                gender=user_data.get('gender', ''),
-                location=user_data.get('location', {'lat': 0, 'lng': 0}),
-                interests=user_data.get('interests', []),
-                profession=user_data.get('profession', ''),
-                education_level=user_data.get('educationLevel', ''),
-                relationship_goals=user_data.get('relationshipGoals', ''),
-                personality_traits=user_data.get('personalityTraits', {}),
-                preferences=user_data.get('preferences', {}),
-                activity_score=user_data.get('activityScore', 0.5),
-                reputation_score=user_data.get('reputationScore', 0.5),
-                verification_level=user_data.get('verificationLevel', 'none'),
-                photos_count=user_data.get('photosCount', 0),
-                bio_length=len(user_data.get('bio', '')),
-                languages=user_data.get('languages', []),
-                smoking=user_data.get('smoking', 'no_preference'),
-                drinking=user_data.get('drinking', 'no_preference'),
-                exercise=user_data.get('exercise', 'no_preference'),
-                religion=user_data.get('religion', 'no_preference'),
-                politics=user_data.get('politics', 'no_preference')
-            )
+            return self._profile_from_data(user_id, user_data)
             
         except Exception as e:
             logger.error(f"[MatchingEngine] Error obteniendo perfil de {user_id}: {e}")
             return None
     
+    def _profile_from_data(self, user_id: str, user_data: Dict) -> UserProfile:
+        """Construir un UserProfile a partir de un documento de `users`"""
+        return UserProfile(
+            user_id=user_id,
+            age=user_data.get('age', 25),
+            gender=user_data.get('gender', ''),
+            location=user_data.get('location', {'lat': 0, 'lng': 0}),
+            interests=user_data.get('interests', []),
+            profession=user_data.get('profession', ''),
+            education_level=user_data.get('educationLevel', ''),
+            relationship_goals=user_data.get('relationshipGoals', ''),
+            personality_traits=user_data.get('personalityTraits', {}),
+            preferences=user_data.get('preferences', {}),
+            activity_score=user_data.get('activityScore', 0.5),
+            reputation_score=user_data.get('reputationScore', 0.5),
+            verification_level=user_data.get('verificationLevel', 'none'),
+            photos_count=user_data.get('photosCount', 0),
+            bio_length=len(user_data.get('bio', '')),
+            languages=user_data.get('languages', []),
+            smoking=user_data.get('smoking', 'no_preference'),
+            drinking=user_data.get('drinking', 'no_preference'),
+            exercise=user_data.get('exercise', 'no_preference'),
+            religion=user_data.get('religion', 'no_preference'),
+            politics=user_data.get('politics', 'no_preference'),
+            bio=user_data.get('bio', '')
+        )
+    
     def _get_demo_user_data(self, user_id: str) -> Optional[Dict]:
         """Datos de demo para testing cuando Firebase no está disponible"""
         demo_users = {
@@ -372,29 +702,7 @@ class MatchingEngine:
                     continue
                 
                 # Crear perfil de candidato
-                candidate = UserProfile(
-                    user_id=candidate_id,
-                    age=candidate_data.get('age', 25),
-                    gender=candidate_data.get('gender', ''),
-                    location=candidate_location,
-                    interests=candidate_data.get('interests', []),
-                    profession=candidate_data.get('profession', ''),
-                    education_level=candidate_data.get('educationLevel', ''),
-                    relationship_goals=candidate_data.get('relationshipGoals', ''),
-                    personality_traits=candidate_data.get('personalityTraits', {}),
-                    preferences=candidate_data.get('preferences', {}),
-                    activity_score=candidate_data.get('activityScore', 0.5),
-                    reputation_score=candidate_data.get('reputationScore', 0.5),
-                    verification_level=candidate_data.get('verificationLevel', 'none'),
-                    photos_count=candidate_data.get('photosCount', 0),
-                    bio_length=len(candidate_data.get('bio', '')),
-                    languages=candidate_data.get('languages', []),
-                    smoking=candidate_data.get('smoking', 'no_preference'),
-                    drinking=candidate_data.get('drinking', 'no_preference'),
-                    exercise=candidate_data.get('exercise', 'no_preference'),
-                    religion=candidate_data.get('religion', 'no_preference'),
-                    politics=candidate_data.get('politics', 'no_preference')
-                )
+                candidate = self._profile_from_data(candidate_id, candidate_data)
                 
                 candidates.append(candidate)
             
@@ -435,17 +743,31 @@ class MatchingEngine:
         
         return final_score, reasons
     
-    def _calculate_collaborative_score(self, user1: UserProfile, user2: UserProfile) -> float:
-        """Calcular score basado en interacciones pasadas"""
+    def _calculate_collaborative_score(
+        self,
+        user1: UserProfile,
+        user2: UserProfile,
+        request_cache: Optional[Dict] = None
+    ) -> float:
+        """
+        Calcular score basado en interacciones pasadas
+        
+        Args:
+            request_cache: Caché compartida por los candidatos de una misma petición
+        """
         try:
+            # Con el grafo residente el score es una consulta en memoria
+            if self.interaction_graph.is_ready:
+                return self.interaction_graph.collaborative_score(user1.user_id, user2)
+            
             # Obtener interacciones del usuario 1 con otros usuarios similares al 2
-            interactions = self._get_user_interactions(user1.user_id)
+            interactions = self._get_user_interactions(user1.user_id, request_cache)
             
             if not interactions:
                 return 0.5  # Score neutral si no hay datos
             
             # Encontrar usuarios similares al usuario 2
-            similar_users = self._find_similar_users(user2)
+            similar_users = set(self._find_similar_users(user2, request_cache))
             
             # Calcular score basado en interacciones exitosas con usuarios similares
             successful_interactions = 0
@@ -481,7 +803,8 @@ class MatchingEngine:
         scores.append(interest_score * 0.3)
         
         if common_interests:
-            reasons.append(f"Intereses comunes: {', '.join(list(common_interests)[:3])}")
+            ordered = [interest for interest in dict.fromkeys(user2.interests) if interest in common_interests]
+            reasons.append(f"Intereses comunes: {', '.join(ordered[:3])}")
         
         # 2. Compatibilidad de metas de relación (25%)
         goal_score = 1.0 if user1.relationship_goals == user2.relationship_goals else 0.3
@@ -592,69 +915,113 @@ class MatchingEngine:
             logger.error(f"[MatchingEngine] Error calculando distancia: {e}")
             return float('inf')
     
-    def _get_user_interactions(self, user_id: str) -> List[InteractionData]:
-        """Obtener historial de interacciones del usuario"""
+    def _get_user_interactions(
+        self,
+        user_id: str,
+        request_cache: Optional[Dict] = None
+    ) -> List[InteractionData]:
+        """Obtener historial de interacciones del usuario (cacheado por user_id)"""
+        key = ('interactions', user_id)
+        if request_cache is not None and key in request_cache:
+            return request_cache[key]
+        
         try:
-            interactions = []
-            
-            # Obtener likes dados
-            likes_query = self.db.collection('likes').where('fromUserId', '==', user_id)
-            for doc in likes_query.stream():
-                data = doc.to_dict()
-                interactions.append(InteractionData(
-                    user_id=user_id,
-                    target_user_id=data.get('toUserId', ''),
-                    interaction_type='like',
-                    timestamp=data.get('timestamp', datetime.now()),
-                    success_outcome=data.get('matched', False),
-                    interaction_score=1.0 if data.get('matched', False) else 0.3
-                ))
-            
-            # Obtener mensajes enviados
-            messages_query = self.db.collection('messages').where('senderId', '==', user_id)
-            for doc in messages_query.stream():
-                data = doc.to_dict()
-                interactions.append(InteractionData(
-                    user_id=user_id,
-                    target_user_id=data.get('receiverId', ''),
-                    interaction_type='message',
-                    timestamp=data.get('timestamp', datetime.now()),
-                    success_outcome=data.get('ledToDate', False),
-                    interaction_score=0.8 if data.get('ledToDate', False) else 0.5
-                ))
-            
-            return interactions
-            
+            interactions = self.interactions_cache.get_or_load(
+                user_id, lambda: self._fetch_user_interactions(user_id)
+            )
         except Exception as e:
             logger.error(f"[MatchingEngine] Error obteniendo interacciones: {e}")
-            return []
+            interactions = []
+        
+        if request_cache is not None:
+            request_cache[key] = interactions
+        return interactions
     
-    def _find_similar_users(self, target_user: UserProfile) -> List[str]:
-        """Encontrar usuarios similares al objetivo"""
+    def _fetch_user_interactions(self, user_id: str) -> List[InteractionData]:
+        """Leer de Firestore los likes y mensajes enviados por el usuario"""
+        interactions = []
+        
+        # Obtener likes dados
+        likes_query = self.db.collection('likes').where('fromUserId', '==', user_id)
+        for doc in likes_query.stream():
+            data = doc.to_dict()
+            interactions.append(InteractionData(
+                user_id=user_id,
+                target_user_id=data.get('toUserId', ''),
+                interaction_type='like',
+                timestamp=data.get('timestamp', datetime.now()),
+                success_outcome=data.get('matched', False),
+                interaction_score=1.0 if data.get('matched', False) else 0.3
+            ))
+        
+        # Obtener mensajes enviados
+        messages_query = self.db.collection('messages').where('senderId', '==', user_id)
+        for doc in messages_query.stream():
+            data = doc.to_dict()
+            interactions.append(InteractionData(
+                user_id=user_id,
+                target_user_id=data.get('receiverId', ''),
+                interaction_type='message',
+                timestamp=data.get('timestamp', datetime.now()),
+                success_outcome=data.get('ledToDate', False),
+                interaction_score=0.8 if data.get('ledToDate', False) else 0.5
+            ))
+        
+        return interactions
+    
+    def _find_similar_users(
+        self,
+        target_user: UserProfile,
+        request_cache: Optional[Dict] = None
+    ) -> List[str]:
+        """
+        Encontrar usuarios similares al objetivo
+        
+        El conjunto depende solo de los intereses y la meta de relación, así que
+        se cachea por esa huella y lo comparten todos los candidatos que la tengan.
+        """
+        key = None
         try:
-            similar_users = []
-            
-            # Buscar usuarios con intereses similares
-            for interest in target_user.interests:
-                users_query = self.db.collection('users').where('interests', 'array_contains', interest)
-                for doc in users_query.stream():
-                    user_id = doc.id
-                    if user_id != target_user.user_id:
-                        similar_users.append(user_id)
+            if self.interaction_graph.is_ready:
+                return list(self.interaction_graph.similar_users(target_user))
             
-            # Buscar usuarios con metas de relación similares
-            goals_query = self.db.collection('users').where('relationshipGoals', '==', target_user.relationship_goals)
-            for doc in goals_query.stream():
-                user_id = doc.id
-                if user_id != target_user.user_id:
-                    similar_users.append(user_id)
+            fingerprint = (frozenset(target_user.interests), target_user.relationship_goals)
+            key = ('similar_users', fingerprint)
+            if request_cache is not None and key in request_cache:
+                members = request_cache[key]
+            else:
+                members = self.similar_users_cache.get_or_load(
+                    fingerprint, lambda: self._fetch_similar_users(target_user)
+                )
+                if request_cache is not None:
+                    request_cache[key] = members
             
-            return list(set(similar_users))  # Eliminar duplicados
+            return list(members - {target_user.user_id})
             
         except Exception as e:
             logger.error(f"[MatchingEngine] Error encontrando usuarios similares: {e}")
+            # Evitar reintentos por cada candidato de la misma petición
+            if request_cache is not None and key is not None:
+                request_cache[key] = frozenset()
             return []
     
+    def _fetch_similar_users(self, target_user: UserProfile) -> frozenset:
+        """Leer de Firestore los usuarios que comparten intereses o meta de relación"""
+        similar_users = set()
+        
+        # Buscar usuarios con intereses similares
+        for interest in set(target_user.interests):
+            users_query = self.db.collection('users').where('interests', 'array_contains', interest)
+            for doc in users_query.stream():
+                similar_users.add(doc.id)
+        
+        # Buscar usuarios con metas de relación similares
+        goals_query = self.db.collection('users').where('relationshipGoals', '==', target_user.relationship_goals)
+        for doc in goals_query.stream():
+            similar_users.add(doc.id)
+        
+        return frozenset(similar_users)
+    
     def _predict_success_rate(self, user1: UserProfile, user2: UserProfile) -> float:
         """Predecir probabilidad de éxito de una potencial relación"""
         try:
@@ -708,8 +1075,29 @@ class MatchingEngine:
         
         return risks
 
-# Instancia global del motor de recomendaciones
-matching_engine = MatchingEngine()
+# Instancia global del motor de recomendaciones: se crea al primer uso
+# (get_matching_engine), no al importar el módulo
+matching_engine: Optional[MatchingEngine] = None
+_matching_engine_lock = threading.Lock()
+
+def get_matching_engine() -> MatchingEngine:
+    """
+    Motor compartido (se crea al primer uso o en el calentamiento de arranque)
+    
+    Con ML_RESIDENT_INDEXES el motor se publica ya con sus índices residentes
+    cargados y escuchando cambios; mientras tanto el resto de hilos espera.
+    """
+    global matching_engine
+    if matching_engine is None:
+        with _matching_engine_lock:
+            if matching_engine is None:
+                engine = MatchingEngine()
+                if RESIDENT_INDEXES:
+                    engine.enable_resident_indexes()
+                # Listas del job de materialización (ML_RECOMMENDATION_STORE_PATH)
+                engine.recommendation_store.refresh()
+                matching_engine = engine
+    return matching_engine
 
 def get_recommendations_for_user(user_id: str, limit: int = 10, filters: Optional[Dict] = None) -> List[Dict]:
     """
@@ -723,7 +1111,15 @@ def get_recommendations_for_user(user_id: str, limit: int = 10, filters: Optiona
     Returns:
         Lista de recomendaciones como diccionarios
     """
-    recommendations = matching_engine.get_smart_recommendations(user_id, limit, filters)
+    # Listas precalculadas (solo se materializan sin filtros adicionales)
+    if not filters:
+        store = get_matching_engine().recommendation_store
+        store.refresh()
+        stored = store.get(user_id, limit)
+        if stored is not None:
+            return stored
+    
+    recommendations = get_matching_engine().get_smart_recommendations(user_id, limit, filters)
     
     # Convertir a diccionarios para serialización JSON
     return [
@@ -739,3 +1135,16 @@ def get_recommendations_for_user(user_id: str, limit: int = 10, filters: Optiona
         }
         for rec in recommendations
     ]
+
+async def get_recommendations_for_user_async(user_id: str, limit: int = 10, filters: Optional[Dict] = None) -> List[Dict]:
+    """Versión async de get_recommendations_for_user (no bloquea el event loop)"""
+    if not filters:
+        store = get_matching_engine().recommendation_store
+        if store.refresh_due():
+            await asyncio.get_running_loop().run_in_executor(None, store.refresh)
+        stored = store.get(user_id, limit)
+        if stored is not None:
+            return stored
+    
+    recommendations = await get_matching_engine().get_smart_recommendations_async(user_id, limit, filters)
+    return [asdict(rec) for rec in recommendations]
@@ -0,0 +1,247 @@
+"""
+TuCitaSegura - Almacén de recomendaciones precalculadas
+
+Guarda, por user_id, el top-K de recomendaciones calculado por el job de
+materialización (ver materialization.py) en forma de tuplas compactas.
+
+Una lista deja de servirse cuando:
+- Caduca (max_age_hours)
+- Cambia de forma relevante el perfil o la ubicación del propio usuario o
+  de alguno de los candidatos recomendados (on_profile_change)
+
+El job guarda el almacén en un fichero JSON (`save`, con reemplazo atómico) y
+los workers de la API lo cargan desde `path` al arrancar y cada vez que el
+fichero cambia (`refresh`, como mucho cada `reload_interval_seconds`).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Set, TYPE_CHECKING
+
+from app.services.ml.batch_scoring import LIFESTYLE_FACTORS, NO_PREFERENCE
+
+if TYPE_CHECKING:
+    from app.services.ml.recommendation_engine import UserProfile
+
+logger = logging.getLogger(__name__)
+
+# Orden de los campos de Recommendation en las tuplas almacenadas
+RECOMMENDATION_FIELDS = (
+    'user_id', 'score', 'reasons', 'compatibility_percentage', 'distance_km',
+    'common_interests', 'predicted_success_rate', 'risk_factors'
+)
+
+
+def _rounded(value, digits: int):
+    try:
+        return round(float(value), digits)
+    except (TypeError, ValueError):
+        return None
+
+
+def profile_signature(profile: 'UserProfile') -> str:
+    """
+    Huella de los campos del perfil que afectan a las recomendaciones
+
+    La ubicación se redondea a ~1 km y actividad/reputación a una décima, de
+    modo que los cambios menores no invalidan las listas guardadas.
+    """
+    location = profile.location if isinstance(profile.location, dict) else {}
+    material = (
+        profile.gender,
+        profile.age,
+        sorted(str(interest) for interest in profile.interests),
+        profile.relationship_goals,
+        profile.education_level,
+        profile.verification_level,
+        [getattr(profile, factor, NO_PREFERENCE) for factor in LIFESTYLE_FACTORS],
+        _rounded(location.get('lat'), 2),
+        _rounded(location.get('lng'), 2),
+        _rounded(profile.activity_score, 1),
+        _rounded(profile.reputation_score, 1),
+        profile.photos_count,
+        profile.bio_length >= 50
+    )
+    return hashlib.blake2b(repr(material).encode(), digest_size=8).hexdigest()
+
+
+class RecommendationStore:
+    """
+    Top-K precalculado por usuario con invalidación por cambios de perfil
+    """
+
+    def __init__(self, max_age_hours: float = 24, path: Optional[str] = None, reload_interval_seconds: float = 60):
+        """
+        Args:
+            max_age_hours: Antigüedad máxima de una lista
+            path: Fichero que escribe el job de materialización (None = solo en memoria)
+            reload_interval_seconds: Intervalo mínimo entre comprobaciones del fichero
+        """
+        self.max_age_seconds = max_age_hours * 3600
+        self.path = path
+        self.reload_interval_seconds = reload_interval_seconds
+        self._loaded_mtime: Optional[float] = None
+        self._checked_at = float('-inf')
+        self._lock = threading.Lock()
+        # user_id -> (filas, top_k, calculado_en)
+        self._entries: Dict[str, tuple] = {}
+        self._candidates_of: Dict[str, Sequence[str]] = {}
+        self._dependents: Dict[str, Set[str]] = {}
+        self._signatures: Dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def put(self, user_id: str, recommendations: List[Dict], top_k: int, signatures: Dict[str, str]):
+        """
+        Guardar el top-K de un usuario
+
+        Args:
+            recommendations: Recomendaciones serializadas (dicts con RECOMMENDATION_FIELDS)
+            top_k: Límite con el que se calcularon
+            signatures: Huellas del usuario y de los candidatos recomendados
+        """
+        rows = [
+            tuple(tuple(rec[field]) if isinstance(rec[field], list) else rec[field]
+                  for field in RECOMMENDATION_FIELDS)
+            for rec in recommendations
+        ]
+        candidates = tuple(row[0] for row in rows)
+        with self._lock:
+            self._drop(user_id)
+            self._entries[user_id] = (rows, top_k, time.time())
+            self._candidates_of[user_id] = candidates
+            for candidate_id in candidates:
+                self._dependents.setdefault(candidate_id, set()).add(user_id)
+            self._signatures.update(signatures)
+
+    def get(self, user_id: str, limit: int) -> Optional[List[Dict]]:
+        """Recomendaciones guardadas, o None si no hay una lista válida para `limit`"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.time() - entry[2] > self.max_age_seconds:
+                self._drop(user_id)
+                entry = None
+            if entry is None or limit > entry[1]:
+                self.misses += 1
+                return None
+            self.hits += 1
+            rows = entry[0][:limit]
+
+        return [
+            {field: list(value) if isinstance(value, tuple) else value
+             for field, value in zip(RECOMMENDATION_FIELDS, row)}
+            for row in rows
+        ]
+
+    def _drop(self, user_id: str):
+        if self._entries.pop(user_id, None) is None:
+            return
+        for candidate_id in self._candidates_of.pop(user_id, ()):
+            dependents = self._dependents.get(candidate_id)
+            if dependents is not None:
+                dependents.discard(user_id)
+                if not dependents:
+                    del self._dependents[candidate_id]
+
+    def invalidate(self, user_id: str):
+        """Descartar la lista del usuario y las listas en las que aparece"""
+        with self._lock:
+            affected = {user_id} | self._dependents.get(user_id, set())
+            for affected_id in affected:
+                if affected_id in self._entries:
+                    self._drop(affected_id)
+                    self.invalidations += 1
+            self._signatures.pop(user_id, None)
+
+    def on_profile_change(self, user_id: str, profile: Optional['UserProfile']):
+        """Callback de CandidateIndex: invalida si el cambio es relevante"""
+        known = self._signatures.get(user_id)
+        if known is None:
+            return
+        if profile is not None and profile_signature(profile) == known:
+            return
+        self.invalidate(user_id)
+
+    def save(self, path: str):
+        """Persistir el almacén en un fichero JSON (los lectores nunca ven uno a medias)"""
+        with self._lock:
+            data = {
+                'entries': {
+                    user_id: [rows, top_k, computed_at]
+                    for user_id, (rows, top_k, computed_at) in self._entries.items()
+                },
+                'signatures': dict(self._signatures)
+            }
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(data, f)
+        os.replace(temporary, path)
+
+    def refresh_due(self) -> bool:
+        """Si toca comprobar el fichero (barato: sin acceso a disco)"""
+        return bool(self.path) and time.monotonic() - self._checked_at >= self.reload_interval_seconds
+
+    def refresh(self) -> bool:
+        """
+        Cargar el fichero de `path` si cambió desde la última carga
+
+        Returns:
+            True si se cargó una versión nueva
+        """
+        if not self.refresh_due():
+            return False
+        self._checked_at = time.monotonic()
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return False
+        if mtime == self._loaded_mtime:
+            return False
+        try:
+            self.load(self.path)
+        except Exception as e:
+            logger.error(f"[RecommendationStore] Error cargando {self.path}: {e}")
+            return False
+        self._loaded_mtime = mtime
+        return True
+
+    def load(self, path: str):
+        """Cargar un almacén persistido con `save`"""
+        with open(path) as f:
+            data = json.load(f)
+        with self._lock:
+            self._entries.clear()
+            self._candidates_of.clear()
+            self._dependents.clear()
+            for user_id, (rows, top_k, computed_at) in data['entries'].items():
+                rows = [
+                    tuple(tuple(value) if isinstance(value, list) else value for value in row)
+                    for row in rows
+                ]
+                self._entries[user_id] = (rows, top_k, computed_at)
+                self._candidates_of[user_id] = tuple(row[0] for row in rows)
+                for row in rows:
+                    self._dependents.setdefault(row[0], set()).add(user_id)
+            self._signatures = dict(data['signatures'])
+        logger.info(f"[RecommendationStore] Cargadas {len(self._entries)} listas desde {path}")
+
+    def get_stats(self) -> Dict:
+        """Estadísticas del almacén para monitorización"""
+        with self._lock:
+            return {
+                'users': len(self._entries),
+                'tracked_profiles': len(self._signatures),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations
+            }
@@ -0,0 +1,189 @@
+"""
+TuCitaSegura - Moderación de mensajes por lotes
+
+Punto de entrada para moderar miles de mensajes de una vez: re-moderación
+de chats históricos tras un cambio de reglas y ráfagas de ingesta.
+
+Los mensajes se reparten en bloques de `chunk_size` entre un pool de
+procesos; cada proceso mantiene un MessageModerator caliente (patrones
+compilados y caché) con las mismas categorías que el moderador de origen,
+de modo que cada resultado es idéntico al de moderate_user_message.
+
+Uso típico:
+
+    with BatchModerator(workers=4) as batch:
+        results = batch.moderate(items)          # en el orden de entrada
+        for index, result in batch.iter_moderate(items):
+            ...                                  # resultados a medida que llegan
+"""
+
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from app.services.nlp.message_moderator import (
+    MessageModerator,
+    get_message_moderator,
+    moderation_result_to_dict
+)
+
+logger = logging.getLogger(__name__)
+
+# Moderador del proceso del pool (se crea en _init_worker)
+_worker_moderator: Optional[MessageModerator] = None
+
+
+def _init_worker(categories: Dict[str, Dict]):
+    global _worker_moderator
+    _worker_moderator = MessageModerator()
+    _worker_moderator.set_categories(categories)
+
+
+def _moderate_items(moderator: MessageModerator, items: List[Dict]) -> List[Dict]:
+    return [
+        moderation_result_to_dict(
+            moderator.moderate_message(item.get('message', ''), item.get('user_id', ''), item.get('context'))
+        )
+        for item in items
+    ]
+
+
+def _moderate_chunk(items: List[Dict]) -> List[Dict]:
+    """Moderar un bloque de mensajes (se ejecuta en el pool)"""
+    return _moderate_items(_worker_moderator, items)
+
+
+class BatchModerator:
+    """
+    Moderación de lotes de mensajes repartida en un pool de procesos
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        chunk_size: int = 256,
+        moderator: Optional[MessageModerator] = None
+    ):
+        """
+        Args:
+            workers: Procesos del pool (None = nº de CPUs, 0 = en el propio proceso)
+            chunk_size: Mensajes por tarea enviada al pool
+            moderator: Moderador de referencia (por defecto el compartido); sus
+                categorías se copian a los procesos del pool
+        """
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.moderator = moderator or get_message_moderator()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.messages = 0
+        self.elapsed_seconds = 0.0
+        self.last_run: Dict = {}
+
+    def __enter__(self) -> 'BatchModerator':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: no se heredan hilos ni conexiones del proceso padre
+            context = multiprocessing.get_context('spawn')
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(self.moderator.categories,)
+            )
+        return self._pool
+
+    def close(self):
+        """Cerrar el pool de procesos (se recrea en el siguiente uso)"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _chunks(self, items: Iterable[Dict]) -> Iterator[List[Dict]]:
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _chunk_results(self, items: Iterable[Dict]) -> Iterator[List[Dict]]:
+        if self.workers == 0:
+            for chunk in self._chunks(items):
+                yield _moderate_items(self.moderator, chunk)
+            return
+
+        pool = self._get_pool()
+        # Bloques en vuelo acotados: la entrada se consume a medida que se procesa
+        max_pending = 2 * (self.workers or os.cpu_count() or 1)
+        pending = deque()
+        for chunk in self._chunks(items):
+            pending.append(pool.submit(_moderate_chunk, chunk))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def iter_moderate(self, items: Iterable[Dict]) -> Iterator[Tuple[int, Dict]]:
+        """
+        Moderar mensajes devolviendo (posición, resultado) en orden de entrada
+
+        Args:
+            items: Iterable de {'message', 'user_id', 'context'} (context opcional)
+
+        Yields:
+            Tuplas (índice del item, resultado con el formato de moderate_user_message)
+        """
+        started = time.perf_counter()
+        index = 0
+        try:
+            for results in self._chunk_results(items):
+                for result in results:
+                    yield index, result
+                    index += 1
+        finally:
+            self._record_run(index, time.perf_counter() - started)
+
+    def moderate(self, items: Iterable[Dict]) -> List[Dict]:
+        """Moderar mensajes y devolver los resultados en orden de entrada"""
+        return [result for _, result in self.iter_moderate(items)]
+
+    def _record_run(self, messages: int, elapsed: float):
+        self.messages += messages
+        self.elapsed_seconds += elapsed
+        self.last_run = {
+            'messages': messages,
+            'elapsed_seconds': elapsed,
+            'messages_per_second': messages / elapsed if elapsed > 0 else 0.0
+        }
+        logger.info(
+            f"[BatchModerator] {messages} mensajes en {elapsed:.2f}s "
+            f"({self.last_run['messages_per_second']:.0f} msg/s)"
+        )
+
+    def get_stats(self) -> Dict:
+        """Rendimiento acumulado y de la última ejecución"""
+        return {
+            'workers': self.workers,
+            'chunk_size': self.chunk_size,
+            'messages': self.messages,
+            'elapsed_seconds': self.elapsed_seconds,
+            'messages_per_second': self.messages / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0,
+            'last_run': self.last_run
+        }
+
+
+def moderate_messages_batch(items: Iterable[Dict], workers: Optional[int] = None) -> List[Dict]:
+    """Moderar un lote de mensajes con un pool temporal"""
+    with BatchModerator(workers=workers) as batch:
+        return batch.moderate(items)
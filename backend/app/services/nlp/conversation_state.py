@@ -0,0 +1,259 @@
+"""
+TuCitaSegura - Estado incremental de moderación de conversaciones
+
+ConversationModerationState recibe los mensajes de un chat uno a uno y
+mantiene en O(1) por mensaje las señales que antes exigían reanalizar la
+conversación completa:
+
+- Ratio de repetición: contenidos distintos contados con hashes exactos de
+  8 bytes. Para estados de larga duración (chats en streaming) se puede
+  acotar con max_exact_hashes: pasado ese número el conjunto se vuelca en un
+  HyperLogLog de 2048 registros (2 KB) y el estado deja de crecer, a cambio
+  de que el número de contenidos distintos sea una estimación (error
+  relativo típico de 1.04/√2048 ≈ 2.3%, hasta ~5% en el peor caso medido)
+  que puede alterar has_repetitive_messages cerca del umbral del 30%
+- Escalada agresiva y racha de mensajes no seguros consecutivos
+- Solicitudes de información personal
+- Ratio de mensajes marcados en los últimos N
+
+Con el conteo exacto (por defecto, y siempre en moderate_conversation)
+pattern_analysis() devuelve en cualquier momento lo mismo que
+MessageModerator._analyze_conversation_patterns sobre los mensajes recibidos.
+El estado se serializa con to_dict/from_dict (JSON) para traspasarlo entre
+workers.
+"""
+
+import base64
+import hashlib
+import math
+import re
+from collections import deque
+from typing import Dict, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from app.services.nlp.message_moderator import MessageModerator, ModerationResult
+
+# Solicitudes de información personal (sobre el contenido en minúsculas)
+PERSONAL_INFO_REQUEST_PATTERNS = [
+    re.compile(pattern) for pattern in (
+        r'dónde\s+vives',
+        r'cuál\s+es\s+tu\s+(nombre|teléfono|dirección)',
+        r'mándame\s+tu\s+(foto|número)',
+        r'envíame\s+tu\s+(ubicación|dirección)'
+    )
+]
+
+# Mensajes mínimos para evaluar patrones de conversación
+MIN_MESSAGES_FOR_PATTERNS = 3
+
+# Límite recomendado de contenidos exactos para estados acotados (opcional)
+MAX_EXACT_HASHES = 64
+# 2^11 registros de un byte
+SKETCH_PRECISION = 11
+SKETCH_REGISTERS = 1 << SKETCH_PRECISION
+
+
+def _content_hash(content: str) -> int:
+    return int.from_bytes(hashlib.blake2b(content.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def _sketch_add(registers: bytearray, value: int):
+    """Añadir un hash de 64 bits al HyperLogLog"""
+    width = 64 - SKETCH_PRECISION
+    index = value >> width
+    rank = width - (value & ((1 << width) - 1)).bit_length() + 1
+    if rank > registers[index]:
+        registers[index] = rank
+
+
+def _sketch_estimate(registers: bytearray) -> float:
+    """Número estimado de hashes distintos (conteo lineal si quedan registros vacíos)"""
+    size = len(registers)
+    zeros = registers.count(0)
+    estimate = 0.7213 / (1 + 1.079 / size) * size * size / sum(2.0 ** -rank for rank in registers)
+    if estimate <= 2.5 * size and zeros:
+        return size * math.log(size / zeros)
+    return estimate
+
+
+class ConversationModerationState:
+    """
+    Señales de moderación de una conversación, actualizadas mensaje a mensaje
+    """
+
+    __slots__ = (
+        'window', 'max_exact_hashes', 'message_count', '_content_hashes', '_sketch', '_history_flags',
+        '_recent_unsafe', '_recent_unsafe_count', '_prev_base_unsafe',
+        'escalation_streak', 'has_aggressive_escalation', 'has_personal_info_requests'
+    )
+
+    def __init__(self, window: int = 10, max_exact_hashes: Optional[int] = None):
+        """
+        Args:
+            window: Mensajes recientes que forman el contexto y el ratio de marcados
+            max_exact_hashes: Contenidos distintos contados de forma exacta antes de
+                pasar al HyperLogLog (None = siempre exacto, sin límite de memoria)
+        """
+        self.window = window
+        self.max_exact_hashes = max_exact_hashes
+        self.message_count = 0
+        # Hashes de los contenidos distintos; None una vez volcados en _sketch
+        self._content_hashes: Optional[set] = set()
+        self._sketch: Optional[bytearray] = None
+        # was_flagged de los últimos mensajes (historial para _analyze_context)
+        self._history_flags = deque(maxlen=window)
+        # Veredictos no seguros de los últimos mensajes
+        self._recent_unsafe = deque(maxlen=window)
+        self._recent_unsafe_count = 0
+        self._prev_base_unsafe = False
+        self.escalation_streak = 0
+        self.has_aggressive_escalation = False
+        self.has_personal_info_requests = False
+
+    def context_for(self, message: Dict) -> Dict:
+        """Contexto de moderación del siguiente mensaje, como en moderate_conversation"""
+        return {
+            'user_history': [{'was_flagged': flagged} for flagged in self._history_flags],
+            'timestamp': message.get('timestamp'),
+            'relationship_context': message.get('relationship_context', {})
+        }
+
+    def add_message(self, message: Dict, user_id: str, moderator: 'MessageModerator') -> 'ModerationResult':
+        """
+        Moderar un mensaje nuevo con el contexto de la conversación y actualizar las señales
+
+        Args:
+            message: Mensaje ({'content', 'timestamp', 'relationship_context', 'was_flagged'})
+            user_id: Autor del mensaje
+            moderator: Moderador a utilizar
+        """
+        content = message.get('content', '')
+        result, base_verdict = moderator._moderate(content, user_id, self.context_for(message))
+        self.observe(content, result.is_safe, base_verdict, message.get('was_flagged', False))
+        return result
+
+    def observe(self, content: str, is_safe: bool, base_verdict: Tuple[bool, str], was_flagged: bool = False):
+        """
+        Registrar un mensaje ya moderado
+
+        Args:
+            content: Contenido original del mensaje
+            is_safe: Veredicto con contexto
+            base_verdict: (is_safe, severity) sin contexto
+            was_flagged: Si el mensaje venía marcado (historial de _analyze_context)
+        """
+        lowered = content.lower()
+        self.message_count += 1
+        self._add_content_hash(_content_hash(lowered))
+        self._history_flags.append(bool(was_flagged))
+
+        base_safe, base_severity = base_verdict
+        if self._prev_base_unsafe and not base_safe and base_severity in ('high', 'critical'):
+            self.has_aggressive_escalation = True
+        self._prev_base_unsafe = not base_safe
+
+        self.escalation_streak = 0 if is_safe else self.escalation_streak + 1
+        if len(self._recent_unsafe) == self._recent_unsafe.maxlen:
+            self._recent_unsafe_count -= self._recent_unsafe[0]
+        self._recent_unsafe.append(not is_safe)
+        self._recent_unsafe_count += not is_safe
+
+        if not self.has_personal_info_requests:
+            self.has_personal_info_requests = any(
+                pattern.search(lowered) for pattern in PERSONAL_INFO_REQUEST_PATTERNS
+            )
+
+    def _add_content_hash(self, value: int):
+        if self._content_hashes is None:
+            _sketch_add(self._sketch, value)
+            return
+        self._content_hashes.add(value)
+        if self.max_exact_hashes is not None and len(self._content_hashes) > self.max_exact_hashes:
+            # Memoria acotada a partir de aquí: el conteo pasa a ser aproximado
+            self._sketch = bytearray(SKETCH_REGISTERS)
+            for content_hash in self._content_hashes:
+                _sketch_add(self._sketch, content_hash)
+            self._content_hashes = None
+
+    @property
+    def distinct_count(self) -> float:
+        """Contenidos distintos (exacto hasta max_exact_hashes, luego estimado)"""
+        if self._content_hashes is not None:
+            return len(self._content_hashes)
+        return min(_sketch_estimate(self._sketch), self.message_count)
+
+    @property
+    def repetition_ratio(self) -> float:
+        """Fracción de mensajes que repiten un contenido anterior"""
+        if not self.message_count:
+            return 0.0
+        return 1 - self.distinct_count / self.message_count
+
+    @property
+    def flagged_ratio(self) -> float:
+        """Fracción de mensajes no seguros entre los últimos `window`"""
+        if not self._recent_unsafe:
+            return 0.0
+        return self._recent_unsafe_count / len(self._recent_unsafe)
+
+    def pattern_analysis(self) -> Dict:
+        """Mismo resultado que MessageModerator._analyze_conversation_patterns"""
+        patterns = {
+            'has_repetitive_messages': False,
+            'has_aggressive_escalation': False,
+            'has_personal_info_requests': False,
+            'has_scam_patterns': False,
+            'message_frequency_anomaly': False
+        }
+        if self.message_count < MIN_MESSAGES_FOR_PATTERNS:
+            return patterns
+
+        patterns['has_repetitive_messages'] = self.distinct_count < self.message_count * 0.7
+        patterns['has_aggressive_escalation'] = self.has_aggressive_escalation
+        patterns['has_personal_info_requests'] = self.has_personal_info_requests
+        return patterns
+
+    def signals(self) -> Dict:
+        """Señales continuas de la conversación para monitorización"""
+        return {
+            'message_count': self.message_count,
+            'repetition_ratio': self.repetition_ratio,
+            'escalation_streak': self.escalation_streak,
+            'flagged_ratio': self.flagged_ratio
+        }
+
+    def to_dict(self) -> Dict:
+        """Estado serializable en JSON"""
+        return {
+            'window': self.window,
+            'max_exact_hashes': self.max_exact_hashes,
+            'message_count': self.message_count,
+            'content_hashes': sorted(self._content_hashes) if self._content_hashes is not None else None,
+            'distinct_sketch': base64.b64encode(self._sketch).decode('ascii') if self._sketch is not None else None,
+            'history_flags': list(self._history_flags),
+            'recent_unsafe': list(self._recent_unsafe),
+            'prev_base_unsafe': self._prev_base_unsafe,
+            'escalation_streak': self.escalation_streak,
+            'has_aggressive_escalation': self.has_aggressive_escalation,
+            'has_personal_info_requests': self.has_personal_info_requests
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'ConversationModerationState':
+        """Reconstruir un estado serializado con to_dict"""
+        state = cls(window=data['window'], max_exact_hashes=data.get('max_exact_hashes'))
+        state.message_count = data['message_count']
+        if data.get('distinct_sketch'):
+            state._content_hashes = None
+            state._sketch = bytearray(base64.b64decode(data['distinct_sketch']))
+        else:
+            for content_hash in data['content_hashes']:
+                state._add_content_hash(content_hash)
+        state._history_flags.extend(data['history_flags'])
+        state._recent_unsafe.extend(data['recent_unsafe'])
+        state._recent_unsafe_count = sum(state._recent_unsafe)
+        state._prev_base_unsafe = data['prev_base_unsafe']
+        state.escalation_streak = data['escalation_streak']
+        state.has_aggressive_escalation = data['has_aggressive_escalation']
+        state.has_personal_info_requests = data['has_personal_info_requests']
+        return state
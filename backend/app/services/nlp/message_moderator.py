@@ -4,7 +4,14 @@ import numpy as np
 from typing import Dict, List, Optional, Tuple
 from dataclasses import dataclass
 from datetime import datetime
-import unicodedata
+import hashlib
+import sys
+import threading
+
+from app.services.nlp.conversation_state import MAX_EXACT_HASHES, ConversationModerationState
+from app.services.nlp.moderation_matcher import ModerationMatcher
+from app.services.nlp.text_normalizer import normalize_text
+from app.utils.cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
@@ -18,8 +25,19 @@ class ModerationResult:
     recommendation: str
     alternative_suggestion: Optional[str] = None
 
+def _score_entry_size(key: bytes, value: Tuple) -> int:
+    """Estimación en bytes de una entrada de la caché de scores"""
+    scores, phrases = value
+    return (sys.getsizeof(key) + sys.getsizeof(value) + sys.getsizeof(scores)
+            + sys.getsizeof(phrases) + sum(sys.getsizeof(phrase) for phrase in phrases))
+
 class MessageModerator:
-    def __init__(self):
+    def __init__(self, cache_size: int = 10000, cache_ttl_seconds: float = 3600):
+        """
+        Args:
+            cache_size: Textos normalizados distintos cuyo análisis se guarda en caché
+            cache_ttl_seconds: Vida de cada entrada de la caché
+        """
         # Categorías de contenido problemático
         self.categories = {
             'hate_speech': {
@@ -99,30 +117,52 @@ class MessageModerator:
             'low': 0.2
         }
 
+        # Mensajes previos que se tienen en cuenta como historial del usuario
+        self.context_window = 10
+
+        # Patrones compilados una sola vez, con pre-filtro de literales
+        self.matcher = ModerationMatcher(self.categories)
+
+        # Scores por categoría y frases detectadas, por hash del texto normalizado.
+        # No dependen del contexto: solo _analyze_context se recalcula en cada llamada.
+        self.score_cache = TTLCache(
+            max_entries=cache_size,
+            ttl_seconds=cache_ttl_seconds,
+            sizeof=_score_entry_size
+        )
+
     def moderate_message(self, message: str, user_id: str, context: Optional[Dict] = None) -> ModerationResult:
         """Modera un mensaje individual"""
+        result, _ = self._moderate(message, user_id, context)
+        return result
+
+    def _moderate(self, message: str, user_id: str, context: Optional[Dict]) -> Tuple[ModerationResult, Tuple[bool, str]]:
+        """
+        Modera un mensaje y devuelve también el veredicto sin contexto
+
+        El veredicto sin contexto (is_safe, severity) es el que usa la detección
+        de escalada de moderate_conversation, que así no vuelve a moderar cada mensaje.
+        """
+        if not message or not message.strip():
+            return ModerationResult(
+                is_safe=True,
+                severity='low',
+                categories=[],
+                confidence=1.0,
+                flagged_phrases=[],
+                recommendation='Mensaje vacío permitido'
+            ), (True, 'low')
+
+        base_verdict = (False, 'medium')
         try:
-            if not message or not message.strip():
-                return ModerationResult(
-                    is_safe=True,
-                    severity='low',
-                    categories=[],
-                    confidence=1.0,
-                    flagged_phrases=[],
-                    recommendation='Mensaje vacío permitido'
-                )
-            
             # Normalizar el mensaje
             normalized_message = self._normalize_text(message)
             
-            # Análisis por categorías
-            category_scores = {}
-            flagged_phrases = []
-            
-            for category_name, category_data in self.categories.items():
-                score, phrases = self._analyze_category(normalized_message, category_data)
-                category_scores[category_name] = score
-                flagged_phrases.extend(phrases)
+            # Análisis por categorías (cacheado por contenido)
+            category_scores, flagged_phrases = self._analyze_categories(normalized_message)
+
+            base_score = self._calculate_final_score(category_scores, 0.0)
+            base_verdict = (base_score < self.severity_thresholds['medium'], self._get_severity(base_score))
             
             # Análisis de contexto
             context_modifier = self._analyze_context(message, context)
@@ -157,7 +197,7 @@ class MessageModerator:
                 flagged_phrases=flagged_phrases[:5],  # Limitar a 5 frases
                 recommendation=recommendation,
                 alternative_suggestion=alternative
-            )
+            ), base_verdict
             
         except Exception as e:
             logger.error(f"Error moderating message: {str(e)}")
@@ -169,44 +209,85 @@ class MessageModerator:
                 flagged_phrases=[],
                 recommendation='Error en moderación - revisar manualmente',
                 alternative_suggestion=None
-            )
+            ), base_verdict
 
-    def _normalize_text(self, text: str) -> str:
-        """Normaliza el texto para análisis"""
-        # Convertir a minúsculas
-        text = text.lower()
-        
-        # Eliminar acentos
-        text = unicodedata.normalize('NFKD', text)
-        text = ''.join(c for c in text if not unicodedata.combining(c))
-        
-        # Eliminar caracteres especiales pero mantener espacios
-        text = re.sub(r'[^\w\s]', ' ', text)
+    def _analyze_categories(self, normalized_message: str) -> Tuple[Dict[str, float], List[str]]:
+        """Scores por categoría y frases detectadas de un texto normalizado, con caché"""
+        key = self._score_key(normalized_message)
+        scores, phrases = self.score_cache.get_or_load(key, lambda: self._scan_categories(normalized_message))
+        return dict(scores), list(phrases)
+
+    @staticmethod
+    def _score_key(normalized_message: str) -> bytes:
+        return hashlib.blake2b(normalized_message.encode('utf-8'), digest_size=16).digest()
+
+    def is_cached(self, message: str) -> bool:
+        """
+        Si moderar el mensaje es barato: su análisis por categorías ya está en caché
+        (solo quedan la normalización y el contexto) o está vacío
+        """
+        if not message or not message.strip():
+            return True
+        return self._score_key(self._normalize_text(message)) in self.score_cache
+
+    def _scan_categories(self, normalized_message: str) -> Tuple[Tuple, Tuple[str, ...]]:
+        category_scores = []
+        flagged_phrases = []
         
-        # Eliminar espacios múltiples
-        text = re.sub(r'\s+', ' ', text).strip()
+        category_hits = self.matcher.scan(normalized_message)
+        for category_name, category_data in self.categories.items():
+            phrases = category_hits[category_name]
+            category_scores.append((category_name, self._score_phrases(phrases, category_data)))
+            flagged_phrases.extend(phrases)
         
-        return text
+        return tuple(category_scores), tuple(flagged_phrases)
+
+    def set_categories(self, categories: Dict[str, Dict]):
+        """Reemplazar el conjunto de patrones: recompila el matcher e invalida la caché"""
+        self.categories = categories
+        self.matcher = ModerationMatcher(categories)
+        self.invalidate_cache()
+
+    def invalidate_cache(self):
+        """
+        Vaciar la caché de análisis
+
+        Debe llamarse si se modifica self.categories directamente en lugar de
+        usar set_categories.
+        """
+        self.score_cache.clear()
+        logger.info("[MessageModerator] Caché de moderación invalidada")
+
+    def get_cache_stats(self) -> Dict:
+        """Aciertos, desalojos y memoria de la caché de moderación"""
+        return self.score_cache.get_stats()
+
+    def _normalize_text(self, text: str) -> str:
+        """Normaliza el texto para análisis (minúsculas, sin acentos ni signos, espacios colapsados)"""
+        return normalize_text(text)
 
     def _analyze_category(self, text: str, category_data: Dict) -> Tuple[float, List[str]]:
         """Analiza una categoría específica"""
-        total_score = 0.0
         flagged_phrases = []
         
         for pattern in category_data['patterns']:
             matches = re.finditer(pattern, text, re.I)
             for match in matches:
-                phrase = match.group().strip()
-                # Calcular score basado en longitud y contexto
-                phrase_score = min(len(phrase) / 50, 1.0) * category_data['weight']
-                total_score += phrase_score
-                flagged_phrases.append(phrase)
+                flagged_phrases.append(match.group().strip())
+        
+        return self._score_phrases(flagged_phrases, category_data), flagged_phrases
+
+    def _score_phrases(self, phrases: List[str], category_data: Dict) -> float:
+        """Score normalizado de una categoría a partir de sus frases detectadas"""
+        total_score = 0.0
+        for phrase in phrases:
+            # Calcular score basado en longitud y contexto
+            phrase_score = min(len(phrase) / 50, 1.0) * category_data['weight']
+            total_score += phrase_score
         
         # Normalizar score
         max_possible_score = len(category_data['patterns']) * category_data['weight']
-        normalized_score = min(total_score / max_possible_score if max_possible_score > 0 else 0, 1.0)
-        
-        return normalized_score, flagged_phrases
+        return min(total_score / max_possible_score if max_possible_score > 0 else 0, 1.0)
 
     def _analyze_context(self, message: str, context: Optional[Dict]) -> float:
         """Analiza el contexto del mensaje"""
@@ -219,8 +300,9 @@ class MessageModerator:
         user_history = context.get('user_history', [])
         if user_history:
             # Verificar si el usuario tiene historial de mensajes problemáticos
-            problematic_ratio = sum(1 for msg in user_history[-10:] 
-                                  if msg.get('was_flagged', False)) / min(len(user_history), 10)
+            window = self.context_window
+            problematic_ratio = sum(1 for msg in user_history[-window:] 
+                                  if msg.get('was_flagged', False)) / min(len(user_history), window)
             
             if problematic_ratio > 0.5:
                 modifier += 0.2
@@ -325,20 +407,11 @@ class MessageModerator:
         try:
             results = []
             conversation_risk = 0.0
+            state = self.create_conversation_state()
             
-            for i, message in enumerate(messages):
-                # Agregar contexto de conversación
-                context = {
-                    'user_history': messages[:i],  # Mensajes previos
-                    'timestamp': message.get('timestamp'),
-                    'relationship_context': message.get('relationship_context', {})
-                }
-                
-                result = self.moderate_message(
-                    message.get('content', ''),
-                    user_id,
-                    context
-                )
+            for message in messages:
+                # Modera con el contexto de la conversación y actualiza sus señales
+                result = state.add_message(message, user_id, self)
                 
                 results.append({
                     'message_id': message.get('id'),
@@ -350,7 +423,7 @@ class MessageModerator:
                                       1.0 if not result.is_safe else 0.0)
             
             # Análisis de patrones en la conversación
-            pattern_analysis = self._analyze_conversation_patterns(messages)
+            pattern_analysis = state.pattern_analysis()
             
             return {
                 'overall_safe': conversation_risk < 0.5,
@@ -371,57 +444,93 @@ class MessageModerator:
                 'analyzed_at': datetime.now().isoformat()
             }
 
-    def _analyze_conversation_patterns(self, messages: List[Dict]) -> Dict:
-        """Analiza patrones en la conversación"""
-        patterns = {
-            'has_repetitive_messages': False,
-            'has_aggressive_escalation': False,
-            'has_personal_info_requests': False,
-            'has_scam_patterns': False,
-            'message_frequency_anomaly': False
-        }
-        
-        if len(messages) < 3:
-            return patterns
-        
-        # Análisis de mensajes repetitivos
-        contents = [msg.get('content', '').lower() for msg in messages]
-        unique_contents = len(set(contents))
-        if unique_contents < len(contents) * 0.7:
-            patterns['has_repetitive_messages'] = True
-        
-        # Análisis de escalada agresiva
-        for i in range(1, len(messages)):
-            prev_result = self.moderate_message(contents[i-1], 'temp', {})
-            curr_result = self.moderate_message(contents[i], 'temp', {})
-            
-            if (not prev_result.is_safe and not curr_result.is_safe and 
-                curr_result.severity in ['high', 'critical']):
-                patterns['has_aggressive_escalation'] = True
-                break
-        
-        # Análisis de solicitudes de información personal
-        personal_info_patterns = [
-            r'dónde\s+vives',
-            r'cuál\s+es\s+tu\s+(nombre|teléfono|dirección)',
-            r'mándame\s+tu\s+(foto|número)',
-            r'envíame\s+tu\s+(ubicación|dirección)'
-        ]
-        
-        for content in contents:
-            for pattern in personal_info_patterns:
-                if re.search(pattern, content):
-                    patterns['has_personal_info_requests'] = True
-                    break
+    def create_conversation_state(self, bounded: bool = False) -> ConversationModerationState:
+        """
+        Estado incremental para moderar un chat mensaje a mensaje (ver add_message)
+
+        Args:
+            bounded: Memoria acotada para estados de larga duración; el ratio de
+                repetición pasa a ser aproximado a partir de MAX_EXACT_HASHES
+                contenidos distintos (moderate_conversation usa el conteo exacto)
+        """
+        return ConversationModerationState(
+            window=self.context_window, max_exact_hashes=MAX_EXACT_HASHES if bounded else None
+        )
+
+    def _analyze_conversation_patterns(
+        self,
+        messages: List[Dict],
+        base_verdicts: Optional[List[Tuple[bool, str]]] = None
+    ) -> Dict:
+        """
+        Analiza patrones en la conversación
+
+        Args:
+            messages: Mensajes de la conversación
+            base_verdicts: (is_safe, severity) sin contexto de cada mensaje, ya
+                calculados; si faltan se calculan aquí
+        """
+        state = self.create_conversation_state()
+        for i, message in enumerate(messages):
+            content = message.get('content', '')
+            if base_verdicts is None:
+                base_verdict = self._moderate(content.lower(), 'temp', {})[1]
+            else:
+                base_verdict = base_verdicts[i]
+            state.observe(content, base_verdict[0], base_verdict)
         
-        return patterns
+        return state.pattern_analysis()
+
+_shared_moderator: Optional[MessageModerator] = None
+_shared_moderator_lock = threading.Lock()
+
+def get_message_moderator() -> MessageModerator:
+    """Moderador compartido (se crea al primer uso), para aprovechar su caché"""
+    global _shared_moderator
+    if _shared_moderator is None:
+        with _shared_moderator_lock:
+            if _shared_moderator is None:
+                _shared_moderator = MessageModerator()
+    return _shared_moderator
 
 # Función auxiliar para uso externo
 def moderate_user_message(message: str, user_id: str, context: Optional[Dict] = None) -> Dict:
-    """Función principal para moderar un mensaje de usuario"""
-    moderator = MessageModerator()
+    """Función principal para moderar un mensaje de usuario (los no seguros quedan en auditoría)"""
+    moderator = get_message_moderator()
     result = moderator.moderate_message(message, user_id, context)
+    if not result.is_safe:
+        record_moderation_result(user_id, result)
+    
+    return moderation_result_to_dict(result)
+
+def record_moderation_result(user_id: str, result: ModerationResult, writer=None) -> Optional[str]:
+    """
+    Encolar un resultado de moderación en la auditoría (moderation_results)
     
+    Usa el escritor diferido por lotes: no espera a Firestore. Devuelve el ID
+    del documento, o None si no se pudo encolar.
+    """
+    try:
+        from firebase_admin import firestore
+        from app.core.firestore_audit import get_audit_writer
+        
+        writer = writer or get_audit_writer()
+        return writer.add('moderation_results', {
+            'userId': user_id,
+            'isSafe': result.is_safe,
+            'severity': result.severity,
+            'categories': result.categories,
+            'confidence': result.confidence,
+            'flaggedPhrases': result.flagged_phrases,
+            'recommendation': result.recommendation,
+            'timestamp': firestore.SERVER_TIMESTAMP
+        })
+    except Exception as e:
+        logger.error(f"Error recording moderation result for user {user_id}: {e}")
+        return None
+
+def moderation_result_to_dict(result: ModerationResult) -> Dict:
+    """Formato de respuesta de la API para un ModerationResult"""
     return {
         'is_safe': result.is_safe,
         'severity': result.severity,
@@ -435,5 +544,5 @@ def moderate_user_message(message: str, user_id: str, context: Optional[Dict] =
 
 def moderate_conversation_messages(messages: List[Dict], user_id: str) -> Dict:
     """Función para moderar una conversación completa"""
-    moderator = MessageModerator()
+    moderator = get_message_moderator()
     return moderator.moderate_conversation(messages, user_id)
\ No newline at end of file
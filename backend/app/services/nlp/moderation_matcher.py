@@ -0,0 +1,243 @@
+"""
+TuCitaSegura - Matcher precompilado de patrones de moderación
+
+Compila una sola vez los patrones de todas las categorías de
+MessageModerator y encuentra sus coincidencias con una única pasada de
+pre-filtro sobre el texto normalizado:
+
+1. De cada patrón se extraen (analizando la expresión regular) los literales
+   de los que toda coincidencia debe contener al menos uno; p. ej. para
+   r'\\b(acosar|hostigar)\\b' son {'acosar', 'hostigar'}.
+2. Todos los literales se combinan en un trie expresado como regex, que se
+   recorre una vez sobre el texto y devuelve los literales presentes.
+3. Solo los patrones con algún literal presente (o sin literales extraíbles)
+   se confirman con su regex precompilada.
+
+El resultado es idéntico al de aplicar re.finditer patrón a patrón: mismas
+frases, en el mismo orden.
+"""
+
+import re
+from typing import Dict, FrozenSet, List, Optional, Set
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+# Límite de cadenas al expandir clases y repeticiones a literales
+_MAX_EXPANSION = 64
+_MAX_CLASS_SIZE = 8
+
+
+def _expand_class(items) -> Optional[Set[str]]:
+    chars: Set[str] = set()
+    for op, av in items:
+        if op is sre_constants.LITERAL:
+            chars.add(chr(av).lower())
+        elif op is sre_constants.RANGE and av[1] - av[0] < _MAX_CLASS_SIZE:
+            chars.update(chr(code).lower() for code in range(av[0], av[1] + 1))
+        else:
+            return None
+    return chars if len(chars) <= _MAX_CLASS_SIZE else None
+
+
+def _product(left: Set[str], right: Set[str]) -> Optional[Set[str]]:
+    if len(left) * len(right) > _MAX_EXPANSION:
+        return None
+    return {a + b for a in left for b in right}
+
+
+def _exact(sequence) -> Optional[Set[str]]:
+    """Conjunto finito de cadenas que puede coincidir la secuencia (None si no es acotable)"""
+    strings = {''}
+    for op, av in sequence:
+        node_strings = _exact_node(op, av)
+        if node_strings is None:
+            return None
+        strings = _product(strings, node_strings)
+        if strings is None:
+            return None
+    return strings
+
+
+def _exact_node(op, av) -> Optional[Set[str]]:
+    if op is sre_constants.LITERAL:
+        return {chr(av).lower()}
+    if op is sre_constants.AT:
+        return {''}
+    if op is sre_constants.IN:
+        return _expand_class(av)
+    if op is sre_constants.SUBPATTERN:
+        return _exact(av[-1])
+    if op is sre_constants.BRANCH:
+        strings: Set[str] = set()
+        for branch in av[1]:
+            branch_strings = _exact(branch)
+            if branch_strings is None:
+                return None
+            strings |= branch_strings
+        return strings if len(strings) <= _MAX_EXPANSION else None
+    if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+        low, high, item = av
+        if high > 3:
+            return None
+        item_strings = _exact(item)
+        if item_strings is None:
+            return None
+        strings = set()
+        repeated = {''}
+        for count in range(high + 1):
+            if count >= low:
+                strings |= repeated
+            repeated = _product(repeated, item_strings)
+            if repeated is None:
+                return None
+        return strings
+    return None
+
+
+def _better(candidate: Optional[Set[str]], best: Optional[Set[str]]) -> bool:
+    if not candidate or '' in candidate:
+        return False
+    if best is None:
+        return True
+    # Preferir literales largos (más selectivos) y, a igualdad, menos literales
+    key = (min(map(len, candidate)), -len(candidate))
+    return key > (min(map(len, best)), -len(best))
+
+
+def _factors(sequence) -> Optional[Set[str]]:
+    """
+    Literales necesarios: toda coincidencia de la secuencia contiene alguno
+
+    Devuelve None si no se puede garantizar ninguno (el patrón se evalúa siempre).
+    """
+    best: Optional[Set[str]] = None
+    run: Optional[Set[str]] = {''}
+    for op, av in sequence:
+        node_strings = _exact_node(op, av)
+        if node_strings is not None:
+            extended = _product(run, node_strings)
+            if extended is None:
+                # La racha de literales es demasiado grande: se cierra y empieza otra
+                if _better(run, best):
+                    best = run
+                extended = node_strings
+            run = extended
+            continue
+
+        if _better(run, best):
+            best = run
+        run = {''}
+
+        node_factors = None
+        if op is sre_constants.SUBPATTERN:
+            node_factors = _factors(av[-1])
+        elif op is sre_constants.BRANCH:
+            node_factors = set()
+            for branch in av[1]:
+                branch_factors = _factors(branch)
+                if branch_factors is None:
+                    node_factors = None
+                    break
+                node_factors |= branch_factors
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            node_factors = _factors(av[2])
+        if _better(node_factors, best):
+            best = node_factors
+
+    if _better(run, best):
+        best = run
+    return best
+
+
+def required_literals(pattern: str) -> Optional[FrozenSet[str]]:
+    """Literales (en minúsculas) de los que toda coincidencia del patrón contiene alguno"""
+    factors = _factors(sre_parse.parse(pattern, re.I))
+    return frozenset(factors) if factors else None
+
+
+def _trie_regex(words: Set[str]) -> str:
+    trie: Dict = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node: Dict) -> str:
+        alternatives = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char != '']
+        if not alternatives:
+            return ''
+        body = alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+        if '' in node:
+            body = '(?:' + body + ')?'
+        return body
+
+    return build(trie)
+
+
+class ModerationMatcher:
+    """
+    Patrones de moderación compilados con pre-filtro de literales en una pasada
+    """
+
+    def __init__(self, categories: Dict[str, Dict]):
+        """
+        Args:
+            categories: Diccionario de categorías de MessageModerator
+                ({nombre: {'weight': float, 'patterns': [regex, ...]}})
+        """
+        self.categories = list(categories)
+        self._patterns: List[tuple] = []   # (categoría, regex compilada, literales o None)
+        literals: Set[str] = set()
+        for category_name, category_data in categories.items():
+            for pattern in category_data['patterns']:
+                required = required_literals(pattern)
+                self._patterns.append((category_name, re.compile(pattern, re.I), required))
+                if required:
+                    literals |= required
+
+        # Todos los literales que empiezan en una posición son prefijos del más
+        # largo, que es el que devuelve el trie (greedy)
+        self._prefixes = {
+            literal: frozenset(other for other in literals if literal.startswith(other))
+            for literal in literals
+        }
+        self._scanner = re.compile('(?=(' + _trie_regex(literals) + '))', re.I) if literals else None
+
+    def literals_in(self, text: str) -> Optional[Set[str]]:
+        """
+        Literales del pre-filtro presentes en el texto (una sola pasada)
+
+        Devuelve None si algún literal aparece con un plegado de mayúsculas que
+        str.lower() no reproduce (p. ej. 'ſ'); en ese caso se evalúan todos los patrones.
+        """
+        found: Set[str] = set()
+        if self._scanner is None:
+            return found
+        for match in self._scanner.finditer(text):
+            prefixes = self._prefixes.get(match.group(1).lower())
+            if prefixes is None:
+                return None
+            found |= prefixes
+        return found
+
+    def scan(self, text: str) -> Dict[str, List[str]]:
+        """
+        Frases encontradas por categoría
+
+        Equivale a recorrer re.finditer(patrón, text, re.I) para cada patrón de
+        cada categoría, en el mismo orden.
+        """
+        found = self.literals_in(text)
+        hits: Dict[str, List[str]] = {category: [] for category in self.categories}
+        for category_name, compiled, required in self._patterns:
+            if found is not None and required is not None and required.isdisjoint(found):
+                continue
+            phrases = hits[category_name]
+            for match in compiled.finditer(text):
+                phrases.append(match.group().strip())
+        return hits
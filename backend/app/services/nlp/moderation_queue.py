@@ -0,0 +1,261 @@
+"""
+TuCitaSegura - Cola asíncrona de moderación con micro-lotes
+
+Para la ruta de envío de mensajes del chat: los productores hacen
+`await queue.submit(mensaje, user_id)` y una tarea de fondo agrupa los
+mensajes que llegan durante unos milisegundos (o hasta `max_batch_size`),
+los pasa al hilo de moderación en una sola entrega y resuelve el future de
+cada uno. El event loop de FastAPI no ejecuta la moderación.
+
+El lote ahorra los saltos entre el event loop y el hilo, no el análisis: cada
+mensaje se sigue moderando por separado con moderate_message (prefiltro y
+matcher compilado por mensaje, sin una pasada conjunta sobre el lote); los
+textos repetidos dentro del lote salen de la caché de scores.
+
+Protecciones ante ráfagas:
+- Cola acotada (backpressure): si está llena el mensaje no espera turno. Si
+  el análisis del texto ya está en caché se devuelve ese veredicto (barato,
+  en el event loop); si no, se modera de forma síncrona con moderate_message
+  en el pool de hilos aparte, nunca en el event loop.
+- Plazo por petición: si el mensaje sigue en cola al vencer el plazo, se
+  saca del lote y se modera en un pool de hilos aparte; si el lote ya lo
+  está moderando, se espera a ese resultado en lugar de repetir el trabajo.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+from app.services.nlp.message_moderator import MessageModerator, ModerationResult, get_message_moderator
+
+logger = logging.getLogger(__name__)
+
+QueueItem = Tuple[str, str, Optional[Dict], asyncio.Future]
+
+
+class ModerationQueue:
+    """
+    Moderación asíncrona por micro-lotes con backpressure y plazo por petición
+    """
+
+    def __init__(
+        self,
+        moderator: Optional[MessageModerator] = None,
+        max_batch_size: int = 64,
+        max_wait_ms: float = 2.0,
+        max_queue_size: int = 1024,
+        deadline_ms: Optional[float] = 50.0,
+        fallback_workers: int = 2
+    ):
+        """
+        Args:
+            moderator: Moderador a utilizar (por defecto el compartido)
+            max_batch_size: Mensajes máximos por lote
+            max_wait_ms: Espera máxima para completar un lote
+            max_queue_size: Mensajes en cola antes de descargar carga
+            deadline_ms: Plazo en cola por petición antes de moderar aparte (None = sin plazo)
+            fallback_workers: Hilos para los mensajes que vencen su plazo en cola o
+                no caben en ella
+        """
+        self.moderator = moderator or get_message_moderator()
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000
+        self.max_queue_size = max_queue_size
+        self.deadline_seconds = deadline_ms / 1000 if deadline_ms is not None else None
+        # Un solo hilo: los lotes se procesan en orden y sin competir entre sí
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='moderation')
+        # Pool pequeño aparte para plazos vencidos y cola llena: no compite con los lotes
+        self._fallback_executor = ThreadPoolExecutor(
+            max_workers=fallback_workers, thread_name_prefix='moderation-fallback'
+        )
+        # Futures del lote que se está moderando (solo se tocan desde el event loop)
+        self._in_flight: Set[asyncio.Future] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=2048)
+        self.submitted = 0
+        self.batches = 0
+        self.batched_messages = 0
+        self.overload_fallbacks = 0
+        self.overload_cached = 0
+        self.deadline_fallbacks = 0
+        self.deadline_waits = 0
+
+    def _ensure_worker(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker is None or self._worker.done():
+            # La cola y la tarea pertenecen al event loop en el que se crean
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._worker = loop.create_task(self._run())
+        return self._queue
+
+    async def submit(
+        self,
+        message: str,
+        user_id: str,
+        context: Optional[Dict] = None,
+        deadline_ms: Optional[float] = None
+    ) -> ModerationResult:
+        """
+        Moderar un mensaje a través de la cola
+
+        Args:
+            deadline_ms: Plazo de esta petición (por defecto el de la cola)
+        """
+        started = time.perf_counter()
+        queue = self._ensure_worker()
+        self.submitted += 1
+
+        future = self._loop.create_future()
+        try:
+            queue.put_nowait((message, user_id, context, future))
+        except asyncio.QueueFull:
+            self.overload_fallbacks += 1
+            return await self._shed(message, user_id, context, started)
+
+        deadline = deadline_ms / 1000 if deadline_ms is not None else self.deadline_seconds
+        try:
+            if deadline is None:
+                result = await future
+            else:
+                # shield: al vencer el plazo el future sigue vivo si el lote ya lo modera
+                result = await asyncio.wait_for(asyncio.shield(future), deadline)
+        except asyncio.TimeoutError:
+            if future in self._in_flight:
+                # Repetir la moderación no la acelera: esperar al lote
+                self.deadline_waits += 1
+                result = await future
+            else:
+                # Aún en cola: el lote descartará el future cancelado
+                future.cancel()
+                self.deadline_fallbacks += 1
+                result = await self._loop.run_in_executor(
+                    self._fallback_executor, self.moderator.moderate_message, message, user_id, context
+                )
+
+        self._record_latency(started)
+        return result
+
+    async def _shed(self, message: str, user_id: str, context: Optional[Dict], started: float) -> ModerationResult:
+        """Cola llena: veredicto cacheado si es barato, si no moderación síncrona en el pool aparte"""
+        if self.moderator.is_cached(message):
+            self.overload_cached += 1
+            result = self.moderator.moderate_message(message, user_id, context)
+        else:
+            result = await self._loop.run_in_executor(
+                self._fallback_executor, self.moderator.moderate_message, message, user_id, context
+            )
+        self._record_latency(started)
+        return result
+
+    def _record_latency(self, started: float):
+        with self._lock:
+            self._latencies.append(time.perf_counter() - started)
+
+    async def _collect(self, queue: asyncio.Queue) -> List[QueueItem]:
+        batch = [await queue.get()]
+        deadline = self._loop.time() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _moderate_batch(self, items: List[Tuple[str, str, Optional[Dict]]]) -> List[ModerationResult]:
+        """Moderar el lote mensaje a mensaje en el hilo de moderación (una sola entrega)"""
+        moderate = self.moderator.moderate_message
+        return [moderate(message, user_id, context) for message, user_id, context in items]
+
+    async def _run(self):
+        queue = self._queue
+        while True:
+            batch = await self._collect(queue)
+            # Peticiones que vencieron su plazo en cola se moderan en el pool aparte
+            live = [item for item in batch if not item[3].done()]
+            if not live:
+                continue
+
+            self.batches += 1
+            self.batched_messages += len(live)
+            self._in_flight = {item[3] for item in live}
+            try:
+                results = await self._loop.run_in_executor(
+                    self._executor, self._moderate_batch, [item[:3] for item in live]
+                )
+            except Exception as e:
+                logger.error(f"[ModerationQueue] Error moderando lote de {len(live)} mensajes: {e}")
+                for *_, future in live:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self._in_flight = set()
+
+            for (*_, future), result in zip(live, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def close(self):
+        """Detener la tarea de fondo y los hilos de moderación"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._executor.shutdown(wait=False)
+        self._fallback_executor.shutdown(wait=False)
+
+    def get_stats(self) -> Dict:
+        """Tamaño de lote, desbordamientos y latencias (p50/p99) para monitorización"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+
+        def percentile(fraction: float) -> float:
+            if not latencies:
+                return 0.0
+            return latencies[min(int(fraction * len(latencies)), len(latencies) - 1)] * 1000
+
+        return {
+            'submitted': self.submitted,
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'batches': self.batches,
+            'avg_batch_size': self.batched_messages / self.batches if self.batches else 0.0,
+            'overload_fallbacks': self.overload_fallbacks,
+            'overload_cached': self.overload_cached,
+            'deadline_fallbacks': self.deadline_fallbacks,
+            'deadline_waits': self.deadline_waits,
+            'latency_p50_ms': percentile(0.5),
+            'latency_p99_ms': percentile(0.99)
+        }
+
+
+_shared: Optional[ModerationQueue] = None
+_shared_lock = threading.Lock()
+
+
+def get_moderation_queue() -> ModerationQueue:
+    """Cola compartida por los endpoints de chat (se crea al primer uso)"""
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = ModerationQueue()
+    return _shared
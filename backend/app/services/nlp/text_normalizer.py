@@ -0,0 +1,60 @@
+"""
+TuCitaSegura - Normalización rápida de texto para moderación
+
+Produce exactamente el mismo resultado que el normalizador original de
+MessageModerator (normalize_text_reference): minúsculas, NFKD sin marcas
+combinantes, signos de puntuación a espacio y espacios colapsados.
+
+Todo el proceso, salvo las minúsculas, es local a cada carácter, así que se
+resuelve con str.translate sobre una tabla:
+
+- Texto ASCII (la mayoría de los mensajes): una tabla precalculada que ya
+  incluye el paso a minúsculas, y split/join para colapsar espacios.
+- Resto: str.lower() sobre el texto completo (respeta reglas contextuales
+  como la sigma final griega) y una tabla que se completa bajo demanda con
+  la traducción de cada carácter nuevo.
+"""
+
+import re
+import unicodedata
+from typing import Dict
+
+_PUNCTUATION = re.compile(r'[^\w\s]')
+
+
+def normalize_text_reference(text: str) -> str:
+    """Implementación original (referencia para pruebas y benchmarks)"""
+    text = text.lower()
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def _translate_char(char: str) -> str:
+    """Traducción de un carácter ya en minúsculas: NFKD sin marcas y puntuación a espacio"""
+    decomposed = ''.join(c for c in unicodedata.normalize('NFKD', char) if not unicodedata.combining(c))
+    return _PUNCTUATION.sub(' ', decomposed)
+
+
+class _LazyTable(dict):
+    """Tabla de str.translate que calcula y guarda los caracteres que no conoce"""
+
+    def __missing__(self, code: int) -> str:
+        translated = _translate_char(chr(code))
+        self[code] = translated
+        return translated
+
+
+# ASCII: minúsculas incluidas en la tabla
+_ASCII_TABLE: Dict[int, str] = {code: _translate_char(chr(code).lower()) for code in range(128)}
+_UNICODE_TABLE = _LazyTable({code: _translate_char(chr(code)) for code in range(128)})
+
+
+def normalize_text(text: str) -> str:
+    """Normalizar texto para el análisis de moderación (misma salida que la referencia)"""
+    if text.isascii():
+        text = text.translate(_ASCII_TABLE)
+    else:
+        text = text.lower().translate(_UNICODE_TABLE)
+    return ' '.join(text.split())
@@ -6,6 +6,8 @@ from dataclasses import dataclass
 from collections import defaultdict
 import re
 import hashlib
+from app.services.cv.perceptual_hash import hamming_distance, hex_to_hash
+from app.services.cv.photo_hash_index import PhotoHashIndex, get_photo_hash_index
 
 logger = logging.getLogger(__name__)
 
@@ -18,7 +20,11 @@ class FraudScore:
     confidence: float
 
 class FraudDetector:
-    def __init__(self):
+    def __init__(self, photo_index: Optional[PhotoHashIndex] = None):
+        # Índice global de hashes perceptuales (fotos reutilizadas entre cuentas),
+        # cargado y al día con el listener que arranca lazy_services
+        self.photo_index = photo_index if photo_index is not None else get_photo_hash_index()
+        
         self.risk_thresholds = {
             'low': 0.3,
             'medium': 0.6,
@@ -289,15 +295,56 @@ class FraudDetector:
         photos = user_data.get('photos', [])
         if len(photos) > 0:
             # Verificar si todas las fotos son similares (posible bot)
-            photo_hashes = [photo.get('hash', '') for photo in photos]
-            unique_hashes = len(set(photo_hashes))
+            unique_hashes = self._count_distinct_photos(photos)
             
             if unique_hashes < len(photos) * 0.5:
                 score += 0.3
                 indicators.append("Fotos muy similares")
         
+        # Fotos (o recortes y recompresiones) presentes en otras cuentas, con los
+        # hashes del perfil y los de las verificaciones del usuario
+        other_accounts = self._find_accounts_sharing_photos(user_data.get('id'), photos)
+        if other_accounts:
+            score += 0.3 if len(other_accounts) == 1 else 0.5
+            indicators.append(f"Fotos usadas en otras cuentas ({len(other_accounts)})")
+        
         return min(score, 1.0), indicators
 
+    def _photo_hash(self, photo: Dict) -> Optional[int]:
+        value = photo.get('perceptualHash')
+        if not value:
+            return None
+        try:
+            return hex_to_hash(value)
+        except (TypeError, ValueError):
+            return None
+
+    def _count_distinct_photos(self, photos: List[Dict]) -> int:
+        """Fotos distintas: casi duplicadas por hash perceptual o iguales por 'hash'"""
+        distinct_hashes: List[int] = []
+        exact_hashes = set()
+        for photo in photos:
+            value = self._photo_hash(photo)
+            if value is None:
+                exact_hashes.add(photo.get('hash', ''))
+            elif all(hamming_distance(value, other) > self.photo_index.max_distance for other in distinct_hashes):
+                distinct_hashes.append(value)
+        return len(distinct_hashes) + len(exact_hashes)
+
+    def _find_accounts_sharing_photos(self, user_id: Optional[str], photos: List[Dict]) -> Dict[str, int]:
+        """Otras cuentas con alguna foto a distancia <= max_distance (usuario -> distancia mínima)"""
+        if not self.photo_index.is_ready:
+            logger.debug("[FraudDetector] Índice de fotos aún sin cargar; solo se consultan las fotos ya indexadas")
+        hashes = [value for value in map(self._photo_hash, photos) if value is not None]
+        if user_id:
+            # Hashes guardados con cada verificación (imageUrl -> perceptualHash)
+            hashes.extend(self.photo_index.hashes_for_user(user_id).values())
+        accounts: Dict[str, int] = {}
+        for value in set(hashes):
+            for other_user, distance in self.photo_index.accounts_near(value, exclude_user_id=user_id).items():
+                accounts[other_user] = min(distance, accounts.get(other_user, distance))
+        return accounts
+
     def _calculate_duplicate_ratio(self, texts: List[str]) -> float:
         """Calcula la ratio de mensajes duplicados"""
         if not texts:
@@ -376,6 +423,9 @@ class FraudDetector:
         if any("VPN/Proxy" in indicator for indicator in indicators):
             recommendations.append("Solicitar desactivación de VPN para verificación")
         
+        if any("Fotos usadas en otras cuentas" in indicator for indicator in indicators):
+            recommendations.append("Revisar las cuentas que comparten fotos con este usuario")
+        
         return recommendations
 
     def _calculate_confidence(self, user_data: Dict, user_history: Dict) -> float:
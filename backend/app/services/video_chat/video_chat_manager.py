@@ -1,4 +1,5 @@
 import logging
+import threading
 import uuid
 import asyncio
 import json
@@ -771,8 +772,19 @@ class WebRTCVideoChatManager:
             logger.error(f"Error moderando contenido: {str(e)}")
             return {'action': 'block', 'reason': 'moderation_error'}
 
-# Instancia global del gestor de video chat
-video_chat_manager = WebRTCVideoChatManager()
+# Instancia global del gestor de video chat: se crea al primer uso
+# (get_video_chat_manager), no al importar el módulo
+video_chat_manager: Optional[WebRTCVideoChatManager] = None
+_video_chat_manager_lock = threading.Lock()
+
+def get_video_chat_manager() -> WebRTCVideoChatManager:
+    """Gestor compartido (se crea al primer uso)"""
+    global video_chat_manager
+    if video_chat_manager is None:
+        with _video_chat_manager_lock:
+            if video_chat_manager is None:
+                video_chat_manager = WebRTCVideoChatManager()
+    return video_chat_manager
 
 def create_video_call_room(host_user_id: str, display_name: str, 
                           max_participants: int = 2, is_private: bool = True) -> Dict:
@@ -789,7 +801,7 @@ def create_video_call_room(host_user_id: str, display_name: str,
         Dict con información de la sala creada
     """
     try:
-        return video_chat_manager.create_call_room(
+        return get_video_chat_manager().create_call_room(
             host_user_id=host_user_id,
             display_name=display_name,
             max_participants=max_participants,
@@ -817,7 +829,7 @@ def invite_user_to_call(call_id: str, caller_user_id: str,
         Dict con información de la invitación
     """
     try:
-        return video_chat_manager.invite_to_call(
+        return get_video_chat_manager().invite_to_call(
             call_id=call_id,
             caller_user_id=caller_user_id,
             callee_user_id=callee_user_id,
@@ -844,7 +856,7 @@ def accept_call_invitation(invitation_id: str, user_id: str,
         Dict con información para unirse a la llamada
     """
     try:
-        return video_chat_manager.accept_call_invitation(
+        return get_video_chat_manager().accept_call_invitation(
             invitation_id=invitation_id,
             user_id=user_id,
             display_name=display_name
@@ -867,7 +879,7 @@ def get_call_information(call_id: str) -> Dict:
         Dict con información de la llamada
     """
     try:
-        return video_chat_manager.get_call_info(call_id)
+        return get_video_chat_manager().get_call_info(call_id)
     except Exception as e:
         logger.error(f"Error obteniendo información de llamada: {str(e)}")
         return {}
@@ -883,7 +895,7 @@ def get_user_video_calls(user_id: str) -> List[Dict]:
         Lista de llamadas del usuario
     """
     try:
-        return video_chat_manager.get_user_active_calls(user_id)
+        return get_video_chat_manager().get_user_active_calls(user_id)
     except Exception as e:
         logger.error(f"Error obteniendo llamadas del usuario: {str(e)}")
         return []
@@ -900,7 +912,7 @@ def end_video_call(call_id: str, user_id: str) -> Dict:
         Dict con información de la finalización
     """
     try:
-        return video_chat_manager.end_call(call_id, user_id)
+        return get_video_chat_manager().end_call(call_id, user_id)
     except Exception as e:
         logger.error(f"Error finalizando llamada: {str(e)}")
         return {
@@ -920,7 +932,7 @@ def start_call_recording(call_id: str, user_id: str) -> Dict:
         Dict con información de la grabación
     """
     try:
-        return video_chat_manager.start_call_recording(call_id, user_id)
+        return get_video_chat_manager().start_call_recording(call_id, user_id)
     except Exception as e:
         logger.error(f"Error iniciando grabación: {str(e)}")
         return {
@@ -940,7 +952,7 @@ def stop_call_recording(call_id: str, user_id: str) -> Dict:
         Dict con información de la grabación detenida
     """
     try:
-        return video_chat_manager.stop_call_recording(call_id, user_id)
+        return get_video_chat_manager().stop_call_recording(call_id, user_id)
     except Exception as e:
         logger.error(f"Error deteniendo grabación: {str(e)}")
         return {
@@ -956,7 +968,7 @@ def get_video_chat_statistics() -> Dict:
         Dict con estadísticas del sistema
     """
     try:
-        return video_chat_manager.get_system_statistics()
+        return get_video_chat_manager().get_system_statistics()
     except Exception as e:
         logger.error(f"Error obteniendo estadísticas: {str(e)}")
         return {}
@@ -976,7 +988,7 @@ def moderate_call_content(call_id: str, user_id: str,
         Dict con resultado de la moderación
     """
     try:
-        return video_chat_manager.moderate_call_content(
+        return get_video_chat_manager().moderate_call_content(
             call_id=call_id,
             user_id=user_id,
             content_type=content_type,
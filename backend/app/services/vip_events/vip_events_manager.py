@@ -1,4 +1,5 @@
 import logging
+import threading
 import uuid
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
@@ -6,6 +7,8 @@ from dataclasses import dataclass, field
 from enum import Enum
 import random
 
+from app.services.geo.spatial_index import GeoGridIndex, haversine_km
+
 logger = logging.getLogger(__name__)
 
 class EventType(Enum):
@@ -88,6 +91,10 @@ class VIPEventsManager:
         self.tickets: Dict[str, EventTicket] = {}
         self.user_events: Dict[str, List[str]] = {}
         
+        # Índice espacial de eventos por coordenadas
+        self.event_locations = GeoGridIndex(cell_size_deg=0.5)
+        self.max_event_distance_km = 50.0
+        
         # Configuración de eventos
         self.event_templates = self._load_event_templates()
         self.matching_weights = {
@@ -188,6 +195,8 @@ class VIPEventsManager:
             
             # Almacenar evento
             self.events[event.id] = event
+            if location.coordinates:
+                self.event_locations.insert(event.id, *location.coordinates[:2])
             
             logger.info(f"Evento VIP creado: {event.title} (ID: {event.id})")
             return event
@@ -200,6 +209,7 @@ class VIPEventsManager:
                               preferences: Optional[Dict] = None) -> List[VIPEvent]:
         """Sugerir eventos VIP basados en perfil y preferencias"""
         try:
+            self.expire_past_events()
             available_events = [
                 event for event in self.events.values() 
                 if event.status in [EventStatus.OPEN, EventStatus.FULL] 
@@ -209,11 +219,14 @@ class VIPEventsManager:
             if not available_events:
                 return []
             
+            # Distancias a los eventos cercanos con una sola consulta espacial
+            nearby_events = self._find_nearby_events(user_profile.get('location', {}))
+            
             # Calcular compatibilidad para cada evento
             scored_events = []
             for event in available_events:
                 compatibility_score = self._calculate_event_compatibility(
-                    user_profile, event, preferences
+                    user_profile, event, preferences, nearby_events
                 )
                 scored_events.append((event, compatibility_score))
             
@@ -227,9 +240,42 @@ class VIPEventsManager:
             logger.error(f"Error sugiriendo eventos: {str(e)}")
             return []
     
+    def cancel_event(self, event_id: str) -> bool:
+        """Cancelar un evento y sacarlo del índice espacial"""
+        event = self.events.get(event_id)
+        if event is None or event.status in (EventStatus.CANCELLED, EventStatus.COMPLETED):
+            return False
+        event.status = EventStatus.CANCELLED
+        self.event_locations.remove(event_id)
+        logger.info(f"Evento VIP cancelado: {event_id}")
+        return True
+    
+    def expire_past_events(self, now: Optional[datetime] = None) -> int:
+        """Marcar como completados los eventos ya terminados y sacarlos del índice espacial"""
+        now = now or datetime.now()
+        expired = 0
+        for event in list(self.events.values()):
+            if event.end_time < now and event.status not in (EventStatus.CANCELLED, EventStatus.COMPLETED):
+                event.status = EventStatus.COMPLETED
+                self.event_locations.remove(event.id)
+                expired += 1
+        return expired
+    
+    def _find_nearby_events(self, user_location: Dict) -> Optional[Dict[str, float]]:
+        """Eventos dentro de la distancia máxima (event_id -> km), None si no hay ubicación"""
+        try:
+            if not user_location or 'coordinates' not in user_location:
+                return None
+            lat, lng = user_location['coordinates'][:2]
+            return dict(self.event_locations.query_radius(lat, lng, self.max_event_distance_km))
+        except Exception as e:
+            logger.error(f"Error buscando eventos cercanos: {str(e)}")
+            return None
+    
     def _calculate_event_compatibility(self, user_profile: Dict, 
                                      event: VIPEvent, 
-                                     preferences: Optional[Dict] = None) -> float:
+                                     preferences: Optional[Dict] = None,
+                                     nearby_events: Optional[Dict[str, float]] = None) -> float:
         """Calcular puntuación de compatibilidad entre usuario y evento"""
         score = 0.0
         weights = self.matching_weights
@@ -248,8 +294,11 @@ class VIPEventsManager:
             score += interests_score * weights['interests_overlap']
             
             # 3. Proximidad de ubicación (20%)
+            distance_km = None
+            if nearby_events is not None and event.id in self.event_locations:
+                distance_km = nearby_events.get(event.id, float('inf'))
             location_score = self._calculate_location_proximity(
-                user_profile.get('location', {}), event.location
+                user_profile.get('location', {}), event.location, distance_km
             )
             score += location_score * weights['location_proximity']
             
@@ -335,22 +384,22 @@ class VIPEventsManager:
             return 0.0
     
     def _calculate_location_proximity(self, user_location: Dict, 
-                                    event_location: EventLocation) -> float:
+                                    event_location: EventLocation,
+                                    distance_km: Optional[float] = None) -> float:
         """Calcular proximidad de ubicación"""
         try:
             if not user_location or 'coordinates' not in user_location:
                 return 0.5  # Puntuación neutral
             
-            user_coords = user_location['coordinates']
-            event_coords = event_location.coordinates
-            
-            # Calcular distancia (simplificada)
-            distance = self._calculate_distance(user_coords, event_coords)
+            # Distancia precalculada por el índice espacial o cálculo directo
+            if distance_km is None:
+                distance_km = self._calculate_distance(
+                    user_location['coordinates'], event_location.coordinates
+                )
             
             # Convertir distancia a puntuación (0-1)
-            # Asumimos que 50km es la distancia máxima aceptable
-            max_distance = 50.0
-            return max(0, 1 - (distance / max_distance))
+            # Asumimos que max_event_distance_km es la distancia máxima aceptable
+            return max(0, 1 - (distance_km / self.max_event_distance_km))
             
         except Exception as e:
             logger.error(f"Error calculando proximidad: {str(e)}")
@@ -358,16 +407,10 @@ class VIPEventsManager:
     
     def _calculate_distance(self, coords1: Tuple[float, float], 
                          coords2: Tuple[float, float]) -> float:
-        """Calcular distancia entre dos coordenadas (simplificado)"""
+        """Calcular distancia entre dos coordenadas (Haversine)"""
         try:
-            # Fórmula simplificada de distancia (no es Haversine)
-            lat_diff = abs(coords1[0] - coords2[0])
-            lon_diff = abs(coords1[1] - coords2[1])
-            
-            # Aproximación: 1 grado ≈ 111 km
-            distance_km = (lat_diff + lon_diff) * 111.0
-            
-            return distance_km
+            # Misma métrica que el índice espacial de eventos
+            return float(haversine_km(coords1[0], coords1[1], coords2[0], coords2[1])[0])
             
         except Exception as e:
             logger.error(f"Error calculando distancia: {str(e)}")
@@ -734,8 +777,19 @@ class VIPEventsManager:
             logger.error(f"Error calculando tasa de cancelación: {str(e)}")
             return 0.0
 
-# Instancia global del gestor de eventos VIP
-vip_events_manager = VIPEventsManager()
+# Instancia global del gestor de eventos VIP: se crea al primer uso
+# (get_vip_events_manager), no al importar el módulo
+vip_events_manager: Optional[VIPEventsManager] = None
+_vip_events_manager_lock = threading.Lock()
+
+def get_vip_events_manager() -> VIPEventsManager:
+    """Gestor compartido (se crea al primer uso)"""
+    global vip_events_manager
+    if vip_events_manager is None:
+        with _vip_events_manager_lock:
+            if vip_events_manager is None:
+                vip_events_manager = VIPEventsManager()
+    return vip_events_manager
 
 def create_exclusive_vip_event(event_type: str, location_data: Dict, 
                              date_time: str, organizer_id: str, 
@@ -774,7 +828,7 @@ def create_exclusive_vip_event(event_type: str, location_data: Dict,
         event_datetime = datetime.fromisoformat(date_time)
         
         # Crear evento
-        event = vip_events_manager.create_exclusive_event(
+        event = get_vip_events_manager().create_exclusive_event(
             event_type_enum, location, event_datetime, organizer_id, customizations
         )
         
@@ -819,7 +873,7 @@ def suggest_vip_events_for_user(user_profile: Dict,
         Lista de eventos sugeridos
     """
     try:
-        suggested_events = vip_events_manager.suggest_events_for_user(user_profile, preferences)
+        suggested_events = get_vip_events_manager().suggest_events_for_user(user_profile, preferences)
         
         return [
             {
@@ -864,7 +918,7 @@ def purchase_vip_event_ticket(event_id: str, user_id: str,
     try:
         ticket_tier_enum = TicketTier(tier)
         
-        ticket = vip_events_manager.purchase_event_ticket(
+        ticket = get_vip_events_manager().purchase_event_ticket(
             event_id, user_id, ticket_tier_enum, companion_user_id
         )
         
@@ -898,7 +952,7 @@ def get_user_vip_events(user_id: str) -> List[Dict]:
         Lista de eventos del usuario
     """
     try:
-        user_events = vip_events_manager.get_user_events(user_id)
+        user_events = get_vip_events_manager().get_user_events(user_id)
         
         return [
             {
@@ -935,7 +989,7 @@ def create_curated_networking_event(user_list: List[str],
         Dict con información del evento creado
     """
     try:
-        event = vip_events_manager.create_curated_networking_event(user_list, event_details)
+        event = get_vip_events_manager().create_curated_networking_event(user_list, event_details)
         
         return {
             'success': True,
@@ -959,6 +1013,28 @@ def create_curated_networking_event(user_list: List[str],
             'error': str(e)
         }
 
+def cancel_vip_event(event_id: str) -> Dict:
+    """
+    Cancelar un evento VIP
+    
+    Args:
+        event_id: ID del evento
+    
+    Returns:
+        Dict con el resultado de la cancelación
+    """
+    try:
+        if get_vip_events_manager().cancel_event(event_id):
+            return {'success': True, 'event_id': event_id}
+        return {'success': False, 'error': 'Evento no encontrado o ya cerrado'}
+        
+    except Exception as e:
+        logger.error(f"Error cancelando evento: {str(e)}")
+        return {
+            'success': False,
+            'error': str(e)
+        }
+
 def get_vip_event_statistics(event_id: str) -> Dict:
     """
     Obtener estadísticas de un evento VIP
@@ -970,7 +1046,7 @@ def get_vip_event_statistics(event_id: str) -> Dict:
         Dict con estadísticas del evento
     """
     try:
-        stats = vip_events_manager.get_event_statistics(event_id)
+        stats = get_vip_events_manager().get_event_statistics(event_id)
         return stats
         
     except Exception as e:
@@ -0,0 +1,131 @@
+"""
+TuCitaSegura - Caché LRU con expiración
+
+Caché en memoria de tamaño acotado: al superar `max_entries` se descarta la
+entrada usada hace más tiempo, y las entradas caducan pasados `ttl_seconds`.
+Es segura entre hilos y lleva contadores de aciertos y fallos para
+monitorización (y, opcionalmente, de la memoria ocupada por los valores).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Caché LRU acotada con expiración por tiempo
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_seconds: float = 300,
+        sizeof: Optional[Callable[[Hashable, Any], int]] = None
+    ):
+        """
+        Args:
+            max_entries: Número máximo de entradas antes de desalojar por LRU
+            ttl_seconds: Vida de cada entrada en segundos
+            sizeof: Estimación en bytes de (clave, valor) para contabilizar memoria
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.sizeof = sizeof
+        # clave -> (valor, caduca_en, bytes)
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.memory_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Valor de la clave si existe y no ha caducado"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at, _ = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._discard(key)
+            self.misses += 1
+            return default
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Si la clave existe y no ha caducado (sin contar acierto ni cambiar el orden LRU)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] > time.monotonic()
+
+    def set(self, key: Hashable, value: Any):
+        """Guardar un valor, desalojando la entrada menos reciente si hace falta"""
+        size = self.sizeof(key, value) if self.sizeof is not None else 0
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl_seconds, size)
+            self.memory_bytes += size
+            while len(self._entries) > self.max_entries:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.memory_bytes -= evicted_size
+                self.evictions += 1
+
+    def _discard(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.memory_bytes -= entry[2]
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """
+        Valor cacheado o, en caso de fallo, el resultado de loader()
+
+        Si loader lanza una excepción no se guarda nada.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._discard(key)
+
+    def invalidate_where(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        """Descartar las entradas para las que predicate(clave, valor) es cierto"""
+        with self._lock:
+            stale = [key for key, (value, _, _) in self._entries.items() if predicate(key, value)]
+            for key in stale:
+                self._discard(key)
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.memory_bytes = 0
+
+    def get_stats(self) -> Dict:
+        """Contadores de la caché para monitorización"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+            if self.sizeof is not None:
+                stats['memory_bytes'] = self.memory_bytes
+            return stats
@@ -20,6 +20,10 @@ try:
     from app.models.schemas import HealthCheck
 except Exception:
     HealthCheck = None
+try:
+    from app.core import lazy_services
+except Exception:
+    lazy_services = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -89,6 +93,12 @@ if firebase_admin and not firebase_admin._apps:
     except Exception as e:
         logger.error(f"Error inicializando Firebase Admin: {e}")
 
+@app.on_event("startup")
+async def warm_up_services():
+    # Los servicios pesados (ML, visión) se cargan en segundo plano: /health responde ya
+    if lazy_services and os.getenv("WARM_UP_SERVICES", "true").lower() == "true":
+        lazy_services.warm_up_in_background()
+
 @app.get("/", response_model=HealthCheck if HealthCheck else None)
 @app.get("/health", response_model=HealthCheck if HealthCheck else None)
 async def health_check():
@@ -103,7 +113,7 @@ async def health_check():
         "services": {
             "api": "running",
             "firebase": "connected" if firebase_connected else "unavailable",
-            "ml": "loaded",
+            "ml": lazy_services.service_status().get("recommendations", "cold") if lazy_services else "unavailable",
         },
     }
 
@@ -0,0 +1,221 @@
+"""
+Moderation benchmark corpus and verdict regression harness
+
+Generates a deterministic corpus of clean, borderline and abusive Spanish
+chat messages at several lengths plus long conversations, measures
+MessageModerator throughput and latency, and diffs verdicts (is_safe,
+severity, categories) against the stored baseline in
+tests/data/moderation_baseline.json.
+
+Usage (from backend/):
+
+    python -m tests.moderation_benchmark                    # benchmark + verdict diff
+    python -m tests.moderation_benchmark --update-baseline  # accept current verdicts
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import time
+from typing import Dict, List, Optional, Sequence
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'data', 'moderation_baseline.json')
+CORPUS_SEED = 2024
+CONVERSATION_LENGTHS = (10, 100, 1000)
+
+CLEAN_SENTENCES = [
+    "Hola, ¿qué tal?", "¡Buenas noches! ¿Cómo estás?", "Me encantó tu perfil 😊",
+    "¿Te apetece un café el sábado?", "Yo también soy de Madrid", "jajaja qué gracioso",
+    "Me gusta mucho viajar y la música en directo", "¿Qué planes tienes para el finde?",
+    "Acabo de salir del trabajo, estoy agotada", "¿Has visto la última peli de Almodóvar?",
+    "Perdona por tardar en contestar", "Feliz cumpleaños 🎉", "Vale, hablamos luego",
+    "Cocino fatal, pero hago una tortilla buenísima", "¿Perros o gatos?"
+]
+BORDERLINE_SENTENCES = [
+    "No seas tonto, anda", "Qué feo eso que dijiste", "Eres un poco malo conmigo",
+    "Sígueme en instagram si quieres", "Tengo una oferta de trabajo interesante",
+    "¿Dónde vives?", "Mándame tu foto", "No me molestes ahora", "Estoy en la calle Mayor 12",
+    "Holaaaaaa", "Te dejo mi web: www.ejemplo.com", "Necesito dinero para el alquiler, qué agobio"
+]
+ABUSIVE_SENTENCES = [
+    "Eres un idiota y un imbécil", "Te voy a hacer daño", "No te escaparás de mí",
+    "Odio gente como tú, racista", "Basura gente, escoria raza", "Vendo porro y marihuana",
+    "Quiero comprar drogas esta noche", "Envíame dinero por transferencia urgente",
+    "Inversión rápido, ganar dinero fácil", "Mi dni 12345678Z y teléfono 612345678",
+    "Quiero follar polla", "Desnuda ahora, quítate la ropa", "Te voy a acosar y perseguir",
+    "Gratis promoción descuento oferta 🔥🔥🔥", "Estúpido retrasado"
+]
+KINDS = {'clean': CLEAN_SENTENCES, 'borderline': BORDERLINE_SENTENCES, 'abusive': ABUSIVE_SENTENCES}
+LENGTHS = {'short': (1, 1), 'medium': (2, 4), 'long': (8, 16)}
+
+
+def _message(rng: random.Random, kind: str, length: str) -> str:
+    low, high = LENGTHS[length]
+    sentences = []
+    for _ in range(rng.randint(low, high)):
+        # Los mensajes problemáticos largos mezclan frases limpias
+        pool = KINDS[kind] if kind == 'clean' or rng.random() < 0.5 else CLEAN_SENTENCES
+        sentences.append(rng.choice(pool))
+    if kind != 'clean' and not any(sentence in KINDS[kind] for sentence in sentences):
+        sentences[rng.randrange(len(sentences))] = rng.choice(KINDS[kind])
+    return ' '.join(sentences)
+
+
+def generate_corpus(seed: int = CORPUS_SEED, per_bucket: int = 40) -> List[Dict]:
+    """Deterministic corpus: per_bucket messages for each (kind, length) pair"""
+    rng = random.Random(seed)
+    corpus = []
+    for kind in KINDS:
+        for length in LENGTHS:
+            for i in range(per_bucket):
+                corpus.append({
+                    'id': f'{kind}-{length}-{i}',
+                    'kind': kind,
+                    'length': length,
+                    'text': _message(rng, kind, length)
+                })
+    return corpus
+
+
+def generate_conversation(length: int, seed: int = CORPUS_SEED) -> List[Dict]:
+    """Mostly clean conversation with occasional borderline and abusive messages"""
+    rng = random.Random(seed + length)
+    messages = []
+    for i in range(length):
+        roll = rng.random()
+        kind = 'abusive' if roll < 0.05 else 'borderline' if roll < 0.2 else 'clean'
+        messages.append({
+            'id': f'msg-{i}',
+            'content': _message(rng, kind, rng.choice(list(LENGTHS))),
+            'was_flagged': kind == 'abusive',
+            'timestamp': f'2024-05-{1 + i % 28:02d}T{i % 24:02d}:00:00'
+        })
+    return messages
+
+
+def corpus_digest(corpus: Sequence[Dict]) -> str:
+    return hashlib.sha256('\n'.join(item['text'] for item in corpus).encode('utf-8')).hexdigest()
+
+
+def _percentile(values: Sequence[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] if ordered else 0.0
+
+
+def benchmark_messages(moderator, corpus: Sequence[Dict], repeat: int = 3) -> Dict:
+    """Throughput and per-call latency of moderate_message over the corpus"""
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for item in corpus:
+            call_started = time.perf_counter()
+            moderator.moderate_message(item['text'], 'bench_user')
+            latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    return {
+        'messages': len(latencies),
+        'messages_per_second': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': _percentile(latencies, 0.5) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000
+    }
+
+
+def benchmark_conversations(moderator, lengths: Sequence[int] = CONVERSATION_LENGTHS) -> List[Dict]:
+    """Cost of moderate_conversation versus conversation length"""
+    results = []
+    for length in lengths:
+        messages = generate_conversation(length)
+        started = time.perf_counter()
+        moderator.moderate_conversation(messages, 'bench_user')
+        elapsed = time.perf_counter() - started
+        results.append({
+            'length': length,
+            'seconds': elapsed,
+            'ms_per_message': elapsed / length * 1000
+        })
+    return results
+
+
+def collect_verdicts(moderator, corpus: Sequence[Dict]) -> Dict[str, Dict]:
+    """Verdict fields tracked by the regression baseline"""
+    verdicts = {}
+    for item in corpus:
+        result = moderator.moderate_message(item['text'], 'bench_user')
+        verdicts[item['id']] = {
+            'is_safe': result.is_safe,
+            'severity': result.severity,
+            'categories': sorted(result.categories)
+        }
+    return verdicts
+
+
+def load_baseline(path: str = BASELINE_PATH) -> Optional[Dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(corpus: Sequence[Dict], verdicts: Dict[str, Dict], path: str = BASELINE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'corpus_digest': corpus_digest(corpus), 'verdicts': verdicts}, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+
+def diff_verdicts(verdicts: Dict[str, Dict], baseline: Dict) -> List[Dict]:
+    """Messages whose verdict differs from the baseline"""
+    differences = []
+    for message_id in sorted(set(verdicts) | set(baseline['verdicts'])):
+        expected = baseline['verdicts'].get(message_id)
+        actual = verdicts.get(message_id)
+        if expected != actual:
+            differences.append({'id': message_id, 'expected': expected, 'actual': actual})
+    return differences
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    from app.services.nlp.message_moderator import MessageModerator
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--update-baseline', action='store_true', help='store current verdicts as the baseline')
+    parser.add_argument('--repeat', type=int, default=3, help='passes over the corpus for the benchmark')
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.INFO)
+    corpus = generate_corpus()
+    moderator = MessageModerator(cache_size=0)
+    verdicts = collect_verdicts(moderator, corpus)
+
+    if args.update_baseline:
+        save_baseline(corpus, verdicts)
+        print(f"Baseline updated: {len(verdicts)} verdicts -> {BASELINE_PATH}")
+        return 0
+
+    stats = benchmark_messages(moderator, corpus, args.repeat)
+    print(f"Messages: {stats['messages']}  {stats['messages_per_second']:.0f} msg/s  "
+          f"p50 {stats['p50_ms']:.3f} ms  p99 {stats['p99_ms']:.3f} ms")
+    for row in benchmark_conversations(moderator):
+        print(f"Conversation of {row['length']:>5}: {row['seconds'] * 1000:8.1f} ms "
+              f"({row['ms_per_message']:.3f} ms/message)")
+
+    baseline = load_baseline()
+    if baseline is None:
+        print("No baseline stored; run with --update-baseline")
+        return 1
+    if baseline['corpus_digest'] != corpus_digest(corpus):
+        print("Corpus changed since the baseline was stored; run with --update-baseline")
+        return 1
+    differences = diff_verdicts(verdicts, baseline)
+    for difference in differences:
+        print(f"  {difference['id']}: {difference['expected']} -> {difference['actual']}")
+    print(f"Verdict differences: {len(differences)}")
+    return 1 if differences else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
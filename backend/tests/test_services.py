@@ -58,9 +58,951 @@ class TestRecommendationEngine:
         assert len(recommendations) == 0
 
 
+class TestBatchScoring:
+    """Test suite for vectorized candidate scoring"""
+    
+    @staticmethod
+    def _random_profiles(count: int, seed: int = 7):
+        import random
+        from app.services.ml.recommendation_engine import UserProfile
+        
+        rng = random.Random(seed)
+        interests = ["music", "travel", "cooking", "sports", "reading", "art", "wine", "tech"]
+        education = ["none", "high_school", "bachelor", "master", "phd", "university", ""]
+        verification = ["none", "email", "phone", "identity", "premium", "verified"]
+        lifestyle = ["no_preference", "yes", "no", "social", "regular"]
+        profiles = []
+        for i in range(count):
+            profiles.append(UserProfile(
+                user_id=f"cand_{i}", age=rng.randint(18, 60), gender="femenino",
+                location={"lat": 40.4 + rng.uniform(-1, 1), "lng": -3.7 + rng.uniform(-1, 1)},
+                interests=rng.sample(interests, rng.randint(0, 5)),
+                profession="", education_level=rng.choice(education),
+                relationship_goals=rng.choice(["serious", "casual", "friendship"]),
+                personality_traits={}, preferences={},
+                activity_score=rng.random(), reputation_score=rng.random(),
+                verification_level=rng.choice(verification),
+                photos_count=rng.randint(0, 5), bio_length=rng.randint(0, 200),
+                languages=["es"], smoking=rng.choice(lifestyle), drinking=rng.choice(lifestyle),
+                exercise=rng.choice(lifestyle), religion=rng.choice(lifestyle),
+                politics=rng.choice(lifestyle)
+            ))
+        return profiles
+    
+    async def test_batch_scores_match_scalar(self):
+        """Vectorized scores must match the per-candidate implementation"""
+        import numpy as np
+        from app.services.ml.recommendation_engine import MatchingEngine
+        from app.services.ml.batch_scoring import CandidateColumns
+        
+        engine = MatchingEngine()
+        user, *candidates = self._random_profiles(300)
+        columns = CandidateColumns.from_profiles(candidates, extra_interests=user.interests)
+        scores = engine.batch_scorer.score(user, columns)
+        
+        for i, candidate in enumerate(candidates):
+            assert np.isclose(scores.content[i], engine._calculate_content_score(user, candidate, []))
+            assert np.isclose(scores.geographic[i], engine._calculate_geographic_score(user, candidate))
+            assert np.isclose(scores.behavioral[i], engine._calculate_behavioral_score(user, candidate))
+            assert np.isclose(scores.distance_km[i], engine._calculate_distance(user.location, candidate.location))
+            assert np.isclose(scores.success_rate[i], engine._predict_success_rate(user, candidate))
+    
+    async def test_batch_recommendations_sorted_and_limited(self):
+        """Batch ranking returns the top candidates above the threshold"""
+        from app.services.ml.recommendation_engine import MatchingEngine
+        
+        engine = MatchingEngine()
+        user, *candidates = self._random_profiles(200, seed=11)
+        recommendations = engine._score_candidates_batch(user, candidates, limit=5)
+        
+        assert len(recommendations) <= 5
+        scores = [rec.score for rec in recommendations]
+        assert scores == sorted(scores, reverse=True)
+        assert all(score >= engine.min_compatibility_score for score in scores)
+
+
+class TestCandidateIndex:
+    """Test suite for the resident columnar candidate index"""
+    
+    @staticmethod
+    def _user_doc(age, gender, lat=40.42, lng=-3.70, **extra):
+        data = {
+            "isActive": True, "age": age, "gender": gender,
+            "location": {"lat": lat, "lng": lng}, "interests": ["music"],
+            "relationshipGoals": "serious", "verificationLevel": "email"
+        }
+        data.update(extra)
+        return data
+    
+    async def test_index_partitions_and_filters(self):
+        """Queries honour gender, age range and exclusions"""
+        from app.services.ml.recommendation_engine import MatchingEngine
+        
+        engine = MatchingEngine()
+        index = engine.candidate_index
+        index.upsert("w1", self._user_doc(24, "femenino"))
+        index.upsert("w2", self._user_doc(31, "femenino"))
+        index.upsert("w3", self._user_doc(45, "femenino", verificationLevel="identity"))
+        index.upsert("m1", self._user_doc(30, "masculino"))
+        
+        result = index.query(genders=["femenino"], min_age=25, max_age=50)
+        assert sorted(result.ids) == ["w2", "w3"]
+        
+        result = index.query(genders=["femenino"], exclude_user_id="w2", verification_level="identity")
+        assert list(result.ids) == ["w3"]
+        
+        # Cambio de edad mueve el perfil de partición; desactivación lo elimina
+        index.upsert("w1", self._user_doc(33, "femenino"))
+        index.upsert("w3", self._user_doc(45, "femenino", isActive=False))
+        result = index.query(genders=["femenino"], min_age=30, max_age=35)
+        assert sorted(result.ids) == ["w1", "w2"]
+        assert index.get("w3") is None
+    
+    async def test_engine_serves_from_index(self):
+        """MatchingEngine uses the index instead of scanning Firestore"""
+        from app.services.ml.recommendation_engine import MatchingEngine
+        
+        engine = MatchingEngine()
+        index = engine.candidate_index
+        index.upsert("near", self._user_doc(27, "femenino", lat=40.7200, lng=-74.0100))
+        index.upsert("far", self._user_doc(27, "femenino", lat=41.9, lng=12.5))
+        index.upsert("man", self._user_doc(27, "masculino", lat=40.7200, lng=-74.0100))
+        index.is_ready = True
+        
+        user = engine._get_user_profile("test_user_123")
+        candidates = engine._get_candidate_columns("test_user_123", user)
+        assert list(candidates.ids) == ["near"]
+        assert index.get_stats()["geo_indexed"] == 3
+
+    @staticmethod
+    def _listening_db(collections):
+        """Firestore en memoria con where/select/stream y on_snapshot"""
+        from types import SimpleNamespace
+
+        listeners = []
+
+        def query(name, conditions=()):
+            def stream():
+                for doc_id, data in collections.get(name, {}).items():
+                    if all(data.get(field) == value for field, _, value in conditions):
+                        yield SimpleNamespace(id=doc_id, exists=True, to_dict=lambda data=data: dict(data))
+
+            def on_snapshot(callback):
+                listeners.append((name, callback))
+                return SimpleNamespace(unsubscribe=lambda: None)
+
+            return SimpleNamespace(
+                where=lambda field, op, value: query(name, tuple(conditions) + ((field, op, value),)),
+                select=lambda fields: query(name, conditions),
+                stream=stream, on_snapshot=on_snapshot
+            )
+
+        return SimpleNamespace(collection=query, listeners=listeners)
+
+    async def test_shared_engine_starts_with_resident_indexes(self, monkeypatch):
+        """get_matching_engine() loads the resident structures and keeps them listening"""
+        from app.services.ml import recommendation_engine
+
+        db = self._listening_db({
+            "users": {"w1": self._user_doc(27, "femenino"), "gone": self._user_doc(30, "femenino", isActive=False)},
+            "likes": {"l1": {"fromUserId": "gone", "toUserId": "w1", "matched": True}}
+        })
+
+        class Engine(recommendation_engine.MatchingEngine):
+            def __init__(self):
+                super().__init__()
+                self.db = db
+
+        monkeypatch.setattr(recommendation_engine, "MatchingEngine", Engine)
+        monkeypatch.setattr(recommendation_engine, "matching_engine", None)
+        monkeypatch.setattr(recommendation_engine, "RESIDENT_INDEXES", True)
+        engine = recommendation_engine.get_matching_engine()
+
+        assert engine.candidate_index.is_ready and engine.candidate_index.get("w1") is not None
+        assert engine.candidate_index.get("gone") is None
+        assert engine.interaction_graph.is_ready
+        assert engine.interaction_graph.get_stats()["interactions"] == 1
+        assert engine.embedding_index.is_ready and engine.embedding_index.get_stats()["profiles"] == 1
+        assert {"users", "likes", "messages"} <= {name for name, _ in db.listeners}
+
+        monkeypatch.setattr(recommendation_engine, "matching_engine", None)
+        monkeypatch.setattr(recommendation_engine, "RESIDENT_INDEXES", False)
+        idle = recommendation_engine.get_matching_engine()
+        assert not idle.candidate_index.is_ready and not idle.interaction_graph.is_ready
+
+
+    async def test_listener_changes_invalidate_cached_interactions(self):
+        """Interaction and profile changes from the listeners drop the stale cache entries"""
+        from types import SimpleNamespace
+        from app.services.ml.recommendation_engine import MatchingEngine
+
+        engine = MatchingEngine()
+        engine.interactions_cache.set("ana", ["old"])
+        engine.interactions_cache.set("leo", ["old"])
+        engine.similar_users_cache.set((frozenset({"music"}), "serious"), frozenset({"ana", "leo"}))
+        engine.similar_users_cache.set((frozenset({"chess"}), "casual"), frozenset({"leo"}))
+        engine.similar_users_cache.set((frozenset({"surf"}), "friends"), frozenset({"leo"}))
+
+        like = SimpleNamespace(
+            type=SimpleNamespace(name='ADDED'),
+            document=SimpleNamespace(id="l1", to_dict=lambda: {"fromUserId": "ana", "toUserId": "leo"})
+        )
+        engine.interaction_graph._interactions_callback("likes")(None, [like], None)
+        assert "ana" not in engine.interactions_cache and "leo" in engine.interactions_cache
+
+        # Nuevo perfil con chess: sale del conjunto de music y entra en el de chess
+        engine.candidate_index.upsert("ana", self._user_doc(30, "femenino", interests=["chess"]))
+        assert len(engine.similar_users_cache) == 1
+        assert (frozenset({"surf"}), "friends") in engine.similar_users_cache
+
+class TestEmbeddingIndex:
+    """Test suite for the profile embedding index"""
+
+    async def test_build_persist_and_search(self, tmp_path):
+        """Embeddings are persisted memory-mapped and searchable after reload"""
+        import numpy as np
+        from app.services.ml.embedding_index import EmbeddingIndex
+
+        profiles = TestBatchScoring._random_profiles(300, seed=2)
+        for i, profile in enumerate(profiles):
+            profile.bio = "me encanta viajar y la fotografía" if i % 3 else "cocina italiana y vino"
+        index = EmbeddingIndex()
+        index.build(profiles, str(tmp_path))
+
+        stats = index.get_stats()
+        assert stats["memory_mapped"] and stats["profiles"] == 300
+        assert np.allclose(np.linalg.norm(index.matrix, axis=1), 1.0, atol=1e-5)
+
+        query = index.embed(profiles[0])
+        results = index.search(query, 5)
+        assert results[0][0] == profiles[0].user_id
+        assert [score for _, score in results] == sorted((score for _, score in results), reverse=True)
+
+        reloaded = EmbeddingIndex()
+        reloaded.load(str(tmp_path))
+        assert reloaded.search(query, 5) == results
+
+    async def test_engine_shortlists_large_pools(self):
+        """Only the most similar profiles reach exact scoring"""
+        import numpy as np
+        from app.services.ml.recommendation_engine import MatchingEngine
+        from app.services.ml.batch_scoring import CandidateColumns
+
+        engine = MatchingEngine()
+        engine.shortlist_size = 50
+        user, *candidates = TestBatchScoring._random_profiles(401, seed=4)
+        engine.embedding_index.build(candidates[:350])
+
+        columns = CandidateColumns.from_profiles(candidates)
+        shortlist = engine._shortlist_candidates(user, columns)
+        # 50 preseleccionados + los 50 perfiles sin embedding
+        assert len(shortlist) == 100
+        assert set(shortlist.ids) >= {profile.user_id for profile in candidates[350:]}
+
+        query = engine.embedding_index.embed(user)
+        similarities = np.asarray(engine.embedding_index.matrix) @ query
+        expected = {candidates[i].user_id for i in np.argsort(-similarities)[:50]}
+        assert expected <= set(shortlist.ids)
+
+
+class TestRecommendationMaterialization:
+    """Test suite for precomputed top-K recommendations"""
+
+    @staticmethod
+    def _engine_with_users(count: int = 60):
+        from app.services.ml.recommendation_engine import MatchingEngine
+
+        engine = MatchingEngine()
+        profiles = TestBatchScoring._random_profiles(count, seed=9)
+        for i, profile in enumerate(profiles):
+            profile.gender = "masculino" if i % 2 else "femenino"
+            engine.candidate_index.add_profile(profile)
+        engine.candidate_index.is_ready = True
+        return engine, profiles
+
+    @staticmethod
+    def _interactions_db(profiles, seed: int = 3):
+        """Firestore en memoria con users y likes (select().stream())"""
+        import random
+        from types import SimpleNamespace
+
+        rng = random.Random(seed)
+        collections = {
+            'users': {p.user_id: {'interests': p.interests, 'relationshipGoals': p.relationship_goals} for p in profiles},
+            'likes': {},
+            'messages': {}
+        }
+        for n, source in enumerate(profiles):
+            for target in rng.sample(profiles, 8):
+                collections['likes'][f'like{n}-{target.user_id}'] = {
+                    'fromUserId': source.user_id, 'toUserId': target.user_id, 'matched': rng.random() < 0.4
+                }
+
+        def collection(name):
+            docs = [SimpleNamespace(id=doc_id, exists=True, to_dict=lambda data=data: dict(data))
+                    for doc_id, data in collections[name].items()]
+            query = SimpleNamespace(stream=lambda: iter(docs))
+            query.select = lambda fields: query
+            return query
+
+        return SimpleNamespace(collection=collection)
+
+    async def test_materialized_lists_match_live_scoring(self):
+        """Stored lists equal what the engine computes on demand, including collaborative scores"""
+        from dataclasses import asdict
+        from app.services.ml.interaction_graph import NEUTRAL_SCORE
+        from app.services.ml.materialization import RecommendationMaterializer
+
+        engine, profiles = self._engine_with_users()
+        stats = RecommendationMaterializer(engine, top_k=5, workers=0).run()
+        assert stats["users"] == len(profiles)
+
+        for profile in profiles[:10]:
+            columns = engine._get_candidate_columns(profile.user_id, profile)
+            live = [asdict(rec) for rec in engine._score_candidates_batch(profile, columns, 5)]
+            assert engine.recommendation_store.get(profile.user_id, 5) == live
+        assert engine.recommendation_store.get(profiles[0].user_id, 10) is None
+
+        # Con interacciones: el job carga el grafo y lo envía a los procesos del pool
+        engine, profiles = self._engine_with_users()
+        engine.db = self._interactions_db(profiles)
+        RecommendationMaterializer(engine, top_k=5, workers=2, cell_size_deg=0.5).run()
+        assert engine.interaction_graph.is_ready and not engine.interaction_graph.get_stats()['listening']
+
+        collaborative = []
+        for profile in profiles:
+            columns = engine._get_candidate_columns(profile.user_id, profile)
+            if columns is None or len(columns) == 0:
+                continue
+            collaborative.extend(engine.interaction_graph.collaborative_scores(profile.user_id, columns))
+            live = [asdict(rec) for rec in engine._score_candidates_batch(profile, columns, 5)]
+            assert engine.recommendation_store.get(profile.user_id, 5) == live
+        assert any(score != NEUTRAL_SCORE for score in collaborative)
+
+    async def test_process_pool_run(self):
+        """Partitions are scored in worker processes"""
+        from app.services.ml.materialization import RecommendationMaterializer
+
+        engine, profiles = self._engine_with_users(20)
+        stats = RecommendationMaterializer(engine, top_k=3, workers=2, cell_size_deg=0.5).run()
+        assert stats["users"] == 20 and stats["partitions"] > 1
+        assert len(engine.recommendation_store) == 20
+
+    async def test_api_worker_serves_the_job_output(self, tmp_path, monkeypatch):
+        """The job saves the store; a fresh API engine loads it and reloads it when it changes"""
+        import os
+        from app.services.ml import recommendation_engine
+        from app.services.ml.materialization import RecommendationMaterializer
+
+        engines = []
+
+        class CountingEngine(recommendation_engine.MatchingEngine):
+            def __init__(self):
+                super().__init__()
+                engines.append(self)
+
+        # Job: un único motor por proceso aunque haya varias particiones
+        engine, profiles = self._engine_with_users()
+        monkeypatch.setattr(recommendation_engine, "MatchingEngine", CountingEngine)
+        stats = RecommendationMaterializer(engine, top_k=5, workers=0, cell_size_deg=0.5).run()
+        assert stats["partitions"] > 1 and len(engines) == 1
+        path = str(tmp_path / "store" / "recommendations.json")
+        engine.recommendation_store.save(path)
+
+        # Worker de la API: el motor compartido carga el fichero del job
+        monkeypatch.setattr(recommendation_engine, "RECOMMENDATION_STORE_PATH", path)
+        monkeypatch.setattr(recommendation_engine, "RESIDENT_INDEXES", False)
+        monkeypatch.setattr(recommendation_engine, "matching_engine", None)
+        worker = recommendation_engine.get_matching_engine()
+        requester = next(p.user_id for p in profiles if engine.recommendation_store.get(p.user_id, 5))
+        expected = engine.recommendation_store.get(requester, 5)
+        assert recommendation_engine.get_recommendations_for_user(requester, 5) == expected
+        assert await recommendation_engine.get_recommendations_for_user_async(requester, 5) == expected
+
+        # Nueva ejecución del job: se recarga al cambiar el fichero
+        store = worker.recommendation_store
+        engine.recommendation_store.put(requester, expected[:1], 5, {})
+        engine.recommendation_store.save(path)
+        os.utime(path, (1, 1))
+        store.reload_interval_seconds = 0
+        assert recommendation_engine.get_recommendations_for_user(requester, 5) == expected[:1]
+        assert not store.refresh()
+
+    async def test_invalidation_and_serving(self):
+        """Material profile changes drop dependent lists; misses fall back to live scoring"""
+        import copy
+        from app.services.ml import recommendation_engine
+        from app.services.ml.materialization import RecommendationMaterializer
+
+        engine, profiles = self._engine_with_users()
+        RecommendationMaterializer(engine, top_k=5, workers=0).run()
+        store = engine.recommendation_store
+
+        requester = next(p for p in profiles if store.get(p.user_id, 5))
+        recommended = store.get(requester.user_id, 5)[0]["user_id"]
+
+        # Cambio menor (dentro del redondeo): no invalida
+        moved = copy.deepcopy(engine.candidate_index.get(recommended))
+        moved.location = dict(moved.location, lat=moved.location["lat"] + 0.0001)
+        engine.candidate_index.add_profile(moved)
+        assert store.get(requester.user_id, 5) is not None
+
+        # Cambio de ubicación relevante: invalida al candidato y a quien lo recomendaba
+        moved = copy.deepcopy(moved)
+        moved.location = dict(moved.location, lat=moved.location["lat"] + 0.5)
+        engine.candidate_index.add_profile(moved)
+        assert store.get(requester.user_id, 5) is None
+        assert store.get(recommended, 5) is None
+        assert store.get_stats()["invalidations"] >= 2
+
+        original = recommendation_engine.matching_engine
+        recommendation_engine.matching_engine = engine
+        try:
+            other = next(p.user_id for p in profiles if store.get(p.user_id, 5))
+            assert recommendation_engine.get_recommendations_for_user(other, 5) == store.get(other, 5)
+        finally:
+            recommendation_engine.matching_engine = original
+
+
+class TestInteractionGraph:
+    """Test suite for the collaborative filtering interaction graph"""
+
+    async def test_batch_scores_match_reference(self):
+        """Sparse lookups reproduce the interaction/similar-users formula"""
+        import random
+        import numpy as np
+        from app.services.ml.interaction_graph import InteractionGraph
+        from app.services.ml.batch_scoring import CandidateColumns
+
+        rng = random.Random(5)
+        user, *candidates = TestBatchScoring._random_profiles(120, seed=5)
+        graph = InteractionGraph()
+        for profile in [user] + candidates:
+            graph.upsert_user(profile.user_id, {
+                "interests": profile.interests, "relationshipGoals": profile.relationship_goals
+            })
+        interactions = []
+        for i in range(60):
+            target = rng.choice(candidates).user_id
+            success = rng.random() < 0.4
+            interactions.append((target, success))
+            if i % 2:
+                graph.add_interaction("likes", f"l{i}", {
+                    "fromUserId": user.user_id, "toUserId": target, "matched": success
+                })
+            else:
+                graph.add_interaction("messages", f"m{i}", {
+                    "senderId": user.user_id, "receiverId": target, "ledToDate": success
+                })
+
+        def reference(candidate):
+            similar = {
+                other.user_id for other in [user] + candidates
+                if other.user_id != candidate.user_id and (
+                    set(other.interests) & set(candidate.interests)
+                    or other.relationship_goals == candidate.relationship_goals
+                )
+            }
+            hits = [success for target, success in interactions if target in similar]
+            return sum(hits) / len(hits) if hits else 0.5
+
+        columns = CandidateColumns.from_profiles(candidates)
+        scores = graph.collaborative_scores(user.user_id, columns)
+        for i, candidate in enumerate(candidates):
+            assert np.isclose(scores[i], reference(candidate))
+            assert np.isclose(graph.collaborative_score(user.user_id, candidate), reference(candidate))
+
+    async def test_incremental_updates(self):
+        """Document changes update the matrix without a full rebuild"""
+        from app.services.ml.interaction_graph import InteractionGraph
+        from app.services.ml.recommendation_engine import MatchingEngine
+
+        engine = MatchingEngine()
+        graph = engine.interaction_graph
+        user = engine._get_user_profile("test_user_123")
+        candidate = engine._get_user_profile("test_user_456")
+        graph.upsert_user("liked", {"interests": ["sports"], "relationshipGoals": "casual"})
+        graph.add_interaction("likes", "l1", {"fromUserId": "test_user_123", "toUserId": "liked"})
+        graph.is_ready = True
+
+        assert engine._calculate_collaborative_score(user, candidate) == 0.0
+        matched = {"fromUserId": "test_user_123", "toUserId": "liked", "matched": True}
+        graph.update_interaction("likes", "l1", matched)
+        graph.update_interaction("likes", "l1", matched)
+        assert engine._calculate_collaborative_score(user, candidate) == 1.0
+
+        # Sin intereses ni metas en común el destino deja de ser similar
+        graph.upsert_user("liked", {"interests": ["chess"]})
+        assert engine._calculate_collaborative_score(user, candidate) == 0.5
+        graph.remove_interaction("likes", "l1", matched)
+        assert graph.get_stats()["interactions"] == 0
+        assert graph.get_stats()["successful_documents"] == 0
+        assert engine._calculate_collaborative_score(user, candidate) == 0.5
+
+    async def test_listener_skips_documents_already_loaded(self):
+        """The first snapshot after load() only applies what changed since, and memory is per pair"""
+        from datetime import datetime, timedelta, timezone
+        from types import SimpleNamespace
+        from app.services.ml.interaction_graph import InteractionGraph
+
+        loaded = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        later = loaded + timedelta(seconds=5)
+
+        def doc(doc_id, data, created=loaded, updated=loaded):
+            return SimpleNamespace(id=doc_id, exists=True, read_time=loaded, create_time=created,
+                                   update_time=updated, to_dict=lambda: dict(data))
+
+        like = {"fromUserId": "ana", "toUserId": "luis", "matched": False}
+        messages = {f"m{i}": {"senderId": "ana", "receiverId": "luis"} for i in range(50)}
+        collections = {
+            "users": {"luis": doc("luis", {"interests": ["music"]})},
+            "likes": {"l1": doc("l1", like)},
+            "messages": {doc_id: doc(doc_id, data) for doc_id, data in messages.items()},
+        }
+
+        def collection(name):
+            query = SimpleNamespace(stream=lambda: iter(list(collections[name].values())))
+            query.select = lambda fields: query
+            return query
+
+        graph = InteractionGraph()
+        graph.load(SimpleNamespace(collection=collection))
+        assert graph.get_stats()["interactions"] == 51
+        assert graph.get_stats()["edges"] == 1
+
+        def added(document):
+            return SimpleNamespace(type=SimpleNamespace(name="ADDED"), document=document)
+
+        # Instantánea inicial: lo cargado, un match posterior y un mensaje nuevo
+        initial = [added(d) for d in collections["messages"].values()]
+        initial.append(added(doc("m50", {"senderId": "ana", "receiverId": "luis"}, created=later, updated=later)))
+        graph._interactions_callback("messages")(None, initial, later)
+        graph._interactions_callback("likes")(None, [added(doc("l1", dict(like, matched=True), updated=later))], later)
+
+        targets, totals, successes = graph._targets("ana")
+        assert list(totals) == [52] and list(successes) == [1]
+        assert graph.get_stats()["successful_documents"] == 1
+
+        # Las instantáneas siguientes se aplican tal cual
+        graph._interactions_callback("messages")(None, initial[:1], later)
+        assert graph.get_stats()["interactions"] == 53
+
+
+class TestCollaborativeCache:
+    """Test suite for interaction and similar-user caching"""
+
+    class _CountingDB:
+        """Firestore mínimo que cuenta las consultas ejecutadas"""
+
+        def __init__(self, collections):
+            self.collections = collections
+            self.streams = 0
+
+        def collection(self, name):
+            return TestCollaborativeCache._Query(self, self.collections.get(name, {}), [])
+
+    class _Query:
+        def __init__(self, db, docs, conditions):
+            self.db, self.docs, self.conditions = db, docs, conditions
+
+        def where(self, field, op, value):
+            return TestCollaborativeCache._Query(self.db, self.docs, self.conditions + [(field, op, value)])
+
+        def stream(self):
+            from types import SimpleNamespace
+            self.db.streams += 1
+            for doc_id, data in self.docs.items():
+                if all(
+                    value in data.get(field, []) if op == "array_contains" else data.get(field) == value
+                    for field, op, value in self.conditions
+                ):
+                    yield SimpleNamespace(id=doc_id, to_dict=lambda data=data: dict(data))
+
+    async def test_ttl_cache_lru_and_expiry(self):
+        """Bounded cache evicts least recently used entries and expires them"""
+        import time
+        from app.utils.cache import TTLCache
+
+        cache = TTLCache(max_entries=2, ttl_seconds=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get_stats()["evictions"] == 1
+
+        short = TTLCache(max_entries=2, ttl_seconds=0.01)
+        short.set("a", 1)
+        time.sleep(0.02)
+        assert short.get("a") is None
+        assert short.get_stats()["misses"] == 1
+
+    async def test_queries_per_request_are_constant(self):
+        """Interactions and similar-user sets are fetched once per request"""
+        from app.services.ml.recommendation_engine import MatchingEngine
+
+        users = {
+            f"cand_{i}": {"interests": ["music", "travel"], "relationshipGoals": "serious"}
+            for i in range(40)
+        }
+        likes = {
+            f"l{i}": {"fromUserId": "me", "toUserId": f"cand_{i}", "matched": i % 2 == 0}
+            for i in range(10)
+        }
+        db = self._CountingDB({"users": users, "likes": likes, "messages": {}})
+        engine = MatchingEngine()
+        engine.db = db
+
+        user, *candidates = TestBatchScoring._random_profiles(41, seed=3)
+        user.user_id = "me"
+        for candidate in candidates:
+            candidate.interests = ["music", "travel"]
+            candidate.relationship_goals = "serious"
+
+        first = engine._score_candidates_batch(user, candidates, limit=10)
+        # likes + messages + 2 intereses + meta, independiente del número de candidatos
+        assert db.streams == 5
+        stats = engine.get_cache_stats()
+        assert stats["interactions"]["misses"] == 1
+        assert stats["similar_users"]["misses"] == 1
+
+        # Segunda petición servida desde la caché de proceso
+        second = engine._score_candidates_batch(user, candidates, limit=10)
+        assert db.streams == 5
+        assert [rec.score for rec in first] == [rec.score for rec in second]
+        assert engine.get_cache_stats()["interactions"]["hits"] == 1
+
+        engine.invalidate_user_cache("me")
+        engine._score_candidates_batch(user, candidates, limit=10)
+        assert db.streams == 7
+
+
+class TestAsyncFirestore:
+    """Test suite for the async Firestore data-access layer"""
+
+    class _SlowClient:
+        """Cliente mínimo de Firestore con latencia configurable"""
+
+        def __init__(self, documents, delay=0.0):
+            import threading
+            self.documents = documents
+            self.delay = delay
+            self.get_all_calls = 0
+            self.active = 0
+            self.peak = 0
+            self._lock = threading.Lock()
+
+        def _snapshot(self, doc_id):
+            import time
+            from types import SimpleNamespace
+            with self._lock:
+                self.active += 1
+                self.peak = max(self.peak, self.active)
+            time.sleep(self.delay)
+            with self._lock:
+                self.active -= 1
+            data = self.documents.get(doc_id)
+            return SimpleNamespace(id=doc_id, exists=data is not None, to_dict=lambda: data)
+
+        def collection(self, name):
+            from types import SimpleNamespace
+            return SimpleNamespace(
+                document=lambda doc_id: SimpleNamespace(id=doc_id, get=lambda: self._snapshot(doc_id))
+            )
+
+        def get_all(self, refs):
+            self.get_all_calls += 1
+            return [self._snapshot(ref.id) for ref in refs]
+
+    async def test_slow_call_does_not_block_event_loop(self):
+        """A slow Firestore read runs off-loop while other coroutines progress"""
+        import asyncio
+        import time
+        from app.core.firestore_async import AsyncFirestore
+
+        layer = AsyncFirestore(client=self._SlowClient({"u1": {"age": 30}}, delay=0.3))
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while ticks < 5:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        started = time.perf_counter()
+        document, _ = await asyncio.gather(layer.get_document("users", "u1"), ticker())
+        assert document == {"age": 30}
+        assert ticks == 5
+        assert time.perf_counter() - started < 0.6
+
+        with pytest.raises(asyncio.TimeoutError):
+            await layer.run(time.sleep, 0.2, timeout=0.05)
+        assert layer.get_stats()["timeouts"] == 1
+        layer.close()
+
+    async def test_batched_reads_and_bounded_concurrency(self):
+        """get_documents uses get_all in batches and respects the concurrency cap"""
+        import asyncio
+        from app.core.firestore_async import AsyncFirestore
+
+        client = self._SlowClient({f"u{i}": {"n": i} for i in range(0, 250, 2)}, delay=0.001)
+        layer = AsyncFirestore(client=client, max_concurrency=2, batch_size=100)
+        documents = await layer.get_documents("users", [f"u{i}" for i in range(250)])
+        assert client.get_all_calls == 3
+        assert documents["u4"] == {"n": 4} and documents["u5"] is None
+
+        await asyncio.gather(*(layer.get_document("users", f"u{i}") for i in range(10)))
+        assert client.peak <= 2
+        layer.close()
+
+    async def test_async_recommendations_match_sync(self):
+        """The async engine entry point returns the same ranking"""
+        from app.services.ml.recommendation_engine import MatchingEngine
+
+        engine = MatchingEngine()
+        sync = engine.get_smart_recommendations("test_user_123", limit=5)
+        result = await engine.get_smart_recommendations_async("test_user_123", limit=5)
+        assert [rec.user_id for rec in result] == [rec.user_id for rec in sync]
+
+    async def test_async_recommendations_read_from_the_injected_client(self):
+        """An engine built with its own Firestore client reads the profile from that client"""
+        from app.services.ml.recommendation_engine import MatchingEngine
+
+        client = self._SlowClient({"u1": {"age": 41, "gender": "femenino", "interests": ["vino"]}})
+        engine = MatchingEngine()
+        engine.db = client
+        profiles = []
+        engine._recommend_for_profile = lambda user_id, profile, limit, filters: profiles.append(profile) or []
+
+        assert await engine.get_smart_recommendations_async("u1") == []
+        assert [profile.age for profile in profiles] == [41]
+        assert engine.async_db.client is client
+        engine.async_db.close()
+
+
+class TestFirestoreAuditWriter:
+    """Test suite for the write-behind batched audit writer"""
+
+    class _FakeFirestore:
+        """In-process Firestore with WriteBatch semantics; can be made unreachable"""
+
+        def __init__(self):
+            import threading
+            self.documents = {}
+            self.batch_sizes = []
+            self.unreachable = False
+            self.failed_commits = 0
+            self.commit_gate = None
+            self.listeners = {}
+            self._lock = threading.Lock()
+
+        @staticmethod
+        def _change(kind, doc_id, data):
+            from types import SimpleNamespace
+            document = SimpleNamespace(id=doc_id, to_dict=lambda data=data: dict(data))
+            return SimpleNamespace(type=SimpleNamespace(name=kind), document=document)
+
+        def collection(self, name):
+            from types import SimpleNamespace
+
+            def stream():
+                with self._lock:
+                    docs = [data for (collection, _), data in self.documents.items() if collection == name]
+                return [SimpleNamespace(to_dict=lambda data=data: dict(data)) for data in docs]
+
+            def on_snapshot(callback):
+                # Primera instantánea con toda la colección; después, cada commit
+                with self._lock:
+                    self.listeners.setdefault(name, []).append(callback)
+                    changes = [self._change('ADDED', doc_id, data)
+                               for (collection, doc_id), data in self.documents.items() if collection == name]
+                callback(None, changes, None)
+                return SimpleNamespace(unsubscribe=lambda: self.listeners[name].remove(callback))
+
+            return SimpleNamespace(
+                document=lambda doc_id: self._Ref(self, name, doc_id), stream=stream, on_snapshot=on_snapshot
+            )
+
+        class _Ref(tuple):
+            """(colección, id) con update() real: falla si el documento no existe"""
+
+            def __new__(cls, fake, name, doc_id):
+                ref = super().__new__(cls, (name, doc_id))
+                ref.fake = fake
+                return ref
+
+            def update(self, data):
+                with self.fake._lock:
+                    if self not in self.fake.documents:
+                        raise KeyError(f"No document to update: {tuple(self)}")
+                    self.fake.documents[self] = {**self.fake.documents[self], **data}
+
+        def batch(self):
+            fake = self
+
+            class Batch:
+                def __init__(self):
+                    self.writes = []
+
+                def set(self, ref, data, merge=False):
+                    self.writes.append((ref, data, merge))
+
+                def commit(self):
+                    if fake.commit_gate is not None:
+                        fake.commit_gate.wait(5)
+                    with fake._lock:
+                        if fake.unreachable:
+                            fake.failed_commits += 1
+                            raise ConnectionError("backend unreachable")
+                        changes = {}
+                        for ref, data, merge in self.writes:
+                            current = fake.documents.get(ref, {}) if merge else {}
+                            kind = 'MODIFIED' if ref in fake.documents else 'ADDED'
+                            fake.documents[ref] = {**current, **data}
+                            changes.setdefault(ref[0], []).append(fake._change(kind, ref[1], fake.documents[ref]))
+                        fake.batch_sizes.append(len(self.writes))
+                        listeners = {name: list(fake.listeners.get(name, ())) for name in changes}
+                    for name, callbacks in listeners.items():
+                        for callback in callbacks:
+                            callback(None, changes[name], None)
+
+            return Batch()
+
+    async def test_writes_are_flushed_in_batches_of_at_most_500(self, tmp_path):
+        """Queued writes go out in WriteBatches capped at 500, or after the flush interval"""
+        import time
+        from app.core.firestore_audit import AuditWriter
+
+        client = self._FakeFirestore()
+        writer = AuditWriter(client=client, flush_interval_ms=20, spill_path=str(tmp_path / 'spill.jsonl'))
+        doc_ids = [writer.add('photo_verifications', {'n': i}) for i in range(1200)]
+        writer.update('users', 'u1', {'photoVerificationStatus': 'APPROVED'})
+        writer.update('users', 'u1', {'photoVerificationScore': 0.9})
+        assert writer.flush(timeout=5)
+
+        assert max(client.batch_sizes) == 500 and sum(client.batch_sizes) == 1202
+        assert client.documents[('photo_verifications', doc_ids[777])] == {'n': 777}
+        assert client.documents[('users', 'u1')] == {'photoVerificationStatus': 'APPROVED', 'photoVerificationScore': 0.9}
+
+        writer.set('photo_verification_jobs', 'job-1', {'status': 'done'})
+        deadline = time.monotonic() + 2
+        while ('photo_verification_jobs', 'job-1') not in client.documents and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert client.documents[('photo_verification_jobs', 'job-1')] == {'status': 'done'}
+
+        stats = writer.get_stats()
+        assert stats['written'] == 1203 and stats['queue_depth'] == 0
+        assert stats['max_queue_depth'] >= 500 and stats['flush_latency_p99_ms'] > 0
+        writer.close()
+
+    async def test_unreachable_backend_spills_and_replays(self, tmp_path):
+        """Failed batches are retried, spilled to disk and re-sent once Firestore is back"""
+        from firebase_admin import firestore
+        from app.core.firestore_audit import AuditWriter
+
+        spill_path = tmp_path / 'spill.jsonl'
+        client = self._FakeFirestore()
+        client.unreachable = True
+        writer = AuditWriter(
+            client=client, flush_interval_ms=10, max_retries=2, retry_base_delay=0.001, spill_path=str(spill_path)
+        )
+        doc_id = writer.add('moderation_results', {'userId': 'u1', 'timestamp': firestore.SERVER_TIMESTAMP})
+        writer.update('users', 'u1', {'photoVerificationScore': 0.5})
+        assert writer.flush(timeout=5)
+        writer.close()
+
+        assert client.failed_commits == 3 and client.documents == {}
+        stats = writer.get_stats()
+        assert stats['retries'] == 2 and stats['spilled'] == 2 and stats['spill_pending']
+        assert len(spill_path.read_text().splitlines()) == 2
+
+        # Reinicio con el backend disponible: el fichero se reenvía y se elimina
+        client.unreachable = False
+        restarted = AuditWriter(client=client, flush_interval_ms=10, spill_path=str(spill_path))
+        restarted.start()
+        assert restarted.flush(timeout=5)
+        restarted.close()
+        assert client.documents[('moderation_results', doc_id)]['timestamp'] is firestore.SERVER_TIMESTAMP
+        assert client.documents[('users', 'u1')] == {'photoVerificationScore': 0.5}
+        assert restarted.get_stats()['replayed'] == 2 and not spill_path.exists()
+
+    async def test_writers_sharing_a_spill_file_do_not_lose_writes(self, tmp_path):
+        """Two writers (one per worker process) share a spill file; only one replays it at a time"""
+        import threading
+        import time
+        from app.core.firestore_audit import AuditWriter
+
+        spill_path = tmp_path / 'spill.jsonl'
+        replay_path = tmp_path / 'spill.jsonl.replay'
+        blocked, free = self._FakeFirestore(), self._FakeFirestore()
+        blocked.commit_gate = threading.Event()
+        first, second = (
+            AuditWriter(client=client, spill_path=str(spill_path), spill_retry_seconds=0, autostart=False)
+            for client in (blocked, free)
+        )
+
+        def operations(prefix):
+            return [{'collection': 'moderation_results', 'doc_id': f'{prefix}{i}', 'data': {'n': i}, 'merge': False}
+                    for i in range(3)]
+
+        first._spill(operations('a'))
+        replaying = threading.Thread(target=first._replay_spill)
+        replaying.start()
+        while not replay_path.exists():
+            time.sleep(0.001)
+
+        # El primero está reenviando su .replay: el segundo añade y no lo toca
+        second._spill(operations('b'))
+        second._replay_spill()
+        assert spill_path.exists() and replay_path.exists() and free.documents == {}
+
+        blocked.commit_gate.set()
+        replaying.join()
+        second._replay_spill()
+
+        written = {doc_id for client in (blocked, free) for _, doc_id in client.documents}
+        assert written == {'a0', 'a1', 'a2', 'b0', 'b1', 'b2'}
+        assert first.get_stats()['replayed'] == 3 and second.get_stats()['replayed'] == 3
+        assert not spill_path.exists() and not replay_path.exists()
+
+
 class TestPhotoVerification:
     """Test suite for photo verification system"""
-    
+
+    @staticmethod
+    def _serve_images(bodies: Dict[str, bytes]):
+        """Local HTTP stand-in for Firebase Storage; returns (server, base_url)"""
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                body = bodies.get(self.path)
+                self.send_response(200 if body else 404)
+                self.send_header('Content-Length', str(len(body or b'')))
+                self.end_headers()
+                self.wfile.write(body or b'')
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+    @staticmethod
+    def _jpeg(width: int = 320, height: int = 240, seed: int = 5) -> bytes:
+        from io import BytesIO
+        import numpy as np
+        from PIL import Image
+
+        buffer = BytesIO()
+        pixels = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(buffer, 'JPEG')
+        return buffer.getvalue()
+
     async def test_photo_verification_basic(self):
         """Test basic photo verification"""
         # This would normally test the actual photo verification
@@ -84,8 +1026,511 @@ class TestPhotoVerification:
         
         # Should handle None age gracefully
         assert claimed_age is None or isinstance(claimed_age, int)
+    
+    async def test_image_context_memoizes_derived_images(self):
+        """Shared analysis context computes each derived image once with unchanged values"""
+        import cv2
+        import numpy as np
+        from app.services.cv.image_context import ImageAnalysisContext
+        
+        image = np.random.default_rng(3).integers(0, 256, (240, 320, 3), dtype=np.uint8)
+        context = ImageAnalysisContext(image)
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        
+        assert np.array_equal(context.gray, gray)
+        assert context.gray is context.gray
+        assert context.hsv is context.hsv
+        assert ImageAnalysisContext.of(context) is context
+        assert context.sharpness == cv2.Laplacian(gray, cv2.CV_64F).var()
+        assert context.noise_level == min(np.std(gray) / 50, 1.0)
+        assert context.mean_saturation == np.mean(cv2.cvtColor(image, cv2.COLOR_RGB2HSV)[:, :, 1])
+        assert np.array_equal(context.channel_histograms[1], cv2.calcHist([image], [1], None, [256], [0, 256]))
+        assert np.std(context.gray_region(40, 30, 100, 80)) == np.std(
+            cv2.cvtColor(image[30:110, 40:140], cv2.COLOR_RGB2GRAY)
+        )
+
+    async def test_image_fetcher_against_local_server(self):
+        """Fetcher reuses connections, caps download size, allow-lists formats and draft-decodes JPEG"""
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from io import BytesIO
+        import numpy as np
+        from PIL import Image
+        from app.services.cv.image_fetcher import ImageFetcher, ImageFetchError
+
+        def encode(size, fmt):
+            buffer = BytesIO()
+            pixels = np.random.default_rng(5).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+            Image.fromarray(pixels).save(buffer, fmt)
+            return buffer.getvalue()
+
+        bodies = {
+            '/large.jpg': encode((4000, 3000), 'JPEG'),
+            '/photo.png': encode((300, 200), 'PNG'),
+            '/photo.gif': encode((300, 200), 'GIF'),
+            '/tiny.jpg': encode((80, 80), 'JPEG')
+        }
+        connections = set()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                connections.add(self.client_address)
+                if self.path == '/stream':
+                    # Sin Content-Length: el límite se aplica durante la lectura
+                    self.send_response(200)
+                    self.send_header('Connection', 'close')
+                    self.end_headers()
+                    try:
+                        for _ in range(64):
+                            self.wfile.write(b'\xff' * 4096)
+                    except OSError:
+                        pass
+                    self.close_connection = True
+                    return
+                body = bodies.get(self.path)
+                self.send_response(200 if body else 404)
+                self.send_header('Content-Length', str(len(body or b'')))
+                self.end_headers()
+                self.wfile.write(body or b'')
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f'http://127.0.0.1:{server.server_address[1]}'
+        fetcher = ImageFetcher(max_bytes=len(bodies['/large.jpg']) + 1, allowed_formats='jpg,png')
+        try:
+            large = fetcher.fetch(base + '/large.jpg')
+            assert large.shape == (768, 1024, 3)
+            assert fetcher.fetch(base + '/photo.png').shape == (200, 300, 3)
+            assert len(connections) == 1
+
+            for path, reason in [('/photo.gif', 'format'), ('/tiny.jpg', 'too_small'), ('/missing.jpg', 'http')]:
+                with pytest.raises(ImageFetchError) as error:
+                    fetcher.fetch(base + path)
+                assert error.value.reason == reason
+
+            # Límite por Content-Length y, sin cabecera, durante el streaming
+            small_limit = ImageFetcher(max_bytes=1024)
+            for path in ('/photo.png', '/stream'):
+                with pytest.raises(ImageFetchError) as error:
+                    small_limit.fetch(base + path)
+                assert error.value.reason == 'too_large'
+            small_limit.close()
+
+            stats = fetcher.get_stats()
+            assert stats['fetched'] == 2
+            assert stats['rejected'] == {'format': 1, 'too_small': 1, 'http': 1}
+
+            # PhotoVerification descarga y decodifica por separado
+            split = ImageFetcher(allowed_formats='jpg,png')
+            split.decode(split.fetch_bytes(base + '/photo.png'))
+            with pytest.raises(ImageFetchError):
+                split.decode(split.fetch_bytes(base + '/tiny.jpg'))
+            stats = split.get_stats()
+            assert stats['fetched'] == 1 and stats['downloaded'] == 2
+            assert stats['bytes_downloaded'] == len(bodies['/photo.png']) + len(bodies['/tiny.jpg'])
+            assert stats['rejected'] == {'too_small': 1}
+            assert stats['avg_fetch_ms'] > 0
+            split.close()
+        finally:
+            fetcher.close()
+            server.shutdown()
+            server.server_close()
+
+    async def test_image_fetcher_draft_decodes_large_jpeg(self):
+        """A 24MP JPEG is decoded by the codec at reduced scale, close to the target size"""
+        from io import BytesIO
+        import numpy as np
+        from PIL import Image
+        from app.services.cv.image_fetcher import ImageFetcher
+
+        buffer = BytesIO()
+        Image.fromarray(np.full((4000, 6000, 3), 128, dtype=np.uint8)).save(buffer, 'JPEG')
+        image = Image.open(BytesIO(buffer.getvalue()))
+        image.draft('RGB', (1024, 1024))
+        assert image.size == (3000, 2000)
+
+        decoded = ImageFetcher().decode(buffer.getvalue())
+        assert decoded.shape == (683, 1024, 3)
+        assert abs(int(decoded.mean()) - 128) <= 1
+
+    async def test_verification_jobs_priority_lanes_and_timings(self):
+        """Profile photos run before gallery backfills; results and timings are kept per job"""
+        from app.services.cv.photo_verifier import PhotoVerification
+        from app.services.cv.verification_jobs import PhotoVerificationJobQueue
+
+        server, base = self._serve_images({f'/photo{i}.jpg': self._jpeg(seed=i) for i in range(4)})
+        queue = PhotoVerificationJobQueue(verifier=PhotoVerification(), workers=0, persist=False, autostart=False)
+        try:
+            backfill = queue.submit_many([f'{base}/photo0.jpg', f'{base}/photo1.jpg'], 'user_1', lane='backfill')
+            gallery = queue.submit(f'{base}/photo2.jpg', 'user_1', lane='gallery')
+            profile = queue.submit(f'{base}/photo3.jpg', 'user_1', claimed_age=30, lane='profile')
+            missing = queue.submit(f'{base}/missing.jpg', 'user_1', lane='backfill')
+            assert queue.get_job(profile)['status'] == 'queued'
+
+            notified = []
+            queue.subscribe(gallery, notified.append)
+            queue.start()
+            jobs = [await queue.wait(job_id, timeout=30) for job_id in [profile, gallery, *backfill, missing]]
+
+            started = [job['started_at'] for job in jobs]
+            assert started == sorted(started)
+            assert all(job['status'] == 'done' for job in jobs[:4])
+            assert jobs[0]['result']['recommendation'] != 'ERROR'
+            assert set(jobs[0]['timings']) == {'queue_wait_ms', 'download_ms', 'analysis_ms', 'overhead_ms', 'total_ms'}
+            assert jobs[0]['timings']['analysis_ms'] > 0
+            assert jobs[4]['status'] == 'failed' and jobs[4]['error']
+            assert notified and notified[0]['job_id'] == gallery
+            assert queue.get_job('unknown') is None
+
+            stats = queue.get_stats()
+            assert stats['completed'] == 4 and stats['failed'] == 1
+            assert stats['lanes'] == {'profile': 1, 'gallery': 1, 'backfill': 3}
+        finally:
+            queue.close()
+            server.shutdown()
+            server.server_close()
+
+    async def test_verification_jobs_finish_off_the_result_thread(self, tmp_path):
+        """The photo index loads at start and duplicate lookups run in the persistence thread"""
+        import threading
+        from app.core.firestore_audit import AuditWriter
+        from app.services.cv.photo_hash_index import PhotoHashIndex
+        from app.services.cv.photo_verifier import PhotoVerification
+        from app.services.cv.verification_cache import VerificationResultCache
+        from app.services.cv.verification_jobs import PhotoVerificationJobQueue
+
+        client = TestFirestoreAuditWriter._FakeFirestore()
+        verifier = PhotoVerification()
+        verifier.db = client
+        verifier.photo_index = PhotoHashIndex()
+        verifier.result_cache = VerificationResultCache(str(tmp_path / 'results.sqlite'))
+        verifier.audit_writer = AuditWriter(client=client, spill_path=str(tmp_path / 'spill.jsonl'))
+        lookups = []
+        check = verifier.check_duplicate_photo
+        verifier.check_duplicate_photo = lambda *args: lookups.append(threading.current_thread().name) or check(*args)
+
+        body = self._jpeg(seed=4)
+        server, base = self._serve_images({'/a.jpg': body, '/b.jpg': body})
+        queue = PhotoVerificationJobQueue(verifier=verifier, workers=0, autostart=False)
+        try:
+            queue.start()
+            first = await queue.wait(queue.submit(f'{base}/a.jpg', 'owner'), timeout=30)
+            second = await queue.wait(queue.submit(f'{base}/b.jpg', 'scammer'), timeout=30)
+        finally:
+            queue.close()
+            server.shutdown()
+            server.server_close()
+
+        assert verifier.photo_index.is_ready
+        assert lookups and all(name.startswith('photo-jobs-persist') for name in lookups)
+        assert 'duplicate_accounts' not in first['result']['details']
+        assert list(second['result']['details']['duplicate_accounts']) == ['owner']
+        assert verifier.audit_writer.flush(timeout=5)
+        assert ('photo_verification_jobs', second['job_id']) in client.documents
+
+    async def test_verification_jobs_run_on_process_pool(self):
+        """Jobs submitted to the spawn pool produce the same result as the in-process pipeline"""
+        from app.services.cv.photo_verifier import PhotoVerification
+        from app.services.cv.verification_jobs import PhotoVerificationJobQueue
+
+        server, base = self._serve_images({'/photo.jpg': self._jpeg(seed=9)})
+        queue = PhotoVerificationJobQueue(workers=1, persist=False)
+        try:
+            job = await queue.wait(queue.submit(f'{base}/photo.jpg', lane='gallery'), timeout=60)
+            expected = PhotoVerification().verify_photo(f'{base}/photo.jpg')
+            assert job['status'] == 'done'
+            assert job['result']['verification_score'] == expected.verification_score
+            assert job['result']['recommendation'] == expected.recommendation
+        finally:
+            queue.close()
+            server.shutdown()
+            server.server_close()
 
 
+    @staticmethod
+    def _scene(seed: int):
+        """Smooth synthetic photo (gradient background with filled circles)"""
+        import cv2
+        import numpy as np
+
+        rng = np.random.default_rng(seed)
+        y, x = np.mgrid[0:600, 0:800]
+        image = np.zeros((600, 800, 3), dtype=np.uint8)
+        image[..., 0] = (x / 800 * 200).astype(np.uint8)
+        image[..., 1] = (y / 600 * 180).astype(np.uint8)
+        for _ in range(12):
+            center = (int(rng.integers(0, 800)), int(rng.integers(0, 600)))
+            color = tuple(int(value) for value in rng.integers(0, 256, 3))
+            cv2.circle(image, center, int(rng.integers(20, 120)), color, -1)
+        return image
+
+    async def test_perceptual_hash_index_finds_near_duplicates(self):
+        """Cropped and recompressed copies stay within the threshold; MIH matches brute force"""
+        import random
+        import cv2
+        from app.services.cv.image_context import ImageAnalysisContext
+        from app.services.cv.perceptual_hash import hamming_distance
+        from app.services.cv.photo_hash_index import PhotoHashIndex
+
+        original = self._scene(1)
+        _, encoded = cv2.imencode('.jpg', original[12:588, 16:784], [cv2.IMWRITE_JPEG_QUALITY, 60])
+        copy = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+        original_hash = ImageAnalysisContext(original).perceptual_hash
+        assert hamming_distance(original_hash, ImageAnalysisContext(copy).perceptual_hash) <= 10
+        assert hamming_distance(original_hash, ImageAnalysisContext(self._scene(2)).perceptual_hash) > 10
+
+        rng = random.Random(4)
+        index = PhotoHashIndex(max_distance=10)
+        hashes = {}
+        for i in range(3000):
+            value = rng.getrandbits(64)
+            if i % 10 == 0 and i:
+                # Casi duplicados de una foto anterior
+                value = hashes[f'p{i - 10}'] ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64))
+            hashes[f'p{i}'] = value
+            index.add(f'p{i}', f'u{i % 700}', value)
+
+        for probe in [hashes['p0'], hashes['p500'], rng.getrandbits(64)]:
+            expected = sorted(
+                (distance, photo_id) for photo_id, value in hashes.items()
+                if (distance := hamming_distance(probe, value)) <= 10
+            )
+            assert sorted((distance, photo_id) for photo_id, _, distance in index.query(probe)) == expected
+
+        assert 'u0' not in index.accounts_near(hashes['p0'], exclude_user_id='u0')
+        index.remove('p0')
+        assert all(photo_id != 'p0' for photo_id, _, _ in index.query(hashes['p0']))
+        assert len(index) == 2999
+
+    async def test_verification_flags_photo_reused_by_other_account(self):
+        """A recompressed copy uploaded by a second account is reported with its distance"""
+        import cv2
+        from app.services.cv.photo_verifier import PhotoVerification
+        from app.services.cv.photo_hash_index import PhotoHashIndex
+
+        scene = self._scene(3)
+        _, first = cv2.imencode('.jpg', scene[..., ::-1])
+        _, second = cv2.imencode('.jpg', scene[10:590, 14:786, ::-1], [cv2.IMWRITE_JPEG_QUALITY, 55])
+        server, base = self._serve_images({'/a.jpg': first.tobytes(), '/b.jpg': second.tobytes()})
+        verifier = PhotoVerification()
+        verifier.photo_index = PhotoHashIndex()
+        try:
+            clean = verifier.verify_photo(f'{base}/a.jpg', user_id='owner')
+            reused = verifier.verify_photo(f'{base}/b.jpg', user_id='scammer')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert 'duplicate_accounts' not in clean.details
+        assert list(reused.details['duplicate_accounts']) == ['owner']
+        assert 'Foto usada también en 1 cuenta(s)' in reused.warnings
+        assert len(verifier.photo_index) == 2
+
+
+    async def test_staged_pipeline_exits_early_on_decided_reject(self):
+        """Cheap stages decide a reject; skipped stages could not change the recommendation"""
+        import numpy as np
+        from app.services.cv.photo_verifier import PhotoVerification
+        from app.services.cv.verification_pipeline import DEFAULT_STAGES, VerificationPipeline, order_stages
+
+        staged = PhotoVerification()
+        full = PhotoVerification()
+        full.pipeline = VerificationPipeline(early_exit=False)
+
+        # Fondo rojo saturado y liso: piel/violencia por color y sin textura de persona real
+        x = np.tile(np.arange(1024), (768, 1))
+        fake = np.zeros((768, 1024, 3), dtype=np.uint8)
+        fake[..., 0] = 230
+        fake[..., 1] = (40 + x / 1024 * 210).astype(np.uint8)
+        fake[..., 2] = 20
+        rng = np.random.default_rng(2)
+        photo = np.clip(
+            np.stack([x % 256, np.tile(np.arange(768)[:, None], (1, 1024)) % 256, np.full_like(x, 128)], -1)
+            + rng.integers(-30, 30, (768, 1024, 3)), 0, 255
+        ).astype(np.uint8)
+
+        for claimed_age in (None, 30):
+            early = staged.verify_image(fake, claimed_age)
+            reference = full.verify_image(fake, claimed_age)
+            assert early.recommendation == reference.recommendation == "REJECT"
+            assert {'filters', 'content_text'} <= set(early.details['skipped_stages'])
+            low, high = early.details['score_bounds']
+            assert low <= reference.verification_score <= high < 0.5
+            # Lo no medido queda sin valor; el score es la cota inferior, numérica
+            assert early.verification_score == early.confidence == low
+            assert early.details['score_is_bound']
+            assert early.has_excessive_filters is None
+            assert early.is_real_person is not None
+            assert set(early.details['processing_time_ms']) == {'faces', 'age', 'content_color', 'real_person', 'total'}
+
+        kept = staged.verify_image(photo, 30)
+        reference = full.verify_image(photo, 30)
+        assert kept.details['skipped_stages'] == []
+        assert kept.verification_score == reference.verification_score
+        assert kept.recommendation == reference.recommendation
+        assert set(kept.details['processing_time_ms']) == {stage.name for stage in DEFAULT_STAGES} | {'total'}
+
+        assert [stage.name for stage in order_stages(reversed(DEFAULT_STAGES))][:2] == ['faces', 'age']
+        with pytest.raises(ValueError):
+            order_stages([stage for stage in DEFAULT_STAGES if stage.name != 'faces'])
+
+    @staticmethod
+    def _fixture_photos():
+        """Seeded 1024px photos: plain, skin-toned, dark, overexposed, text overlay and noisy"""
+        import cv2
+        import numpy as np
+
+        photos = []
+        for seed in range(12):
+            rng = np.random.default_rng(seed)
+            height, width = (768, 1024) if seed % 2 else (1024, 768)
+            y, x = np.mgrid[0:height, 0:width]
+            base = rng.integers(0, 256, 3)
+            image = np.stack([
+                np.clip(base[0] * 0.5 + x / width * 120, 0, 255),
+                np.clip(base[1] * 0.5 + y / height * 120, 0, 255),
+                np.clip(base[2] * 0.5 + x / width * 120, 0, 255)
+            ], -1).astype(np.uint8)
+            kind = seed % 6
+            if kind == 1:
+                image[...] = (200, 150, 120)
+            elif kind == 2:
+                image //= 4
+            elif kind == 3:
+                image = np.clip(image.astype(int) + 120, 0, 255).astype(np.uint8)
+            for _ in range(int(rng.integers(4, 20))):
+                center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+                color = tuple(int(value) for value in rng.integers(0, 256, 3))
+                cv2.circle(image, center, int(rng.integers(10, 150)), color, -1)
+            if kind == 4:
+                for line in range(8):
+                    cv2.putText(image, 'CALL 555 WHATSAPP', (20, 60 + line * 80), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (255, 255, 255), 3)
+            if kind == 5 or seed % 4 == 0:
+                noise = rng.normal(0, int(rng.integers(5, 40)), image.shape)
+                image = np.clip(image.astype(int) + noise, 0, 255).astype(np.uint8)
+            photos.append(image)
+        return photos
+
+    async def test_pyramid_levels_stay_within_documented_tolerance(self):
+        """Global stats on the 256px level match full-resolution scores within the documented tolerance"""
+        from app.services.cv.image_context import ImageAnalysisContext
+        from app.services.cv.photo_verifier import ANALYSIS_RESOLUTION, PhotoVerification
+
+        pyramid = PhotoVerification()
+        full = PhotoVerification()
+        full.analysis_resolution = {analysis: None for analysis in ANALYSIS_RESOLUTION}
+        for verifier in (pyramid, full):
+            verifier.pipeline.early_exit = False
+
+        for photo in self._fixture_photos():
+            result = pyramid.verify_image(photo, 28)
+            reference = full.verify_image(photo, 28)
+            assert abs(result.verification_score - reference.verification_score) <= 0.05
+            assert abs(pyramid._assess_image_quality(photo) - full._assess_image_quality(photo)) <= 0.05
+            assert result.recommendation == reference.recommendation
+            assert result.estimated_age == reference.estimated_age
+            filters, reference_filters = pyramid._detect_filters(photo), full._detect_filters(photo)
+            assert filters.filter_types == reference_filters.filter_types
+            assert filters.has_filters == reference_filters.has_filters
+            assert abs(filters.filter_intensity - reference_filters.filter_intensity) <= 0.05
+            assert result.warnings == reference.warnings
+
+        context = ImageAnalysisContext(self._fixture_photos()[0])
+        level = context.level(256)
+        assert max(level.shape[:2]) == 256 and context.level(256) is level
+        assert context.level(None) is context and context.level(4096) is context
+
+    async def test_result_cache_skips_decoding_and_unchanged_writes(self, tmp_path):
+        """Byte-identical re-verifications come from the cache; unchanged results are not re-written"""
+        from app.services.cv.photo_verifier import PhotoVerification
+        from app.core.firestore_audit import AuditWriter
+        from app.services.cv.verification_cache import VerificationResultCache, content_key
+
+        body = self._jpeg(400, 300, seed=9)
+        other_photo = self._jpeg(400, 300, seed=4)
+        server, base = self._serve_images({'/a.jpg': body, '/copy.jpg': body, '/b.jpg': other_photo})
+        verifier = PhotoVerification()
+        verifier.result_cache = VerificationResultCache(str(tmp_path / 'results.sqlite'))
+        client = TestFirestoreAuditWriter._FakeFirestore()
+        client.documents[('users', 'u1')] = {'name': 'Ana'}
+        verifier.db = client
+        verifier.audit_writer = AuditWriter(client=client, spill_path=str(tmp_path / 'spill.jsonl'))
+        decoded = []
+        decode = verifier._decode_image
+        verifier._decode_image = lambda data: decoded.append(len(data)) or decode(data)
+        try:
+            first = verifier.verify_photo(f'{base}/a.jpg', 30, user_id='u1')
+            again = verifier.verify_photo(f'{base}/copy.jpg', 30, user_id='u1')
+            repeated = verifier.verify_photo(f'{base}/a.jpg', 30, user_id='u1')
+            other_age = verifier.verify_photo(f'{base}/a.jpg', 45, user_id='u1')
+            # Otra foto y vuelta a la primera: sin auditoría nueva, pero el perfil se actualiza
+            verifier.verify_photo(f'{base}/b.jpg', 45, user_id='u2')
+            client.documents[('users', 'u2')] = {}
+            photo_b = verifier.verify_photo(f'{base}/b.jpg', 45, user_id='u2')
+            back = verifier.verify_photo(f'{base}/a.jpg', 45, user_id='u2')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert len(decoded) == 3  # primera verificación, edad distinta y b.jpg
+        assert 'cached' not in first.details and again.details['cached'] and repeated.details['cached']
+        assert again.verification_score == first.verification_score
+        assert again.recommendation == first.recommendation
+        assert 'cached' not in other_age.details
+        # a.jpg (30), copy.jpg (30) y a.jpg (45): la repetición idéntica no escribe
+        assert verifier.audit_writer.flush(timeout=5)
+        # El perfil se actualiza al momento, fuera del escritor diferido
+        assert verifier.audit_writer.get_stats()['written'] == 5
+        assert sum(1 for collection, _ in client.documents if collection == 'photo_verifications') == 5
+        assert client.documents[('users', 'u1')]['photoVerificationStatus'] == other_age.recommendation
+        assert client.documents[('users', 'u1')]['name'] == 'Ana'
+        assert photo_b.verification_score != back.verification_score
+        assert client.documents[('users', 'u2')]['photoVerificationScore'] == back.verification_score
+
+        # Cuenta borrada: el update falla y no se recrea el documento
+        verifier._save_verification_result('gone', f'{base}/a.jpg', first)
+        assert ('users', 'gone') not in client.documents
+        assert verifier.result_cache.get_stats()['skipped_writes'] == 2
+
+        cache = VerificationResultCache(':memory:', max_entries=2)
+        for age in (20, 21, 22):
+            cache.set(content_key(body, age), first)
+            if age == 21:
+                assert cache.get(content_key(body, 20)) is not None
+        assert len(cache) == 2
+        assert cache.get(content_key(body, 21)) is None
+        assert cache.get(content_key(body, 20)).verification_score == first.verification_score
+        assert content_key(body, 20) != content_key(body, 20, version='old')
+
+        # Resultados en JSON (no pickle) y huellas guardadas acotadas como los resultados
+        stored = cache._conn.execute('SELECT result FROM results LIMIT 1').fetchone()[0]
+        assert json.loads(stored)['recommendation'] == first.recommendation
+        for n in range(5):
+            cache.mark_saved('u1', f'https://x/{n}.jpg', 'f')
+        assert cache.get_stats()['saved_entries'] == 2 and cache.get_stats()['saved_evictions'] == 3
+        assert cache.is_saved('u1', 'https://x/4.jpg', 'f') and not cache.is_saved('u1', 'https://x/0.jpg', 'f')
+
+    async def test_result_cache_default_directory_is_private(self, tmp_path):
+        """The default cache directory is created 0700 and a foreign-owned one is refused"""
+        import os
+        import stat
+        from app.services.cv.verification_cache import private_dir
+
+        path = private_dir(str(tmp_path / 'cache'))
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+        os.chmod(path, 0o777)
+        private_dir(path)
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+        if os.getuid() == 0:
+            os.chown(path, 12345, -1)
+            with pytest.raises(PermissionError):
+                private_dir(path)
+
 class TestFraudDetection:
     """Test suite for fraud detection system"""
     
@@ -159,6 +1604,96 @@ class TestFraudDetection:
         assert result["risk_level"] in ["low", "medium"]
 
 
+    async def test_fraud_score_flags_photos_shared_across_accounts(self):
+        """Near-duplicate perceptual hashes in other accounts raise the content fraud score"""
+        from app.services.cv.perceptual_hash import hash_to_hex
+        from app.services.cv.photo_hash_index import PhotoHashIndex
+        from app.services.security.fraud_detector import FraudDetector
+
+        stolen = 0x9F3A5C7E12B4D680
+        index = PhotoHashIndex()
+        for account in ('victim', 'scam_2', 'scam_3'):
+            index.add(f'{account}/photo.jpg', account, stolen ^ (1 << len(account)))
+        detector = FraudDetector(photo_index=index)
+
+        user_data = {
+            "id": "scam_1",
+            "bio": "Me encanta viajar y conocer gente nueva. Busco una relación seria.",
+            "photos": [{"perceptualHash": hash_to_hex(stolen ^ 0b101)}, {"perceptualHash": hash_to_hex(0x0123456789ABCDEF)}]
+        }
+        score, indicators = detector._analyze_content_fraud(user_data)
+        assert "Fotos usadas en otras cuentas (3)" in indicators
+        assert "Fotos muy similares" not in indicators
+        assert score >= 0.5
+
+        clean_score, clean_indicators = detector._analyze_content_fraud({
+            "id": "maria", "bio": user_data["bio"], "photos": [{"perceptualHash": hash_to_hex(0x0123456789ABCDEF)}]
+        })
+        assert clean_score == 0.0 and clean_indicators == []
+
+        # Dos fotos propias casi iguales cuentan como una sola
+        _, indicators = detector._analyze_content_fraud({
+            "id": "bot", "photos": [{"perceptualHash": hash_to_hex(stolen ^ (1 << 40))},
+                                    {"perceptualHash": hash_to_hex(stolen ^ (1 << 41))},
+                                    {"perceptualHash": hash_to_hex(stolen ^ (1 << 42))}]
+        })
+        assert "Fotos muy similares" in indicators
+
+    async def test_fraud_score_uses_hashes_saved_by_photo_verification(self, tmp_path):
+        """Verified photos reach the fraud score of another process through photo_verifications"""
+        import cv2
+        from app.core.firestore_audit import AuditWriter
+        from app.services.cv.perceptual_hash import hash_to_hex
+        from app.services.cv.photo_hash_index import PhotoHashIndex
+        from app.services.cv.photo_verifier import PhotoVerification
+        from app.services.cv.verification_cache import VerificationResultCache
+        from app.services.security.fraud_detector import FraudDetector
+
+        scene = TestPhotoVerification._scene(3)
+        _, first = cv2.imencode('.jpg', scene[..., ::-1])
+        _, second = cv2.imencode('.jpg', scene[10:590, 14:786, ::-1], [cv2.IMWRITE_JPEG_QUALITY, 55])
+        server, base = TestPhotoVerification._serve_images({'/a.jpg': first.tobytes(), '/b.jpg': second.tobytes()})
+        client = TestFirestoreAuditWriter._FakeFirestore()
+        verifier = PhotoVerification()
+        verifier.db = client
+        verifier.photo_index = PhotoHashIndex()
+        verifier.result_cache = VerificationResultCache(str(tmp_path / 'results.sqlite'))
+        verifier.audit_writer = AuditWriter(client=client, spill_path=str(tmp_path / 'spill.jsonl'))
+        try:
+            verifier.verify_photo(f'{base}/a.jpg', user_id='owner')
+            verifier.verify_photo(f'{base}/b.jpg', user_id='scammer')
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert verifier.audit_writer.flush(timeout=5)
+
+        # Otro proceso: índice vacío, el perfil no lleva hashes
+        index = PhotoHashIndex()
+        index.start_listener(client)
+        detector = FraudDetector(photo_index=index)
+        result = detector.analyze_user_fraud_risk(
+            {"id": "scammer", "photos": [{"url": f'{base}/b.jpg'}]}, {"account_age_days": 30}
+        )
+        assert "Fotos usadas en otras cuentas (1)" in result.indicators
+        assert index.is_ready and len(index) == 2
+
+        # Una foto verificada en otro worker después de la carga llega por el listener
+        verifier.audit_writer.add('photo_verifications', {
+            'userId': 'scammer_2', 'imageUrl': f'{base}/c.jpg',
+            'perceptualHash': hash_to_hex(next(iter(verifier.photo_index.hashes_for_user('owner').values())))
+        })
+        assert verifier.audit_writer.flush(timeout=5)
+        assert len(index) == 3
+        result = detector.analyze_user_fraud_risk(
+            {"id": "scammer", "photos": [{"url": f'{base}/b.jpg'}]}, {"account_age_days": 30}
+        )
+        assert "Fotos usadas en otras cuentas (2)" in result.indicators
+        assert index.get_stats()['listening']
+
+        _, indicators = detector._analyze_content_fraud({"id": "maria", "photos": []})
+        assert indicators == []
+
+
 class TestMessageModeration:
     """Test suite for message moderation system"""
     
@@ -213,6 +1748,21 @@ class TestMessageModeration:
             assert "harassment" in result["categories"] or "hate_speech" in result["categories"]
             assert result["severity"] in ["medium", "high", "critical"]
     
+    async def test_flagged_outcome_is_queued_for_audit(self, tmp_path):
+        """Unsafe results are written to moderation_results through the batched writer"""
+        from app.core.firestore_audit import AuditWriter
+        from app.services.nlp.message_moderator import get_message_moderator, record_moderation_result
+
+        client = TestFirestoreAuditWriter._FakeFirestore()
+        writer = AuditWriter(client=client, spill_path=str(tmp_path / 'spill.jsonl'))
+        result = get_message_moderator().moderate_message("Eres un estúpido idiota imbécil de mierda", "user_123")
+        doc_id = record_moderation_result("user_123", result, writer=writer)
+        assert writer.flush(timeout=5)
+        stored = client.documents[('moderation_results', doc_id)]
+        assert stored['userId'] == "user_123" and stored['severity'] == result.severity
+        assert stored['flaggedPhrases'] == result.flagged_phrases
+        writer.close()
+
     async def test_message_moderation_personal_info(self):
         """Test message moderation with personal information"""
         from app.services.nlp.message_moderator import moderate_user_message
@@ -238,6 +1788,258 @@ class TestMessageModeration:
         else:
             assert "personal_info" in result["categories"]
 
+    def test_matcher_equivalent_to_per_pattern_scan(self):
+        """Test precompiled matcher finds the same phrases as scanning pattern by pattern"""
+        import random
+        import re
+        from app.services.nlp.message_moderator import MessageModerator
+
+        moderator = MessageModerator()
+        words = "hola cena mañana 12345678 +34612345678 aaaaaa www.web.com ſexo".split()
+        for category_data in moderator.categories.values():
+            for pattern in category_data['patterns']:
+                words.extend(re.findall(r'[a-zñáéíóú]+', pattern))
+
+        rng = random.Random(7)
+        for _ in range(2000):
+            message = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 20)))
+            for text in (message, moderator._normalize_text(message)):
+                hits = moderator.matcher.scan(text)
+                for category_name, category_data in moderator.categories.items():
+                    _, phrases = moderator._analyze_category(text, category_data)
+                    assert hits[category_name] == phrases
+
+    def test_conversation_moderates_each_message_once(self):
+        """Test conversation moderation scans every message once and reuses it for escalation"""
+        from app.services.nlp.message_moderator import MessageModerator
+
+        moderator = MessageModerator(cache_size=0)
+        scans = []
+        original_scan = moderator.matcher.scan
+        moderator.matcher.scan = lambda text: scans.append(text) or original_scan(text)
+
+        messages = [{'id': str(i), 'content': f'hola, ¿qué tal el día {i}?'} for i in range(50)]
+        hostile = 'maldita gente, matar personas, asesinar personas, odio gente, racista supremacista, basura gente, escoria gente'
+        messages += [{'id': 'a', 'content': hostile}, {'id': 'b', 'content': hostile.upper()}]
+        result = moderator.moderate_conversation(messages, 'user_123')
+
+        assert len(scans) == len(messages)
+        assert len(result['message_results']) == len(messages)
+        assert result['pattern_analysis']['has_aggressive_escalation'] is True
+
+    def test_moderation_cache_reuses_scores_and_reapplies_context(self):
+        """Test repeated messages are served from the content cache with per-call context"""
+        from app.services.nlp.message_moderator import MessageModerator
+
+        moderator = MessageModerator(cache_size=2)
+        first = moderator.moderate_message("Hola, ¿qué tal?", "user_1")
+        second = moderator.moderate_message("hola   que tal", "user_2")
+        assert first == second
+
+        # Mismo texto normalizado, pero el contexto sube el score
+        message = "eres idiota y estúpido, imbécil"
+        plain = moderator.moderate_message(message, "user_1")
+        flagged = moderator.moderate_message(message, "user_1", {
+            'user_history': [{'was_flagged': True}] * 3,
+            'relationship_context': {'has_blocked_before': True}
+        })
+        assert flagged.confidence > plain.confidence
+        assert plain.flagged_phrases == flagged.flagged_phrases
+
+        stats = moderator.get_cache_stats()
+        assert stats['hits'] == 2 and stats['misses'] == 2
+        assert stats['memory_bytes'] > 0
+
+        moderator.moderate_message("tercer mensaje distinto", "user_1")
+        assert moderator.get_cache_stats()['evictions'] == 1
+
+        # Cambiar los patrones invalida la caché
+        categories = dict(moderator.categories)
+        categories['harassment'] = {'weight': 0.8, 'patterns': [r'\bnada\b']}
+        moderator.set_categories(categories)
+        assert moderator.get_cache_stats()['entries'] == 0
+        assert moderator.moderate_message(message, "user_1").flagged_phrases == []
+
+    def test_batch_moderation_matches_single_path(self):
+        """Test batch moderation across a process pool returns single-path results in order"""
+        from app.services.nlp.batch_moderation import BatchModerator
+        from app.services.nlp.message_moderator import moderate_user_message
+
+        texts = ["Hola, ¿qué tal?", "eres un idiota", "sígueme en instagram, oferta gratis", "",
+                 "quiero vender drogas", "odio gente racista"]
+        items = [
+            {'message': texts[i % len(texts)], 'user_id': f'user_{i}',
+             'context': {'user_history': [{'was_flagged': True}] * (i % 3)}}
+            for i in range(60)
+        ]
+
+        def comparable(result):
+            return {key: value for key, value in result.items() if key != 'moderated_at'}
+
+        expected = [comparable(moderate_user_message(**item)) for item in items]
+        with BatchModerator(workers=1, chunk_size=16) as batch:
+            streamed = [(index, comparable(result)) for index, result in batch.iter_moderate(iter(items))]
+            stats = batch.get_stats()
+
+        assert [index for index, _ in streamed] == list(range(len(items)))
+        assert [result for _, result in streamed] == expected
+        assert stats['last_run']['messages'] == len(items)
+        assert stats['messages_per_second'] > 0
+
+    def test_conversation_state_streams_pattern_analysis(self):
+        """Test incremental conversation state matches full re-analysis and survives serialization"""
+        import json
+        from app.services.nlp.conversation_state import ConversationModerationState
+        from app.services.nlp.message_moderator import MessageModerator
+
+        moderator = MessageModerator()
+        hostile = 'maldita gente, matar personas, asesinar personas, odio gente, racista supremacista, basura gente, escoria gente'
+        contents = ["hola", "hola", "¿dónde vives?", "hola", hostile, "vale", hostile, hostile.upper(), "hola"]
+        messages = [{'id': str(i), 'content': content, 'was_flagged': i % 2 == 0}
+                    for i, content in enumerate(contents)]
+
+        state = moderator.create_conversation_state()
+        for i, message in enumerate(messages):
+            result = state.add_message(message, 'user_123', moderator)
+            expected = moderator.moderate_conversation(messages[:i + 1], 'user_123')
+            assert result == expected['message_results'][-1]['moderation_result']
+            assert state.pattern_analysis() == expected['pattern_analysis']
+
+            # Traspaso a otro worker a mitad de conversación
+            state = ConversationModerationState.from_dict(json.loads(json.dumps(state.to_dict())))
+
+        analysis = state.pattern_analysis()
+        assert analysis['has_repetitive_messages'] and analysis['has_personal_info_requests']
+        assert analysis['has_aggressive_escalation']
+        signals = state.signals()
+        assert signals['message_count'] == len(messages)
+        assert signals['escalation_streak'] == 0
+        assert 0 < signals['flagged_ratio'] < 1
+
+    def test_conversation_state_size_is_bounded_for_long_chats(self):
+        """Test per-chat state stops growing past the exact-count cap and the repetition ratio stays close"""
+        import json
+        import random
+        from app.services.nlp.conversation_state import MAX_EXACT_HASHES, ConversationModerationState
+
+        rng = random.Random(7)
+        state = ConversationModerationState(max_exact_hashes=MAX_EXACT_HASHES)
+        contents = []
+        sizes = []
+        for i in range(20000):
+            # ~40% de los mensajes repiten un contenido anterior
+            content = rng.choice(contents) if contents and rng.random() < 0.4 else f"mensaje {i}"
+            contents.append(content)
+            state.observe(content, True, (True, 'low'))
+            if i in (MAX_EXACT_HASHES * 2, 2000, 19999):
+                sizes.append(len(json.dumps(state.to_dict())))
+
+        exact = 1 - len(set(contents)) / len(contents)
+        assert abs(state.repetition_ratio - exact) < 0.03
+        # Solo cambian los dígitos del contador de mensajes
+        assert max(sizes) < 4000 and max(sizes) - min(sizes) < 10
+
+        restored = ConversationModerationState.from_dict(json.loads(json.dumps(state.to_dict())))
+        assert restored.repetition_ratio == state.repetition_ratio
+        assert restored.pattern_analysis() == state.pattern_analysis()
+
+    def test_conversation_state_is_exact_by_default_past_the_sketch_cap(self):
+        """Test the default state matches full re-analysis above MAX_EXACT_HASHES distinct messages"""
+        from app.services.nlp.conversation_state import MAX_EXACT_HASHES
+        from app.services.nlp.message_moderator import MessageModerator
+
+        moderator = MessageModerator()
+        # Justo alrededor del umbral del 30% de repetición
+        for total, distinct in ((100, 70), (100, 69), (300, 209), (300, 210), (1000, 699), (1000, 700)):
+            assert distinct > MAX_EXACT_HASHES
+            messages = [{'content': f"mensaje {i % distinct}"} for i in range(total)]
+            state = moderator.create_conversation_state()
+            for message in messages:
+                state.observe(message['content'], True, (True, 'low'))
+            expected = moderator._analyze_conversation_patterns(messages, [(True, 'low')] * total)
+            assert state.pattern_analysis() == expected
+            assert expected['has_repetitive_messages'] == (distinct < total * 0.7)
+            assert state.distinct_count == distinct
+
+    async def test_moderation_queue_batches_and_falls_back(self):
+        """Test micro-batching queue resolves every submit and moderates synchronously on overload"""
+        from app.services.nlp.message_moderator import MessageModerator
+        from app.services.nlp.moderation_queue import ModerationQueue
+
+        moderator = MessageModerator()
+        texts = [f"hola, ¿qué tal el día {i}?" if i % 3 else "eres un idiota" for i in range(300)]
+        expected = [moderator.moderate_message(text, "user_1") for text in texts]
+
+        queue = ModerationQueue(moderator, max_batch_size=32, max_wait_ms=1, deadline_ms=None)
+        results = await asyncio.gather(*(queue.submit(text, "user_1") for text in texts))
+        stats = queue.get_stats()
+        await queue.close()
+
+        assert results == expected
+        assert stats['batches'] < len(texts)
+        assert stats['overload_fallbacks'] == 0
+
+        small = ModerationQueue(moderator, max_queue_size=4, deadline_ms=None)
+        results = await asyncio.gather(*(small.submit(text, "user_1") for text in texts[:20]))
+        stats = small.get_stats()
+        await small.close()
+
+        # Textos ya analizados (en caché): el veredicto barato es el completo
+        assert results == expected[:20]
+        assert stats['overload_fallbacks'] == stats['overload_cached'] == 16
+
+        # Sin caché, el exceso se modera en el pool aparte: mismos veredictos, nada bloqueado
+        fresh = MessageModerator()
+        small = ModerationQueue(fresh, max_queue_size=4, deadline_ms=None)
+        texts = [f"mensaje nuevo {i}" for i in range(20)]
+        results = await asyncio.gather(*(small.submit(text, "user_1") for text in texts))
+        stats = small.get_stats()
+        await small.close()
+
+        assert stats['overload_fallbacks'] == 16 and stats['overload_cached'] == 0
+        assert results == [moderator.moderate_message(text, "user_1") for text in texts]
+        assert all(result.is_safe for result in results)
+        assert fresh.get_cache_stats()['misses'] == 20
+
+    async def test_moderation_queue_deadline_runs_off_the_event_loop_once(self):
+        """Expired queued messages are moderated in the fallback pool; in-flight ones are awaited, not repeated"""
+        import threading
+        import time
+        from app.services.nlp.message_moderator import MessageModerator
+        from app.services.nlp.moderation_queue import ModerationQueue
+
+        calls = []
+
+        class SlowModerator(MessageModerator):
+            def moderate_message(self, message, user_id, context=None):
+                calls.append((message, threading.current_thread().name))
+                time.sleep(0.05)
+                return super().moderate_message(message, user_id, context)
+
+        queue = ModerationQueue(SlowModerator(), max_batch_size=1, max_wait_ms=0, deadline_ms=10)
+        texts = ["hola", "eres un idiota", "¿cenamos el viernes?"]
+        results = await asyncio.gather(*(queue.submit(text, "user_1") for text in texts))
+        stats = queue.get_stats()
+        await queue.close()
+
+        assert results == [MessageModerator().moderate_message(text, "user_1") for text in texts]
+        assert sorted(message for message, _ in calls) == sorted(texts)
+        assert all(name != threading.current_thread().name for _, name in calls)
+        assert stats['deadline_waits'] == 1 and stats['deadline_fallbacks'] == 2
+
+    def test_verdicts_match_stored_baseline(self):
+        """Test moderation verdicts on the benchmark corpus have not drifted from the baseline"""
+        from app.services.nlp.message_moderator import MessageModerator
+        from tests import moderation_benchmark
+
+        corpus = moderation_benchmark.generate_corpus()
+        baseline = moderation_benchmark.load_baseline()
+        assert baseline is not None
+        assert baseline['corpus_digest'] == moderation_benchmark.corpus_digest(corpus)
+
+        verdicts = moderation_benchmark.collect_verdicts(MessageModerator(), corpus)
+        assert moderation_benchmark.diff_verdicts(verdicts, baseline) == []
+
 
 class TestGeolocationServices:
     """Test suite for geolocation services"""
@@ -273,6 +2075,86 @@ class TestGeolocationServices:
         assert tolerance_meters > 0
 
 
+class TestSpatialIndex:
+    """Test suite for the geospatial grid index"""
+    
+    async def test_query_radius_matches_brute_force(self):
+        """Grid results equal an exhaustive haversine scan"""
+        import random
+        from app.services.geo.spatial_index import GeoGridIndex, haversine_km
+        
+        rng = random.Random(5)
+        index = GeoGridIndex(cell_size_deg=0.1)
+        points = {}
+        for i in range(2000):
+            lat, lng = 40.4 + rng.uniform(-2, 2), -3.7 + rng.uniform(-2, 2)
+            points[f"p{i}"] = (lat, lng)
+            index.insert(f"p{i}", lat, lng)
+        
+        for radius in (1, 10, 50, 150):
+            result = index.query_radius(40.4, -3.7, radius)
+            expected = {
+                key for key, (lat, lng) in points.items()
+                if haversine_km(40.4, -3.7, lat, lng)[0] <= radius
+            }
+            assert {key for key, _ in result} == expected
+            distances = [distance for _, distance in result]
+            assert distances == sorted(distances)
+    
+    async def test_query_radius_across_antimeridian(self):
+        """Points on both sides of the 180° meridian are found"""
+        from app.services.geo.spatial_index import GeoGridIndex
+        
+        index = GeoGridIndex(cell_size_deg=0.1)
+        index.insert("east", -17.0, 179.95)
+        index.insert("west", -17.0, -179.95)
+        index.insert("far", -17.0, 170.0)
+        
+        found = {key for key, _ in index.query_radius(-17.0, 179.99, 20)}
+        assert found == {"east", "west"}
+        
+        index.remove("west")
+        assert {key for key, _ in index.query_radius(-17.0, 179.99, 20)} == {"east"}
+    
+    async def test_places_cache_serves_covered_areas(self):
+        """Searches inside a previously fetched area are answered from cache"""
+        from app.services.geo.location_intelligence import NearbyPlacesCache
+        
+        cache = NearbyPlacesCache()
+        places = [
+            {"place_id": "cafe", "geometry": {"location": {"lat": 40.4170, "lng": -3.7040}}},
+            {"place_id": "park", "geometry": {"location": {"lat": 40.4300, "lng": -3.7040}}},
+        ]
+        assert cache.get(40.4168, -3.7038, 2.0) is None
+        cache.add(40.4168, -3.7038, 2.0, places)
+        
+        nearby = cache.get(40.4168, -3.7038, 0.5)
+        assert [place["place_id"] for place in nearby] == ["cafe"]
+        # Un círculo que sale del área consultada no está cubierto
+        assert cache.get(40.45, -3.7038, 2.0) is None
+
+        # Respuesta truncada (20 resultados): solo responde a la misma consulta
+        cache.add(41.3874, 2.1686, 2.0, places, complete=False)
+        assert cache.get(41.3874, 2.1686, 2.0) is not None
+        assert cache.get(41.3874, 2.1686, 0.5) is None
+
+    async def test_places_cache_evicts_expired_places(self):
+        """Expired places leave both the dictionary and the spatial index"""
+        from datetime import timedelta
+        from app.services.geo.location_intelligence import NearbyPlacesCache
+
+        cache = NearbyPlacesCache(ttl_minutes=10)
+        cache.add(40.4168, -3.7038, 2.0, [{"place_id": "old", "geometry": {"location": {"lat": 40.417, "lng": -3.704}}}])
+        # Envejecer la consulta anterior más allá del TTL
+        cache._places["old"] = (cache._places["old"][0], cache._places["old"][1] - timedelta(minutes=11))
+        cache._areas = {area_id: (radius, fetched_at - timedelta(minutes=11), complete)
+                        for area_id, (radius, fetched_at, complete) in cache._areas.items()}
+
+        cache.add(48.8566, 2.3522, 1.0, [{"place_id": "new", "geometry": {"location": {"lat": 48.857, "lng": 2.352}}}])
+        assert set(cache._places) == {"new"} and len(cache.index) == 1 and len(cache._areas) == 1
+        assert len(cache.area_index) == 1 and cache.get(40.4168, -3.7038, 1.0) is None
+
+
 class TestReferralSystem:
     """Test suite for referral system"""
     
@@ -386,6 +2268,30 @@ class TestVIPEvents:
         assert isinstance(suggested_events, list)
         # Should return events that match user preferences
 
+    async def test_cancelled_and_past_events_leave_the_spatial_index(self):
+        """Cancelled or finished events are dropped from the event grid index"""
+        from datetime import datetime, timedelta
+        from app.services.vip_events.vip_events_manager import (
+            EventLocation, EventStatus, EventType, VIPEventsManager
+        )
+
+        manager = VIPEventsManager()
+        location = EventLocation("Bodega", "Calle Mayor 1", "Madrid", (40.4168, -3.7038), "restaurant", 30)
+        soon, later, past = (
+            manager.create_exclusive_event(EventType.WINE_TASTING, location, start, "org", {})
+            for start in (datetime.now() + timedelta(days=1), datetime.now() + timedelta(days=7),
+                          datetime.now() - timedelta(days=2))
+        )
+        for event in (soon, later, past):
+            event.status = EventStatus.OPEN
+        assert len(manager.event_locations) == 3
+
+        assert manager.cancel_event(later.id) and not manager.cancel_event(later.id)
+        suggested = manager.suggest_events_for_user({"age": 30, "location": {"coordinates": [40.4168, -3.7038]}})
+        assert [event.id for event in suggested] == [soon.id]
+        assert past.status == EventStatus.COMPLETED and later.status == EventStatus.CANCELLED
+        assert soon.id in manager.event_locations and len(manager.event_locations) == 1
+
 
 class TestVideoChat:
     """Test suite for video chat system"""
@@ -630,6 +2536,40 @@ class TestSystemIntegration:
 class TestPerformance:
     """Performance tests for critical operations"""
     
+    async def test_startup_imports_stay_within_budget(self):
+        """Importing the app and its services loads no heavy ML/CV library nor service instances (-X importtime)"""
+        import os
+        import subprocess
+        import sys
+
+        singletons = {
+            'app.services.ml.recommendation_engine': 'matching_engine',
+            'app.services.cv.photo_verifier': 'photo_verifier',
+            'app.services.video_chat.video_chat_manager': 'video_chat_manager',
+            'app.services.vip_events.vip_events_manager': 'vip_events_manager',
+        }
+        modules = list(singletons) + ['app.services.security.fraud_detector', 'app.services.nlp.message_moderator']
+        code = (
+            f"import sys, main, {', '.join(modules)}\n"
+            f"assert all(getattr(sys.modules[m], name) is None for m, name in {list(singletons.items())!r})"
+        )
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True, timeout=120
+        )
+        assert completed.returncode == 0, completed.stderr[-2000:]
+
+        cumulative_us = {}
+        for line in completed.stderr.splitlines():
+            if line.startswith('import time:') and line.count('|') == 2:
+                _, total, name = line.split('|')
+                if total.strip().isdigit():
+                    cumulative_us[name.strip()] = int(total)
+        assert not {'cv2', 'sklearn', 'pandas', 'scipy'} & set(cumulative_us)
+        # Presupuesto de los módulos de servicios una vez cargada la app (~100 ms en local)
+        assert sum(cumulative_us.get(module, 0) for module in modules) / 1000 < 750
+
     async def test_recommendations_performance(self):
         """Test recommendation generation performance"""
         from app.services.ml.recommendation_engine import get_recommendations_for_user
@@ -675,6 +2615,53 @@ class TestPerformance:
         
         print(f"✅ Completed 20 fraud checks in {total_time:.2f}s")
 
+    async def test_text_normalizer_performance(self):
+        """Benchmark fast moderation normalizer against the original implementation"""
+        from app.services.nlp.text_normalizer import normalize_text, normalize_text_reference
+        
+        import random
+        import time
+        
+        rng = random.Random(13)
+        templates = [
+            "Hola! ¿qué tal?", "jajaja me encantó tu perfil 😍", "¿Quedamos mañana a las 20:00?",
+            "Buenas noches, ¿cómo estás?", "Me gusta mucho la música y viajar 🎶✈️",
+            "Estoy en Madrid, ¿tú de dónde eres??", "ok, hablamos luego", "¡Qué guapa!! 😊😊",
+            "hey what's up", "Te mando mi insta: @usuario_123", "Perdón por tardar en responder...",
+            "¿Te apetece un café en el centro? ☕", "vale!!", "Feliz cumpleaños 🎉🎂",
+            "Nos vemos el sábado en la Plaza Mayor, ¿te parece bien?"
+        ]
+        corpus = [rng.choice(templates) for _ in range(20000)]
+        assert [normalize_text(text) for text in corpus] == [normalize_text_reference(text) for text in corpus]
+        
+        timings = {}
+        for name, normalizer in (("reference", normalize_text_reference), ("fast", normalize_text)):
+            start_time = time.perf_counter()
+            for text in corpus:
+                normalizer(text)
+            timings[name] = (time.perf_counter() - start_time) / len(corpus) * 1e6
+        
+        assert timings["fast"] < timings["reference"]
+        
+        print(f"✅ Normalización por mensaje: {timings['reference']:.2f}µs -> {timings['fast']:.2f}µs")
+
+    async def test_moderation_benchmark(self):
+        """Test moderation throughput and conversation cost on the benchmark corpus"""
+        from app.services.nlp.message_moderator import MessageModerator
+        from tests import moderation_benchmark
+        
+        moderator = MessageModerator(cache_size=0)
+        corpus = moderation_benchmark.generate_corpus(per_bucket=10)
+        stats = moderation_benchmark.benchmark_messages(moderator, corpus, repeat=1)
+        conversations = moderation_benchmark.benchmark_conversations(moderator, lengths=(50, 500))
+        
+        assert stats['messages'] == len(corpus)
+        assert stats['p99_ms'] < 50, f"Moderation too slow: p99 {stats['p99_ms']:.2f}ms"
+        # El coste por mensaje no crece con la longitud de la conversación
+        assert conversations[1]['ms_per_message'] < 5 * conversations[0]['ms_per_message']
+        
+        print(f"✅ Moderación: {stats['messages_per_second']:.0f} msg/s, p99 {stats['p99_ms']:.3f}ms")
+
 
 # Security tests
 class TestSecurity: